@@ -4,38 +4,91 @@
 """Handles computationally expensive analysis tasks. Implements a celery worker."""
 
 from __future__ import absolute_import
-from CeleryWorker import celery_worker
+from CeleryWorker import celery_worker, shared_data_mgr, shared_user_mgr
+import concurrent.futures
 import datetime
 import json
 import logging
-import os
 import sys
+import threading
 import time
 import traceback
+import uuid
 import ActivityHasher
-import AnalysisScheduler
-import Config
 import DataMgr
 import IntensityCalculator
 import Keys
 import LocationAnalyzer
+import Perf
 import SensorAnalyzerFactory
+import TrackSimplifier
 import Units
-import UserMgr
+import VectorizedAnalyzer
+
+BATCH_LEASE_SECS = 15 * 60 # How long a batch job can go without checkpointing before another worker may take it over
+
+class BatchResults(object):
+    """Collects the results of analyzing a batch of activities, so they can be written to the database in bulk rather than one activity at a time."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.summaries = {} # Maps the activity ID to its summary
+        self.simplified_data = {} # Maps the activity ID to its simplified tracks and downsampled sensor readings
+        self.bests = {} # Maps the user ID to a list of (activity ID, activity type, activity time, bests) tuples
+        self.setting_entries = {} # Maps (user ID, setting key) to the entries to add to that setting, for settings that are dictionaries
+        super(BatchResults, self).__init__()
+
+    def add_summary(self, activity_id, summary_data):
+        with self.lock:
+            self.summaries[activity_id] = summary_data
+
+    def add_simplified_data(self, activity_id, simplified_data):
+        with self.lock:
+            self.simplified_data[activity_id] = simplified_data
+
+    def add_bests(self, user_id, activity_id, activity_type, activity_time, activity_bests):
+        with self.lock:
+            self.bests.setdefault(user_id, []).append((activity_id, activity_type, activity_time, dict(activity_bests)))
+
+    def add_setting_entry(self, user_id, key, entry_key, entry_value):
+        """Settings like the list of maximum heart rates are read, added to, and written back. Doing that once per batch means"""
+        """activities being analyzed at the same time can't overwrite each other's entries."""
+        with self.lock:
+            self.setting_entries.setdefault((user_id, key), {})[entry_key] = entry_value
+
+    def write(self, data_mgr, user_mgr):
+        """Writes everything that was collected. Returns TRUE on success, FALSE otherwise."""
+        now = datetime.datetime.utcnow()
+        result = True
+        if len(self.summaries) > 0:
+            result = data_mgr.create_activity_summaries(self.summaries) and result
+        if len(self.simplified_data) > 0:
+            result = data_mgr.create_activity_simplified_data(self.simplified_data) and result
+        for user_id in self.bests:
+            result = data_mgr.create_activity_bests_in_bulk(user_id, self.bests[user_id]) and result
+        for (user_id, key), entries in self.setting_entries.items():
+            setting = user_mgr.retrieve_user_setting(user_id, key)
+            setting.update(entries)
+            result = user_mgr.update_user_setting(user_id, key, setting, now) and result
+        return result
 
 class ActivityAnalyzer(object):
     """Class for performing the computationally expensive activity analysis task."""
 
-    def __init__(self, activity, internal_task_id):
+    def __init__(self, activity, internal_task_id, analysis_engine=Keys.ANALYSIS_ENGINE_ITERATIVE, data_mgr=None, user_mgr=None, batch_results=None):
+        if data_mgr is None:
+            data_mgr = shared_data_mgr()
+        if user_mgr is None:
+            user_mgr = shared_user_mgr()
+
         self.activity = activity
         self.internal_task_id = internal_task_id # For tracking the status of the analysis
+        self.analysis_engine = analysis_engine # Either feed the analyzers one reading at a time, or convert everything to arrays first
         self.summary_data = {}
         self.speed_graph = None
-        root_dir = os.path.dirname(os.path.abspath(__file__))
-        analysis_scheduler = AnalysisScheduler.AnalysisScheduler()
-        config = Config.Config()
-        self.data_mgr = DataMgr.DataMgr(config=config, root_url="file://" + root_dir, analysis_scheduler=analysis_scheduler, import_scheduler=None)
-        self.user_mgr = UserMgr.UserMgr(config=config, session_mgr=None)
+        self.data_mgr = data_mgr
+        self.user_mgr = user_mgr
+        self.batch_results = batch_results # If provided, the summary, bests, and setting updates are collected here instead of being written
         self.last_yield = time.time()
         super(ActivityAnalyzer, self).__init__()
 
@@ -62,6 +115,7 @@ class ActivityAnalyzer(object):
             # So we only do this once, in two formats.
             now = datetime.datetime.utcnow()
             now2 = time.time()
+            start_time = time.perf_counter()
 
             # Want the variable in scope, but will set it later.
             activity_id = None
@@ -82,8 +136,9 @@ class ActivityAnalyzer(object):
                 self.log_error("The activity user ID was not provided.")
                 return
 
-            # Update the status of the analysis in the database.
-            self.data_mgr.update_deferred_task(activity_user_id, self.internal_task_id, activity_id, Keys.TASK_STATUS_STARTED)
+            # Update the status of the analysis in the database. Activities analyzed as part of a batch don't have their own task.
+            if self.internal_task_id is not None:
+                self.data_mgr.update_deferred_task(activity_user_id, self.internal_task_id, activity_id, Keys.TASK_STATUS_STARTED)
 
             # Make sure the activity start time is set.
             print("Computing the start time...")
@@ -98,7 +153,10 @@ class ActivityAnalyzer(object):
             # Do the location analysis.
             print("Performing location analysis...")
             location_analyzer = None
-            if Keys.ACTIVITY_LOCATIONS_KEY in self.activity:
+            if Keys.ACTIVITY_LOCATIONS_KEY in self.activity and self.analysis_engine == Keys.ANALYSIS_ENGINE_VECTORIZED:
+                location_analyzer = VectorizedAnalyzer.create_location_analyzer(activity_type, self.activity[Keys.ACTIVITY_LOCATIONS_KEY])
+                self.summary_data.update(location_analyzer.analyze())
+            elif Keys.ACTIVITY_LOCATIONS_KEY in self.activity:
                 location_analyzer = LocationAnalyzer.LocationAnalyzer(activity_type)
                 locations = self.activity[Keys.ACTIVITY_LOCATIONS_KEY]
                 for location in locations:
@@ -134,7 +192,10 @@ class ActivityAnalyzer(object):
 
                     try:
                         # Do the analysis.
-                        sensor_analyzer = SensorAnalyzerFactory.create_with_data(sensor_type, self.activity[sensor_type], activity_type, activity_user_id, self.data_mgr, self.user_mgr)
+                        if self.analysis_engine == Keys.ANALYSIS_ENGINE_VECTORIZED:
+                            sensor_analyzer = VectorizedAnalyzer.create_sensor_analyzer(sensor_type, self.activity[sensor_type], activity_type, activity_user_id, self.data_mgr, self.user_mgr)
+                        else:
+                            sensor_analyzer = SensorAnalyzerFactory.create_with_data(sensor_type, self.activity[sensor_type], activity_type, activity_user_id, self.data_mgr, self.user_mgr)
 
                         # Save the results to the database.
                         self.summary_data.update(sensor_analyzer.analyze())
@@ -143,17 +204,23 @@ class ActivityAnalyzer(object):
                         # This list will be used to compute the user's estimated maximum heart rate.
                         if sensor_type == Keys.APP_HEART_RATE_KEY:
 
-                            existing_max_hrs = self.user_mgr.retrieve_user_setting(activity_user_id, Keys.ESTIMATED_MAX_HEART_RATE_LIST_KEY)
-                            existing_max_hrs[str(sensor_analyzer.max_time)] = sensor_analyzer.max
-                            self.user_mgr.update_user_setting(activity_user_id, Keys.ESTIMATED_MAX_HEART_RATE_LIST_KEY, existing_max_hrs, now)
+                            if self.batch_results is not None:
+                                self.batch_results.add_setting_entry(activity_user_id, Keys.ESTIMATED_MAX_HEART_RATE_LIST_KEY, str(sensor_analyzer.max_time), sensor_analyzer.max)
+                            else:
+                                existing_max_hrs = self.user_mgr.retrieve_user_setting(activity_user_id, Keys.ESTIMATED_MAX_HEART_RATE_LIST_KEY)
+                                existing_max_hrs[str(sensor_analyzer.max_time)] = sensor_analyzer.max
+                                self.user_mgr.update_user_setting(activity_user_id, Keys.ESTIMATED_MAX_HEART_RATE_LIST_KEY, existing_max_hrs, now)
 
                         # Did we find the power meter for a cycling activity. If so, find the best 20 minute power.
                         # This list will be used to compute the user's estimated FTP.
                         if sensor_type == Keys.APP_POWER_KEY and activity_type in Keys.CYCLING_ACTIVITIES and Keys.BEST_20_MIN_POWER in self.summary_data:
 
-                            existing_20_minute_power_bests = self.user_mgr.retrieve_user_setting(activity_user_id, Keys.BEST_CYCLING_20_MINUTE_POWER_LIST_KEY)
-                            existing_20_minute_power_bests[str(sensor_analyzer.max_time)] = self.summary_data[Keys.BEST_20_MIN_POWER]
-                            self.user_mgr.update_user_setting(activity_user_id, Keys.BEST_CYCLING_20_MINUTE_POWER_LIST_KEY, existing_20_minute_power_bests, now)
+                            if self.batch_results is not None:
+                                self.batch_results.add_setting_entry(activity_user_id, Keys.BEST_CYCLING_20_MINUTE_POWER_LIST_KEY, str(sensor_analyzer.max_time), self.summary_data[Keys.BEST_20_MIN_POWER])
+                            else:
+                                existing_20_minute_power_bests = self.user_mgr.retrieve_user_setting(activity_user_id, Keys.BEST_CYCLING_20_MINUTE_POWER_LIST_KEY)
+                                existing_20_minute_power_bests[str(sensor_analyzer.max_time)] = self.summary_data[Keys.BEST_20_MIN_POWER]
+                                self.user_mgr.update_user_setting(activity_user_id, Keys.BEST_CYCLING_20_MINUTE_POWER_LIST_KEY, existing_20_minute_power_bests, now)
 
                     except:
                         self.log_error("Exception when analyzing activity " + sensor_type + " data.")
@@ -182,6 +249,27 @@ class ActivityAnalyzer(object):
                     if not self.data_mgr.create_activity_metadata_list(activity_id, Keys.APP_DISTANCES_KEY, location_analyzer.distance_buf):
                         self.log_error("Error returned when saving activity speed graph.")
 
+                # Simplify the track and downsample the sensor readings, so the maps and charts don't need every point.
+                print("Simplifying the track and sensor data...")
+                try:
+                    sensor_data = { key: self.activity[key] for key in TrackSimplifier.DOWNSAMPLED_SENSOR_KEYS if key in self.activity }
+                    if self.speed_graph is not None:
+                        sensor_data[Keys.APP_CURRENT_SPEED_KEY] = [ { str(point[0]): point[1] } for point in self.speed_graph ]
+                    elif Keys.APP_CURRENT_SPEED_KEY in self.activity:
+                        # The existing speed graph isn't read with the rest of the activity.
+                        streams = self.data_mgr.retrieve_activity_streams(activity_id, [ Keys.APP_CURRENT_SPEED_KEY ])
+                        if streams:
+                            sensor_data.update(streams)
+                    simplified_data = TrackSimplifier.create_simplified_data(self.activity.get(Keys.ACTIVITY_LOCATIONS_KEY), sensor_data)
+                    if self.batch_results is not None:
+                        self.batch_results.add_simplified_data(activity_id, simplified_data)
+                    elif not self.data_mgr.create_activity_simplified_data({ activity_id: simplified_data }):
+                        self.log_error("Error returned when saving the simplified activity data.")
+                except:
+                    self.log_error("Exception when simplifying the activity data.")
+                    self.log_error(traceback.format_exc())
+                    self.log_error(sys.exc_info()[0])
+
                 # Where was this activity performed?
                 print("Computing the location description...")
                 location_description = self.data_mgr.get_location_description(activity_id)
@@ -197,9 +285,12 @@ class ActivityAnalyzer(object):
                     end_time_secs = end_time_ms / 1000
                     self.data_mgr.update_activity_end_time_secs(self.activity, end_time_secs)
 
+                    # Store the fingerprint used to detect duplicate uploads, activities that weren't imported from a file won't have one yet.
+                    self.data_mgr.create_activity_fingerprint(activity_id, ActivityHasher.compute_fingerprint(activity_type, start_time_secs, int(end_time_secs), hash_str))
+
                     # If activity duration and distance have been calculated.
                     print("Computing the intensity score and training paces...")
-                    if start_time_secs > 0 and end_time_secs > 0 and end_time_secs > start_time_secs and len(location_analyzer.distance_buf) > 0:
+                    if start_time_secs > 0 and end_time_secs > 0 and end_time_secs > start_time_secs and location_analyzer is not None and len(location_analyzer.distance_buf) > 0:
 
                         # These are used by both cycling and running intensity calculations.
                         distance_entry = location_analyzer.distance_buf[-1]
@@ -232,13 +323,17 @@ class ActivityAnalyzer(object):
 
                 # Store the results.
                 print("Storing the activity summary...")
-                if not self.data_mgr.create_activity_summary(activity_id, self.summary_data):
+                if self.batch_results is not None:
+                    self.batch_results.add_summary(activity_id, self.summary_data)
+                elif not self.data_mgr.create_activity_summary(activity_id, self.summary_data):
                     self.log_error("Error returned when saving activity summary data: " + str(self.summary_data))
             else:
                 self.log_error("Activity ID not provided. Cannot create activity summary.")
 
-            # Update personal bests.
-            if Keys.ACTIVITY_START_TIME_KEY in self.activity:
+            # Update personal bests. When analyzing a batch the personal records are rebuilt once, at the end.
+            if Keys.ACTIVITY_START_TIME_KEY in self.activity and self.batch_results is not None:
+                self.batch_results.add_bests(activity_user_id, activity_id, activity_type, self.activity[Keys.ACTIVITY_START_TIME_KEY], self.summary_data)
+            elif Keys.ACTIVITY_START_TIME_KEY in self.activity:
                 print("Updating personal bests...")
                 activity_time = self.activity[Keys.ACTIVITY_START_TIME_KEY]
 
@@ -255,30 +350,193 @@ class ActivityAnalyzer(object):
                 self.log_error("Activity time not provided. Cannot update personal records.")
 
             # Update the status of the analysis in the database.
-            self.data_mgr.update_deferred_task(activity_user_id, self.internal_task_id, activity_id, Keys.TASK_STATUS_FINISHED)
+            if self.internal_task_id is not None:
+                self.data_mgr.update_deferred_task(activity_user_id, self.internal_task_id, activity_id, Keys.TASK_STATUS_FINISHED)
+
+            Perf.record_latency(Perf.ANALYSIS_SECONDS_METRIC, { "activity_type": activity_type, "engine": self.analysis_engine }, time.perf_counter() - start_time)
         except:
             self.log_error("Exception when analyzing activity data: " + str(self.summary_data))
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
 
+    def load_activity(self, activity_id, activity_user_id):
+        """Reads the activity from the database, limited to the fields needed for the analysis."""
+        self.activity = self.data_mgr.retrieve_activity_for_analysis(activity_id)
+        if self.activity is not None:
+            self.activity[Keys.ACTIVITY_USER_ID_KEY] = activity_user_id
+        return self.activity is not None
+
+class BatchAnalyzer(object):
+    """Analyzes many activities, i.e. after the analysis code changes or a backlog of uploads. Activities are read a batch at a time, in the"""
+    """order they were created, and analyzed in parallel. The results of each batch are written in bulk and the job's position is saved,"""
+    """so an interrupted job is resumed from its last checkpoint rather than starting over."""
+
+    def __init__(self, user_id, only_unanalyzed, internal_task_id, analysis_engine=Keys.ANALYSIS_ENGINE_ITERATIVE, batch_size=16, batch_workers=4, data_mgr=None, user_mgr=None):
+        if data_mgr is None:
+            data_mgr = shared_data_mgr()
+        if user_mgr is None:
+            user_mgr = shared_user_mgr()
+
+        self.user_id = user_id # None to analyze every user's activities
+        self.only_unanalyzed = only_unanalyzed # Skip activities that already have a summary
+        self.internal_task_id = internal_task_id # For tracking the status of the job, only used when the job is for one user
+        self.analysis_engine = analysis_engine
+        self.batch_size = max(1, batch_size)
+        self.batch_workers = max(1, batch_workers)
+        self.data_mgr = data_mgr
+        self.user_mgr = user_mgr
+        super(BatchAnalyzer, self).__init__()
+
+    def log_error(self, log_str):
+        """Writes an error message to the log file."""
+        logger = logging.getLogger()
+        logger.error(log_str)
+
+    def job_name(self):
+        """Jobs with the same name do the same work, so only one of them is allowed to run at a time."""
+        name = "analysis"
+        if self.user_id is None:
+            name += " all users"
+        else:
+            name += " " + str(self.user_id)
+        if self.only_unanalyzed:
+            name += " unanalyzed"
+        return name
+
+    def report_progress(self, status, num_processed, num_failed):
+        """Updates the deferred task, so the user can see how far along the job is."""
+        print("Batch analysis: " + str(num_processed) + " activities processed, " + str(num_failed) + " could not be analyzed.")
+        if self.user_id is not None and self.internal_task_id is not None:
+            self.data_mgr.update_deferred_task(self.user_id, self.internal_task_id, None, status, { Keys.BATCH_JOB_NUM_PROCESSED_KEY: num_processed, Keys.BATCH_JOB_NUM_FAILED_KEY: num_failed })
+
+    def analyze_activity(self, activity_summary, batch_results):
+        """Analyzes one activity, adding its results to the batch. Returns the ID of the user that owns the activity, or None if it could not be analyzed."""
+        activity_id = activity_summary.get(Keys.ACTIVITY_ID_KEY)
+        if activity_id is None:
+            return None
+        activity_user_id = self.user_mgr.retrieve_user_from_activity(activity_summary)
+        if activity_user_id is None:
+            self.log_error("Batch analysis could not determine the owner of activity " + str(activity_id) + ".")
+            return None
+
+        analyzer = ActivityAnalyzer(None, None, self.analysis_engine, self.data_mgr, self.user_mgr, batch_results)
+        if not analyzer.load_activity(activity_id, str(activity_user_id)):
+            self.log_error("Activity " + str(activity_id) + " could not be loaded.")
+            return None
+        analyzer.perform_analysis()
+        return str(activity_user_id)
+
+    def run(self):
+        """Analyzes everything from the job's last checkpoint to the end. Returns TRUE on success, FALSE otherwise."""
+        job_name = self.job_name()
+        owner = str(uuid.uuid4()) # Identifies this run of the job, so it stops if its lease expires and another worker takes over
+        job = self.data_mgr.acquire_batch_job(job_name, owner, BATCH_LEASE_SECS)
+        if job is None:
+            # Someone else is already doing this.
+            print("Batch analysis job '" + job_name + "' is already running.")
+            self.report_progress(Keys.TASK_STATUS_FINISHED, 0, 0)
+            return True
+
+        checkpoint = job.get(Keys.BATCH_JOB_CHECKPOINT_KEY)
+        num_processed = job.get(Keys.BATCH_JOB_NUM_PROCESSED_KEY, 0)
+        num_failed = job.get(Keys.BATCH_JOB_NUM_FAILED_KEY, 0)
+        user_ids = set(job.get(Keys.BATCH_JOB_USERS_KEY, []))
+
+        try:
+            self.report_progress(Keys.TASK_STATUS_STARTED, num_processed, num_failed)
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.batch_workers) as executor:
+                while True:
+                    activities = self.data_mgr.retrieve_activities_for_batch_analysis(self.user_id, self.only_unanalyzed, checkpoint, self.batch_size)
+                    if activities is None:
+                        raise Exception("Failed to retrieve the next batch of activities.")
+                    if len(activities) == 0:
+                        break
+
+                    batch_results = BatchResults()
+                    batch_user_ids = list(executor.map(lambda activity: self.analyze_activity(activity, batch_results), activities))
+                    num_failed = num_failed + batch_user_ids.count(None)
+                    batch_user_ids = set([user_id for user_id in batch_user_ids if user_id is not None])
+                    if not batch_results.write(self.data_mgr, self.user_mgr):
+                        self.log_error("Error returned when saving the results of a batch analysis.")
+
+                    # Checkpoint after the results are written, so a restarted job never skips an activity.
+                    checkpoint = activities[-1][Keys.BATCH_JOB_CHECKPOINT_KEY]
+                    num_processed = num_processed + len(activities)
+                    user_ids.update(batch_user_ids)
+                    if not self.data_mgr.update_batch_job(job_name, owner, checkpoint, num_processed, num_failed, batch_user_ids, BATCH_LEASE_SECS):
+                        raise Exception("Failed to save the checkpoint for batch job '" + job_name + "', its lease may have been taken over by another worker.")
+                    self.report_progress(Keys.TASK_STATUS_STARTED, num_processed, num_failed)
+
+            # Personal records depend on every activity's bests, so they're rebuilt once per user rather than after each activity.
+            for user_id in user_ids:
+                print("Rebuilding personal records for user " + user_id + "...")
+                self.data_mgr.rebuild_personal_records(user_id)
+
+            if not self.data_mgr.delete_batch_job(job_name, owner):
+                self.log_error("Batch analysis job '" + job_name + "' was taken over by another worker before it could be removed.")
+            self.report_progress(Keys.TASK_STATUS_FINISHED, num_processed, num_failed)
+            return True
+        except:
+            # The job is left in place, so it will resume from the last checkpoint once its lease expires.
+            self.log_error("Exception when running batch analysis job '" + job_name + "'.")
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+            if self.user_id is not None and self.internal_task_id is not None:
+                self.data_mgr.update_deferred_task(self.user_id, self.internal_task_id, None, Keys.TASK_STATUS_ERROR)
+        return False
+
 @celery_worker.task(ignore_result=True)
-def analyze_activity(activity_str, internal_task_id):
+def analyze_activity(envelope_str, internal_task_id):
     print("Starting activity analysis...")
-    activity_obj = json.loads(activity_str)
-    analyzer = ActivityAnalyzer(activity_obj, internal_task_id)
-    analyzer.perform_analysis()
+    start_time = time.time()
+    envelope = json.loads(envelope_str)
+    activity_id = envelope[Keys.ACTIVITY_ID_KEY]
+    activity_user_id = envelope[Keys.ACTIVITY_USER_ID_KEY]
+
+    # How long did the task wait in the queue?
+    if Keys.TASK_ENQUEUE_TIME_KEY in envelope:
+        Perf.record_metric("analysis task queue latency", start_time - envelope[Keys.TASK_ENQUEUE_TIME_KEY])
+
+    analysis_engine = envelope.get(Keys.ANALYSIS_ENGINE_KEY, Keys.ANALYSIS_ENGINE_ITERATIVE)
+    analyzer = ActivityAnalyzer(None, internal_task_id, analysis_engine)
+    if analyzer.load_activity(activity_id, activity_user_id):
+        analyzer.perform_analysis()
+    else:
+        analyzer.log_error("Activity " + str(activity_id) + " could not be loaded.")
+        analyzer.data_mgr.update_deferred_task(activity_user_id, internal_task_id, activity_id, Keys.TASK_STATUS_ERROR)
+
+    # How long did it take from the request to the end of the analysis?
+    if Keys.TASK_ENQUEUE_TIME_KEY in envelope:
+        Perf.record_metric("analysis task end-to-end latency", time.time() - envelope[Keys.TASK_ENQUEUE_TIME_KEY])
     print("Activity analysis finished!")
 
 @celery_worker.task(ignore_result=True)
 def analyze_personal_records(user_str, internal_task_id):
     print("Starting personal record analysis...")
-    root_dir = os.path.dirname(os.path.abspath(__file__))
-    analysis_scheduler = AnalysisScheduler.AnalysisScheduler()
-    config = Config.Config()
-    data_mgr = DataMgr.DataMgr(config=config, root_url="file://" + root_dir, analysis_scheduler=analysis_scheduler, import_scheduler=None)
+    data_mgr = shared_data_mgr()
     data_mgr.refresh_personal_records_cache(user_str)
     print("Personal record analysis finished!")
 
+@celery_worker.task(ignore_result=True)
+def analyze_activities_in_batch(envelope_str, internal_task_id):
+    print("Starting batch analysis...")
+    start_time = time.time()
+    envelope = json.loads(envelope_str)
+
+    # How long did the task wait in the queue?
+    if Keys.TASK_ENQUEUE_TIME_KEY in envelope:
+        Perf.record_metric("batch analysis task queue latency", start_time - envelope[Keys.TASK_ENQUEUE_TIME_KEY])
+
+    analyzer = BatchAnalyzer(envelope.get(Keys.ACTIVITY_USER_ID_KEY),
+        envelope.get(Keys.ANALYSIS_ONLY_UNANALYZED_KEY, False),
+        internal_task_id,
+        envelope.get(Keys.ANALYSIS_ENGINE_KEY, Keys.ANALYSIS_ENGINE_ITERATIVE),
+        envelope.get(Keys.ANALYSIS_BATCH_SIZE_KEY, 16),
+        envelope.get(Keys.ANALYSIS_BATCH_WORKERS_KEY, 4))
+    analyzer.run()
+    print("Batch analysis finished!")
+
 def main():
     """Entry point for an analysis worker."""
     pass
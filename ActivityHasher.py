@@ -4,11 +4,19 @@
 import hashlib
 import Keys
 
+DURATION_BUCKET_SECS = 60 # Durations are rounded down to this so that fingerprints don't depend on how the end time was recorded
+
+def compute_fingerprint(activity_type, start_time_sec, end_time_sec, hash_str):
+    """Returns a string that identifies an activity by its type, start time, duration, and location hash. Used to detect duplicate uploads."""
+    duration_bucket = int(max(end_time_sec - start_time_sec, 0) // DURATION_BUCKET_SECS)
+    return "{}:{}:{}:{}".format(activity_type, int(start_time_sec), duration_bucket, hash_str)
+
 class ActivityHasher(object):
     """Computes the hash of an activity. Used to determine uniqueness."""
 
     def __init__(self, activity):
         self.activity = activity
+        self.h = hashlib.sha512()
         super(ActivityHasher, self).__init__()
 
     def float_to_str(self, num):
@@ -19,6 +27,17 @@ class ActivityHasher(object):
         formatted_str = str(int(float(str_num)))
         return formatted_str
 
+    def add_location(self, date_time, latitude, longitude, altitude):
+        """Adds a location to the hash, so the hash can be computed as the locations are read (i.e. during an import). Locations must be added in time order."""
+        self.h.update(str(int(date_time)).encode('utf-8'))
+        self.h.update(self.float_to_str(latitude))
+        self.h.update(self.float_to_str(longitude))
+        self.h.update(self.float_to_str(altitude))
+
+    def digest(self):
+        """Returns the hash of the locations added so far."""
+        return self.h.hexdigest()
+
     def hash(self):
         """Main analysis routine."""
 
@@ -27,23 +46,15 @@ class ActivityHasher(object):
             return
 
         # We're going to hash the activity so we'll know if it's been modified.
-        h = hashlib.sha512()
+        self.h = hashlib.sha512()
 
         # Hash the locations.
         print("Hashing locations...")
         if Keys.ACTIVITY_LOCATIONS_KEY in self.activity:
             locations = self.activity[Keys.ACTIVITY_LOCATIONS_KEY]
             for location in locations:
-                date_time = str(int(location[Keys.LOCATION_TIME_KEY])).encode('utf-8')
-                latitude = self.float_to_str(location[Keys.LOCATION_LAT_KEY])
-                longitude = self.float_to_str(location[Keys.LOCATION_LON_KEY])
-                altitude = self.float_to_str(location[Keys.LOCATION_ALT_KEY])
-
-                h.update(date_time)
-                h.update(latitude)
-                h.update(longitude)
-                h.update(altitude)
+                self.add_location(location[Keys.LOCATION_TIME_KEY], location[Keys.LOCATION_LAT_KEY], location[Keys.LOCATION_LON_KEY], location[Keys.LOCATION_ALT_KEY])
 
         # Finalize the hash digest.
-        hash_str = h.hexdigest()
+        hash_str = self.digest()
         return hash_str
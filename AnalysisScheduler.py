@@ -23,8 +23,10 @@
 # SOFTWARE.
 """Schedules computationally expensive analysis tasks"""
 
+import json
 import logging
 import sys
+import time
 import traceback
 import uuid
 
@@ -39,16 +41,26 @@ class AnalysisScheduler(object):
         logger = logging.getLogger()
         logger.error(log_str)
 
-    def add_activity_to_analysis_queue(self, activity):
+    def add_activity_to_analysis_queue(self, activity_id, activity_user_id, analysis_engine):
         """Adds the activity ID to the list of activities to be analyzed."""
+        """Only the identifiers (and the choice of analysis engine) are sent through the broker, the worker reads the activity from the database."""
         """Returns [celery task id, our task id]."""
-        from bson.json_util import dumps
         from ActivityAnalyzer import analyze_activity
 
+        import Keys
+        import Perf
+
         try:
-            activity_str = dumps(activity)
+            envelope = {}
+            envelope[Keys.ACTIVITY_ID_KEY] = activity_id
+            envelope[Keys.ACTIVITY_USER_ID_KEY] = activity_user_id
+            envelope[Keys.TASK_ENQUEUE_TIME_KEY] = time.time()
+            envelope[Keys.ANALYSIS_ENGINE_KEY] = analysis_engine
+            envelope_str = json.dumps(envelope)
+            Perf.record_metric("analysis task message size", len(envelope_str))
+
             internal_task_id = uuid.uuid4()
-            analysis_task = analyze_activity.delay(activity_str, internal_task_id)
+            analysis_task = analyze_activity.delay(envelope_str, internal_task_id)
             return analysis_task.task_id, internal_task_id
         except:
             self.log_error(traceback.format_exc())
@@ -68,6 +80,31 @@ class AnalysisScheduler(object):
             self.log_error(sys.exc_info()[0])
         return None, None
 
+    def add_batch_analysis_to_queue(self, user_id, only_unanalyzed, analysis_engine, batch_size, batch_workers):
+        """Adds a job that analyzes all of the user's activities (or every user's, if the user ID is None), or just the ones that haven't been analyzed."""
+        """Returns [celery task id, our task id]."""
+        from ActivityAnalyzer import analyze_activities_in_batch
+
+        import Keys
+
+        try:
+            envelope = {}
+            envelope[Keys.ACTIVITY_USER_ID_KEY] = user_id
+            envelope[Keys.ANALYSIS_ONLY_UNANALYZED_KEY] = only_unanalyzed
+            envelope[Keys.TASK_ENQUEUE_TIME_KEY] = time.time()
+            envelope[Keys.ANALYSIS_ENGINE_KEY] = analysis_engine
+            envelope[Keys.ANALYSIS_BATCH_SIZE_KEY] = batch_size
+            envelope[Keys.ANALYSIS_BATCH_WORKERS_KEY] = batch_workers
+            envelope_str = json.dumps(envelope)
+
+            internal_task_id = uuid.uuid4()
+            analysis_task = analyze_activities_in_batch.delay(envelope_str, internal_task_id)
+            return analysis_task.task_id, internal_task_id
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None, None
+
     def add_user_to_workout_plan_queue(self, user_id, data_mgr):
         """Adds the user to the list of workout plans to be generated."""
         from bson.json_util import dumps
@@ -33,6 +33,9 @@ import ApiException
 import Exporter
 import InputChecker
 import Keys
+import LiveFeed
+import Perf
+import TrackSimplifier
 import Units
 import TrainingPaceCalculator
 import Workout
@@ -40,6 +43,58 @@ import Workout
 from urllib.parse import unquote_plus
 from distutils.util import strtobool
 
+LIVE_ACTIVITY_TIMEOUT_SECS = 10 * 60 # Activities that haven't been updated in this long are no longer considered to be live
+LIVE_MAX_WAIT_SECS = 25 # Longest a live track request may wait, short enough to stay under typical proxy timeouts
+LIVE_POLL_INTERVAL_SECS = 2.0 # Data written by other processes doesn't wake waiting requests, so check the database this often
+LIVE_RETRY_MS = 5000 # How soon clients should ask again if the request couldn't wait
+NOT_LIVE_RETRY_MS = 60000 # How soon clients should ask again about an activity that isn't being updated
+MAX_ACTIVITY_LIST_PAGE_SIZE = 1000 # Most activities that can be requested in one page of an activity list
+
+def format_cursor(cursor):
+    """Converts a live track cursor (the number of the last write that was read) to the string handed to clients."""
+    return str(cursor)
+
+def parse_cursor(cursor_str):
+    """Converts a cursor string from a client back to the number of the last write it read. Returns None if it isn't valid."""
+    if not InputChecker.is_unsigned_integer(cursor_str):
+        return None
+    return int(cursor_str)
+
+def format_page_cursor(activity):
+    """Converts the last activity in a page of the activity list to the string handed to clients, so the next page starts after it."""
+    """Activities without a start time have an empty time, since they're listed after all of the others."""
+    start_time = activity.get(Keys.ACTIVITY_START_TIME_KEY)
+    if start_time is None:
+        return ":" + activity[Keys.ACTIVITY_ID_KEY]
+    return str(start_time) + ":" + activity[Keys.ACTIVITY_ID_KEY]
+
+def parse_page_cursor(cursor_str):
+    """Converts a page cursor string from a client back to a (start time, activity ID) tuple. Returns None if it isn't valid."""
+    parts = cursor_str.split(":")
+    if len(parts) != 2 or not InputChecker.is_uuid(parts[1]):
+        return None
+    if len(parts[0]) == 0:
+        return None, parts[1]
+    if InputChecker.is_unsigned_integer(parts[0]):
+        return int(parts[0]), parts[1]
+    if InputChecker.is_float(parts[0]):
+        return float(parts[0]), parts[1]
+    return None
+
+def parse_resolution(values):
+    """Returns the resolution requested by either the resolution or the zoom parameter, or None if neither was given."""
+    if Keys.ACTIVITY_RESOLUTION_KEY in values:
+        resolution = values[Keys.ACTIVITY_RESOLUTION_KEY]
+        if not TrackSimplifier.is_valid_resolution(resolution):
+            raise ApiException.ApiMalformedRequestException("Invalid resolution.")
+        return resolution
+    if Keys.ACTIVITY_ZOOM_KEY in values:
+        zoom = values[Keys.ACTIVITY_ZOOM_KEY]
+        if not InputChecker.is_unsigned_integer(zoom):
+            raise ApiException.ApiMalformedRequestException("Invalid zoom level.")
+        return TrackSimplifier.resolution_for_zoom(int(zoom))
+    return None
+
 class Api(object):
     """Class for managing API messages."""
 
@@ -261,21 +316,112 @@ class Api(object):
             raise ApiException.ApiMalformedRequestException("Invalid number of points.")
         num_points = int(num_points)
 
-        # Get the activity from the database.
-        activity = self.data_mgr.retrieve_activity(activity_id)
+        # Optional parameters: how much detail the client needs. Defaults to every point.
+        resolution = parse_resolution(values)
+
+        # Get the activity from the database, without the location and sensor data.
+        activity = self.data_mgr.retrieve_activity_small(activity_id)
+        if activity is None:
+            raise ApiException.ApiMalformedRequestException("Invalid activity.")
 
         # Determine if the requesting user can view the activity.
         if not self.activity_can_be_viewed(activity):
             raise ApiException.ApiMalformedRequestException("The requested activity is not viewable to this user.")
 
-        # Format the locations track as JSON.
+        # Format the locations track as JSON. The number of points the client already has is an index into the full track, which doesn't
+        # line up with the simplified tracks, so a client that's catching up gets the rest of the full track.
         response = ""
-        if Keys.APP_LOCATIONS_KEY in activity:
-            locations = activity[Keys.APP_LOCATIONS_KEY]
-            response += json.dumps(locations[num_points:])
+        if resolution is None or num_points > 0:
+            locations = self.data_mgr.retrieve_activity_locations(activity_id)
+            if locations is not None:
+                locations = locations[num_points:]
+        else:
+            locations = self.data_mgr.retrieve_activity_track(activity_id, resolution)
+        if locations is not None:
+            response += json.dumps(locations)
 
         return True, response
 
+    def handle_retrieve_activity_track_since(self, values):
+        """Called when an API message to get the new points in a live activity's track is received. Result is a JSON string."""
+        """The client passes back the cursor from the previous response, so only new points are read. If there aren't any then the"""
+        """request can wait for them, so spectators don't have to keep asking."""
+
+        # Required parameters.
+        if Keys.ACTIVITY_ID_KEY not in values:
+            raise ApiException.ApiMalformedRequestException("Activity ID not specified.")
+
+        # Get the activity ID from the request.
+        activity_id = values[Keys.ACTIVITY_ID_KEY]
+        if not InputChecker.is_uuid(activity_id):
+            raise ApiException.ApiMalformedRequestException("Invalid activity ID.")
+
+        # Optional parameters: where the client left off and how long it's willing to wait.
+        cursor = None
+        if Keys.ACTIVITY_CURSOR_KEY in values and len(values[Keys.ACTIVITY_CURSOR_KEY]) > 0:
+            cursor = parse_cursor(values[Keys.ACTIVITY_CURSOR_KEY])
+            if cursor is None:
+                raise ApiException.ApiMalformedRequestException("Invalid cursor.")
+        wait_secs = 0
+        if Keys.ACTIVITY_WAIT_KEY in values:
+            if not InputChecker.is_unsigned_integer(values[Keys.ACTIVITY_WAIT_KEY]):
+                raise ApiException.ApiMalformedRequestException("Invalid wait time.")
+            wait_secs = min(int(values[Keys.ACTIVITY_WAIT_KEY]), LIVE_MAX_WAIT_SECS)
+        resolution = parse_resolution(values)
+
+        # Get the activity from the database, without the location and sensor data.
+        activity = self.data_mgr.retrieve_activity_small(activity_id)
+        if activity is None:
+            raise ApiException.ApiMalformedRequestException("Invalid activity.")
+
+        # Determine if the requesting user can view the activity.
+        if not self.activity_can_be_viewed(activity):
+            raise ApiException.ApiMalformedRequestException("The requested activity is not viewable to this user.")
+
+        # Only wait on activities that are still being updated.
+        is_live = False
+        if Keys.ACTIVITY_LAST_UPDATED_KEY in activity:
+            is_live = time.time() - activity[Keys.ACTIVITY_LAST_UPDATED_KEY] < LIVE_ACTIVITY_TIMEOUT_SECS
+        retry_ms = NOT_LIVE_RETRY_MS
+        if is_live:
+            retry_ms = LIVE_RETRY_MS
+        else:
+            wait_secs = 0
+
+        # A finished activity can be drawn from its simplified track. Live activities aren't simplified, since every point counts while
+        # they're still changing, and the resolution only applies to the first request since later ones only read new points.
+        if cursor is None and resolution is not None and resolution != Keys.TRACK_RESOLUTION_FULL and not is_live:
+            cursor = self.data_mgr.retrieve_activity_locations_end_cursor(activity_id)
+            locations = self.data_mgr.retrieve_activity_track(activity_id, resolution)
+            if locations is None:
+                locations = []
+        else:
+            locations, cursor = self.data_mgr.retrieve_activity_locations_since(activity_id, cursor)
+        if locations is None or cursor is None:
+            raise ApiException.ApiMalformedRequestException("Could not read the activity track.")
+
+        # Nothing new, so wait for it. Each check of the database only reads points written since the last check.
+        if len(locations) == 0 and wait_secs > 0 and LiveFeed.acquire_waiter():
+            try:
+                deadline = time.time() + wait_secs
+                remaining_secs = wait_secs
+                while len(locations) == 0 and remaining_secs > 0:
+                    LiveFeed.wait(activity_id, min(remaining_secs, LIVE_POLL_INTERVAL_SECS))
+                    locations, cursor = self.data_mgr.retrieve_activity_locations_since(activity_id, cursor)
+                    if locations is None:
+                        raise ApiException.ApiMalformedRequestException("Could not read the activity track.")
+                    remaining_secs = deadline - time.time()
+                retry_ms = 0
+            finally:
+                LiveFeed.release_waiter()
+
+        response_dict = {}
+        response_dict[Keys.ACTIVITY_CURSOR_KEY] = format_cursor(cursor)
+        response_dict[Keys.APP_LOCATIONS_KEY] = locations
+        response_dict[Keys.ACTIVITY_IS_LIVE_KEY] = is_live
+        response_dict[Keys.ACTIVITY_RETRY_MS_KEY] = retry_ms
+        return True, json.dumps(response_dict)
+
     def handle_retrieve_activity_metadata(self, values):
         """Called when an API message to get the activity metadata. Result is a JSON string."""
 
@@ -288,8 +434,8 @@ class Api(object):
         if not InputChecker.is_uuid(activity_id):
             raise ApiException.ApiMalformedRequestException("Invalid activity ID.")
 
-        # Get the activity from the database.
-        activity = self.data_mgr.retrieve_activity(activity_id)
+        # Get the activity from the database, without the location and sensor data.
+        activity = self.data_mgr.retrieve_activity_small(activity_id)
         if activity is None:
             raise ApiException.ApiMalformedRequestException("Invalid activity.")
 
@@ -297,6 +443,12 @@ class Api(object):
         if not self.activity_can_be_viewed(activity):
             raise ApiException.ApiMalformedRequestException("The requested activity is not viewable to this user.")
 
+        # Only the most recent sensor values are needed.
+        stream_names = [ Keys.APP_DISTANCE_KEY, Keys.APP_AVG_SPEED_KEY, Keys.APP_MOVING_SPEED_KEY, Keys.APP_HEART_RATE_KEY, Keys.APP_CADENCE_KEY, Keys.APP_POWER_KEY ]
+        latest_values = self.data_mgr.retrieve_activity_latest_values(activity_id, stream_names)
+        if latest_values is None:
+            latest_values = {}
+
         # Is this is a foot based activity? Need to know so we can display steps per minute instead of revs per minute.
         is_foot_based = False
 
@@ -328,47 +480,41 @@ class Api(object):
             tags = activity[Keys.ACTIVITY_TAGS_KEY]
             response_dict[Keys.ACTIVITY_TAGS_KEY] = tags
 
-        if Keys.APP_DISTANCE_KEY in activity:
-            distances = activity[Keys.APP_DISTANCE_KEY]
-            if distances is not None and len(distances) > 0:
-                distance = distances[-1]
+        if Keys.APP_DISTANCE_KEY in latest_values:
+            distance = latest_values[Keys.APP_DISTANCE_KEY]
+            if distance is not None:
                 value = float(list(distance.values())[0])
                 response_dict[Keys.APP_DISTANCE_KEY] = value
 
-        if Keys.APP_AVG_SPEED_KEY in activity:
-            avg_speeds = activity[Keys.APP_AVG_SPEED_KEY]
-            if avg_speeds is not None and len(avg_speeds) > 0:
-                speed = avg_speeds[-1]
+        if Keys.APP_AVG_SPEED_KEY in latest_values:
+            speed = latest_values[Keys.APP_AVG_SPEED_KEY]
+            if speed is not None:
                 value = float(list(speed.values())[0])
                 response_dict[Keys.APP_AVG_SPEED_KEY] = value
 
-        if Keys.APP_MOVING_SPEED_KEY in activity:
-            moving_speeds = activity[Keys.APP_MOVING_SPEED_KEY]
-            if moving_speeds is not None and len(moving_speeds) > 0:
-                speed = moving_speeds[-1]
+        if Keys.APP_MOVING_SPEED_KEY in latest_values:
+            speed = latest_values[Keys.APP_MOVING_SPEED_KEY]
+            if speed is not None:
                 value = float(list(speed.values())[0])
                 response_dict[Keys.APP_MOVING_SPEED_KEY] = value
 
-        if Keys.APP_HEART_RATE_KEY in activity:
-            heart_rates = activity[Keys.APP_HEART_RATE_KEY]
-            if heart_rates is not None and len(heart_rates) > 0:
-                heart_rate = heart_rates[-1]
+        if Keys.APP_HEART_RATE_KEY in latest_values:
+            heart_rate = latest_values[Keys.APP_HEART_RATE_KEY]
+            if heart_rate is not None:
                 value = float(list(heart_rate.values())[0])
                 response_dict[Keys.APP_HEART_RATE_KEY] = value
 
-        if Keys.APP_CADENCE_KEY in activity:
-            cadences = activity[Keys.APP_CADENCE_KEY]
-            if cadences is not None and len(cadences) > 0:
-                cadence = cadences[-1]
+        if Keys.APP_CADENCE_KEY in latest_values:
+            cadence = latest_values[Keys.APP_CADENCE_KEY]
+            if cadence is not None:
                 value = float(list(cadence.values())[0])
                 if is_foot_based:
                     value = value * 2.0
                 response_dict[Keys.APP_CADENCE_KEY] = value
 
-        if Keys.APP_POWER_KEY in activity:
-            powers = activity[Keys.APP_POWER_KEY]
-            if powers is not None and len(powers) > 0:
-                power = powers[-1]
+        if Keys.APP_POWER_KEY in latest_values:
+            power = latest_values[Keys.APP_POWER_KEY]
+            if power is not None:
                 value = float(list(power.values())[0])
                 response_dict[Keys.APP_POWER_KEY] = value
 
@@ -390,8 +536,11 @@ class Api(object):
         if not InputChecker.is_uuid(activity_id):
             raise ApiException.ApiMalformedRequestException("Invalid activity ID.")
 
-        # Get the activity from the database.
-        activity = self.data_mgr.retrieve_activity(activity_id)
+        # Optional parameters: how much detail the client needs. Defaults to every reading.
+        resolution = parse_resolution(values)
+
+        # Get the activity from the database, without the location and sensor data.
+        activity = self.data_mgr.retrieve_activity_small(activity_id)
         if activity is None:
             raise ApiException.ApiMalformedRequestException("Activity not found.")
 
@@ -399,30 +548,43 @@ class Api(object):
         if not self.activity_can_be_viewed(activity):
             raise ApiException.ApiMalformedRequestException("The requested activity is not viewable to this user.")
 
+        # Only read the sensors that were asked for, using the readings downsampled for charts unless every reading was requested.
+        sensor_names = values[Keys.SENSOR_LIST_KEY].split(',')
+        sensor_data = {}
+        if resolution is not None and resolution != Keys.TRACK_RESOLUTION_FULL:
+            downsampled_names = [ sensor_name for sensor_name in sensor_names if sensor_name in TrackSimplifier.DOWNSAMPLED_SENSOR_KEYS ]
+            if downsampled_names:
+                sensor_data.update(self.data_mgr.retrieve_activity_downsampled_sensor_data(activity_id, downsampled_names))
+            sensor_names = [ sensor_name for sensor_name in sensor_names if sensor_name not in TrackSimplifier.DOWNSAMPLED_SENSOR_KEYS ]
+        if sensor_names:
+            streams = self.data_mgr.retrieve_activity_streams(activity_id, sensor_names)
+            if streams is None:
+                raise ApiException.ApiMalformedRequestException("Activity not found.")
+            sensor_data.update(streams)
+
         response = {}
 
-        for sensor_name in values[Keys.SENSOR_LIST_KEY].split(','):
-            if sensor_name in activity:
-
-                # Need to fix up the datetime item for each event.
-                if sensor_name == 'Events':
-                    events = activity[sensor_name]
-                    for event in events:
-                        if 'timestamp' in event:
-                            dt_tuple = event['timestamp'].timetuple()
-                            dt_unix = calendar.timegm(dt_tuple)
-                            event['timestamp'] = dt_unix
-                        if 'start_time' in event:
-                            dt_tuple = event['start_time'].timetuple()
-                            dt_unix = calendar.timegm(dt_tuple)
-                            event['start_time'] = dt_unix
-                        if 'local_timestamp' in event:
-                            dt_tuple = event['local_timestamp'].timetuple()
-                            dt_unix = calendar.timegm(dt_tuple)
-                            event['local_timestamp'] = dt_unix
-                    response[sensor_name] = events
-                else:
-                    response[sensor_name] = activity[sensor_name]
+        for sensor_name in sensor_data:
+
+            # Need to fix up the datetime item for each event.
+            if sensor_name == 'Events':
+                events = sensor_data[sensor_name]
+                for event in events:
+                    if 'timestamp' in event:
+                        dt_tuple = event['timestamp'].timetuple()
+                        dt_unix = calendar.timegm(dt_tuple)
+                        event['timestamp'] = dt_unix
+                    if 'start_time' in event:
+                        dt_tuple = event['start_time'].timetuple()
+                        dt_unix = calendar.timegm(dt_tuple)
+                        event['start_time'] = dt_unix
+                    if 'local_timestamp' in event:
+                        dt_tuple = event['local_timestamp'].timetuple()
+                        dt_unix = calendar.timegm(dt_tuple)
+                        event['local_timestamp'] = dt_unix
+                response[sensor_name] = events
+            else:
+                response[sensor_name] = sensor_data[sensor_name]
 
         return True, json.dumps(response)
 
@@ -816,6 +978,7 @@ class Api(object):
 
     def handle_list_activities(self, values, include_friends):
         """Returns a JSON string describing all of the user's activities."""
+        """If a limit or a cursor is given then only one page of the list is returned, along with the cursor for the next page."""
         if self.user_id is None:
             raise ApiException.ApiNotLoggedInException()
 
@@ -823,9 +986,9 @@ class Api(object):
         start_time = None
         end_time = None
         if Keys.START_DATE_KEY in values:
-            start_time = int(datetime.datetime.strptime(values[Keys.START_DATE_KEY], '%Y-%m-%d').strftime("%s"))
+            start_time = calendar.timegm(datetime.datetime.strptime(values[Keys.START_DATE_KEY], '%Y-%m-%d').timetuple())
         if Keys.END_DATE_KEY in values:
-            end_time = int(datetime.datetime.strptime(values[Keys.END_DATE_KEY], '%Y-%m-%d').strftime("%s"))
+            end_time = calendar.timegm(datetime.datetime.strptime(values[Keys.END_DATE_KEY], '%Y-%m-%d').timetuple())
         if Keys.START_TIME_KEY in values:
             start_time = values[Keys.START_TIME_KEY]
             if InputChecker.is_unsigned_integer(start_time):
@@ -839,6 +1002,26 @@ class Api(object):
             else:
                 raise ApiException.ApiMalformedRequestException("Invalid ending time.")
 
+        # Fetch and validate the page size and position (optional).
+        paged = False
+        num_results = None
+        before = None
+        if Keys.LIMIT_KEY in values:
+            num_results = values[Keys.LIMIT_KEY]
+            if not InputChecker.is_unsigned_integer(num_results):
+                raise ApiException.ApiMalformedRequestException("Invalid limit.")
+            num_results = int(num_results)
+            if num_results == 0 or num_results > MAX_ACTIVITY_LIST_PAGE_SIZE:
+                raise ApiException.ApiMalformedRequestException("Invalid limit.")
+            paged = True
+        if Keys.PAGE_CURSOR_KEY in values:
+            before = parse_page_cursor(values[Keys.PAGE_CURSOR_KEY])
+            if before is None:
+                raise ApiException.ApiMalformedRequestException("Invalid cursor.")
+            paged = True
+        if paged and num_results is None:
+            num_results = MAX_ACTIVITY_LIST_PAGE_SIZE
+
         # Get the logged in user.
         username = self.user_mgr.get_logged_in_username()
         if username is None:
@@ -849,7 +1032,9 @@ class Api(object):
 
         # Get the activities that belong to the logged in user.
         matched_activities = []
-        if include_friends:
+        if paged:
+            activities = self.data_mgr.retrieve_activity_list_page(self.user_id, user_realname, include_friends, start_time, end_time, before, num_results)
+        elif include_friends:
             activities = self.data_mgr.retrieve_all_activities_visible_to_user(self.user_id, user_realname, start_time, end_time, None)
         else:
             activities = self.data_mgr.retrieve_user_activity_list(self.user_id, user_realname, start_time, end_time, None)
@@ -876,6 +1061,14 @@ class Api(object):
                     temp_activity = {'title':'[' + activity_type + '] ' + activity_name, 'url': url, 'time': int(activity[Keys.ACTIVITY_START_TIME_KEY]), Keys.ACTIVITY_TAGS_KEY: activity_tags, Keys.ACTIVITY_ID_KEY: activity_id}
                     matched_activities.append(temp_activity)
 
+        # Pages come with the cursor for the next one. A short page is the last one.
+        if paged:
+            next_cursor = None
+            if activities is not None and len(activities) == num_results:
+                next_cursor = format_page_cursor(activities[-1])
+            json_result = json.dumps({ Keys.ACTIVITY_LIST_KEY: matched_activities, Keys.NEXT_PAGE_CURSOR_KEY: next_cursor }, ensure_ascii=False)
+            return True, json_result
+
         json_result = json.dumps(matched_activities, ensure_ascii=False)
         return True, json_result
 
@@ -1426,9 +1619,9 @@ class Api(object):
         if not self.activity_can_be_viewed(activity):
             raise ApiException.ApiMalformedRequestException("The requested activity is not viewable to this user.")
 
-        # Export it to the desired format.
+        # Export it to the desired format. The file is streamed to the client as it is formatted.
         exporter = Exporter.Exporter()
-        result = exporter.export(activity, None, export_format)
+        result = exporter.export_stream(activity, None, export_format)
 
         return True, result
 
@@ -1961,12 +2154,12 @@ class Api(object):
         if not InputChecker.is_uuid(activity_id):
             raise ApiException.ApiMalformedRequestException("Invalid activity ID.")
 
-        activity = self.data_mgr.retrieve_activity(activity_id)
+        activity = self.data_mgr.retrieve_activity_small(activity_id)
         if not activity:
             raise ApiException.ApiMalformedRequestException("Invalid activity.")
 
         activity_user_id, _, _ = self.data_mgr.get_activity_user(activity)
-        self.data_mgr.schedule_activity_analysis(activity, activity_user_id)
+        self.data_mgr.analyze_activity_by_id(activity_id, activity_user_id)
         return True, ""
 
     def handle_refresh_personal_records(self, values):
@@ -2149,9 +2342,9 @@ class Api(object):
         start_time = None
         end_time = None
         if Keys.START_DATE_KEY in values:
-            start_time = int(datetime.datetime.strptime(values[Keys.START_DATE_KEY], '%Y-%m-%d').strftime("%s"))
+            start_time = calendar.timegm(datetime.datetime.strptime(values[Keys.START_DATE_KEY], '%Y-%m-%d').timetuple())
         if Keys.END_DATE_KEY in values:
-            end_time = int(datetime.datetime.strptime(values[Keys.END_DATE_KEY], '%Y-%m-%d').strftime("%s"))
+            end_time = calendar.timegm(datetime.datetime.strptime(values[Keys.END_DATE_KEY], '%Y-%m-%d').timetuple())
         if Keys.START_TIME_KEY in values:
             start_time = values[Keys.START_TIME_KEY]
             if InputChecker.is_unsigned_integer(start_time):
@@ -2621,6 +2814,33 @@ class Api(object):
         result = self.data_mgr.compute_training_intensity_for_timeframe(self.user_id, start_time, end_time)
         return True, str(result)
 
+    def handle_get_training_rollups(self, values):
+        """Returns the user's daily, weekly, or monthly training totals for the periods that start within the specified range. Result is a JSON string."""
+        if self.user_id is None:
+            raise ApiException.ApiNotLoggedInException()
+
+        # Required parameters.
+        if Keys.ROLLUP_PERIOD_KEY not in values:
+            raise ApiException.ApiMalformedRequestException("Period not specified.")
+        if Keys.START_TIME_KEY not in values:
+            raise ApiException.ApiMalformedRequestException("Start time not specified.")
+        if Keys.END_TIME_KEY not in values:
+            raise ApiException.ApiMalformedRequestException("End time not specified.")
+
+        # Decode and validate the required parameters.
+        period = values[Keys.ROLLUP_PERIOD_KEY]
+        if period not in Keys.ROLLUP_PERIODS:
+            raise ApiException.ApiMalformedRequestException("Invalid period.")
+        if not InputChecker.is_unsigned_integer(values[Keys.START_TIME_KEY]):
+            raise ApiException.ApiMalformedRequestException("Invalid start time.")
+        if not InputChecker.is_unsigned_integer(values[Keys.END_TIME_KEY]):
+            raise ApiException.ApiMalformedRequestException("Invalid ending time.")
+        start_time = int(values[Keys.START_TIME_KEY])
+        end_time = int(values[Keys.END_TIME_KEY])
+
+        rollups = self.data_mgr.retrieve_training_rollups(self.user_id, period, start_time, end_time)
+        return True, json.dumps(rollups)
+
     def handle_get_user_setting(self, values):
         """Returns the value associated with the specified user setting."""
         if self.user_id is None:
@@ -2796,6 +3016,8 @@ class Api(object):
         """Called to parse a version 1.0 API GET request."""
         if request == 'activity_track':
             return self.handle_retrieve_activity_track(values)
+        elif request == 'activity_track_since':
+            return self.handle_retrieve_activity_track_since(values)
         elif request == 'activity_metadata':
             return self.handle_retrieve_activity_metadata(values)
         elif request == 'activity_sensordata':
@@ -2858,6 +3080,8 @@ class Api(object):
             return self.handle_get_record_progression(values)
         elif request == 'get_training_intensity_for_timeframe':
             return self.handle_get_training_intensity_for_timeframe(values)
+        elif request == 'get_training_rollups':
+            return self.handle_get_training_rollups(values)
         elif request == 'get_user_setting':
             return self.handle_get_user_setting(values)
         elif request == 'get_user_settings':
@@ -3001,7 +3225,22 @@ class Api(object):
         return False, ""
 
     def handle_api_1_0_request(self, verb, request, values):
-        """Called to parse a version 1.0 API message."""
+        """Called to parse a version 1.0 API message. Records the time taken, by verb and request."""
+        start_time = time.perf_counter()
+        request_label = "unknown" # Unrecognized requests share a label, so they can't create an unlimited number of histograms
+        try:
+            handled, response = self.dispatch_api_1_0_request(verb, request, values)
+            if handled:
+                request_label = request
+            return handled, response
+        except ApiException.ApiException:
+            request_label = request
+            raise
+        finally:
+            Perf.record_latency(Perf.API_SECONDS_METRIC, { "verb": verb, "request": request_label }, time.perf_counter() - start_time)
+
+    def dispatch_api_1_0_request(self, verb, request, values):
+        """Passes a version 1.0 API message to the handler for its verb."""
         if self.user_id is None:
             if Keys.SESSION_KEY in values:
                 username = self.user_mgr.get_logged_in_username_from_cookie(values[Keys.SESSION_KEY])
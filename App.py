@@ -23,6 +23,7 @@
 # SOFTWARE.
 """Main application, contains all web page handlers"""
 
+import hmac
 import inspect
 import json
 import logging
@@ -36,15 +37,16 @@ import pstats
 
 import Keys
 import Api
+import Cache
 import Config
 import Dirs
 import IcalServer
 import InputChecker
 import Perf
+import Templates
 import Units
 
 from io import StringIO ## for Python 3
-from mako.template import Template
 
 # Locate and load the Distance calculations module.
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
@@ -61,6 +63,8 @@ ZWIFT_WATOPIA_MAP_FILE_NAME = 'watopia.png'
 ZWIFT_CRIT_CITY_MAP_FILE_NAME = 'crit_city.png'
 ZWIFT_MAKURI_ISLANDS_MAP_FILE_NAME = 'makuri_islands.png'
 
+g_export_controls = {} # Maps (has location data, has accelerometer data) to the rendered export control, there are only a few combinations
+
 class RedirectException(Exception):
     """This is thrown when the app needs to redirect to another page."""
 
@@ -86,13 +90,13 @@ class App(object):
         self.zwift_watopia_map_file = os.path.join(root_dir, Dirs.MEDIA_DIR, ZWIFT_WATOPIA_MAP_FILE_NAME)
         self.zwift_crit_city_map_file = os.path.join(root_dir, Dirs.MEDIA_DIR, ZWIFT_CRIT_CITY_MAP_FILE_NAME)
         self.zwift_makuri_islands_map_file = os.path.join(root_dir, Dirs.MEDIA_DIR, ZWIFT_MAKURI_ISLANDS_MAP_FILE_NAME)
-        self.zwift_html_file = os.path.join(root_dir, Dirs.HTML_DIR, 'zwift.html')
-        self.unmapped_activity_html_file = os.path.join(root_dir, Dirs.HTML_DIR, 'unmapped_activity.html')
-        self.map_single_osm_html_file = os.path.join(root_dir, Dirs.HTML_DIR, 'map_single_osm.html')
-        self.map_single_google_html_file = os.path.join(root_dir, Dirs.HTML_DIR, 'map_single_google.html')
-        self.map_multi_html_file = os.path.join(root_dir, Dirs.HTML_DIR, 'map_multi_google.html')
-        self.error_logged_in_html_file = os.path.join(root_dir, Dirs.HTML_DIR, 'error_logged_in.html')
-        self.error_activity_html_file = os.path.join(root_dir, Dirs.HTML_DIR, 'error_activity.html')
+        self.zwift_html_file = 'zwift.html'
+        self.unmapped_activity_html_file = 'unmapped_activity.html'
+        self.map_single_osm_html_file = 'map_single_osm.html'
+        self.map_single_google_html_file = 'map_single_google.html'
+        self.map_multi_html_file = 'map_multi_google.html'
+        self.error_logged_in_html_file = 'error_logged_in.html'
+        self.error_activity_html_file = 'error_activity.html'
         self.ical_server = IcalServer.IcalServer(user_mgr, data_mgr, self.root_url)
 
         self.logged_in_navbar = "<nav>\n\t<ul>\n" \
@@ -117,6 +121,11 @@ class App(object):
         if not os.path.exists(self.tempfile_dir):
             os.makedirs(self.tempfile_dir)
 
+        # Compile the page templates up front, rather than on each request. When debugging, the template files are
+        # checked for changes so they can be edited without restarting.
+        Templates.create_lookup(os.path.join(root_dir, Dirs.HTML_DIR), self.tempmod_dir, debug)
+        Templates.warm()
+
         if enable_profiling:
             print("Start profiling...")
             self.pr = cProfile.Profile()
@@ -169,26 +178,33 @@ class App(object):
             self.log_error('Unknown user ID')
             raise RedirectException(LOGIN_URL)
 
-        # Make a copy of the data so we don't have to hold the lock.
-        Perf.g_stats_lock.acquire()
-        temp_stats_count = Perf.g_stats_count
-        temp_stats_time = Perf.g_stats_time
-        Perf.g_stats_lock.release()
-
-        # Build a list of table rows from the device information.
-        page_stats_str = "<td><b>Page</b></td><td><b>Num Accesses</b></td><td><b>Avg Time (secs)</b></td><tr>\n"
-        for key, count_value in temp_stats_count.items():
+        # Build a list of table rows from the latency histograms, one row for each function, API request, task, or database command.
+        page_stats_str = "<td><b>Metric</b></td><td><b>Labels</b></td><td><b>Count</b></td><td><b>Avg Time (secs)</b></td><td><b>p50 (secs)</b></td><td><b>p95 (secs)</b></td><td><b>p99 (secs)</b></td><tr>\n"
+        for key, summary in sorted(Perf.retrieve_latency_summaries().items()):
+            if summary["count"] == 0:
+                continue
+            metric_name, labels = key
             page_stats_str += "\t\t<tr><td>"
-            page_stats_str += str(key)
+            page_stats_str += metric_name
             page_stats_str += "</td><td>"
-            page_stats_str += str(count_value)
+            page_stats_str += ", ".join(label_name + "=" + label_value for label_name, label_value in labels)
             page_stats_str += "</td><td>"
-            if key in temp_stats_time and count_value > 0:
-                total_time = temp_stats_time[key]
-                avg_time = total_time / count_value
-                page_stats_str += str(avg_time)
+            page_stats_str += str(summary["count"])
+            for summary_name in [ "avg", "p50", "p95", "p99" ]:
+                page_stats_str += "</td><td>"
+                page_stats_str += "{:.6f}".format(summary[summary_name])
             page_stats_str += "</td></tr>\n"
 
+        # Build a list of table rows from the cache counters.
+        cache_stats_str = "<td><b>Cache</b></td><td><b>Size</b></td><td><b>Hits</b></td><td><b>Misses</b></td><td><b>Evictions</b></td><td><b>Invalidations</b></td><tr>\n"
+        for cache_name, cache_stats in Cache.retrieve_statistics().items():
+            cache_stats_str += "\t\t<tr><td>"
+            cache_stats_str += str(cache_name)
+            for counter_name in [ "size", "hits", "misses", "evictions", "invalidations" ]:
+                cache_stats_str += "</td><td>"
+                cache_stats_str += str(cache_stats[counter_name])
+            cache_stats_str += "</td></tr>\n"
+
         # The number of users and activities.
         total_users_str = ""
         total_activities_str = ""
@@ -199,9 +215,18 @@ class App(object):
             self.log_error("Exception while getting counts.")
 
         # Render from template.
-        html_file = os.path.join(self.root_dir, Dirs.HTML_DIR, 'stats.html')
-        my_template = Template(filename=html_file, module_directory=self.tempmod_dir)
-        return my_template.render(nav=self.create_navbar(True), product=PRODUCT_NAME, root_url=self.root_url, email=username, name=user_realname, page_stats=page_stats_str, total_activities=total_activities_str, total_users=total_users_str)
+        my_template = Templates.retrieve_template('stats.html')
+        return my_template.render(nav=self.create_navbar(True), product=PRODUCT_NAME, root_url=self.root_url, email=username, name=user_realname, page_stats=page_stats_str, cache_stats=cache_stats_str, total_activities=total_activities_str, total_users=total_users_str)
+
+    def metrics(self, authorization):
+        """Returns the latency histograms and other metrics in the Prometheus text exposition format."""
+        """Only served when a token is configured, and then only to requests that include it in the Authorization header."""
+        metrics_token = self.config.get_metrics_token()
+        if metrics_token is None or len(metrics_token) == 0:
+            return False, ""
+        if authorization is None or not hmac.compare_digest(authorization.strip().encode('utf-8'), ("Bearer " + metrics_token).encode('utf-8')):
+            return False, ""
+        return True, Perf.render_exposition()
 
     def render_simple_page(self, template_file_name, **kwargs):
         """Renders a basic page from the specified template. This exists because a lot of pages only need this to be rendered."""
@@ -218,8 +243,7 @@ class App(object):
             raise RedirectException(LOGIN_URL)
 
         # Render from template.
-        html_file = os.path.join(self.root_dir, Dirs.HTML_DIR, template_file_name)
-        my_template = Template(filename=html_file, module_directory=self.tempmod_dir)
+        my_template = Templates.retrieve_template(template_file_name)
         return my_template.render(nav=self.create_navbar(True), product=PRODUCT_NAME, root_url=self.root_url, email=username, name=user_realname, **kwargs)
 
     def render_tags(self, activity, activity_user_id, belongs_to_current_user):
@@ -278,7 +302,15 @@ class App(object):
     @staticmethod
     def render_export_control(has_location_data, has_accel_data):
         """Helper function for building the exports string that appears on the activity details screens."""
+        global g_export_controls
+
+        key = (bool(has_location_data), bool(has_accel_data))
+        exports_str = g_export_controls.get(key)
+        if exports_str is not None:
+            return exports_str
+
         if not (has_location_data or has_accel_data):
+            g_export_controls[key] = ""
             return ""
         exports_str = "<td><select id=\"format\" >\n"
         if has_location_data:
@@ -288,6 +320,7 @@ class App(object):
             exports_str += "\t<option value=\"csv\">CSV</option>\n"
         exports_str += "</select>\n</td><tr>\n"
         exports_str += "<td><button type=\"button\" onclick=\"return export_activity()\">Export</button></td><tr>\n"
+        g_export_controls[key] = exports_str
         return exports_str
 
     def render_page_for_unmapped_activity(self, user_realname, activity_id, activity, activity_user_id, activity_user_resting_hr, activity_user_max_hr, logged_in_username, belongs_to_current_user, is_live):
@@ -367,7 +400,7 @@ class App(object):
         else:
             page_title = "Activity"
 
-        my_template = Template(filename=self.unmapped_activity_html_file, module_directory=self.tempmod_dir)
+        my_template = Templates.retrieve_template(self.unmapped_activity_html_file)
         return my_template.render(nav=self.create_navbar(logged_in), product=PRODUCT_NAME, root_url=self.root_url, name=user_realname, pagetitle=page_title, description=description_str, details=details, summary=summary, activity_id=activity_id, user_id=activity_user_id, max_hr=activity_user_max_hr, tags=tags_str, comments=comments_str, exports=exports_str, visibility=visibility_str)
 
     def render_description_for_page(self, activity):
@@ -476,7 +509,7 @@ class App(object):
         if belongs_to_current_user is not None:
             delete_str = "<td><button type=\"button\" onclick=\"return delete_activity()\" style=\"color:red\">Delete</button></td><tr>\n"
 
-        my_template = Template(filename=self.error_activity_html_file, module_directory=self.tempmod_dir)
+        my_template = Templates.retrieve_template(self.error_activity_html_file)
         return my_template.render(nav=self.create_navbar(logged_in), product=PRODUCT_NAME, root_url=self.root_url, error="There is no data for the specified activity.", activity_id=activity_id, delete=delete_str)
 
     def render_page_for_mapped_activity(self, user_realname, activity_id, activity, activity_user_id, activity_user_resting_hr, activity_user_max_hr, logged_in_user_id, belongs_to_current_user, is_live):
@@ -598,19 +631,19 @@ class App(object):
 
         # If a google maps key was provided then use google maps, otherwise use open street map.
         if is_in_watopia and os.path.isfile(self.zwift_watopia_map_file) > 0:
-            my_template = Template(filename=self.zwift_html_file, module_directory=self.tempmod_dir)
+            my_template = Templates.retrieve_template(self.zwift_html_file)
             return my_template.render(nav=self.create_navbar(logged_in), product=PRODUCT_NAME, root_url=self.root_url, name=user_realname, pagetitle=page_title, unit_system=unit_system, is_foot_based_activity=is_foot_based_activity_str, summary=summary, activity_id=activity_id, user_id=activity_user_id, ftp=ftp, resting_hr=activity_user_resting_hr, max_hr=activity_user_max_hr, description=description_str, details=details_str, tags=tags_str, comments=comments_str, exports=exports_str, visibility=visibility_str, map_file_name=ZWIFT_WATOPIA_MAP_FILE_NAME)
         elif is_in_crit_city and os.path.isfile(self.zwift_crit_city_map_file) > 0:
-            my_template = Template(filename=self.zwift_html_file, module_directory=self.tempmod_dir)
+            my_template = Templates.retrieve_template(self.zwift_html_file)
             return my_template.render(nav=self.create_navbar(logged_in), product=PRODUCT_NAME, root_url=self.root_url, name=user_realname, pagetitle=page_title, unit_system=unit_system, is_foot_based_activity=is_foot_based_activity_str, summary=summary, activity_id=activity_id, user_id=activity_user_id, ftp=ftp, resting_hr=activity_user_resting_hr, max_hr=activity_user_max_hr, description=description_str, details=details_str, tags=tags_str, comments=comments_str, exports=exports_str, visibility=visibility_str, map_file_name=ZWIFT_CRIT_CITY_MAP_FILE_NAME)
         elif is_in_makuri_islands and os.path.isfile(self.zwift_makuri_islands_map_file) > 0:
-            my_template = Template(filename=self.zwift_html_file, module_directory=self.tempmod_dir)
+            my_template = Templates.retrieve_template(self.zwift_html_file)
             return my_template.render(nav=self.create_navbar(logged_in), product=PRODUCT_NAME, root_url=self.root_url, name=user_realname, pagetitle=page_title, unit_system=unit_system, is_foot_based_activity=is_foot_based_activity_str, summary=summary, activity_id=activity_id, user_id=activity_user_id, ftp=ftp, resting_hr=activity_user_resting_hr, max_hr=activity_user_max_hr, description=description_str, details=details_str, tags=tags_str, comments=comments_str, exports=exports_str, visibility=visibility_str, map_file_name=ZWIFT_MAKURI_ISLANDS_MAP_FILE_NAME)
         elif self.google_maps_key:
-            my_template = Template(filename=self.map_single_google_html_file, module_directory=self.tempmod_dir)
+            my_template = Templates.retrieve_template(self.map_single_google_html_file)
             return my_template.render(nav=self.create_navbar(logged_in), product=PRODUCT_NAME, root_url=self.root_url, name=user_realname, pagetitle=page_title, unit_system=unit_system, is_foot_based_activity=is_foot_based_activity_str, summary=summary, activity_id=activity_id, user_id=activity_user_id, ftp=ftp, resting_hr=activity_user_resting_hr, max_hr=activity_user_max_hr, description=description_str, details=details_str, tags=tags_str, comments=comments_str, exports=exports_str, visibility=visibility_str)
         else:
-            my_template = Template(filename=self.map_single_osm_html_file, module_directory=self.tempmod_dir)
+            my_template = Templates.retrieve_template(self.map_single_osm_html_file)
             return my_template.render(nav=self.create_navbar(logged_in), product=PRODUCT_NAME, root_url=self.root_url, name=user_realname, pagetitle=page_title, unit_system=unit_system, is_foot_based_activity=is_foot_based_activity_str, summary=summary, activity_id=activity_id, user_id=activity_user_id, ftp=ftp, resting_hr=activity_user_resting_hr, max_hr=activity_user_max_hr, description=description_str, details=details_str, tags=tags_str, comments=comments_str, exports=exports_str, visibility=visibility_str)
 
     def render_page_for_activity(self, activity, user_realname, activity_user_id, activity_user_resting_hr, activity_user_max_hr, logged_in_user_id, belongs_to_current_user, is_live):
@@ -633,7 +666,7 @@ class App(object):
         """Helper function for rendering the map to track multiple devices."""
 
         if device_id_strs is None:
-            my_template = Template(filename=self.error_logged_in_html_file, module_directory=self.tempmod_dir)
+            my_template = Templates.retrieve_template(self.error_logged_in_html_file)
             return my_template.render(nav=self.create_navbar(logged_in), product=PRODUCT_NAME, root_url=self.root_url, error="No device IDs were specified.")
 
         last_lat = 0.0
@@ -654,14 +687,13 @@ class App(object):
                 last_lat = last_loc[Keys.LOCATION_LAT_KEY]
                 last_lon = last_loc[Keys.LOCATION_LON_KEY]
 
-        my_template = Template(filename=self.map_multi_html_file, module_directory=self.tempmod_dir)
+        my_template = Templates.retrieve_template(self.map_multi_html_file)
         return my_template.render(nav=self.create_navbar(logged_in), product=PRODUCT_NAME, root_url=self.root_url, email=email, name=user_realname, lastLat=last_lat, lastLon=last_lon, user_id=str(user_id))
 
     def render_error(self, error_str=None):
         """Renders the error page."""
         try:
-            error_html_file = os.path.join(self.root_dir, Dirs.HTML_DIR, 'error.html')
-            my_template = Template(filename=error_html_file, module_directory=self.tempmod_dir)
+            my_template = Templates.retrieve_template('error.html')
             if error_str is None:
                 error_str = "Internal Error."
             return my_template.render(product=PRODUCT_NAME, root_url=self.root_url, error=error_str)
@@ -672,8 +704,7 @@ class App(object):
     def render_no_live_data_error(self, user_str):
         """Renders the error page."""
         try:
-            error_html_file = os.path.join(self.root_dir, Dirs.HTML_DIR, 'no_live_data.html')
-            my_template = Template(filename=error_html_file, module_directory=self.tempmod_dir)
+            my_template = Templates.retrieve_template('no_live_data.html')
             return my_template.render(product=PRODUCT_NAME, root_url=self.root_url, user_str=user_str)
         except:
             pass
@@ -686,8 +717,7 @@ class App(object):
     def render_page_not_found(self):
         """Renders the 404 error page."""
         try:
-            error_html_file = os.path.join(self.root_dir, Dirs.HTML_DIR, 'error_404.html')
-            my_template = Template(filename=error_html_file, module_directory=self.tempmod_dir)
+            my_template = Templates.retrieve_template('error_404.html')
             return my_template.render(product=PRODUCT_NAME, root_url=self.root_url)
         except:
             pass
@@ -861,8 +891,7 @@ class App(object):
             description_str = activity[Keys.ACTIVITY_DESCRIPTION_KEY]
 
         # Render from template.
-        html_file = os.path.join(self.root_dir, Dirs.HTML_DIR, 'edit_activity.html')
-        my_template = Template(filename=html_file, module_directory=self.tempmod_dir)
+        my_template = Templates.retrieve_template('edit_activity.html')
         return my_template.render(nav=self.create_navbar(True), product=PRODUCT_NAME, root_url=self.root_url, email=username, name=user_realname, activity_id=activity_id, activity_name=activity_name_str, activity_type=activity_type_str, description=description_str)
 
     @Perf.statistics
@@ -890,8 +919,7 @@ class App(object):
             return self.render_error("The requested activity does not exist.")
 
         # Render from template.
-        html_file = os.path.join(self.root_dir, Dirs.HTML_DIR, 'trim_activity.html')
-        my_template = Template(filename=html_file, module_directory=self.tempmod_dir)
+        my_template = Templates.retrieve_template('trim_activity.html')
         return my_template.render(nav=self.create_navbar(True), product=PRODUCT_NAME, root_url=self.root_url, email=username, name=user_realname, activity_id=activity_id)
 
     @Perf.statistics
@@ -927,8 +955,7 @@ class App(object):
             end_time = activity[Keys.ACTIVITY_END_TIME_KEY]
 
         # Render from template.
-        html_file = os.path.join(self.root_dir, Dirs.HTML_DIR, 'merge_activity.html')
-        my_template = Template(filename=html_file, module_directory=self.tempmod_dir)
+        my_template = Templates.retrieve_template('merge_activity.html')
         return my_template.render(nav=self.create_navbar(True), product=PRODUCT_NAME, root_url=self.root_url, email=username, name=user_realname, activity_id=activity_id, start_time=start_time, end_time=end_time)
 
     @Perf.statistics
@@ -951,8 +978,7 @@ class App(object):
             raise RedirectException(LOGIN_URL)
 
         # Render from template.
-        html_file = os.path.join(self.root_dir, Dirs.HTML_DIR, 'add_photos.html')
-        my_template = Template(filename=html_file, module_directory=self.tempmod_dir)
+        my_template = Templates.retrieve_template('add_photos.html')
         return my_template.render(nav=self.create_navbar(True), product=PRODUCT_NAME, root_url=self.root_url, email=username, name=user_realname, activity_id=activity_id)
 
     @Perf.statistics
@@ -1107,15 +1133,15 @@ class App(object):
         return self.render_simple_page('settings.html')
 
     @Perf.statistics
-    def ical(self, calendar_id):
-        """Returns the ical calendar with the specified ID."""
+    def ical(self, calendar_id, if_none_match=None, if_modified_since=None):
+        """Returns a tuple of the HTTP status code, the ical calendar with the specified ID, and a dictionary of response headers."""
+        """The conditional request headers are passed along so that clients with an up to date copy get a 304."""
         if calendar_id is None:
-            return self.render_error()
+            return 400, "", {}
         if not InputChecker.is_uuid(calendar_id):
-            return self.render_error()
+            return 400, "", {}
 
-        handled, response = self.ical_server.handle_request(calendar_id)
-        return handled, response
+        return self.ical_server.handle_request(calendar_id, if_none_match, if_modified_since)
 
     @Perf.statistics
     def api(self, user_id, verb, method, params):
@@ -1140,8 +1166,7 @@ class App(object):
             extensions = ['extra', 'smarty']
             html = markdown.markdown(md, extensions=extensions, output_format='html5')
 
-        login_html_file = os.path.join(self.root_dir, Dirs.HTML_DIR, 'login.html')
-        my_template = Template(filename=login_html_file, module_directory=self.tempmod_dir)
+        my_template = Templates.retrieve_template('login.html')
         return my_template.render(product=PRODUCT_NAME, root_url=self.root_url, readme=html)
 
     @Perf.statistics
@@ -1152,8 +1177,7 @@ class App(object):
         if self.config.is_create_login_disabled():
             return self.render_error("Login creation is currently disabled.")
 
-        create_login_html_file = os.path.join(self.root_dir, Dirs.HTML_DIR, 'create_login.html')
-        my_template = Template(filename=create_login_html_file, module_directory=self.tempmod_dir)
+        my_template = Templates.retrieve_template('create_login.html')
         return my_template.render(product=PRODUCT_NAME, root_url=self.root_url)
 
     @Perf.statistics
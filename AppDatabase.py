@@ -23,21 +23,57 @@
 # SOFTWARE.
 """Database implementation"""
 
+import copy
+import datetime
+import io
 import json
-import re
+import os
+import socket
 import sys
+import threading
 import traceback
 import uuid
 from bson.objectid import ObjectId
+import gridfs
 import pymongo
 import time
+import BlobStore
+import Cache
 import Database
 import DatabaseException
 import InputChecker
 import Keys
 import Perf
+import RateLimiter
 import Workout
 
+ACTIVITY_BUCKET_DURATION_MS = 5 * 60 * 1000 # Length of the time span covered by a single bucket of activity data
+
+g_clients_lock = threading.Lock()
+g_clients = {} # Maps the database URL to the MongoClient used by everything in this process
+g_clients_pid = None # Process that created the clients, MongoClient objects must not be shared across a fork
+g_clients_created = 0 # Number of MongoClient objects created by this process
+
+g_schema_lock = threading.Lock()
+g_schema_updated = False # Indexes and data migrations only need to be checked once per process
+
+USER_SETTINGS_CACHE_NAME = "user settings"
+USERS_BY_NAME_CACHE_NAME = "users by name"
+USERS_BY_ID_CACHE_NAME = "users by id"
+SESSIONS_CACHE_NAME = "sessions"
+PLAN_VERSIONS_CACHE_NAME = "workout plan versions"
+LEGACY_PLAN_VERSION = "legacy" # Version of workout plans that haven't been changed since versions were added
+VALID_USER_SETTINGS = frozenset(k.lower() for k in Keys.USER_SETTINGS) # Settings are looked up in a case insensitive manner
+CACHE_INVALIDATION_OVERLAP_SECS = 5.0 # Invalidations are re-read for this long, in case of clock differences between servers
+CACHE_INVALIDATION_RETENTION_SECS = 3600 # Invalidations are removed from the database after this long
+
+g_caches_lock = threading.Lock()
+g_user_settings_cache = None # Maps the user ID to a dictionary of the user's settings
+g_users_by_name_cache = None # Maps the username to (user ID, password hash, real name)
+g_users_by_id_cache = None # Maps the user ID to (username, real name)
+g_sessions_cache = None # Maps the session token to (username, expiry)
+g_plan_versions_cache = None # Maps the calendar ID to (plan version, last modified time)
+
 def insert_into_collection(collection, doc):
     """Handles differences in document insertion between pymongo 3 and 4."""
     if int(pymongo.__version__[0]) < 4:
@@ -46,6 +82,82 @@ def insert_into_collection(collection, doc):
         result = collection.insert_one(doc)
     return result is not None and result.inserted_id is not None 
 
+class CommandLatencyListener(pymongo.monitoring.CommandListener):
+    """Records the time taken by each database command, by command and collection."""
+
+    def __init__(self):
+        self.collections = {} # Maps (connection, request ID) to the collection name, for commands that haven't finished yet
+        super(CommandLatencyListener, self).__init__()
+
+    def started(self, event):
+        # Most commands are of the form { command name: collection name, ... }, getMore is the exception.
+        if event.command_name == "getMore":
+            collection_name = event.command.get("collection")
+        else:
+            collection_name = event.command.get(event.command_name)
+        if not isinstance(collection_name, str):
+            collection_name = ""
+        self.collections[(event.connection_id, event.request_id)] = collection_name
+
+    def record_latency(self, event):
+        collection_name = self.collections.pop((event.connection_id, event.request_id), "")
+        Perf.record_latency(Perf.DATABASE_SECONDS_METRIC, { "command": event.command_name, "collection": collection_name }, event.duration_micros / 1000000.0)
+
+    def succeeded(self, event):
+        self.record_latency(event)
+
+    def failed(self, event):
+        self.record_latency(event)
+
+def retrieve_client(config):
+    """Returns the MongoClient for the configured database URL, creating it if this process doesn't already have one."""
+    """MongoClient maintains its own connection pool and is thread safe, so one client per process is all that's needed."""
+    global g_clients_lock
+    global g_clients
+    global g_clients_pid
+    global g_clients_created
+
+    database_url = config.get_database_url()
+
+    with g_clients_lock:
+
+        # Clients inherited from a parent process are not usable, start over.
+        pid = os.getpid()
+        if g_clients_pid != pid:
+            g_clients = {}
+            g_clients_pid = pid
+
+        if database_url not in g_clients:
+            g_clients[database_url] = pymongo.MongoClient(database_url, maxPoolSize=config.get_database_max_pool_size(), minPoolSize=config.get_database_min_pool_size(), event_listeners=[ CommandLatencyListener() ])
+            g_clients_created = g_clients_created + 1
+            Perf.record_metric("database clients created", 1)
+        return g_clients[database_url]
+
+def configure_caches(config):
+    """Creates the caches used by this module, if this process doesn't already have them."""
+    global g_caches_lock
+    global g_user_settings_cache
+    global g_users_by_name_cache
+    global g_users_by_id_cache
+    global g_sessions_cache
+    global g_plan_versions_cache
+
+    with g_caches_lock:
+        if g_user_settings_cache is None:
+            max_size = config.get_cache_size()
+            ttl_secs = config.get_cache_ttl()
+            g_user_settings_cache = Cache.TtlCache(USER_SETTINGS_CACHE_NAME, max_size, ttl_secs)
+            g_users_by_name_cache = Cache.TtlCache(USERS_BY_NAME_CACHE_NAME, max_size, ttl_secs)
+            g_users_by_id_cache = Cache.TtlCache(USERS_BY_ID_CACHE_NAME, max_size, ttl_secs)
+            g_sessions_cache = Cache.TtlCache(SESSIONS_CACHE_NAME, max_size, ttl_secs)
+            g_plan_versions_cache = Cache.TtlCache(PLAN_VERSIONS_CACHE_NAME, max_size, ttl_secs)
+
+def copy_setting_value(value):
+    """Cached lists and dictionaries must not be modified by the caller, i.e. when appending to the race calendar."""
+    if isinstance(value, list) or isinstance(value, dict):
+        return copy.deepcopy(value)
+    return value
+
 def update_collection(collection, doc):
     """Handles differences in document updates between pymongo 3 and 4."""
     if int(pymongo.__version__[0]) < 4:
@@ -70,6 +182,32 @@ def retrieve_time_from_time_value_pair(value):
     """Used with the sort function."""
     return list(value.keys())[0]
 
+def normalize_activity_id(activity_id):
+    """Activity IDs are stored in canonical (lowercase) form so that they can be looked up with an exact match."""
+    return str(activity_id).lower()
+
+def retrieve_bucket_start_time(time_ms):
+    """Returns the start time (ms) of the bucket that holds data for the given timestamp (ms)."""
+    time_ms = int(time_ms)
+    return time_ms - (time_ms % ACTIVITY_BUCKET_DURATION_MS)
+
+def sort_time_series(values):
+    """Sorts a list of locations, accelerometer readings, or time/value pairs by time."""
+    if values and Keys.LOCATION_TIME_KEY in values[0]:
+        values.sort(key=retrieve_time_from_location)
+    else:
+        values.sort(key=retrieve_time_from_time_value_pair)
+
+
+def group_activity_bests(records):
+    """Takes activity bests documents and groups them into a dictionary of bests for each activity, keyed by activity ID."""
+    bests = {}
+    for record in records:
+        activity_id = record[Keys.ACTIVITY_ID_KEY]
+        if activity_id not in bests:
+            bests[activity_id] = { Keys.ACTIVITY_TYPE_KEY: record[Keys.ACTIVITY_TYPE_KEY], Keys.ACTIVITY_START_TIME_KEY: record[Keys.ACTIVITY_START_TIME_KEY] }
+        bests[activity_id][record[Keys.RECORD_NAME_KEY]] = record[Keys.RECORD_VALUE_KEY]
+    return bests
 
 class Device(object):
     def __init__(self):
@@ -79,16 +217,157 @@ class Device(object):
         super(Device, self).__init__()
 
 
+class DatabaseInvalidationChannel(Cache.InvalidationChannel):
+    """Shares cache invalidations between processes through a collection that every process polls."""
+
+    def __init__(self, collection):
+        super(DatabaseInvalidationChannel, self).__init__()
+        self.collection = collection
+        self.origin = None
+        self.origin_pid = None
+        self.last_poll_time = datetime.datetime.now(datetime.timezone.utc)
+        self.seen_ids = set() # Invalidations from the overlap period of the previous poll, which don't need to be applied again
+
+    def retrieve_origin(self):
+        """Identifies this process, so it can skip its own invalidations. Recomputed after a fork."""
+        pid = os.getpid()
+        if self.origin_pid != pid:
+            self.origin = "%s:%d" % (socket.gethostname(), pid)
+            self.origin_pid = pid
+        return self.origin
+
+    def publish(self, cache_name, key):
+        """Tells the other processes that the key is no longer valid."""
+        post = { Keys.CACHE_INVALIDATION_NAME_KEY: cache_name, Keys.CACHE_INVALIDATION_ITEM_KEY: key, Keys.CACHE_INVALIDATION_ORIGIN_KEY: self.retrieve_origin(), Keys.CACHE_INVALIDATION_TIME_KEY: datetime.datetime.now(datetime.timezone.utc) }
+        insert_into_collection(self.collection, post)
+
+    def poll(self):
+        """Returns a list of (cache name, key) tuples that other processes published since the last call."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        since = self.last_poll_time - datetime.timedelta(seconds=CACHE_INVALIDATION_OVERLAP_SECS)
+        origin = self.retrieve_origin()
+
+        invalidations = []
+        seen_ids = set()
+        for doc in self.collection.find({ Keys.CACHE_INVALIDATION_TIME_KEY: { "$gt": since } }):
+            doc_id = doc[Keys.DATABASE_ID_KEY]
+            seen_ids.add(doc_id)
+            if doc_id in self.seen_ids or doc[Keys.CACHE_INVALIDATION_ORIGIN_KEY] == origin:
+                continue
+            invalidations.append((doc[Keys.CACHE_INVALIDATION_NAME_KEY], doc[Keys.CACHE_INVALIDATION_ITEM_KEY]))
+
+        self.last_poll_time = now
+        self.seen_ids = seen_ids
+        return invalidations
+
+
+class DatabaseRateLimiter(RateLimiter.RateLimiter):
+    """Keeps the counts in a collection shared by every process, so the limit doesn't grow with the number of processes."""
+    """Counting a request is a single atomic find-and-modify, which also enforces the limit."""
+
+    def __init__(self, collection, max_keys=100000):
+        self.collection = collection
+        self.lock = threading.Lock()
+        self.previous_counts = {} # Maps the key to (window start, count) for its previous window, which no longer changes
+        self.max_keys = max_keys
+        super(DatabaseRateLimiter, self).__init__()
+
+    def retrieve_previous_count(self, key, window_start):
+        """Returns the number of requests counted against the key in the window that starts at the given time."""
+        with self.lock:
+            previous = self.previous_counts.get(key)
+        if previous is not None and previous[0] == window_start:
+            return previous[1]
+
+        doc = self.collection.find_one({ Keys.RATE_LIMIT_KEY_KEY: key, Keys.RATE_LIMIT_WINDOW_KEY: window_start }, { Keys.RATE_LIMIT_COUNT_KEY: 1 })
+        count = 0
+        if doc is not None:
+            count = doc[Keys.RATE_LIMIT_COUNT_KEY]
+        with self.lock:
+            if len(self.previous_counts) >= self.max_keys:
+                self.previous_counts = {}
+            self.previous_counts[key] = (window_start, count)
+        return count
+
+    def check(self, key, limit, window_secs, now=None):
+        """Counts a request against the key. Returns TRUE if the request is within the limit, FALSE otherwise."""
+        if now is None:
+            now = time.time()
+        window_start = RateLimiter.retrieve_window_start(now, window_secs)
+        previous_count = self.retrieve_previous_count(key, window_start - window_secs)
+
+        # The number of requests the current window can hold, given the requests from the previous window that are still within the sliding window.
+        allowed = limit - RateLimiter.estimate_count(0, previous_count, now, window_start, window_secs)
+        if allowed <= 0:
+            return False
+
+        # Only increment the count if it's below the limit. If it isn't then the filter won't match, the upsert will
+        # try to insert a second document for the same window, and the unique index will reject it.
+        query = { Keys.RATE_LIMIT_KEY_KEY: key, Keys.RATE_LIMIT_WINDOW_KEY: window_start, Keys.RATE_LIMIT_COUNT_KEY: { "$lt": allowed } }
+        expiry = datetime.datetime.fromtimestamp(window_start + 2 * window_secs, datetime.timezone.utc)
+        update = { "$inc": { Keys.RATE_LIMIT_COUNT_KEY: 1 }, "$setOnInsert": { Keys.RATE_LIMIT_EXPIRY_KEY: expiry } }
+        try:
+            self.collection.find_one_and_update(query, update, projection={ Keys.DATABASE_ID_KEY: 1 }, upsert=True)
+        except pymongo.errors.DuplicateKeyError:
+            return False
+        return True
+
+
+class GridFsBlobStore(BlobStore.BlobStore):
+    """Keeps blobs in GridFS, which splits them into chunks small enough to be documents, so no file is too big to store and"""
+    """reading one doesn't require holding all of it in memory."""
+
+    def __init__(self, database, bucket_name):
+        self.bucket = gridfs.GridFSBucket(database, bucket_name=bucket_name)
+        super(GridFsBlobStore, self).__init__()
+
+    def write(self, name, chunks):
+        """Stores the chunks, in order, under the given name. Returns the number of bytes stored."""
+        num_bytes = 0
+        stream = self.bucket.open_upload_stream(name)
+        try:
+            for chunk in chunks:
+                stream.write(chunk)
+                num_bytes = num_bytes + len(chunk)
+            stream.close()
+        except:
+            # Don't leave the chunks that were written behind.
+            stream.abort()
+            raise
+        return num_bytes
+
+    def open(self, name):
+        """Returns a file-like object for reading the stored bytes, or None if nothing is stored under the name."""
+        try:
+            return self.bucket.open_download_stream_by_name(name)
+        except gridfs.errors.NoFile:
+            pass
+        return None
+
+    def delete(self, name):
+        """Removes whatever is stored under the name, if anything."""
+        for grid_out in self.bucket.find({ "filename": name }):
+            self.bucket.delete(grid_out._id)
+
+
 class MongoDatabase(Database.Database):
     """Mongo DB implementation of the application database."""
     conn = None
     database = None
     users_collection = None
     activities_collection = None
+    activity_buckets_collection = None
     workouts_collection = None
     tasks_collectoin = None
     uploads_collection = None
     sessions_collection = None
+    cache_invalidations_collection = None
+    rate_limits_collection = None
+    batch_jobs_collection = None
+    rollups_collection = None
+    blobs_collection = None
+    blob_store = None
+    blob_compression = Keys.BLOB_COMPRESSION_GZIP
 
     def __init__(self):
         Database.Database.__init__(self)
@@ -97,8 +376,7 @@ class MongoDatabase(Database.Database):
         """Connects/creates the database"""
         try:
             # If we weren't given a database URL then assume localhost and default port.
-            database_url = config.get_database_url()
-            self.conn = pymongo.MongoClient(database_url)
+            self.conn = retrieve_client(config)
 
             # Database.
             self.database = self.conn['openworkoutdb']
@@ -108,17 +386,244 @@ class MongoDatabase(Database.Database):
             # Handles to the various collections.
             self.users_collection = self.database['users']
             self.activities_collection = self.database['activities']
+            self.activity_buckets_collection = self.database['activity_buckets']
             self.records_collection = self.database['records']
+            self.activity_bests_collection = self.database['activity_bests']
             self.workouts_collection = self.database['workouts']
             self.tasks_collection = self.database['tasks']
             self.uploads_collection = self.database['uploads']
             self.sessions_collection = self.database['sessions']
+            self.cache_invalidations_collection = self.database['cache_invalidations']
+            self.rate_limits_collection = self.database['rate_limits']
+            self.batch_jobs_collection = self.database['batch_jobs']
+            self.rollups_collection = self.database['rollups']
+            self.blobs_collection = self.database['blobs']
+
+            # Where uploaded files are kept. Only their digests are stored with the uploads.
+            if config.get_upload_store() == 'directory':
+                self.blob_store = BlobStore.DirectoryBlobStore(config.get_upload_dir())
+            else:
+                self.blob_store = GridFsBlobStore(self.database, 'blobs')
+            self.blob_compression = BlobStore.select_compression(config.get_upload_compression())
+
+            # Caches, shared by every database object in this process.
+            configure_caches(config)
+            if Cache.retrieve_invalidation_channel() is None and config.get_cache_invalidation_channel() == 'database':
+                Cache.set_invalidation_channel(DatabaseInvalidationChannel(self.cache_invalidations_collection))
 
-            # Create indexes.
-            self.activities_collection.create_index(Keys.ACTIVITY_ID_KEY)
+            # Create indexes and normalize old data, if this process hasn't already done so.
+            self.update_schema()
         except pymongo.errors.ConnectionFailure as e:
             raise DatabaseException.DatabaseException("Could not connect to MongoDB: %s" % e)
 
+    def update_schema(self):
+        """Creates indexes and normalizes old data. Only done once per process since it only needs to happen at startup."""
+        """Migrations that have to read every document in a collection are left to db_manage.py, so that every web server"""
+        """and worker process doesn't repeat them (or race each other) at startup."""
+        global g_schema_lock
+        global g_schema_updated
+
+        with g_schema_lock:
+            if not g_schema_updated:
+                self.create_indexes()
+                self.normalize_activity_ids()
+                g_schema_updated = True
+
+    def create_indexes(self):
+        """Creates the indexes used by the query paths in this class. Creating an index that already exists does nothing."""
+        self.users_collection.create_index(Keys.USERNAME_KEY)
+        self.users_collection.create_index(Keys.REALNAME_KEY)
+        self.users_collection.create_index(Keys.DEVICES_KEY)
+        self.users_collection.create_index(Keys.FRIENDS_KEY)
+        self.users_collection.create_index(Keys.FRIEND_REQUESTS_KEY)
+        self.users_collection.create_index(Keys.API_KEYS)
+        self.users_collection.create_index(Keys.API_KEYS + "." + Keys.API_KEY)
+        self.activities_collection.create_index(Keys.ACTIVITY_ID_KEY)
+        self.activities_collection.create_index([ (Keys.ACTIVITY_USER_ID_KEY, pymongo.ASCENDING), (Keys.ACTIVITY_START_TIME_KEY, pymongo.ASCENDING), (Keys.ACTIVITY_ID_KEY, pymongo.ASCENDING) ])
+        self.activities_collection.create_index([ (Keys.ACTIVITY_DEVICE_STR_KEY, pymongo.ASCENDING), (Keys.ACTIVITY_START_TIME_KEY, pymongo.ASCENDING), (Keys.ACTIVITY_ID_KEY, pymongo.ASCENDING) ])
+        self.activities_collection.create_index(Keys.ACTIVITY_START_TIME_KEY)
+        self.activities_collection.create_index(Keys.ACTIVITY_LAST_UPDATED_KEY)
+        self.activities_collection.create_index([ (Keys.ACTIVITY_USER_ID_KEY, pymongo.ASCENDING), (Keys.ACTIVITY_FINGERPRINT_KEY, pymongo.ASCENDING) ])
+        self.activities_collection.create_index([ (Keys.ACTIVITY_USER_ID_KEY, pymongo.ASCENDING), (Keys.DATABASE_ID_KEY, pymongo.ASCENDING) ])
+        self.activity_buckets_collection.create_index([ (Keys.ACTIVITY_ID_KEY, pymongo.ASCENDING), (Keys.ACTIVITY_BUCKET_STREAM_KEY, pymongo.ASCENDING), (Keys.ACTIVITY_BUCKET_START_KEY, pymongo.ASCENDING) ])
+        self.records_collection.create_index(Keys.USER_ID_KEY)
+        self.activity_bests_collection.create_index([ (Keys.USER_ID_KEY, pymongo.ASCENDING), (Keys.ACTIVITY_START_TIME_KEY, pymongo.ASCENDING) ])
+        self.activity_bests_collection.create_index([ (Keys.USER_ID_KEY, pymongo.ASCENDING), (Keys.RECORD_NAME_KEY, pymongo.ASCENDING), (Keys.ACTIVITY_START_TIME_KEY, pymongo.ASCENDING) ])
+        self.activity_bests_collection.create_index([ (Keys.USER_ID_KEY, pymongo.ASCENDING), (Keys.ACTIVITY_TYPE_KEY, pymongo.ASCENDING), (Keys.RECORD_NAME_KEY, pymongo.ASCENDING), (Keys.RECORD_VALUE_KEY, pymongo.ASCENDING) ])
+        self.activity_bests_collection.create_index(Keys.ACTIVITY_ID_KEY)
+        self.workouts_collection.create_index(Keys.USER_ID_KEY)
+        self.workouts_collection.create_index(Keys.WORKOUT_PLAN_CALENDAR_ID_KEY)
+        self.workouts_collection.create_index(Keys.WORKOUT_LAST_SCHEDULED_WORKOUT_TIME_KEY)
+        self.tasks_collection.create_index(Keys.USER_ID_KEY)
+        self.uploads_collection.create_index(Keys.ACTIVITY_ID_KEY)
+        self.blobs_collection.create_index(Keys.BLOB_DIGEST_KEY, unique=True)
+        self.sessions_collection.create_index(Keys.SESSION_TOKEN_KEY)
+        self.cache_invalidations_collection.create_index(Keys.CACHE_INVALIDATION_TIME_KEY, expireAfterSeconds=CACHE_INVALIDATION_RETENTION_SECS)
+        self.rate_limits_collection.create_index([ (Keys.RATE_LIMIT_KEY_KEY, pymongo.ASCENDING), (Keys.RATE_LIMIT_WINDOW_KEY, pymongo.ASCENDING) ], unique=True)
+        self.rate_limits_collection.create_index(Keys.RATE_LIMIT_EXPIRY_KEY, expireAfterSeconds=0)
+        self.batch_jobs_collection.create_index(Keys.BATCH_JOB_NAME_KEY, unique=True)
+        self.rollups_collection.create_index([ (Keys.USER_ID_KEY, pymongo.ASCENDING), (Keys.ROLLUP_PERIOD_KEY, pymongo.ASCENDING), (Keys.ROLLUP_PERIOD_START_KEY, pymongo.ASCENDING) ], unique=True)
+
+    def normalize_activity_ids(self):
+        """Activity IDs used to be stored as provided by the client (i.e. upper case from some devices) and looked up with a case insensitive regex."""
+        """This converts any such IDs to the canonical lower case form so they can be found with an exact match. Returns the number of activities that were updated."""
+        renamed_ids = {}
+
+        # Only upper case IDs need updating. The regex is evaluated against the activity ID index, not the documents.
+        query = { Keys.ACTIVITY_ID_KEY: { "$regex": "[A-F]" } }
+        for activity in self.activities_collection.find(query, { Keys.DATABASE_ID_KEY: 1, Keys.ACTIVITY_ID_KEY: 1 }):
+            old_id = activity[Keys.ACTIVITY_ID_KEY]
+            new_id = normalize_activity_id(old_id)
+            self.activities_collection.update_one({ Keys.DATABASE_ID_KEY: activity[Keys.DATABASE_ID_KEY] }, { "$set": { Keys.ACTIVITY_ID_KEY: new_id } })
+            renamed_ids[old_id] = new_id
+
+        if not renamed_ids:
+            return 0
+
+        # Other collections that refer to activities by ID.
+        for old_id in renamed_ids:
+            new_id = renamed_ids[old_id]
+            self.activity_buckets_collection.update_many({ Keys.ACTIVITY_ID_KEY: old_id }, { "$set": { Keys.ACTIVITY_ID_KEY: new_id } })
+            self.uploads_collection.update_many({ Keys.ACTIVITY_ID_KEY: old_id }, { "$set": { Keys.ACTIVITY_ID_KEY: new_id } })
+            self.activity_bests_collection.update_many({ Keys.ACTIVITY_ID_KEY: old_id }, { "$set": { Keys.ACTIVITY_ID_KEY: new_id } })
+
+        # Personal records are stored in a per-user document, keyed by activity ID.
+        for user_records in self.records_collection.find({}):
+            renames = {}
+            for key in user_records:
+                if key in renamed_ids:
+                    renames[key] = renamed_ids[key]
+            if renames:
+                self.records_collection.update_one({ Keys.DATABASE_ID_KEY: user_records[Keys.DATABASE_ID_KEY] }, { "$rename": renames })
+
+        return len(renamed_ids)
+
+    def migrate_uploaded_files(self):
+        """Uploaded files used to be stored in the upload document. This moves their contents to the blob store, leaving the digest in their place."""
+        """Returns the number of files that were migrated. Not done at startup, since it reads every old upload."""
+        num_migrated = 0
+
+        query = { Keys.UPLOADED_FILE_DATA_KEY: { "$exists": True } }
+        for upload in self.uploads_collection.find(query, { Keys.DATABASE_ID_KEY: 1 }):
+            upload = self.uploads_collection.find_one({ Keys.DATABASE_ID_KEY: upload[Keys.DATABASE_ID_KEY] }, { Keys.UPLOADED_FILE_DATA_KEY: 1 })
+            if upload is None or Keys.UPLOADED_FILE_DATA_KEY not in upload:
+                continue
+
+            digest = self.create_blob(upload[Keys.UPLOADED_FILE_DATA_KEY])
+            new_values = { "$set": { Keys.UPLOADED_FILE_DIGEST_KEY: digest }, "$unset": { Keys.UPLOADED_FILE_DATA_KEY: "" } }
+            result = self.uploads_collection.update_one({ Keys.DATABASE_ID_KEY: upload[Keys.DATABASE_ID_KEY], Keys.UPLOADED_FILE_DATA_KEY: { "$exists": True } }, new_values)
+            if result.matched_count == 0:
+                self.release_blob(digest)
+            else:
+                num_migrated = num_migrated + 1
+
+        return num_migrated
+
+    def migrate_activity_bests(self):
+        """Activity bests used to be stored in the user's records document, keyed by activity ID. This moves them to the activity bests collection,"""
+        """which has one document per user, activity, and record. Returns the number of activities that were migrated."""
+        """Run from db_manage.py. Running it again only finds whatever was written in the old format since the last time."""
+        num_migrated = 0
+
+        for user_records in self.records_collection.find({}):
+            user_id = user_records[Keys.USER_ID_KEY]
+            migrated_ids = []
+            requests = []
+            for activity_id in user_records:
+                if InputChecker.is_uuid(activity_id):
+                    activity_bests = user_records[activity_id]
+
+                    # Deleted activities were left as empty dictionaries, those don't need to be moved.
+                    if Keys.ACTIVITY_TYPE_KEY in activity_bests and Keys.ACTIVITY_START_TIME_KEY in activity_bests:
+                        requests.extend(self.list_activity_bests_requests(user_id, activity_id, activity_bests[Keys.ACTIVITY_TYPE_KEY], activity_bests[Keys.ACTIVITY_START_TIME_KEY], activity_bests))
+                        num_migrated = num_migrated + 1
+                    migrated_ids.append(activity_id)
+
+            # Write the new documents before removing the old entries, leaving the personal records.
+            if requests:
+                self.activity_bests_collection.bulk_write(requests, ordered=True)
+            if migrated_ids:
+                self.records_collection.update_one({ Keys.DATABASE_ID_KEY: user_records[Keys.DATABASE_ID_KEY] }, { "$unset": { activity_id: "" for activity_id in migrated_ids } })
+
+        return num_migrated
+
+    def list_query_shapes(self):
+        """Returns a description of each query this class makes against the database, as (name, collection, query, sort order) tuples."""
+        """Used to verify that each query is served by an index. Values are placeholders, only the shape of the query matters."""
+        user_id = str(ObjectId())
+        user_id_obj = ObjectId(user_id)
+        activity_id = str(uuid.uuid4())
+        device_str = str(uuid.uuid4())
+        start_time = 0
+        end_time = int(time.time())
+
+        shapes = []
+        shapes.append(("user by name", self.users_collection, { Keys.USERNAME_KEY: "user@example.com" }, None))
+        shapes.append(("user by id", self.users_collection, { Keys.DATABASE_ID_KEY: user_id_obj }, None))
+        shapes.append(("user by api key", self.users_collection, { Keys.API_KEYS + "." + Keys.API_KEY: activity_id }, None))
+        shapes.append(("matched users", self.users_collection, { Keys.USERNAME_KEY: { "$regex": "user" } }, None))
+        shapes.append(("matched real names", self.users_collection, { Keys.REALNAME_KEY: { "$regex": "user" } }, None))
+        shapes.append(("user by device", self.users_collection, { Keys.DEVICES_KEY: device_str }, None))
+        shapes.append(("pending friends", self.users_collection, { Keys.FRIEND_REQUESTS_KEY: user_id }, None))
+        shapes.append(("friends", self.users_collection, { Keys.FRIENDS_KEY: user_id }, None))
+        shapes.append(("records by user", self.records_collection, { Keys.USER_ID_KEY: user_id }, None))
+        shapes.append(("activity bests by user", self.activity_bests_collection, { Keys.USER_ID_KEY: user_id }, None))
+        shapes.append(("bounded activity bests by user", self.activity_bests_collection, { Keys.USER_ID_KEY: user_id, Keys.ACTIVITY_START_TIME_KEY: { "$gte": start_time, "$lt": end_time } }, None))
+        shapes.append(("record history", self.activity_bests_collection, { Keys.USER_ID_KEY: user_id, Keys.RECORD_NAME_KEY: Keys.BEST_5K, Keys.ACTIVITY_TYPE_KEY: Keys.TYPE_RUNNING_KEY }, [ (Keys.ACTIVITY_START_TIME_KEY, pymongo.ASCENDING) ]))
+        shapes.append(("top records", self.activity_bests_collection, { Keys.USER_ID_KEY: user_id, Keys.ACTIVITY_TYPE_KEY: Keys.TYPE_RUNNING_KEY, Keys.RECORD_NAME_KEY: Keys.BEST_5K }, [ (Keys.RECORD_VALUE_KEY, pymongo.ASCENDING) ]))
+        shapes.append(("activity bests by activity", self.activity_bests_collection, { Keys.USER_ID_KEY: user_id, Keys.ACTIVITY_ID_KEY: activity_id }, None))
+        shapes.append(("user activity list", self.activities_collection, { "$and": [ { Keys.ACTIVITY_USER_ID_KEY: { '$eq': user_id } } ] }, None))
+        shapes.append(("bounded user activity list", self.activities_collection, { "$and": [ { Keys.ACTIVITY_USER_ID_KEY: { '$eq': user_id }}, { Keys.ACTIVITY_START_TIME_KEY: { '$gt': start_time } }, { Keys.ACTIVITY_START_TIME_KEY: { '$lt': end_time } } ] }, None))
+        shapes.append(("device activity list", self.activities_collection, { "$or": [ { Keys.ACTIVITY_DEVICE_STR_KEY: { '$eq': device_str } } ] }, None))
+        shapes.append(("bounded device activity list", self.activities_collection, { "$and": [ { "$or": [ { Keys.ACTIVITY_DEVICE_STR_KEY: { '$eq': device_str } } ] }, { Keys.ACTIVITY_START_TIME_KEY: { '$gt': start_time } }, { Keys.ACTIVITY_START_TIME_KEY: { '$lt': end_time } } ] }, None))
+        shapes.append(("activity list page", self.activities_collection, { "$and": [ { "$or": [ { Keys.ACTIVITY_USER_ID_KEY: { "$in": [ user_id ] } }, { Keys.ACTIVITY_DEVICE_STR_KEY: { "$in": [ device_str ] } } ] }, { "$or": [ { Keys.ACTIVITY_START_TIME_KEY: { "$lt": end_time } }, { Keys.ACTIVITY_START_TIME_KEY: end_time, Keys.ACTIVITY_ID_KEY: { "$lt": activity_id } }, { Keys.ACTIVITY_START_TIME_KEY: None } ] } ] }, [ (Keys.ACTIVITY_START_TIME_KEY, pymongo.DESCENDING), (Keys.ACTIVITY_ID_KEY, pymongo.DESCENDING) ]))
+        shapes.append(("most recent device activity", self.activities_collection, { Keys.ACTIVITY_DEVICE_STR_KEY: device_str }, [ ('_id', pymongo.DESCENDING) ]))
+        shapes.append(("activity by id", self.activities_collection, { Keys.ACTIVITY_ID_KEY: activity_id }, None))
+        shapes.append(("activity by id and device", self.activities_collection, { Keys.ACTIVITY_ID_KEY: activity_id, Keys.ACTIVITY_DEVICE_STR_KEY: device_str }, None))
+        shapes.append(("user activity times", self.activities_collection, { Keys.ACTIVITY_USER_ID_KEY: user_id, Keys.ACTIVITY_START_TIME_KEY: { "$gte": start_time, "$lte": end_time } }, None))
+        shapes.append(("activities by fingerprint", self.activities_collection, { Keys.ACTIVITY_USER_ID_KEY: user_id, Keys.ACTIVITY_FINGERPRINT_KEY: { "$in": [ activity_id ] } }, None))
+        shapes.append(("activities updated since", self.activities_collection, { Keys.ACTIVITY_LAST_UPDATED_KEY: { '$gt': start_time } }, None))
+        shapes.append(("activities that exist", self.activities_collection, { Keys.ACTIVITY_ID_KEY: { "$in": [ activity_id ] } }, None))
+        shapes.append(("user activities for batch analysis", self.activities_collection, { Keys.ACTIVITY_USER_ID_KEY: user_id, Keys.DATABASE_ID_KEY: { "$gt": user_id_obj } }, [ (Keys.DATABASE_ID_KEY, pymongo.ASCENDING) ]))
+        shapes.append(("activities for batch analysis", self.activities_collection, { Keys.DATABASE_ID_KEY: { "$gt": user_id_obj } }, [ (Keys.DATABASE_ID_KEY, pymongo.ASCENDING) ]))
+        shapes.append(("activity buckets written since cursor", self.activity_buckets_collection, { Keys.ACTIVITY_ID_KEY: activity_id, Keys.ACTIVITY_BUCKET_STREAM_KEY: Keys.ACTIVITY_LOCATIONS_KEY, Keys.ACTIVITY_BUCKET_LAST_SEQUENCE_KEY: { "$gt": 0 } }, [ (Keys.ACTIVITY_BUCKET_START_KEY, pymongo.ASCENDING) ]))
+        shapes.append(("latest activity bucket values", self.activity_buckets_collection, { Keys.ACTIVITY_ID_KEY: activity_id, Keys.ACTIVITY_BUCKET_STREAM_KEY: { "$in": [ Keys.APP_HEART_RATE_KEY ] } }, [ (Keys.ACTIVITY_BUCKET_STREAM_KEY, pymongo.ASCENDING), (Keys.ACTIVITY_BUCKET_START_KEY, pymongo.DESCENDING) ]))
+        shapes.append(("activity buckets", self.activity_buckets_collection, { Keys.ACTIVITY_ID_KEY: activity_id, Keys.ACTIVITY_BUCKET_STREAM_KEY: { "$in": [ Keys.ACTIVITY_LOCATIONS_KEY ] } }, [ (Keys.ACTIVITY_BUCKET_STREAM_KEY, pymongo.ASCENDING), (Keys.ACTIVITY_BUCKET_START_KEY, pymongo.ASCENDING) ]))
+        shapes.append(("workouts by user", self.workouts_collection, { Keys.USER_ID_KEY: user_id }, None))
+        shapes.append(("workouts by calendar id", self.workouts_collection, { Keys.WORKOUT_PLAN_CALENDAR_ID_KEY: activity_id }, None))
+        shapes.append(("workouts last scheduled before", self.workouts_collection, { Keys.WORKOUT_LAST_SCHEDULED_WORKOUT_TIME_KEY: { "$lt": end_time } }, None))
+        shapes.append(("tasks by user", self.tasks_collection, { Keys.USER_ID_KEY: user_id }, None))
+        shapes.append(("uploads by activity", self.uploads_collection, { Keys.ACTIVITY_ID_KEY: activity_id }, None))
+        shapes.append(("blob by digest", self.blobs_collection, { Keys.BLOB_DIGEST_KEY: activity_id, Keys.BLOB_REFERENCES_KEY: { "$lte": 0 } }, None))
+        shapes.append(("session by token", self.sessions_collection, { Keys.SESSION_TOKEN_KEY: activity_id }, None))
+        shapes.append(("rate limit by key", self.rate_limits_collection, { Keys.RATE_LIMIT_KEY_KEY: activity_id, Keys.RATE_LIMIT_WINDOW_KEY: start_time, Keys.RATE_LIMIT_COUNT_KEY: { "$lt": 100 } }, None))
+        shapes.append(("batch job by name", self.batch_jobs_collection, { Keys.BATCH_JOB_NAME_KEY: activity_id, Keys.BATCH_JOB_LEASE_EXPIRY_KEY: { "$lt": end_time } }, None))
+        shapes.append(("rollups by user and period", self.rollups_collection, { Keys.USER_ID_KEY: user_id, Keys.ROLLUP_PERIOD_KEY: Keys.ROLLUP_PERIOD_DAY, Keys.ROLLUP_PERIOD_START_KEY: { "$gte": start_time, "$lt": end_time } }, [ (Keys.ROLLUP_PERIOD_START_KEY, pymongo.ASCENDING) ]))
+        shapes.append(("cache invalidations since", self.cache_invalidations_collection, { Keys.CACHE_INVALIDATION_TIME_KEY: { "$gt": datetime.datetime.now(datetime.timezone.utc) } }, None))
+        return shapes
+
+    def verify_indexes(self):
+        """Runs explain() on each query shape and returns the names of the ones that would be served by a collection scan."""
+        """Queries that are meant to visit every document (total counts, enumerating all users, the periodic sweep for unanalyzed activities, etc.) are not included."""
+        def contains_collection_scan(plan):
+            if isinstance(plan, dict):
+                if plan.get("stage") == "COLLSCAN":
+                    return True
+                return any(contains_collection_scan(value) for value in plan.values())
+            if isinstance(plan, list):
+                return any(contains_collection_scan(value) for value in plan)
+            return False
+
+        failures = []
+        for name, collection, query, sort_order in self.list_query_shapes():
+            cursor = collection.find(query)
+            if sort_order is not None:
+                cursor = cursor.sort(sort_order)
+            explanation = cursor.explain()
+            if contains_collection_scan(explanation.get("queryPlanner", {}).get("winningPlan", {})):
+                failures.append(name)
+        return failures
+
     def total_users_count(self):
         """Returns the number of users in the database."""
         try:
@@ -150,6 +655,8 @@ class MongoDatabase(Database.Database):
         exclude_keys[Keys.APP_HEART_RATE_KEY] = False
         exclude_keys[Keys.APP_CADENCE_KEY] = False
         exclude_keys[Keys.APP_POWER_KEY] = False
+        exclude_keys[Keys.ACTIVITY_SIMPLIFIED_TRACKS_KEY] = False
+        exclude_keys[Keys.ACTIVITY_DOWNSAMPLED_SENSORS_KEY] = False
         return exclude_keys
 
     #
@@ -187,13 +694,22 @@ class MongoDatabase(Database.Database):
             raise Exception("username is empty")
 
         try:
+            # Is it cached?
+            Cache.process_invalidations()
+            found, cached_user = g_users_by_name_cache.get(username)
+            if found:
+                return cached_user
+            generation = g_users_by_name_cache.current_generation()
+
             # Find the user.
             result_keys = { Keys.DATABASE_ID_KEY: 1, Keys.HASH_KEY: 1, Keys.REALNAME_KEY: 1 }
             user = self.users_collection.find_one({ Keys.USERNAME_KEY: username }, result_keys)
 
             # If the user was found.
             if user is not None:
-                return str(user[Keys.DATABASE_ID_KEY]), user[Keys.HASH_KEY], str(user[Keys.REALNAME_KEY])
+                result = str(user[Keys.DATABASE_ID_KEY]), user[Keys.HASH_KEY], str(user[Keys.REALNAME_KEY])
+                g_users_by_name_cache.put(username, result, generation=generation)
+                return result
             return None, None, None
         except:
             self.log_error(traceback.format_exc())
@@ -225,14 +741,24 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: user_id")
 
         try:
+            # Is it cached?
+            Cache.process_invalidations()
+            user_id = str(user_id)
+            found, cached_user = g_users_by_id_cache.get(user_id)
+            if found:
+                return cached_user
+            generation = g_users_by_id_cache.current_generation()
+
             # Find the user.
-            user_id_obj = ObjectId(str(user_id))
+            user_id_obj = ObjectId(user_id)
             result_keys = { Keys.USERNAME_KEY: 1, Keys.REALNAME_KEY: 1 }
             user = self.users_collection.find_one({ Keys.DATABASE_ID_KEY: user_id_obj }, result_keys)
 
             # If the user was found.
             if user is not None:
-                return user[Keys.USERNAME_KEY], user[Keys.REALNAME_KEY]
+                result = user[Keys.USERNAME_KEY], user[Keys.REALNAME_KEY]
+                g_users_by_id_cache.put(user_id, result, generation=generation)
+                return result
             return None, None
         except:
             self.log_error(traceback.format_exc())
@@ -245,24 +771,34 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: api_key")
 
         try:
-            # Find the user.
-            rate = 100
-            query = { Keys.API_KEYS: { Keys.API_KEY: str(api_key), Keys.API_KEY_RATE : rate } }
-            result_keys = { Keys.DATABASE_ID_KEY: 1, Keys.HASH_KEY: 1, Keys.REALNAME_KEY: 1 }
+            # Find the user, along with the matching key so we know the key's rate.
+            query = { Keys.API_KEYS + "." + Keys.API_KEY: str(api_key) }
+            result_keys = { Keys.DATABASE_ID_KEY: 1, Keys.HASH_KEY: 1, Keys.REALNAME_KEY: 1, Keys.API_KEYS + ".$": 1 }
             user = self.users_collection.find_one(query, result_keys)
 
             # If the user was found.
             if user is not None:
+                rate = int(user[Keys.API_KEYS][0][Keys.API_KEY_RATE])
                 return str(user[Keys.DATABASE_ID_KEY]), user[Keys.HASH_KEY], user[Keys.REALNAME_KEY], rate
-            return None, None, None, rate
+            return None, None, None, None
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
         return None, None, None, None
 
+    def invalidate_cached_user(self, user_id, username):
+        """Removes the user from the caches in this process, and in the other processes."""
+        user_id = str(user_id)
+        Cache.invalidate(USER_SETTINGS_CACHE_NAME, user_id)
+        Cache.invalidate(USERS_BY_ID_CACHE_NAME, user_id)
+        if username is not None:
+            Cache.invalidate(USERS_BY_NAME_CACHE_NAME, username)
+
     def update_user_doc(self, doc):
         """Update method for a user."""
-        return update_collection(self.users_collection, doc)
+        result = update_collection(self.users_collection, doc)
+        self.invalidate_cached_user(doc[Keys.DATABASE_ID_KEY], doc.get(Keys.USERNAME_KEY))
+        return result
 
     def update_user(self, user_id, username, realname, passhash):
         """Update method for a user."""
@@ -283,11 +819,15 @@ class MongoDatabase(Database.Database):
 
             # If the user was found.
             if user is not None:
+                old_username = user[Keys.USERNAME_KEY]
                 user[Keys.USERNAME_KEY] = username
                 user[Keys.REALNAME_KEY] = realname
                 if passhash is not None:
                     user[Keys.HASH_KEY] = passhash
-                return self.update_user_doc(user)
+                result = self.update_user_doc(user)
+                if old_username != username:
+                    Cache.invalidate(USERS_BY_NAME_CACHE_NAME, old_username)
+                return result
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
@@ -299,8 +839,10 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: user_id")
 
         try:
+            username, _ = self.retrieve_user_from_id(user_id)
             user_id_obj = ObjectId(str(user_id))
             deleted_result = self.users_collection.delete_one({ Keys.DATABASE_ID_KEY: user_id_obj })
+            self.invalidate_cached_user(user_id, username)
             if deleted_result is not None:
                 return True
         except:
@@ -559,14 +1101,17 @@ class MongoDatabase(Database.Database):
             self.log_error(sys.exc_info()[0])
         return False
 
-    def retrieve_friends(self, user_id):
+    def retrieve_friends(self, user_id, include_devices=False):
         """Returns the user ids for all users that are friends with the user who has the specified id."""
+        """The friends' devices are only included when asked for, since the list is returned by the API."""
         if user_id is None:
             raise Exception("Unexpected empty object: user_id")
 
         try:
             # Only return these keys.
             result_keys = { Keys.USERNAME_KEY: 1, Keys.REALNAME_KEY: 1 }
+            if include_devices:
+                result_keys[Keys.DEVICES_KEY] = 1
 
             # Find the user's friends list.
             friends_list = []
@@ -657,6 +1202,30 @@ class MongoDatabase(Database.Database):
             self.log_error(sys.exc_info()[0])
         return False
 
+    def retrieve_cached_user_settings(self, user_id):
+        """Returns a dictionary of all the user's settings, keyed by the lower case setting name, or None if the user doesn't exist."""
+        """The user document is only read if the settings aren't already cached. The dictionary is shared, so it must not be modified."""
+        Cache.process_invalidations()
+        user_id = str(user_id)
+        found, settings = g_user_settings_cache.get(user_id)
+        if found:
+            return settings
+        generation = g_user_settings_cache.current_generation()
+
+        # Find the user.
+        user = self.retrieve_user_doc_from_id(user_id)
+        if user is None:
+            return None
+
+        # We want to search for keys in a case insensitive manner.
+        settings = {}
+        for k, v in user.items():
+            key_lower = k.lower()
+            if key_lower in VALID_USER_SETTINGS:
+                settings[key_lower] = v
+        g_user_settings_cache.put(user_id, settings, generation=generation)
+        return settings
+
     def retrieve_user_setting(self, user_id, key):
         """Retrieve method for user preferences."""
         if user_id is None:
@@ -665,19 +1234,14 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: key")
 
         try:
-            # Find the user.
-            user = self.retrieve_user_doc_from_id(user_id)
-            if user is None:
+            settings = self.retrieve_cached_user_settings(user_id)
+            if settings is None:
                 return None
 
-            # We want to search for keys in a case insensitive manner.
-            user_lower = { k.lower():v for k,v in user.items() }
-            key_lower = key.lower()
-            valid_settings = set(k.lower() for k in Keys.USER_SETTINGS)
-
             # Find the setting.
-            if user_lower is not None and key_lower in user_lower and key_lower in valid_settings:
-                return user_lower[key_lower]
+            key_lower = key.lower()
+            if key_lower in settings:
+                return copy_setting_value(settings[key_lower])
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
@@ -691,21 +1255,15 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: keys")
 
         try:
-            # Find the user.
-            user = self.retrieve_user_doc_from_id(user_id)
-            if user is None:
+            settings = self.retrieve_cached_user_settings(user_id)
+            if settings is None:
                 return []
 
-            # We want to search for keys in a case insensitive manner.
-            user_lower = { k.lower():v for k,v in user.items() }
-            keys_lower = set(k.lower() for k in keys)
-            valid_settings = set(k.lower() for k in Keys.USER_SETTINGS)
-
             # Find the settings.
             results = []
-            for key in keys_lower:
-                if key in user_lower and key in valid_settings:
-                    results.append({key: user_lower[key]})
+            for key in set(k.lower() for k in keys):
+                if key in settings:
+                    results.append({key: copy_setting_value(settings[key])})
             return results
         except:
             self.log_error(traceback.format_exc())
@@ -768,6 +1326,7 @@ class MongoDatabase(Database.Database):
             user_id_str = str(user_id)
             deleted_result = self.records_collection.delete_one({ Keys.USER_ID_KEY: user_id_str })
             if deleted_result is not None:
+                self.activity_bests_collection.delete_many({ Keys.USER_ID_KEY: user_id_str })
                 return True
         except:
             self.log_error(traceback.format_exc())
@@ -778,14 +1337,26 @@ class MongoDatabase(Database.Database):
     # Activity bests management methods
     #
 
+    def list_activity_bests_requests(self, user_id, activity_id, activity_type, activity_time, bests):
+        """Returns the bulk write requests that replace the activity's bests with the given ones, one document per record."""
+        """The activity type and start time are copied into each document so they can be used for range queries."""
+        user_id_str = str(user_id)
+        requests = [ pymongo.DeleteMany({ Keys.USER_ID_KEY: user_id_str, Keys.ACTIVITY_ID_KEY: activity_id }) ]
+        for record_name in bests:
+            record = { Keys.USER_ID_KEY: user_id_str, Keys.ACTIVITY_ID_KEY: activity_id, Keys.ACTIVITY_TYPE_KEY: activity_type, Keys.ACTIVITY_START_TIME_KEY: activity_time, \
+                Keys.RECORD_NAME_KEY: record_name, Keys.RECORD_VALUE_KEY: bests[record_name] }
+            requests.append(pymongo.InsertOne(record))
+        return requests
+
     def create_activity_bests(self, user_id, activity_id, activity_type, activity_time, bests):
-        """Create method for a user's personal records for a given activity."""
+        """Create method for a user's personal records for a given activity. Replaces anything previously stored for the activity."""
         if user_id is None:
             raise Exception("Unexpected empty object: user_id")
         if activity_id is None:
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
         if activity_type is None:
             raise Exception("Unexpected empty object: activity_type")
         if activity_time is None:
@@ -794,13 +1365,37 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: bests")
 
         try:
-            # Find the user's records collection.
-            user_records = self.records_collection.find_one({ Keys.USER_ID_KEY: user_id })
-            if user_records is not None:
+            # Every activity gets a type and start time record, even if nothing else is stored, so we know it has been analyzed.
+            bests[Keys.ACTIVITY_TYPE_KEY] = activity_type
+            bests[Keys.ACTIVITY_START_TIME_KEY] = activity_time
+
+            # Replace the old records in a single round trip.
+            self.activity_bests_collection.bulk_write(self.list_activity_bests_requests(user_id, activity_id, activity_type, activity_time, bests), ordered=True)
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def create_activity_bests_in_bulk(self, user_id, activities_bests):
+        """Create method for a user's personal records for several activities, in a single round trip. Takes a list of"""
+        """(activity ID, activity type, activity time, bests) tuples. Replaces anything previously stored for those activities."""
+        if user_id is None:
+            raise Exception("Unexpected empty object: user_id")
+        if activities_bests is None:
+            raise Exception("Unexpected empty object: activities_bests")
+
+        try:
+            requests = []
+            for activity_id, activity_type, activity_time, bests in activities_bests:
+                if not InputChecker.is_uuid(activity_id):
+                    raise Exception("Invalid object: activity_id " + str(activity_id))
                 bests[Keys.ACTIVITY_TYPE_KEY] = activity_type
                 bests[Keys.ACTIVITY_START_TIME_KEY] = activity_time
-                user_records[activity_id] = bests
-                return update_collection(self.records_collection, user_records)
+                requests.extend(self.list_activity_bests_requests(user_id, normalize_activity_id(activity_id), activity_type, activity_time, bests))
+            if requests:
+                self.activity_bests_collection.bulk_write(requests, ordered=True)
+            return True
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
@@ -812,24 +1407,15 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: user_id")
 
         try:
-            user_records = self.records_collection.find_one({ Keys.USER_ID_KEY: user_id })
-            if user_records is None:
-                return {}
-
-            # Each record is named using the activity ID of the corresponding activity.
-            bests = {}
-            for activity_id in user_records:
-                if InputChecker.is_uuid(activity_id):
-                    activity_bests = user_records[activity_id]
-                    bests[activity_id] = activity_bests
-            return bests
+            records = self.activity_bests_collection.find({ Keys.USER_ID_KEY: str(user_id) }, { Keys.DATABASE_ID_KEY: 0 })
+            return group_activity_bests(records)
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
         return {}
 
     def retrieve_bounded_activity_bests_for_user(self, user_id, cutoff_time_lower, cutoff_time_higher):
-        """Retrieve method for a user's activity records. Only activities more recent than the specified cutoff time will be returned."""
+        """Retrieve method for a user's activity records. Only activities that started within the specified time range will be returned."""
         if user_id is None:
             raise Exception("Unexpected empty object: user_id")
         if cutoff_time_lower is None:
@@ -838,25 +1424,63 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: cutoff_time_higher")
 
         try:
-            user_records = self.records_collection.find_one({ Keys.USER_ID_KEY: user_id })
-            if user_records is None:
-                return {}
-
-            # Each record is named using the activity ID of the corresponding activity.
-            bests = {}
-            for activity_id in user_records:
-                if InputChecker.is_uuid(activity_id):
-                    activity_bests = user_records[activity_id]
-                    if Keys.ACTIVITY_START_TIME_KEY in activity_bests:
-                        activity_time = activity_bests[Keys.ACTIVITY_START_TIME_KEY]
-                        if activity_time >= cutoff_time_lower and activity_time < cutoff_time_higher:
-                            bests[activity_id] = activity_bests
-            return bests
+            query = { Keys.USER_ID_KEY: str(user_id), Keys.ACTIVITY_START_TIME_KEY: { "$gte": cutoff_time_lower, "$lt": cutoff_time_higher } }
+            records = self.activity_bests_collection.find(query, { Keys.DATABASE_ID_KEY: 0 })
+            return group_activity_bests(records)
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
         return {}
 
+    def retrieve_record_history_for_user(self, user_id, activity_type, record_name):
+        """Returns a list of (activity ID, start time, value) tuples for the given record, in order of activity start time."""
+        if user_id is None:
+            raise Exception("Unexpected empty object: user_id")
+        if activity_type is None:
+            raise Exception("Unexpected empty object: activity_type")
+        if record_name is None:
+            raise Exception("Unexpected empty object: record_name")
+
+        try:
+            query = { Keys.USER_ID_KEY: str(user_id), Keys.RECORD_NAME_KEY: record_name, Keys.ACTIVITY_TYPE_KEY: activity_type }
+            records = self.activity_bests_collection.find(query, { Keys.DATABASE_ID_KEY: 0 }, sort=[ (Keys.ACTIVITY_START_TIME_KEY, pymongo.ASCENDING) ])
+            return [ (record[Keys.ACTIVITY_ID_KEY], record[Keys.ACTIVITY_START_TIME_KEY], record[Keys.RECORD_VALUE_KEY]) for record in records ]
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return []
+
+    def retrieve_top_records_for_user(self, user_id, activity_type, record_name, cutoff_time_lower, cutoff_time_higher, lower_is_better, limit):
+        """Returns a list of (activity ID, start time, value) tuples for the best 'limit' performances of the given record, best first."""
+        """If cutoff times are provided then only activities that started within that range are considered."""
+        if user_id is None:
+            raise Exception("Unexpected empty object: user_id")
+        if activity_type is None:
+            raise Exception("Unexpected empty object: activity_type")
+        if record_name is None:
+            raise Exception("Unexpected empty object: record_name")
+        if limit is None or limit <= 0:
+            raise Exception("Invalid object: limit")
+
+        try:
+            query = { Keys.USER_ID_KEY: str(user_id), Keys.ACTIVITY_TYPE_KEY: activity_type, Keys.RECORD_NAME_KEY: record_name }
+            if cutoff_time_lower is not None or cutoff_time_higher is not None:
+                time_query = {}
+                if cutoff_time_lower is not None:
+                    time_query["$gte"] = cutoff_time_lower
+                if cutoff_time_higher is not None:
+                    time_query["$lt"] = cutoff_time_higher
+                query[Keys.ACTIVITY_START_TIME_KEY] = time_query
+
+            # The index is ordered by value, so this is an index scan that stops after 'limit' matches.
+            sort_order = [ (Keys.RECORD_VALUE_KEY, pymongo.ASCENDING if lower_is_better else pymongo.DESCENDING) ]
+            records = self.activity_bests_collection.find(query, { Keys.DATABASE_ID_KEY: 0 }, sort=sort_order, limit=limit)
+            return [ (record[Keys.ACTIVITY_ID_KEY], record[Keys.ACTIVITY_START_TIME_KEY], record[Keys.RECORD_VALUE_KEY]) for record in records ]
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return []
+
     def delete_activity_best_for_user(self, user_id, activity_id):
         """Delete method for a user's personal records for a given activity."""
         if user_id is None:
@@ -865,12 +1489,28 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
 
         try:
-            user_records = self.records_collection.find_one({ Keys.USER_ID_KEY: user_id })
-            if user_records is not None:
-                user_records[activity_id] = {}
-                return update_collection(self.records_collection, user_records)
+            self.activity_bests_collection.delete_many({ Keys.USER_ID_KEY: str(user_id), Keys.ACTIVITY_ID_KEY: activity_id })
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def delete_activity_bests_for_user(self, user_id, activity_ids):
+        """Delete method for a user's personal records for several activities, in a single round trip."""
+        if user_id is None:
+            raise Exception("Unexpected empty object: user_id")
+        if activity_ids is None:
+            raise Exception("Unexpected empty object: activity_ids")
+
+        try:
+            if len(activity_ids) > 0:
+                activity_ids = [ normalize_activity_id(activity_id) for activity_id in activity_ids ]
+                self.activity_bests_collection.delete_many({ Keys.USER_ID_KEY: str(user_id), Keys.ACTIVITY_ID_KEY: { "$in": activity_ids } })
+            return True
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
@@ -902,6 +1542,121 @@ class MongoDatabase(Database.Database):
             self.log_error(sys.exc_info()[0])
         return []
 
+    @Perf.statistics
+    def retrieve_activity_list_page(self, owners, start_time, end_time, before, num_results, list_keys):
+        """Retrieves the activities belonging to the given owners, most recent first, with a single query. Activities that started at the same"""
+        """time are ordered by activity ID, so each activity has a unique position in the list and pages can start after a given activity."""
+        """Owners is a list of (user ID, list of device IDs, public only) tuples, public only being set for activities shared by friends."""
+        """Before is the (start time, activity ID) of the last activity on the previous page, or None to start at the most recent activity."""
+        """If list_keys is None then all of the metadata is returned, as with retrieve_user_activity_list, otherwise only the listed keys."""
+        if owners is None:
+            raise Exception("Unexpected empty object: owners")
+
+        try:
+            # Owners are grouped so the query has at most four branches, however many friends there are. Each branch can use one of the
+            # (owner, start time, activity ID) indexes, which the database merges to produce the sorted list.
+            owner_branches = []
+            for public_only in [ False, True ]:
+                user_ids = [ str(owner[0]) for owner in owners if owner[2] == public_only and owner[0] is not None ]
+                devices = [ device_str for owner in owners if owner[2] == public_only for device_str in owner[1] if InputChecker.is_uuid(device_str) ]
+                branches = []
+                if len(user_ids) > 0:
+                    branches.append({ Keys.ACTIVITY_USER_ID_KEY: { "$in": user_ids } })
+                if len(devices) > 0:
+                    branches.append({ Keys.ACTIVITY_DEVICE_STR_KEY: { "$in": devices } })
+                if public_only:
+                    for branch in branches:
+                        branch[Keys.ACTIVITY_VISIBILITY_KEY] = { "$ne": Keys.ACTIVITY_VISIBILITY_PRIVATE }
+                owner_branches.extend(branches)
+
+            # If there's nobody to look for then there's nothing to do and we'll just get a db error.
+            if len(owner_branches) == 0:
+                return []
+
+            conditions = [ { "$or": owner_branches } ]
+            if start_time is not None and end_time is not None:
+                conditions.append({ Keys.ACTIVITY_START_TIME_KEY: { "$gt": start_time, "$lt": end_time } })
+
+            # Activities without a start time sort after all of the others.
+            if before is not None:
+                before_time, before_id = before
+                if before_time is None:
+                    conditions.append({ Keys.ACTIVITY_START_TIME_KEY: None, Keys.ACTIVITY_ID_KEY: { "$lt": before_id } })
+                else:
+                    conditions.append({ "$or": [ { Keys.ACTIVITY_START_TIME_KEY: { "$lt": before_time } }, { Keys.ACTIVITY_START_TIME_KEY: before_time, Keys.ACTIVITY_ID_KEY: { "$lt": before_id } }, { Keys.ACTIVITY_START_TIME_KEY: None } ] })
+
+            # Things we don't need.
+            if list_keys is None:
+                projection = self.list_excluded_activity_keys()
+            else:
+                projection = { key: 1 for key in list_keys }
+                projection[Keys.DATABASE_ID_KEY] = 0
+
+            cursor = self.activities_collection.find({ "$and": conditions }, projection).sort([ (Keys.ACTIVITY_START_TIME_KEY, pymongo.DESCENDING), (Keys.ACTIVITY_ID_KEY, pymongo.DESCENDING) ])
+            if num_results is not None:
+                cursor = cursor.limit(num_results)
+            return list(cursor)
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return []
+
+    def retrieve_user_activity_times(self, user_id, start_time, end_time):
+        """Returns the activity ID, start time, end time (if known), and fingerprint (if any) of each of the user's activities that started within the given time range (inclusive)."""
+        if user_id is None:
+            raise Exception("Unexpected empty object: user_id")
+        if start_time is None:
+            raise Exception("Unexpected empty object: start_time")
+        if end_time is None:
+            raise Exception("Unexpected empty object: end_time")
+
+        try:
+            query = { Keys.ACTIVITY_USER_ID_KEY: user_id, Keys.ACTIVITY_START_TIME_KEY: { "$gte": start_time, "$lte": end_time } }
+            projection = { Keys.DATABASE_ID_KEY: 0, Keys.ACTIVITY_ID_KEY: 1, Keys.ACTIVITY_START_TIME_KEY: 1, Keys.ACTIVITY_END_TIME_KEY: 1, Keys.ACTIVITY_FINGERPRINT_KEY: 1 }
+            return list(self.activities_collection.find(query, projection))
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return []
+
+    def retrieve_activity_ids_by_fingerprints(self, user_id, fingerprints):
+        """Returns a dictionary that maps each of the given fingerprints that matches one of the user's activities to that activity's ID."""
+        if user_id is None:
+            raise Exception("Unexpected empty object: user_id")
+        if fingerprints is None:
+            raise Exception("Unexpected empty object: fingerprints")
+
+        try:
+            matches = {}
+            if len(fingerprints) > 0:
+                query = { Keys.ACTIVITY_USER_ID_KEY: user_id, Keys.ACTIVITY_FINGERPRINT_KEY: { "$in": list(fingerprints) } }
+                projection = { Keys.DATABASE_ID_KEY: 0, Keys.ACTIVITY_ID_KEY: 1, Keys.ACTIVITY_FINGERPRINT_KEY: 1 }
+                for activity in self.activities_collection.find(query, projection):
+                    matches[activity[Keys.ACTIVITY_FINGERPRINT_KEY]] = activity[Keys.ACTIVITY_ID_KEY]
+            return matches
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return {}
+
+    def update_activity_fingerprint(self, activity_id, fingerprint):
+        """Stores the fingerprint that is used to detect duplicate uploads."""
+        if activity_id is None:
+            raise Exception("Unexpected empty object: activity_id")
+        if not InputChecker.is_uuid(activity_id):
+            raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
+        if fingerprint is None:
+            raise Exception("Unexpected empty object: fingerprint")
+
+        try:
+            result = self.activities_collection.update_one({ Keys.ACTIVITY_ID_KEY: activity_id }, { "$set": { Keys.ACTIVITY_FINGERPRINT_KEY: fingerprint } })
+            return result.matched_count > 0
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
     @Perf.statistics
     def retrieve_each_user_activity(self, user_id, context, callback_func, start_time, end_time, return_all_data):
         """Retrieves each user activity and calls the callback function for each one."""
@@ -922,7 +1677,8 @@ class MongoDatabase(Database.Database):
             # Get an iterator to the activities.
             if start_time is None or end_time is None:
                 activities_cursor = self.activities_collection.find({ Keys.ACTIVITY_USER_ID_KEY: user_id }, exclude_keys)
-            activities_cursor = self.activities_collection.find({ "$and": [ { Keys.ACTIVITY_START_TIME_KEY: { '$gt': start_time } }, { Keys.ACTIVITY_START_TIME_KEY: { '$lt': end_time } } ]}, exclude_keys)
+            else:
+                activities_cursor = self.activities_collection.find({ "$and": [ { Keys.ACTIVITY_USER_ID_KEY: { '$eq': user_id } }, { Keys.ACTIVITY_START_TIME_KEY: { '$gt': start_time } }, { Keys.ACTIVITY_START_TIME_KEY: { '$lt': end_time } } ]}, exclude_keys)
 
             # Iterate over the results, triggering the callback for each.
             if activities_cursor is not None:
@@ -990,7 +1746,8 @@ class MongoDatabase(Database.Database):
             # Get an iterator to the activities.
             if start_time is None or end_time is None:
                 activities_cursor = self.activities_collection.find({ Keys.ACTIVITY_DEVICE_STR_KEY: device_str }, exclude_keys)
-            activities_cursor = self.activities_collection.find({ "$and": [ { Keys.ACTIVITY_DEVICE_STR_KEY: { '$eq': device_str } }, { Keys.ACTIVITY_START_TIME_KEY: { '$gt': start_time } }, { Keys.ACTIVITY_START_TIME_KEY: { '$lt': end_time } } ]}, exclude_keys)
+            else:
+                activities_cursor = self.activities_collection.find({ "$and": [ { Keys.ACTIVITY_DEVICE_STR_KEY: { '$eq': device_str } }, { Keys.ACTIVITY_START_TIME_KEY: { '$gt': start_time } }, { Keys.ACTIVITY_START_TIME_KEY: { '$lt': end_time } } ]}, exclude_keys)
 
             # Iterate over the results, triggering the callback for each.
             if activities_cursor is not None:
@@ -1019,7 +1776,12 @@ class MongoDatabase(Database.Database):
                 exclude_keys = self.list_excluded_activity_keys()
 
             # Find the activity.
-            return self.activities_collection.find_one({ Keys.ACTIVITY_DEVICE_STR_KEY: device_str }, exclude_keys, sort=[( '_id', pymongo.DESCENDING )])
+            activity = self.activities_collection.find_one({ Keys.ACTIVITY_DEVICE_STR_KEY: device_str }, exclude_keys, sort=[( '_id', pymongo.DESCENDING )])
+
+            # Reassemble any bucketed data.
+            if activity is not None and return_all_data:
+                self.merge_activity_buckets(activity, None)
+            return activity
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
@@ -1031,6 +1793,7 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
         if activity_name is None:
             raise Exception("Unexpected empty object: activity_name")
         if date_time is None:
@@ -1056,6 +1819,8 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity")
 
         try:
+            if Keys.ACTIVITY_ID_KEY in activity:
+                activity[Keys.ACTIVITY_ID_KEY] = normalize_activity_id(activity[Keys.ACTIVITY_ID_KEY])
             return insert_into_collection(self.activities_collection, activity)
         except:
             self.log_error(traceback.format_exc())
@@ -1068,8 +1833,12 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity")
 
         try:
+            activity[Keys.ACTIVITY_ID_KEY] = normalize_activity_id(activity[Keys.ACTIVITY_ID_KEY])
             deleted_result = self.activities_collection.delete_one({ Keys.ACTIVITY_ID_KEY: activity[Keys.ACTIVITY_ID_KEY] })
             if deleted_result is not None:
+
+                # The new document contains everything, including whatever was previously bucketed.
+                self.delete_activity_buckets(activity[Keys.ACTIVITY_ID_KEY], None)
                 activity.pop(Keys.DATABASE_ID_KEY)
                 return insert_into_collection(self.activities_collection, activity)
         except:
@@ -1084,10 +1853,66 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
 
         try:
             # Find the activity.
-            return self.activities_collection.find_one({ Keys.ACTIVITY_ID_KEY: re.compile(activity_id, re.IGNORECASE) })
+            activity = self.activities_collection.find_one({ Keys.ACTIVITY_ID_KEY: activity_id })
+
+            # Reassemble any bucketed data.
+            if activity is not None:
+                self.merge_activity_buckets(activity, None)
+            return activity
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def list_activity_analysis_keys(self):
+        """This is the list of stuff the analysis workers need. Anything else (i.e. previously computed summaries and speed graphs) stays in the database."""
+        include_keys = {}
+        include_keys[Keys.ACTIVITY_ID_KEY] = True
+        include_keys[Keys.ACTIVITY_TYPE_KEY] = True
+        include_keys[Keys.ACTIVITY_USER_ID_KEY] = True
+        include_keys[Keys.ACTIVITY_DEVICE_STR_KEY] = True
+        include_keys[Keys.ACTIVITY_START_TIME_KEY] = True
+        include_keys[Keys.ACTIVITY_END_TIME_KEY] = True
+        include_keys[Keys.APP_LOCATIONS_KEY] = True
+        include_keys[Keys.APP_ACCELEROMETER_KEY] = True
+        include_keys[Keys.APP_CADENCE_KEY] = True
+        include_keys[Keys.APP_HEART_RATE_KEY] = True
+        include_keys[Keys.APP_POWER_KEY] = True
+        include_keys[Keys.APP_TEMP_KEY] = True # Only read to be downsampled for the charts, see TrackSimplifier.DOWNSAMPLED_SENSOR_KEYS
+        include_keys[Keys.APP_THREAT_COUNT_KEY] = True
+        include_keys[Keys.APP_BATTERY_LEVEL_KEY] = True
+        return include_keys
+
+    @Perf.statistics
+    def retrieve_activity_for_analysis(self, activity_id):
+        """Retrieve method for an activity, specified by the activity ID, limited to the fields used by the analysis workers."""
+        if activity_id is None:
+            raise Exception("Unexpected empty object: activity_id")
+        if not InputChecker.is_uuid(activity_id):
+            raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
+
+        try:
+            # Find the activity.
+            include_keys = self.list_activity_analysis_keys()
+            activity = self.activities_collection.find_one({ Keys.ACTIVITY_ID_KEY: activity_id }, include_keys)
+
+            # Reassemble any bucketed data, but only for the streams we're going to analyze.
+            if activity is not None:
+                stream_names = [ Keys.APP_LOCATIONS_KEY, Keys.APP_ACCELEROMETER_KEY, Keys.APP_CADENCE_KEY, Keys.APP_HEART_RATE_KEY, Keys.APP_POWER_KEY, Keys.APP_TEMP_KEY, Keys.APP_THREAT_COUNT_KEY, Keys.APP_BATTERY_LEVEL_KEY ]
+                self.merge_activity_buckets(activity, stream_names)
+
+                # The speed graph is only created if it doesn't already exist, so the analyzer needs to know whether it's there, but not what's in it.
+                speed_query = { Keys.ACTIVITY_ID_KEY: activity_id, Keys.APP_CURRENT_SPEED_KEY: { "$exists": True } }
+                speed_bucket_query = { Keys.ACTIVITY_ID_KEY: activity_id, Keys.ACTIVITY_BUCKET_STREAM_KEY: Keys.APP_CURRENT_SPEED_KEY }
+                if self.activities_collection.find_one(speed_query, { Keys.DATABASE_ID_KEY: 1 }) is not None or \
+                    self.activity_buckets_collection.find_one(speed_bucket_query, { Keys.DATABASE_ID_KEY: 1 }) is not None:
+                    activity[Keys.APP_CURRENT_SPEED_KEY] = []
+            return activity
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
@@ -1100,13 +1925,14 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
 
         try:
             # Things we don't need.
             exclude_keys = self.list_excluded_activity_keys()
 
             # Find the activity.
-            return self.activities_collection.find_one({ Keys.ACTIVITY_ID_KEY: re.compile(activity_id, re.IGNORECASE) }, exclude_keys)
+            return self.activities_collection.find_one({ Keys.ACTIVITY_ID_KEY: activity_id }, exclude_keys)
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
@@ -1114,85 +1940,44 @@ class MongoDatabase(Database.Database):
 
     def update_activity(self, device_str, activity_id, locations, sensor_readings_dict, metadata_list_dict):
         """Updates locations, sensor readings, and metadata associated with a moving activity. Provided as a performance improvement over making several database updates."""
+        """New data is appended to the activity's buckets, so the activity document itself is never rewritten."""
         if device_str is None:
             raise Exception("Unexpected empty object: device_str")
         if activity_id is None:
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
         if not locations:
             raise Exception("Unexpected empty object: locations")
 
         try:
-            # Find the activity.
-            activity = self.activities_collection.find_one({ Keys.ACTIVITY_ID_KEY: activity_id, Keys.ACTIVITY_DEVICE_STR_KEY: device_str })
-
-            # If the activity was not found then create it.
-            if activity is None:
-                first_location = locations[0]
-                if self.create_activity(activity_id, "", first_location[0] / 1000, device_str):
-                    activity = self.activities_collection.find_one({ Keys.ACTIVITY_ID_KEY: activity_id, Keys.ACTIVITY_DEVICE_STR_KEY: device_str })
-
-            # If the activity was found.
-            if activity is not None:
-
-                # Update the locations. Location data is an array, the order is defined in Api.parse_json_loc_obj.
-                if len(locations) > 0:
-
-                    # Find any existing location data.
-                    old_locations = []
-                    if Keys.ACTIVITY_LOCATIONS_KEY in activity:
-                        old_locations = activity[Keys.ACTIVITY_LOCATIONS_KEY]
-
-                    # Append the new locations.
-                    for location in locations:
-                        value = { Keys.LOCATION_TIME_KEY: location[0], Keys.LOCATION_LAT_KEY: location[1], Keys.LOCATION_LON_KEY: location[2], Keys.LOCATION_ALT_KEY: location[3], Keys.LOCATION_HORIZONTAL_ACCURACY_KEY: location[4], Keys.LOCATION_VERTICAL_ACCURACY_KEY: location[5] }
-                        old_locations.append(value)
-
-                    # Make sure everything is in the right order, no guarantee we got the updates in the correct order.
-                    old_locations.sort(key=retrieve_time_from_location)
-
-                    # Update the database.
-                    activity[Keys.ACTIVITY_LOCATIONS_KEY] = old_locations
-
-                # Update the sensor readings.
-                if sensor_readings_dict:
-                    for sensor_type in sensor_readings_dict:
-
-                        # Existing sensor values.
-                        old_value_list = []
-                        if sensor_type in activity:
-                            old_value_list = activity[sensor_type]
-
-                        # Append new values.
-                        for value in sensor_readings_dict[sensor_type]:
-                            time_value_pair = { str(value[0]): float(value[1]) }
-                            old_value_list.append(time_value_pair)
-
-                        # Sort and update.
-                        old_value_list.sort(key=retrieve_time_from_time_value_pair)
-                        activity[sensor_type] = old_value_list
-
-                # Update the metadata readings.
-                if metadata_list_dict:
-                    for metadata_type in metadata_list_dict:
-
-                        # Existing metadata values.
-                        old_value_list = []
-                        if metadata_type in activity:
-                            old_value_list = activity[metadata_type]
-
-                        # Append new values.
-                        for value in metadata_list_dict[metadata_type]:
-                            time_value_pair = { str(value[0]): float(value[1]) }
-                            old_value_list.append(time_value_pair)
-
-                        # Sort and update.
-                        old_value_list.sort(key=retrieve_time_from_time_value_pair)
-                        activity[metadata_type] = old_value_list
+            # Find the activity, creating it if it doesn't exist.
+            first_location = locations[0]
+            if not self.find_or_create_device_activity(device_str, activity_id, first_location[0]):
+                return False
 
-                # Write out the changes.
-                return update_activities_collection(self, activity)
+            streams = {}
+
+            # Update the locations. Location data is an array, the order is defined in Api.parse_json_loc_obj.
+            location_values = []
+            for location in locations:
+                value = { Keys.LOCATION_TIME_KEY: location[0], Keys.LOCATION_LAT_KEY: location[1], Keys.LOCATION_LON_KEY: location[2], Keys.LOCATION_ALT_KEY: location[3], Keys.LOCATION_HORIZONTAL_ACCURACY_KEY: location[4], Keys.LOCATION_VERTICAL_ACCURACY_KEY: location[5] }
+                location_values.append([location[0], value])
+            streams[Keys.ACTIVITY_LOCATIONS_KEY] = location_values
+
+            # Update the sensor readings and the metadata readings, both are lists of time/value pairs.
+            for readings_dict in [ sensor_readings_dict, metadata_list_dict ]:
+                if readings_dict:
+                    for reading_type in readings_dict:
+                        time_value_pairs = []
+                        for value in readings_dict[reading_type]:
+                            time_value_pairs.append([value[0], { str(value[0]): float(value[1]) }])
+                        streams[reading_type] = time_value_pairs
+
+            # Write out the changes.
+            self.append_activity_buckets(activity_id, streams)
+            return self.update_activity_last_updated_time(activity_id, max(location[0] for location in locations))
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
@@ -1204,11 +1989,12 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
 
         try:
             deleted_result = self.activities_collection.delete_one({ Keys.ACTIVITY_ID_KEY: activity_id })
             if deleted_result is not None:
-                return True
+                return self.delete_activity_buckets(activity_id, None)
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
@@ -1220,6 +2006,7 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
 
         try:
             return self.activities_collection.count_documents({ Keys.ACTIVITY_ID_KEY: activity_id }, limit = 1) != 0
@@ -1228,6 +2015,48 @@ class MongoDatabase(Database.Database):
             self.log_error(sys.exc_info()[0])
         return False
 
+    def retrieve_existing_activity_ids(self, activity_ids):
+        """Returns the subset of the given activity IDs that still have an activity document, in a single query."""
+        if activity_ids is None:
+            raise Exception("Unexpected empty object: activity_ids")
+
+        try:
+            existing_ids = set()
+            if len(activity_ids) > 0:
+                activity_ids = [ normalize_activity_id(activity_id) for activity_id in activity_ids ]
+                for activity in self.activities_collection.find({ Keys.ACTIVITY_ID_KEY: { "$in": activity_ids } }, { Keys.DATABASE_ID_KEY: 0, Keys.ACTIVITY_ID_KEY: 1 }):
+                    existing_ids.add(activity[Keys.ACTIVITY_ID_KEY])
+            return existing_ids
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def retrieve_activities_for_batch_analysis(self, user_id, only_unanalyzed, checkpoint, limit):
+        """Returns the next 'limit' activities after the checkpoint, in the order they were created, for the given user (or every user, if None)."""
+        """Only the fields needed to find the activity and its owner are returned. Each activity includes its checkpoint, which is passed"""
+        """to the next call, so an interrupted job can pick up where it left off without keeping a cursor open while it works."""
+        if limit is None or limit <= 0:
+            raise Exception("Invalid object: limit")
+
+        try:
+            query = {}
+            if user_id is not None:
+                query[Keys.ACTIVITY_USER_ID_KEY] = str(user_id)
+            if checkpoint is not None:
+                query[Keys.DATABASE_ID_KEY] = { "$gt": ObjectId(checkpoint) }
+            if only_unanalyzed:
+                query[Keys.ACTIVITY_SUMMARY_KEY] = { "$exists": False }
+            projection = { Keys.DATABASE_ID_KEY: 1, Keys.ACTIVITY_ID_KEY: 1, Keys.ACTIVITY_USER_ID_KEY: 1, Keys.ACTIVITY_DEVICE_STR_KEY: 1 }
+            activities = list(self.activities_collection.find(query, projection, sort=[ (Keys.DATABASE_ID_KEY, pymongo.ASCENDING) ], limit=limit))
+            for activity in activities:
+                activity[Keys.BATCH_JOB_CHECKPOINT_KEY] = str(activity.pop(Keys.DATABASE_ID_KEY))
+            return activities
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
     def list_activities_with_last_updated_times_before(self, user_id, last_modified_time):
         """Returns a list of activity IDs with last modified times greater than the date provided."""
         if user_id is None:
@@ -1258,46 +2087,234 @@ class MongoDatabase(Database.Database):
     # Activity data methods
     #
 
-    def create_activity_locations(self, device_str, activity_id, locations):
-        """Adds several locations to the database. 'locations' is an array of arrays in the form [time, lat, lon, alt]."""
-        if device_str is None:
-            raise Exception("Unexpected empty object: device_str")
+    def find_or_create_device_activity(self, device_str, activity_id, first_time_ms):
+        """Makes sure there is a document for the activity, creating it if it does not already exist. Returns TRUE if the activity exists (or was created)."""
+        if self.activities_collection.count_documents({ Keys.ACTIVITY_ID_KEY: activity_id, Keys.ACTIVITY_DEVICE_STR_KEY: device_str }, limit = 1) != 0:
+            return True
+        return self.create_activity(activity_id, "", first_time_ms / 1000, device_str)
+
+    def update_activity_last_updated_time(self, activity_id, end_time_ms):
+        """Updates the activity's last updated time, and end time (if provided), without rewriting the activity document."""
+        new_values = { "$set": { Keys.ACTIVITY_LAST_UPDATED_KEY: time.time() } }
+        if end_time_ms is not None:
+            new_values["$max"] = { Keys.ACTIVITY_END_TIME_KEY: int(end_time_ms / 1000) }
+        result = self.activities_collection.update_one({ Keys.ACTIVITY_ID_KEY: activity_id }, new_values)
+        return result.matched_count > 0
+
+    def append_activity_buckets(self, activity_id, streams):
+        """Appends time series data to fixed-size time buckets instead of rewriting the entire activity document."""
+        """'streams' maps the stream name (i.e. locations) to a list of [time (ms), value] pairs, where value is in the form stored in the activity document."""
+        """Each write is numbered, so that readers can ask for everything written since a given write no matter which buckets it went into."""
+
+        # Group the values by the bucket they belong in.
+        stream_buckets = {}
+        for stream_name in streams:
+            buckets = {}
+            for time_ms, value in streams[stream_name]:
+                bucket_start = retrieve_bucket_start_time(time_ms)
+                if bucket_start not in buckets:
+                    buckets[bucket_start] = []
+                buckets[bucket_start].append(value)
+            if buckets:
+                stream_buckets[stream_name] = buckets
+        if not stream_buckets:
+            return True
+
+        # Number this write. An activity's data comes from one device at a time, so its writes are stored in the order they're numbered.
+        activity = self.activities_collection.find_one_and_update({ Keys.ACTIVITY_ID_KEY: activity_id }, { "$inc": { Keys.ACTIVITY_WRITE_SEQUENCE_KEY: 1 } }, projection={ Keys.DATABASE_ID_KEY: 0, Keys.ACTIVITY_WRITE_SEQUENCE_KEY: 1 }, return_document=pymongo.ReturnDocument.AFTER)
+        sequence = 0
+        if activity is not None:
+            sequence = activity[Keys.ACTIVITY_WRITE_SEQUENCE_KEY]
+
+        # One upsert per bucket, the bucket is created the first time something is written to it.
+        requests = []
+        for stream_name in stream_buckets:
+            buckets = stream_buckets[stream_name]
+            for bucket_start in buckets:
+                bucket_values = buckets[bucket_start]
+                query = { Keys.ACTIVITY_ID_KEY: activity_id, Keys.ACTIVITY_BUCKET_STREAM_KEY: stream_name, Keys.ACTIVITY_BUCKET_START_KEY: bucket_start }
+                new_values = { "$push": { Keys.ACTIVITY_BUCKET_VALUES_KEY: { "$each": bucket_values }, Keys.ACTIVITY_BUCKET_SEQUENCES_KEY: { "$each": [ sequence ] * len(bucket_values) } }, \
+                    "$inc": { Keys.ACTIVITY_BUCKET_COUNT_KEY: len(bucket_values) }, "$max": { Keys.ACTIVITY_BUCKET_LAST_SEQUENCE_KEY: sequence } }
+                requests.append(pymongo.UpdateOne(query, new_values, upsert=True))
+
+        # Send everything in a single round trip.
+        self.activity_buckets_collection.bulk_write(requests, ordered=False)
+        return True
+
+    def retrieve_activity_buckets(self, activity_id, stream_names):
+        """Returns a dictionary that maps each stream name to the values stored in the activity's buckets, in bucket order."""
+        """If stream_names is None then every stream is returned."""
+        query = { Keys.ACTIVITY_ID_KEY: activity_id }
+        if stream_names is not None:
+            query[Keys.ACTIVITY_BUCKET_STREAM_KEY] = { "$in": stream_names }
+        projection = { Keys.DATABASE_ID_KEY: 0, Keys.ACTIVITY_BUCKET_STREAM_KEY: 1, Keys.ACTIVITY_BUCKET_VALUES_KEY: 1 }
+        sort_order = [ (Keys.ACTIVITY_BUCKET_STREAM_KEY, pymongo.ASCENDING), (Keys.ACTIVITY_BUCKET_START_KEY, pymongo.ASCENDING) ]
+
+        streams = {}
+        for bucket in self.activity_buckets_collection.find(query, projection, sort=sort_order):
+            stream_name = bucket[Keys.ACTIVITY_BUCKET_STREAM_KEY]
+            if stream_name not in streams:
+                streams[stream_name] = []
+            streams[stream_name].extend(bucket[Keys.ACTIVITY_BUCKET_VALUES_KEY])
+        return streams
+
+    def merge_activity_buckets(self, activity, stream_names):
+        """Folds the activity's bucketed data into the activity document so that callers see the same structure as if everything were stored inline."""
+        streams = self.retrieve_activity_buckets(activity[Keys.ACTIVITY_ID_KEY], stream_names)
+        for stream_name in streams:
+
+            # Start with anything that was stored inline, i.e. by older versions of the software.
+            values = []
+            if stream_name in activity and isinstance(activity[stream_name], list):
+                values = activity[stream_name]
+            values.extend(streams[stream_name])
+
+            # Buckets are in order, but there's no guarantee the values within each bucket arrived in order.
+            sort_time_series(values)
+            activity[stream_name] = values
+        return activity
+
+    def retrieve_activity_stream_since(self, activity_id, stream_name, cursor):
+        """Returns the values appended to one of the activity's streams since the cursor was issued, along with a cursor for the new end of the stream."""
+        """The cursor is the number of the last write that was read (see append_activity_buckets), or None to read everything. Values that arrive late,"""
+        """and so land in an earlier bucket than values that have already been read, are still returned. Only buckets that were written to are transferred."""
         if activity_id is None:
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
-        if not locations:
-            raise Exception("Unexpected empty object: locations")
+        activity_id = normalize_activity_id(activity_id)
 
         try:
-            # Find the activity.
-            activity = self.activities_collection.find_one({ Keys.ACTIVITY_ID_KEY: activity_id, Keys.ACTIVITY_DEVICE_STR_KEY: device_str })
+            values = []
+            query = { Keys.ACTIVITY_ID_KEY: activity_id, Keys.ACTIVITY_BUCKET_STREAM_KEY: stream_name }
+            projection = { Keys.DATABASE_ID_KEY: 0, Keys.ACTIVITY_BUCKET_VALUES_KEY: 1, Keys.ACTIVITY_BUCKET_LAST_SEQUENCE_KEY: 1 }
 
-            # If the activity was not found then create it.
-            if activity is None:
-                first_location = locations[0]
-                if self.create_activity(activity_id, "", first_location[0] / 1000, device_str):
-                    activity = self.activities_collection.find_one({ Keys.ACTIVITY_ID_KEY: activity_id, Keys.ACTIVITY_DEVICE_STR_KEY: device_str })
+            if cursor is None:
 
-            # If the activity was found.
+                # Anything stored inline, i.e. by older versions of the software, comes before the buckets.
+                activity = self.activities_collection.find_one({ Keys.ACTIVITY_ID_KEY: activity_id }, { Keys.DATABASE_ID_KEY: 0, stream_name: 1 })
+                if activity is not None and isinstance(activity.get(stream_name), list):
+                    values.extend(activity[stream_name])
+                last_sequence = 0
+            else:
+
+                # Only the buckets that have been written to since the cursor was issued, usually just the latest one.
+                query[Keys.ACTIVITY_BUCKET_LAST_SEQUENCE_KEY] = { "$gt": cursor }
+                projection[Keys.ACTIVITY_BUCKET_SEQUENCES_KEY] = 1
+                last_sequence = cursor
+
+            for bucket in self.activity_buckets_collection.find(query, projection, sort=[ (Keys.ACTIVITY_BUCKET_START_KEY, pymongo.ASCENDING) ]):
+                bucket_values = bucket[Keys.ACTIVITY_BUCKET_VALUES_KEY]
+                if cursor is None:
+                    values.extend(bucket_values)
+                else:
+                    # Values stored before writes were numbered don't have a sequence number, and come first.
+                    sequences = bucket.get(Keys.ACTIVITY_BUCKET_SEQUENCES_KEY, [])
+                    first_numbered = len(bucket_values) - len(sequences)
+                    for value, sequence in zip(bucket_values[first_numbered:], sequences):
+                        if sequence > cursor:
+                            values.append(value)
+                last_sequence = max(last_sequence, bucket.get(Keys.ACTIVITY_BUCKET_LAST_SEQUENCE_KEY, 0))
+
+            # New values can be spread over several buckets, in the order they arrived, so put them in time order.
+            sort_time_series(values)
+            return values, last_sequence
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None, cursor
+
+    def retrieve_activity_stream_end_cursor(self, activity_id, stream_name):
+        """Returns the cursor retrieve_activity_stream_since would return after reading the whole stream, without reading any of it."""
+        if activity_id is None:
+            raise Exception("Unexpected empty object: activity_id")
+        if not InputChecker.is_uuid(activity_id):
+            raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
+
+        try:
+            query = { Keys.ACTIVITY_ID_KEY: activity_id, Keys.ACTIVITY_BUCKET_STREAM_KEY: stream_name }
+            projection = { Keys.DATABASE_ID_KEY: 0, Keys.ACTIVITY_BUCKET_LAST_SEQUENCE_KEY: 1 }
+            bucket = self.activity_buckets_collection.find_one(query, projection, sort=[ (Keys.ACTIVITY_BUCKET_LAST_SEQUENCE_KEY, pymongo.DESCENDING) ])
+            if bucket is None:
+                return 0
+            return bucket.get(Keys.ACTIVITY_BUCKET_LAST_SEQUENCE_KEY, 0)
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def retrieve_activity_latest_values(self, activity_id, stream_names):
+        """Returns a dictionary that maps each of the stream names to the most recently written value, for streams that have any values."""
+        """Only the last value of each stream is transferred, rather than the entire activity."""
+        if activity_id is None:
+            raise Exception("Unexpected empty object: activity_id")
+        if not InputChecker.is_uuid(activity_id):
+            raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
+
+        try:
+            latest_values = {}
+
+            # Values stored inline, i.e. by older versions of the software.
+            projection = { Keys.DATABASE_ID_KEY: 0, Keys.ACTIVITY_ID_KEY: 1 }
+            for stream_name in stream_names:
+                projection[stream_name] = { "$slice": -1 }
+            activity = self.activities_collection.find_one({ Keys.ACTIVITY_ID_KEY: activity_id }, projection)
             if activity is not None:
-                location_list = []
+                for stream_name in stream_names:
+                    inline_values = activity.get(stream_name)
+                    if isinstance(inline_values, list) and len(inline_values) > 0:
+                        latest_values[stream_name] = inline_values[-1]
+
+            # Bucketed values are newer. Only the last value of the newest bucket of each stream comes back from the server.
+            pipeline = []
+            pipeline.append({ "$match": { Keys.ACTIVITY_ID_KEY: activity_id, Keys.ACTIVITY_BUCKET_STREAM_KEY: { "$in": stream_names } } })
+            pipeline.append({ "$sort": { Keys.ACTIVITY_BUCKET_STREAM_KEY: pymongo.ASCENDING, Keys.ACTIVITY_BUCKET_START_KEY: pymongo.DESCENDING } })
+            pipeline.append({ "$group": { Keys.DATABASE_ID_KEY: "$" + Keys.ACTIVITY_BUCKET_STREAM_KEY, Keys.ACTIVITY_BUCKET_VALUES_KEY: { "$first": { "$arrayElemAt": [ "$" + Keys.ACTIVITY_BUCKET_VALUES_KEY, -1 ] } } } })
+            for result in self.activity_buckets_collection.aggregate(pipeline):
+                latest_values[result[Keys.DATABASE_ID_KEY]] = result[Keys.ACTIVITY_BUCKET_VALUES_KEY]
+            return latest_values
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
 
-                # Get the existing list.
-                if Keys.ACTIVITY_LOCATIONS_KEY in activity:
-                    location_list = activity[Keys.ACTIVITY_LOCATIONS_KEY]
+    def delete_activity_buckets(self, activity_id, stream_name):
+        """Deletes the activity's bucketed data. If stream_name is None then every stream is deleted."""
+        query = { Keys.ACTIVITY_ID_KEY: activity_id }
+        if stream_name is not None:
+            query[Keys.ACTIVITY_BUCKET_STREAM_KEY] = stream_name
+        self.activity_buckets_collection.delete_many(query)
+        return True
+
+    def create_activity_locations(self, device_str, activity_id, locations):
+        """Adds several locations to the database. 'locations' is an array of arrays in the form [time, lat, lon, alt]."""
+        if device_str is None:
+            raise Exception("Unexpected empty object: device_str")
+        if activity_id is None:
+            raise Exception("Unexpected empty object: activity_id")
+        if not InputChecker.is_uuid(activity_id):
+            raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
+        if not locations:
+            raise Exception("Unexpected empty object: locations")
 
-                # Append the new locations.
-                for location in locations:
-                    value = { Keys.LOCATION_TIME_KEY: location[0], Keys.LOCATION_LAT_KEY: location[1], Keys.LOCATION_LON_KEY: location[2], Keys.LOCATION_ALT_KEY: location[3] }
-                    location_list.append(value)
+        try:
+            # Find the activity, creating it if it doesn't exist.
+            first_location = locations[0]
+            if not self.find_or_create_device_activity(device_str, activity_id, first_location[0]):
+                return False
 
-                # Make sure everything is in order.
-                location_list.sort(key=retrieve_time_from_location)
+            # Append the new locations.
+            location_values = []
+            for location in locations:
+                value = { Keys.LOCATION_TIME_KEY: location[0], Keys.LOCATION_LAT_KEY: location[1], Keys.LOCATION_LON_KEY: location[2], Keys.LOCATION_ALT_KEY: location[3] }
+                location_values.append([location[0], value])
 
-                # Save the changes.
-                activity[Keys.ACTIVITY_LOCATIONS_KEY] = location_list
-                return update_activities_collection(self, activity)
+            # Save the changes.
+            self.append_activity_buckets(activity_id, { Keys.ACTIVITY_LOCATIONS_KEY: location_values })
+            return self.update_activity_last_updated_time(activity_id, max(location[0] for location in locations))
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
@@ -1309,13 +2326,17 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
 
         try:
-            # Find the activity.
-            activity = self.activities_collection.find_one({ Keys.ACTIVITY_ID_KEY: activity_id })
+            # Find the activity, we only need the inline locations (if any).
+            activity = self.activities_collection.find_one({ Keys.ACTIVITY_ID_KEY: activity_id }, { Keys.DATABASE_ID_KEY: 0, Keys.ACTIVITY_ID_KEY: 1, Keys.ACTIVITY_LOCATIONS_KEY: 1 })
             if activity is None:
                 return None
 
+            # Reassemble any bucketed locations.
+            self.merge_activity_buckets(activity, [ Keys.ACTIVITY_LOCATIONS_KEY ])
+
             # If the activity was found and it has location data.
             if Keys.ACTIVITY_LOCATIONS_KEY in activity:
                 locations = activity[Keys.ACTIVITY_LOCATIONS_KEY]
@@ -1326,12 +2347,44 @@ class MongoDatabase(Database.Database):
             self.log_error(sys.exc_info()[0])
         return None
 
+    def retrieve_activity_streams(self, activity_id, stream_names):
+        """Returns a dictionary that maps each of the named streams (locations, sensor readings, etc.) to its values, leaving out"""
+        """any the activity doesn't have. Nothing else is read, so this is much cheaper than retrieving the whole activity."""
+        if activity_id is None:
+            raise Exception("Unexpected empty object: activity_id")
+        if not InputChecker.is_uuid(activity_id):
+            raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
+        if stream_names is None:
+            raise Exception("Unexpected empty object: stream_names")
+
+        try:
+            if len(stream_names) == 0:
+                return {}
+
+            # Find the activity, we only need the inline values (if any).
+            projection = { stream_name: 1 for stream_name in stream_names }
+            projection[Keys.DATABASE_ID_KEY] = 0
+            projection[Keys.ACTIVITY_ID_KEY] = 1
+            activity = self.activities_collection.find_one({ Keys.ACTIVITY_ID_KEY: activity_id }, projection)
+            if activity is None:
+                return None
+
+            # Reassemble any bucketed values.
+            self.merge_activity_buckets(activity, stream_names)
+            return { stream_name: activity[stream_name] for stream_name in stream_names if stream_name in activity }
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
     def create_activity_sensor_reading(self, activity_id, date_time, sensor_type, value):
         """Create method for a piece of sensor data, such as a heart rate or power meter reading."""
         if activity_id is None:
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception(" object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
         if date_time is None:
             raise Exception("Unexpected empty object: date_time")
         if sensor_type is None:
@@ -1340,24 +2393,14 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: value")
 
         try:
-            # Find the activity.
-            activity = self.activities_collection.find_one({ Keys.ACTIVITY_ID_KEY: activity_id })
-            if activity is None:
+            # Make sure the activity exists.
+            if self.activities_collection.count_documents({ Keys.ACTIVITY_ID_KEY: activity_id }, limit = 1) == 0:
                 return False
 
-            value_list = []
-
-            # Get the existing list.
-            if sensor_type in activity:
-                value_list = activity[sensor_type]
-
-            time_value_pair = { str(date_time): float(value) }
-            value_list.append(time_value_pair)
-            value_list.sort(key=retrieve_time_from_time_value_pair)
-
             # Save the changes.
-            activity[sensor_type] = value_list
-            return update_activities_collection(self, activity)
+            time_value_pair = { str(date_time): float(value) }
+            self.append_activity_buckets(activity_id, { sensor_type: [ [date_time, time_value_pair] ] })
+            return self.update_activity_last_updated_time(activity_id, None)
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
@@ -1369,32 +2412,25 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
         if sensor_type is None:
             raise Exception("Unexpected empty object: sensor_type")
         if values is None:
             raise Exception("Unexpected empty object: values")
 
         try:
-            # Find the activity.
-            activity = self.activities_collection.find_one({ Keys.ACTIVITY_ID_KEY: activity_id })
-            if activity is None:
+            # Make sure the activity exists.
+            if self.activities_collection.count_documents({ Keys.ACTIVITY_ID_KEY: activity_id }, limit = 1) == 0:
                 return False
 
-            value_list = []
-
-            # Get the existing list.
-            if sensor_type in activity:
-                value_list = activity[sensor_type]
-
+            time_value_pairs = []
             for value in values:
                 time_value_pair = { str(value[0]): float(value[1]) }
-                value_list.append(time_value_pair)
-
-            value_list.sort(key=retrieve_time_from_time_value_pair)
+                time_value_pairs.append([value[0], time_value_pair])
 
             # Save the changes.
-            activity[sensor_type] = value_list
-            return update_activities_collection(self, activity)
+            self.append_activity_buckets(activity_id, { sensor_type: time_value_pairs })
+            return self.update_activity_last_updated_time(activity_id, None)
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
@@ -1406,18 +2442,19 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
         if sensor_type is None:
             raise Exception("Unexpected empty object: sensor_type")
 
         try:
-            # Find the activity.
-            activity = self.activities_collection.find_one({ Keys.ACTIVITY_ID_KEY: activity_id })
-            if activity is None:
+            # Clear anything that's stored inline, including the readings that were downsampled for the charts.
+            new_values = { "$set": { sensor_type: [], Keys.ACTIVITY_LAST_UPDATED_KEY: time.time() }, "$unset": { Keys.ACTIVITY_DOWNSAMPLED_SENSORS_KEY + "." + sensor_type: "" } }
+            result = self.activities_collection.update_one({ Keys.ACTIVITY_ID_KEY: activity_id }, new_values)
+            if result.matched_count == 0:
                 return False
 
-            # Save the changes.
-            activity[sensor_type] = []
-            return update_activities_collection(self, activity)
+            # Clear anything that's stored in buckets.
+            return self.delete_activity_buckets(activity_id, sensor_type)
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
@@ -1429,6 +2466,7 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
         if event is None:
             raise Exception("Unexpected empty object: event")
 
@@ -1461,6 +2499,7 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
         if events is None:
             raise Exception("Unexpected empty object: events")
 
@@ -1486,12 +2525,70 @@ class MongoDatabase(Database.Database):
             self.log_error(sys.exc_info()[0])
         return False
 
+    def create_activity_streams(self, device_str, activity_id, locations, sensor_readings_dict, events):
+        """Adds a chunk of imported data, i.e. locations, sensor readings, and events, with one bulk write to the buckets and one update to the activity."""
+        """'locations' is an array of arrays in the form [time, lat, lon, alt], 'sensor_readings_dict' maps the sensor type to an array of arrays in the form [time, value]."""
+        if device_str is None:
+            raise Exception("Unexpected empty object: device_str")
+        if activity_id is None:
+            raise Exception("Unexpected empty object: activity_id")
+        if not InputChecker.is_uuid(activity_id):
+            raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
+        if sensor_readings_dict is None:
+            raise Exception("Unexpected empty object: sensor_readings_dict")
+
+        try:
+            # Find the activity, creating it if it doesn't exist and we have locations (same as create_activity_locations).
+            if locations:
+                if not self.find_or_create_device_activity(device_str, activity_id, locations[0][0]):
+                    return False
+            elif self.activities_collection.count_documents({ Keys.ACTIVITY_ID_KEY: activity_id }, limit = 1) == 0:
+                return False
+
+            streams = {}
+            end_time_ms = None
+
+            # Convert the locations to the stored form.
+            if locations:
+                location_values = []
+                for location in locations:
+                    value = { Keys.LOCATION_TIME_KEY: location[0], Keys.LOCATION_LAT_KEY: location[1], Keys.LOCATION_LON_KEY: location[2], Keys.LOCATION_ALT_KEY: location[3] }
+                    location_values.append([location[0], value])
+                streams[Keys.ACTIVITY_LOCATIONS_KEY] = location_values
+                end_time_ms = max(location[0] for location in locations)
+
+            # Convert the sensor readings to the stored form.
+            for sensor_type in sensor_readings_dict:
+                time_value_pairs = []
+                for value in sensor_readings_dict[sensor_type]:
+                    time_value_pairs.append([value[0], { str(value[0]): float(value[1]) }])
+                if time_value_pairs:
+                    streams[sensor_type] = time_value_pairs
+
+            # Save the time series data in a single round trip.
+            self.append_activity_buckets(activity_id, streams)
+
+            # Update the activity document, without rewriting it.
+            new_values = { "$set": { Keys.ACTIVITY_LAST_UPDATED_KEY: time.time() } }
+            if end_time_ms is not None:
+                new_values["$max"] = { Keys.ACTIVITY_END_TIME_KEY: int(end_time_ms / 1000) }
+            if events:
+                new_values["$push"] = { Keys.APP_EVENTS_KEY: { "$each": events } }
+            result = self.activities_collection.update_one({ Keys.ACTIVITY_ID_KEY: activity_id }, new_values)
+            return result.matched_count > 0
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
     def create_or_update_activity_metadata(self, activity_id, date_time, key, value, create_list):
         """Create method for a piece of metaadata. When dealing with a list, will append values."""
         if activity_id is None:
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
         if date_time is None and create_list:
             raise Exception("Unexpected empty object: date_time")
         if key is None:
@@ -1545,6 +2642,7 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
         if key is None:
             raise Exception("Unexpected empty object: key")
         if values is None:
@@ -1577,6 +2675,7 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
         if start_time_ms is None:
             raise Exception("Unexpected empty object: start_time_ms")
 
@@ -1603,6 +2702,7 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
         if sets is None:
             raise Exception("Unexpected empty object: sets")
 
@@ -1627,38 +2727,25 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
         if not accels:
             raise Exception("Unexpected empty object: accels")
 
         try:
-            # Find the activity.
-            activity = self.activities_collection.find_one({ Keys.ACTIVITY_ID_KEY: activity_id, Keys.ACTIVITY_DEVICE_STR_KEY: device_str })
-
-            # If the activity was not found then create it.
-            if activity is None:
-                first_accel = accels[0]
-                if self.create_activity(activity_id, "", first_accel[0] / 1000, device_str):
-                    activity = self.activities_collection.find_one({ Keys.ACTIVITY_ID_KEY: activity_id, Keys.ACTIVITY_DEVICE_STR_KEY: device_str })
-
-            # If the activity was found.
-            if activity is not None:
-                accel_list = []
-
-                # Get the existing list.
-                if Keys.APP_ACCELEROMETER_KEY in activity:
-                    accel_list = activity[Keys.APP_ACCELEROMETER_KEY]
-
-                for accel in accels:
+            # Find the activity, creating it if it doesn't exist.
+            first_accel = accels[0]
+            if not self.find_or_create_device_activity(device_str, activity_id, first_accel[0]):
+                return False
 
-                    # Make sure time values are monotonically increasing.
-                    if accel_list and int(accel_list[-1][Keys.ACCELEROMETER_TIME_KEY]) > accel[0]:
-                        self.log_error(MongoDatabase.create_activity_accelerometer_reading.__name__ + ": Received out-of-order time value.")
-                    else:
-                        value = { Keys.ACCELEROMETER_TIME_KEY: accel[0], Keys.ACCELEROMETER_AXIS_NAME_X: accel[1], Keys.ACCELEROMETER_AXIS_NAME_Y: accel[2], Keys.ACCELEROMETER_AXIS_NAME_Z: accel[3] }
-                        accel_list.append(value)
+            # Append the new readings. Out-of-order readings are put in order when the buckets are reassembled.
+            accel_values = []
+            for accel in accels:
+                value = { Keys.ACCELEROMETER_TIME_KEY: accel[0], Keys.ACCELEROMETER_AXIS_NAME_X: accel[1], Keys.ACCELEROMETER_AXIS_NAME_Y: accel[2], Keys.ACCELEROMETER_AXIS_NAME_Z: accel[3] }
+                accel_values.append([accel[0], value])
 
-                activity[Keys.APP_ACCELEROMETER_KEY] = accel_list
-                return update_activities_collection(self, activity)
+            # Save the changes.
+            self.append_activity_buckets(activity_id, { Keys.APP_ACCELEROMETER_KEY: accel_values })
+            return self.update_activity_last_updated_time(activity_id, max(accel[0] for accel in accels))
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
@@ -1674,6 +2761,7 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
         if summary_data is None:
             raise Exception("Unexpected empty object: summary_data")
 
@@ -1690,12 +2778,131 @@ class MongoDatabase(Database.Database):
             self.log_error(sys.exc_info()[0])
         return False
 
+    def create_activity_summaries(self, summaries):
+        """Create method for the summary data of several activities, in a single round trip. Takes a dictionary that maps the activity ID to its summary."""
+        """Only the summary is written, rather than the whole activity document."""
+        if summaries is None:
+            raise Exception("Unexpected empty object: summaries")
+
+        try:
+            now = time.time()
+            requests = []
+            for activity_id in summaries:
+                if not InputChecker.is_uuid(activity_id):
+                    raise Exception("Invalid object: activity_id " + str(activity_id))
+                new_values = { "$set": { Keys.ACTIVITY_SUMMARY_KEY: summaries[activity_id], Keys.ACTIVITY_LAST_UPDATED_KEY: now } }
+                requests.append(pymongo.UpdateOne({ Keys.ACTIVITY_ID_KEY: normalize_activity_id(activity_id) }, new_values))
+            if requests:
+                self.activities_collection.bulk_write(requests, ordered=False)
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def create_activity_simplified_data(self, simplified):
+        """Create method for the simplified tracks and downsampled sensor readings of one or more activities, in a single round trip."""
+        """Takes a dictionary that maps the activity ID to a dictionary of the keys to store, as returned by TrackSimplifier.create_simplified_data."""
+        if simplified is None:
+            raise Exception("Unexpected empty object: simplified")
+
+        try:
+            requests = []
+            for activity_id in simplified:
+                if not InputChecker.is_uuid(activity_id):
+                    raise Exception("Invalid object: activity_id " + str(activity_id))
+                requests.append(pymongo.UpdateOne({ Keys.ACTIVITY_ID_KEY: normalize_activity_id(activity_id) }, { "$set": simplified[activity_id] }))
+            if requests:
+                self.activities_collection.bulk_write(requests, ordered=False)
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def retrieve_activity_simplified_data(self, activity_id, key, names):
+        """Returns a dictionary of the named simplified tracks (key is ACTIVITY_SIMPLIFIED_TRACKS_KEY) or downsampled sensor readings"""
+        """(key is ACTIVITY_DOWNSAMPLED_SENSORS_KEY), leaving out any that weren't stored. Returns None if nothing was stored."""
+        if activity_id is None:
+            raise Exception("Unexpected empty object: activity_id")
+        if not InputChecker.is_uuid(activity_id):
+            raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
+        if key is None:
+            raise Exception("Unexpected empty object: key")
+        if names is None:
+            raise Exception("Unexpected empty object: names")
+
+        try:
+            # Only read the ones we were asked for.
+            projection = { key + "." + name: 1 for name in names }
+            projection[Keys.DATABASE_ID_KEY] = 0
+            projection[Keys.ACTIVITY_ID_KEY] = 1
+            activity = self.activities_collection.find_one({ Keys.ACTIVITY_ID_KEY: activity_id }, projection)
+            if activity is not None and key in activity:
+                return activity[key]
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def update_activity_rollup_contributions(self, contributions):
+        """Records what each activity has added to its owner's training rollups, in a single round trip. Takes a dictionary that maps"""
+        """the activity ID to its contribution, or to None if the activity no longer contributes anything."""
+        if contributions is None:
+            raise Exception("Unexpected empty object: contributions")
+
+        try:
+            requests = []
+            for activity_id in contributions:
+                if not InputChecker.is_uuid(activity_id):
+                    raise Exception("Invalid object: activity_id " + str(activity_id))
+                if contributions[activity_id] is None:
+                    new_values = { "$unset": { Keys.ACTIVITY_ROLLUP_CONTRIBUTION_KEY: "" } }
+                else:
+                    new_values = { "$set": { Keys.ACTIVITY_ROLLUP_CONTRIBUTION_KEY: contributions[activity_id] } }
+                requests.append(pymongo.UpdateOne({ Keys.ACTIVITY_ID_KEY: normalize_activity_id(activity_id) }, new_values))
+            if requests:
+                self.activities_collection.bulk_write(requests, ordered=False)
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def swap_activity_rollup_contribution(self, activity_id, old_contribution, new_contribution):
+        """Replaces what the activity has added to its owner's training rollups, but only if it is still the old contribution (None if it has none)."""
+        """Returns TRUE if it was replaced, FALSE if something else changed it first."""
+        if activity_id is None:
+            raise Exception("Unexpected empty object: activity_id")
+        if not InputChecker.is_uuid(activity_id):
+            raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
+
+        try:
+            query = { Keys.ACTIVITY_ID_KEY: activity_id }
+            if old_contribution is None:
+                query[Keys.ACTIVITY_ROLLUP_CONTRIBUTION_KEY] = { "$exists": False }
+            else:
+                query[Keys.ACTIVITY_ROLLUP_CONTRIBUTION_KEY] = old_contribution
+            if new_contribution is None:
+                new_values = { "$unset": { Keys.ACTIVITY_ROLLUP_CONTRIBUTION_KEY: "" } }
+            else:
+                new_values = { "$set": { Keys.ACTIVITY_ROLLUP_CONTRIBUTION_KEY: new_contribution } }
+            result = self.activities_collection.update_one(query, new_values)
+            return result.matched_count > 0
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
     def delete_activity_summary(self, activity_id):
         """Delete method for activity summary data. Summary data is data computed from the raw data."""
         if activity_id is None:
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
 
         try:
             # Find the activity.
@@ -1703,8 +2910,12 @@ class MongoDatabase(Database.Database):
             if activity is None:
                 return False
 
-            if Keys.ACTIVITY_SUMMARY_KEY in activity:
-                activity[Keys.ACTIVITY_SUMMARY_KEY] = {}
+            # The simplified tracks and downsampled sensor readings were computed along with the summary, so they go too.
+            if Keys.ACTIVITY_SUMMARY_KEY in activity or Keys.ACTIVITY_SIMPLIFIED_TRACKS_KEY in activity or Keys.ACTIVITY_DOWNSAMPLED_SENSORS_KEY in activity:
+                if Keys.ACTIVITY_SUMMARY_KEY in activity:
+                    activity[Keys.ACTIVITY_SUMMARY_KEY] = {}
+                activity.pop(Keys.ACTIVITY_SIMPLIFIED_TRACKS_KEY, None)
+                activity.pop(Keys.ACTIVITY_DOWNSAMPLED_SENSORS_KEY, None)
                 return update_activities_collection(self, activity)
         except:
             self.log_error(traceback.format_exc())
@@ -1721,6 +2932,7 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
         if tag is None:
             raise Exception("Unexpected empty object: tag")
 
@@ -1762,6 +2974,7 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
         if tags is None:
             raise Exception("Unexpected empty object: tags")
 
@@ -1806,6 +3019,7 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
         if commenter_id is None:
             raise Exception("Unexpected empty object: commenter_id")
         if comment is None:
@@ -1842,6 +3056,7 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
         if photo_hash is None:
             raise Exception("Unexpected empty object: photo_hash")
 
@@ -1874,6 +3089,7 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity_id")
         if not InputChecker.is_uuid(activity_id):
             raise Exception("Invalid object: activity_id " + str(activity_id))
+        activity_id = normalize_activity_id(activity_id)
         if photo_id is None:
             raise Exception("Unexpected empty object: photo_id")
 
@@ -1939,7 +3155,7 @@ class MongoDatabase(Database.Database):
                 # Update and save the document.
                 workouts_doc[Keys.WORKOUT_LIST_KEY] = workouts_list
                 workouts_doc[Keys.WORKOUT_LAST_SCHEDULED_WORKOUT_TIME_KEY] = last_scheduled_workout
-                return update_collection(self.workouts_collection, workouts_doc)
+                return self.update_workouts_doc(workouts_doc)
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
@@ -2064,7 +3280,7 @@ class MongoDatabase(Database.Database):
 
                 # Update and save the document.
                 workouts_doc[Keys.WORKOUT_LIST_KEY] = [ workout_obj.to_dict() for workout_obj in workout_objs ]
-                return update_collection(self.workouts_collection, workouts_doc)
+                return self.update_workouts_doc(workouts_doc)
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
@@ -2086,7 +3302,7 @@ class MongoDatabase(Database.Database):
                 workouts_list = workouts_doc[Keys.WORKOUT_LIST_KEY]
                 new_list = [i for i in workouts_list if not (i[Keys.WORKOUT_ID_KEY] == workout_id)]
                 workouts_doc[Keys.WORKOUT_LIST_KEY] = new_list
-                return update_collection(self.workouts_collection, workouts_doc)
+                return self.update_workouts_doc(workouts_doc)
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
@@ -2104,12 +3320,48 @@ class MongoDatabase(Database.Database):
             # If the workouts document was found.
             if workouts_doc is not None and Keys.WORKOUT_LIST_KEY in workouts_doc:
                 workouts_doc[Keys.WORKOUT_LIST_KEY] = []
-                return update_collection(self.workouts_collection, workouts_doc)
+                return self.update_workouts_doc(workouts_doc)
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
         return False
 
+    def update_workouts_doc(self, workouts_doc):
+        """Saves the user's workouts document with a new plan version, so calendar feeds built from the old version are no longer used."""
+        workouts_doc[Keys.WORKOUT_PLAN_VERSION_KEY] = str(uuid.uuid4())
+        workouts_doc[Keys.WORKOUT_PLAN_LAST_MODIFIED_KEY] = int(time.time())
+        result = update_collection(self.workouts_collection, workouts_doc)
+        if Keys.WORKOUT_PLAN_CALENDAR_ID_KEY in workouts_doc:
+            Cache.invalidate(PLAN_VERSIONS_CACHE_NAME, workouts_doc[Keys.WORKOUT_PLAN_CALENDAR_ID_KEY])
+        return result
+
+    def retrieve_planned_workouts_version_by_calendar_id(self, calendar_id):
+        """Returns a tuple of the plan version and last modified time (or None) for the calendar with the specified ID, or (None, None) if there is no such calendar."""
+        """Calendar clients poll often, so this is cached and only reads the database after the plan changes."""
+        if calendar_id is None:
+            raise Exception("Unexpected empty object: calendar_id")
+
+        try:
+            Cache.process_invalidations()
+            found, version = g_plan_versions_cache.get(calendar_id)
+            if found:
+                return version
+            generation = g_plan_versions_cache.current_generation()
+
+            # Find the user's document with the specified calendar ID, without the workouts themselves.
+            workouts_doc = self.workouts_collection.find_one({ Keys.WORKOUT_PLAN_CALENDAR_ID_KEY: calendar_id }, { Keys.WORKOUT_PLAN_VERSION_KEY: 1, Keys.WORKOUT_PLAN_LAST_MODIFIED_KEY: 1 })
+            if workouts_doc is None:
+                return None, None
+
+            # Plans that haven't changed since versions were added will get one the next time they change.
+            version = (workouts_doc.get(Keys.WORKOUT_PLAN_VERSION_KEY, LEGACY_PLAN_VERSION), workouts_doc.get(Keys.WORKOUT_PLAN_LAST_MODIFIED_KEY))
+            g_plan_versions_cache.put(calendar_id, version, generation=generation)
+            return version
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None, None
+
     def retrieve_users_without_scheduled_workouts(self):
         """Returns a list of user IDs for users who have workout plans that need to be re-run."""
         try:
@@ -2684,8 +3936,8 @@ class MongoDatabase(Database.Database):
             self.log_error(sys.exc_info()[0])
         return []
 
-    def update_deferred_task(self, user_id, internal_task_id, activity_id, status):
-        """Updated method for deferred task status."""
+    def update_deferred_task(self, user_id, internal_task_id, activity_id, status, details=None):
+        """Updated method for deferred task status. Long running tasks can also replace the task's details, i.e. to report their progress."""
         if user_id is None:
             raise Exception("Unexpected empty object: user_id")
         if internal_task_id is None:
@@ -2707,8 +3959,12 @@ class MongoDatabase(Database.Database):
                 # Find and update the record.
                 for task in user_tasks[Keys.TASKS_KEY]:
                     if Keys.TASK_INTERNAL_ID_KEY in task and task[Keys.TASK_INTERNAL_ID_KEY] == internal_task_id_str:
+                        if activity_id is not None:
+                            activity_id = normalize_activity_id(activity_id)
                         task[Keys.TASK_ACTIVITY_ID_KEY] = activity_id
                         task[Keys.TASK_STATUS_KEY] = status
+                        if details is not None:
+                            task[Keys.TASK_DETAILS_KEY] = details
                         break
 
                 # Update the database.
@@ -2745,6 +4001,196 @@ class MongoDatabase(Database.Database):
             self.log_error(sys.exc_info()[0])
         return False
 
+    #
+    # Batch job methods
+    #
+
+    def acquire_batch_job(self, job_name, owner, lease_secs):
+        """Takes ownership of the named job for the given number of seconds, creating it if it doesn't exist. Returns the job's"""
+        """checkpoint document, or None if another worker holds the job. A job whose worker died is taken over once its lease expires."""
+        """The owner token is stored with the job, so a worker whose lease was taken over can no longer change it."""
+        if job_name is None:
+            raise Exception("Unexpected empty object: job_name")
+        if owner is None:
+            raise Exception("Unexpected empty object: owner")
+        if lease_secs is None or lease_secs <= 0:
+            raise Exception("Invalid object: lease_secs")
+
+        # If another worker holds the lease then the filter won't match, the upsert will try to insert a second document
+        # for the same job, and the unique index will reject it.
+        now = time.time()
+        query = { Keys.BATCH_JOB_NAME_KEY: job_name, Keys.BATCH_JOB_LEASE_EXPIRY_KEY: { "$lt": now } }
+        update = { "$set": { Keys.BATCH_JOB_OWNER_KEY: owner, Keys.BATCH_JOB_LEASE_EXPIRY_KEY: now + lease_secs }, \
+            "$setOnInsert": { Keys.BATCH_JOB_CHECKPOINT_KEY: None, Keys.BATCH_JOB_NUM_PROCESSED_KEY: 0, Keys.BATCH_JOB_NUM_FAILED_KEY: 0, Keys.BATCH_JOB_USERS_KEY: [] } }
+        try:
+            return self.batch_jobs_collection.find_one_and_update(query, update, projection={ Keys.DATABASE_ID_KEY: 0 }, upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+        except pymongo.errors.DuplicateKeyError:
+            pass
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def update_batch_job(self, job_name, owner, checkpoint, num_processed, num_failed, user_ids, lease_secs):
+        """Records the job's progress and extends its lease. The users are added to the set of users whose records need to be rebuilt."""
+        """Returns FALSE if the job is no longer held by the given owner, i.e. its lease expired and another worker took it over."""
+        if job_name is None:
+            raise Exception("Unexpected empty object: job_name")
+        if owner is None:
+            raise Exception("Unexpected empty object: owner")
+        if user_ids is None:
+            raise Exception("Unexpected empty object: user_ids")
+
+        try:
+            update = { "$set": { Keys.BATCH_JOB_CHECKPOINT_KEY: checkpoint, Keys.BATCH_JOB_NUM_PROCESSED_KEY: num_processed, Keys.BATCH_JOB_NUM_FAILED_KEY: num_failed, \
+                Keys.BATCH_JOB_LEASE_EXPIRY_KEY: time.time() + lease_secs }, "$addToSet": { Keys.BATCH_JOB_USERS_KEY: { "$each": list(user_ids) } } }
+            result = self.batch_jobs_collection.update_one({ Keys.BATCH_JOB_NAME_KEY: job_name, Keys.BATCH_JOB_OWNER_KEY: owner }, update)
+            return result.matched_count > 0
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def delete_batch_job(self, job_name, owner):
+        """Removes a finished job, so the next one with the same name starts from the beginning. Returns FALSE if the job is no longer held by the given owner."""
+        if job_name is None:
+            raise Exception("Unexpected empty object: job_name")
+        if owner is None:
+            raise Exception("Unexpected empty object: owner")
+
+        try:
+            result = self.batch_jobs_collection.delete_one({ Keys.BATCH_JOB_NAME_KEY: job_name, Keys.BATCH_JOB_OWNER_KEY: owner })
+            return result.deleted_count > 0
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    #
+    # Training rollup methods
+    #
+
+    def update_training_rollups(self, user_id, increments):
+        """Adds to the user's rollups, creating any that don't exist yet, in a single round trip. Takes a dictionary that maps"""
+        """(period, period start) to a dictionary of (dotted) field names to the amount to add, which may be negative."""
+        if user_id is None:
+            raise Exception("Unexpected empty object: user_id")
+        if increments is None:
+            raise Exception("Unexpected empty object: increments")
+
+        try:
+            user_id_str = str(user_id)
+            requests = []
+            for (period, period_start), fields in increments.items():
+                query = { Keys.USER_ID_KEY: user_id_str, Keys.ROLLUP_PERIOD_KEY: period, Keys.ROLLUP_PERIOD_START_KEY: period_start }
+                requests.append(pymongo.UpdateOne(query, { "$inc": fields }, upsert=True))
+            if requests:
+                self.rollups_collection.bulk_write(requests, ordered=False)
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def retrieve_training_rollups(self, user_id, period, start_time, end_time):
+        """Returns the user's rollups for the given period length, in order, for periods that start at or after the start time and before"""
+        """the end time. Either time may be None, for no bound."""
+        if user_id is None:
+            raise Exception("Unexpected empty object: user_id")
+        if period is None:
+            raise Exception("Unexpected empty object: period")
+
+        try:
+            query = { Keys.USER_ID_KEY: str(user_id), Keys.ROLLUP_PERIOD_KEY: period }
+            bounds = {}
+            if start_time is not None:
+                bounds["$gte"] = start_time
+            if end_time is not None:
+                bounds["$lt"] = end_time
+            if bounds:
+                query[Keys.ROLLUP_PERIOD_START_KEY] = bounds
+            projection = { Keys.DATABASE_ID_KEY: 0, Keys.USER_ID_KEY: 0 }
+            return list(self.rollups_collection.find(query, projection, sort=[ (Keys.ROLLUP_PERIOD_START_KEY, pymongo.ASCENDING) ]))
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return []
+
+    def delete_training_rollups(self, user_id):
+        """Delete method for all of the user's rollups, i.e. before rebuilding them."""
+        if user_id is None:
+            raise Exception("Unexpected empty object: user_id")
+
+        try:
+            self.rollups_collection.delete_many({ Keys.USER_ID_KEY: str(user_id) })
+            return True
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    #
+    # Blob methods
+    #
+
+    def create_blob(self, file_data):
+        """Adds a reference to the blob with the given contents, storing the contents if they aren't already stored. Returns the blob's digest."""
+        """Each call must be matched by a call to release_blob once the reference is no longer needed."""
+        if file_data is None:
+            raise Exception("Unexpected empty object: file_data")
+
+        digest = BlobStore.compute_digest(file_data)
+
+        # Taking the reference first means a blob that's being released can't be deleted out from under us, since the release
+        # only deletes blobs that have no references. If the release deleted it first then this creates a new one.
+        update = { "$inc": { Keys.BLOB_REFERENCES_KEY: 1 }, "$setOnInsert": { Keys.BLOB_SIZE_KEY: len(file_data) } }
+        try:
+            blob = self.blobs_collection.find_one_and_update({ Keys.BLOB_DIGEST_KEY: digest }, update, upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+        except pymongo.errors.DuplicateKeyError:
+            # Someone else inserted the same blob at the same time, so there's a document to update now.
+            blob = self.blobs_collection.find_one_and_update({ Keys.BLOB_DIGEST_KEY: digest }, update, upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+        if Keys.BLOB_NAME_KEY in blob:
+            return digest
+
+        # The contents haven't been stored yet. If someone else is storing the same contents at the same time then whichever of
+        # us finishes first is kept, and the other copy is deleted.
+        try:
+            name = BlobStore.create_blob_name(digest)
+            stored_size = self.blob_store.write(name, BlobStore.compress_chunks(file_data, self.blob_compression))
+            query = { Keys.DATABASE_ID_KEY: blob[Keys.DATABASE_ID_KEY], Keys.BLOB_NAME_KEY: { "$exists": False } }
+            new_values = { "$set": { Keys.BLOB_NAME_KEY: name, Keys.BLOB_COMPRESSION_KEY: self.blob_compression, Keys.BLOB_STORED_SIZE_KEY: stored_size } }
+            if self.blobs_collection.update_one(query, new_values).matched_count == 0:
+                self.blob_store.delete(name)
+        except:
+            self.release_blob(digest)
+            raise
+        return digest
+
+    def open_blob(self, digest):
+        """Returns a file-like object for reading the blob's uncompressed contents, or None if there is no such blob."""
+        if digest is None:
+            raise Exception("Unexpected empty object: digest")
+
+        blob = self.blobs_collection.find_one({ Keys.BLOB_DIGEST_KEY: digest })
+        if blob is None or Keys.BLOB_NAME_KEY not in blob:
+            return None
+        stream = self.blob_store.open(blob[Keys.BLOB_NAME_KEY])
+        if stream is None:
+            return None
+        return BlobStore.open_decompressed(stream, blob[Keys.BLOB_COMPRESSION_KEY])
+
+    def release_blob(self, digest):
+        """Removes a reference added by create_blob, deleting the blob once nothing refers to it."""
+        if digest is None:
+            raise Exception("Unexpected empty object: digest")
+
+        self.blobs_collection.update_one({ Keys.BLOB_DIGEST_KEY: digest }, { "$inc": { Keys.BLOB_REFERENCES_KEY: -1 } })
+
+        # Only delete it if nothing took a new reference in the meantime.
+        blob = self.blobs_collection.find_one_and_delete({ Keys.BLOB_DIGEST_KEY: digest, Keys.BLOB_REFERENCES_KEY: { "$lte": 0 } })
+        if blob is not None and Keys.BLOB_NAME_KEY in blob:
+            self.blob_store.delete(blob[Keys.BLOB_NAME_KEY])
+
     #
     # Uploaded file methods
     #
@@ -2757,8 +4203,101 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: file_data")
 
         try:
-            post = { Keys.ACTIVITY_ID_KEY: activity_id, Keys.UPLOADED_FILE_DATA_KEY: bytes(file_data) }
-            return insert_into_collection(self.uploads_collection, post)
+            digest = self.create_blob(file_data)
+            post = { Keys.ACTIVITY_ID_KEY: normalize_activity_id(activity_id), Keys.UPLOADED_FILE_DIGEST_KEY: digest }
+            if insert_into_collection(self.uploads_collection, post):
+                return True
+            self.release_blob(digest)
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def create_pending_uploaded_file(self, file_data):
+        """Create method for an uploaded file that has not yet been imported, and so isn't associated with an activity. Returns the ID of the new document."""
+        if file_data is None:
+            raise Exception("Unexpected empty object: file_data")
+
+        try:
+            digest = self.create_blob(file_data)
+            post = { Keys.UPLOADED_FILE_DIGEST_KEY: digest }
+            try:
+                if int(pymongo.__version__[0]) < 4:
+                    return str(self.uploads_collection.insert(post))
+                return str(self.uploads_collection.insert_one(post).inserted_id)
+            except:
+                self.release_blob(digest)
+                raise
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def open_pending_uploaded_file(self, uploaded_file_id):
+        """Returns a file-like object for reading the contents of an uploaded file, specified by the ID returned from create_pending_uploaded_file."""
+        """The contents are read from the blob store as they're needed, rather than all at once. Returns None if the file wasn't found."""
+        if uploaded_file_id is None:
+            raise Exception("Unexpected empty object: uploaded_file_id")
+        if not InputChecker.is_hex_str(uploaded_file_id):
+            raise Exception("Invalid object: uploaded_file_id " + str(uploaded_file_id))
+
+        try:
+            upload = self.uploads_collection.find_one({ Keys.DATABASE_ID_KEY: ObjectId(uploaded_file_id) })
+            if upload is not None:
+                if Keys.UPLOADED_FILE_DIGEST_KEY in upload:
+                    return self.open_blob(upload[Keys.UPLOADED_FILE_DIGEST_KEY])
+
+                # Files uploaded before the blob store was added have their contents in the upload document.
+                if Keys.UPLOADED_FILE_DATA_KEY in upload:
+                    return io.BytesIO(upload[Keys.UPLOADED_FILE_DATA_KEY])
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def retrieve_pending_uploaded_file(self, uploaded_file_id):
+        """Retrieve method for the contents of an uploaded file, specified by the ID returned from create_pending_uploaded_file."""
+        stream = self.open_pending_uploaded_file(uploaded_file_id)
+        if stream is None:
+            return None
+
+        try:
+            with stream:
+                return stream.read()
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return None
+
+    def attach_uploaded_file_to_activity(self, uploaded_file_id, activity_id):
+        """Update method for associating an uploaded file with the activity that was imported from it."""
+        if uploaded_file_id is None:
+            raise Exception("Unexpected empty object: uploaded_file_id")
+        if not InputChecker.is_hex_str(uploaded_file_id):
+            raise Exception("Invalid object: uploaded_file_id " + str(uploaded_file_id))
+        if activity_id is None:
+            raise Exception("Unexpected empty object: activity_id")
+
+        try:
+            result = self.uploads_collection.update_one({ Keys.DATABASE_ID_KEY: ObjectId(uploaded_file_id) }, { "$set": { Keys.ACTIVITY_ID_KEY: normalize_activity_id(activity_id) } })
+            return result.matched_count > 0
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+        return False
+
+    def delete_pending_uploaded_file(self, uploaded_file_id):
+        """Delete method for an uploaded file, specified by the ID returned from create_pending_uploaded_file."""
+        if uploaded_file_id is None:
+            raise Exception("Unexpected empty object: uploaded_file_id")
+        if not InputChecker.is_hex_str(uploaded_file_id):
+            raise Exception("Invalid object: uploaded_file_id " + str(uploaded_file_id))
+
+        try:
+            upload = self.uploads_collection.find_one_and_delete({ Keys.DATABASE_ID_KEY: ObjectId(uploaded_file_id) }, { Keys.UPLOADED_FILE_DIGEST_KEY: 1 })
+            if upload is not None and Keys.UPLOADED_FILE_DIGEST_KEY in upload:
+                self.release_blob(upload[Keys.UPLOADED_FILE_DIGEST_KEY])
+            return True
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
@@ -2770,9 +4309,10 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: activity_id")
 
         try:
-            deleted_result = self.uploads_collection.delete_one({ Keys.ACTIVITY_ID_KEY: str(activity_id) })
-            if deleted_result is not None:
-                return True
+            upload = self.uploads_collection.find_one_and_delete({ Keys.ACTIVITY_ID_KEY: normalize_activity_id(activity_id) }, { Keys.UPLOADED_FILE_DIGEST_KEY: 1 })
+            if upload is not None and Keys.UPLOADED_FILE_DIGEST_KEY in upload:
+                self.release_blob(upload[Keys.UPLOADED_FILE_DIGEST_KEY])
+            return True
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
@@ -2879,9 +4419,19 @@ class MongoDatabase(Database.Database):
             raise Exception("Unexpected empty object: token")
 
         try:
+            # Is it cached?
+            Cache.process_invalidations()
+            found, cached_session = g_sessions_cache.get(token)
+            if found:
+                return cached_session
+            generation = g_sessions_cache.current_generation()
+
+            # Cache it until it expires, at which point the session manager will delete it.
             session_data = self.sessions_collection.find_one({ Keys.SESSION_TOKEN_KEY: token })
             if session_data is not None:
-                return session_data[Keys.SESSION_USER_KEY], session_data[Keys.SESSION_EXPIRY_KEY]
+                result = session_data[Keys.SESSION_USER_KEY], session_data[Keys.SESSION_EXPIRY_KEY]
+                g_sessions_cache.put(token, result, ttl_secs=result[1] - time.time(), generation=generation)
+                return result
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
@@ -2894,6 +4444,7 @@ class MongoDatabase(Database.Database):
 
         try:
             deleted_result = self.sessions_collection.delete_one({ Keys.SESSION_TOKEN_KEY: token })
+            Cache.invalidate(SESSIONS_CACHE_NAME, token)
             if deleted_result is not None:
                 return True
         except:
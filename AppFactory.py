@@ -23,12 +23,12 @@
 # SOFTWARE.
 
 import logging
-import mako
 
 import App
 import DataMgr
 import AnalysisScheduler
 import ImportScheduler
+import Perf
 import SessionMgr
 import UserMgr
 
@@ -64,10 +64,6 @@ def create_cherrypy(config, root_dir, session_mgr):
         root_url = root_url + ":" + str(hostport)
     print("Root URL is " + root_url)
 
-    # Configure the template engine.
-    mako.collection_size = 100
-    mako.directories = "templates"
-
     # Create all the objects that actually implement the functionality.
     user_mgr = UserMgr.UserMgr(config=config, session_mgr=session_mgr)
     analysis_scheduler = AnalysisScheduler.AnalysisScheduler()
@@ -83,6 +79,9 @@ def create_cherrypy(config, root_dir, session_mgr):
     markdown_logger = logging.getLogger("MARKDOWN")
     markdown_logger.setLevel(logging.ERROR)
 
+    # Share the latency histograms with the other processes, if there are any.
+    Perf.configure(config.get_metrics_dir())
+
     # The direcory for session objects.
     session_dir = session_mgr.session_dir(root_dir)
 
@@ -179,10 +178,6 @@ def create_flask(config, root_dir):
         root_url = root_url + ":" + str(hostport)
     print("Root URL is " + root_url)
 
-    # Configure the template engine.
-    mako.collection_size = 100
-    mako.directories = "templates"
-
     # Create all the objects that actually implement the functionality.
     session_mgr = SessionMgr.FlaskSessionMgr(config)
     user_mgr = UserMgr.UserMgr(config=config, session_mgr=session_mgr)
@@ -199,4 +194,7 @@ def create_flask(config, root_dir):
     markdown_logger = logging.getLogger("MARKDOWN")
     markdown_logger.setLevel(logging.ERROR)
 
+    # Share the latency histograms with the other processes, if there are any.
+    Perf.configure(config.get_metrics_dir())
+
     return backend
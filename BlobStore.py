@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2017 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Content addressed storage for uploaded files. Contents are compressed as they're written and decompressed as they're read, so"""
+"""a file never has to be held in memory in its compressed form, and readers can copy it somewhere else a piece at a time."""
+
+import gzip
+import hashlib
+import os
+import uuid
+import zlib
+import Keys
+
+try:
+    import zstandard
+except ModuleNotFoundError:
+    zstandard = None
+
+CHUNK_SIZE = 1024 * 1024 # Number of bytes compressed, written, or read at a time
+GZIP_LEVEL = 6 # Same as the gzip command line default
+ZSTD_LEVEL = 3 # Same as the zstd command line default, which compresses better and faster than gzip level 6
+
+def compute_digest(data):
+    """Returns the key that the contents are stored under."""
+    return hashlib.sha256(data).hexdigest()
+
+def create_blob_name(digest):
+    """Returns a new name for storing contents with the given digest. Names are unique to each write so that contents that are"""
+    """deleted and then uploaded again can't be mistaken for the copy that was deleted."""
+    return digest + "." + uuid.uuid4().hex
+
+def select_compression(requested):
+    """Returns the compression to use for the requested compression, falling back to gzip if the zstandard module isn't installed."""
+    if requested == Keys.BLOB_COMPRESSION_ZSTD and zstandard is None:
+        return Keys.BLOB_COMPRESSION_GZIP
+    if requested not in [ Keys.BLOB_COMPRESSION_NONE, Keys.BLOB_COMPRESSION_GZIP, Keys.BLOB_COMPRESSION_ZSTD ]:
+        raise Exception("Unknown compression: " + str(requested))
+    return requested
+
+def compress_chunks(data, compression):
+    """Generates the compressed contents, a chunk at a time."""
+    if compression == Keys.BLOB_COMPRESSION_NONE:
+        for offset in range(0, len(data), CHUNK_SIZE):
+            yield bytes(data[offset:offset + CHUNK_SIZE])
+        return
+
+    if compression == Keys.BLOB_COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise Exception("The zstandard module is not installed.")
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    elif compression == Keys.BLOB_COMPRESSION_GZIP:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS) # Adding 16 to the window size writes a gzip header
+    else:
+        raise Exception("Unknown compression: " + str(compression))
+
+    view = memoryview(data)
+    for offset in range(0, len(view), CHUNK_SIZE):
+        chunk = compressor.compress(view[offset:offset + CHUNK_SIZE])
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+class GzipReader(gzip.GzipFile):
+    """A GzipFile doesn't close a stream it was given when it's closed, this does."""
+
+    def __init__(self, stream):
+        self.compressed_stream = stream
+        super(GzipReader, self).__init__(fileobj=stream, mode="rb")
+
+    def close(self):
+        try:
+            super(GzipReader, self).close()
+        finally:
+            self.compressed_stream.close()
+
+def open_decompressed(stream, compression):
+    """Wraps a stream of compressed contents in a file-like object that returns the uncompressed contents."""
+    if compression == Keys.BLOB_COMPRESSION_NONE:
+        return stream
+    if compression == Keys.BLOB_COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise Exception("The zstandard module is not installed.")
+        return zstandard.ZstdDecompressor().stream_reader(stream, read_size=CHUNK_SIZE, closefd=True)
+    if compression == Keys.BLOB_COMPRESSION_GZIP:
+        return GzipReader(stream)
+    raise Exception("Unknown compression: " + str(compression))
+
+class BlobStore(object):
+    """Base class for the places that blobs can be kept. Blobs are written once and never modified, so stores only need to"""
+    """be able to write, read, and delete them."""
+
+    def __init__(self):
+        super(BlobStore, self).__init__()
+
+    def write(self, name, chunks):
+        """Pure virtual method for storing the chunks, in order, under the given name. Returns the number of bytes stored."""
+        return 0
+
+    def open(self, name):
+        """Pure virtual method that returns a file-like object for reading the stored bytes, or None if nothing is stored under the name."""
+        return None
+
+    def delete(self, name):
+        """Pure virtual method for removing whatever is stored under the name, if anything."""
+        pass
+
+class DirectoryBlobStore(BlobStore):
+    """Keeps each blob in its own file. Files are spread across subdirectories so that no one directory gets too big."""
+
+    def __init__(self, root_dir):
+        if root_dir is None or len(root_dir) == 0:
+            raise Exception("Bad parameter.")
+        self.root_dir = os.path.normpath(os.path.expanduser(root_dir))
+        super(DirectoryBlobStore, self).__init__()
+
+    def path_for_name(self, name):
+        """Returns the name of the file that holds the blob."""
+        if len(name) < 4 or os.path.basename(name) != name or name.startswith("."):
+            raise Exception("Bad parameter.")
+        return os.path.join(self.root_dir, name[0:2], name[2:4], name)
+
+    def write(self, name, chunks):
+        """Stores the chunks, in order, under the given name. Returns the number of bytes stored."""
+        """The file is written under a temporary name and then renamed, so readers never see part of a blob."""
+        path = self.path_for_name(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + ".tmp"
+        num_bytes = 0
+        try:
+            with open(temp_path, "wb") as blob_file:
+                for chunk in chunks:
+                    blob_file.write(chunk)
+                    num_bytes = num_bytes + len(chunk)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return num_bytes
+
+    def open(self, name):
+        """Returns a file-like object for reading the stored bytes, or None if nothing is stored under the name."""
+        try:
+            return open(self.path_for_name(name), "rb")
+        except FileNotFoundError:
+            pass
+        return None
+
+    def delete(self, name):
+        """Removes whatever is stored under the name, if anything."""
+        try:
+            os.remove(self.path_for_name(name))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2017 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""In-process caches, with least recently used eviction and a time to live, and the means of keeping them coherent across processes."""
+
+import collections
+import logging
+import threading
+import time
+
+INVALIDATION_POLL_INTERVAL_SECS = 1.0 # How often to check the invalidation channel for changes made by other processes
+
+g_caches_lock = threading.Lock()
+g_caches = {} # Maps the cache name to the cache object
+
+g_channel_lock = threading.Lock()
+g_channel = None # Shares invalidations with other processes, None if this process is on its own
+g_last_poll_time = 0.0
+
+class TtlCache(object):
+    """Thread safe, size bounded cache. Items are evicted in least recently used order and expire after a fixed time."""
+
+    def __init__(self, name, max_size, ttl_secs):
+        if max_size <= 0:
+            raise Exception("Bad parameter.")
+        if ttl_secs <= 0:
+            raise Exception("Bad parameter.")
+
+        self.name = name
+        self.max_size = max_size
+        self.ttl_secs = ttl_secs
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict() # Maps the key to (expiry time, value), least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.generation = 0 # Incremented by every invalidation, so a value read from the database before an invalidation isn't cached after it
+        register_cache(self)
+
+    def get(self, key):
+        """Returns a tuple of (found, value). The found flag is needed because None is a legitimate value to cache."""
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None:
+                if item[0] > time.time():
+                    self.items.move_to_end(key)
+                    self.hits = self.hits + 1
+                    return True, item[1]
+                del self.items[key]
+            self.misses = self.misses + 1
+        return False, None
+
+    def current_generation(self):
+        """Returns a value to be passed to put() by callers that read the value from somewhere else before caching it."""
+        with self.lock:
+            return self.generation
+
+    def put(self, key, value, ttl_secs=None, generation=None):
+        """Adds or replaces an item. The optional time to live can only shorten the cache's default, i.e. for session tokens that are about to expire."""
+        """If a generation is provided and something was invalidated since it was retrieved then the value may be stale, so it is not cached."""
+        expiry = time.time() + self.ttl_secs
+        if ttl_secs is not None:
+            expiry = min(expiry, time.time() + ttl_secs)
+
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.items[key] = (expiry, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+                self.evictions = self.evictions + 1
+
+    def invalidate(self, key):
+        """Removes an item, if it is in the cache."""
+        with self.lock:
+            self.generation = self.generation + 1
+            if self.items.pop(key, None) is not None:
+                self.invalidations = self.invalidations + 1
+
+    def clear(self):
+        """Removes everything."""
+        with self.lock:
+            self.generation = self.generation + 1
+            self.invalidations = self.invalidations + len(self.items)
+            self.items.clear()
+
+    def statistics(self):
+        """Returns a dictionary of the cache's counters."""
+        with self.lock:
+            return { "size": len(self.items), "max size": self.max_size, "hits": self.hits, "misses": self.misses, "evictions": self.evictions, "invalidations": self.invalidations }
+
+class InvalidationChannel(object):
+    """Base class for sharing cache invalidations between processes. Each process only caches what it has read, so"""
+    """it only needs to know which keys to drop, never the new values."""
+
+    def publish(self, cache_name, key):
+        """Tells the other processes that the key is no longer valid."""
+        pass
+
+    def poll(self):
+        """Returns a list of (cache name, key) tuples that were published since the last call."""
+        return []
+
+def register_cache(cache):
+    """Makes the cache visible to invalidations and statistics by name. Caches are normally module level objects, so registering the same name twice replaces the old one."""
+    global g_caches_lock
+    global g_caches
+
+    with g_caches_lock:
+        g_caches[cache.name] = cache
+
+def set_invalidation_channel(channel):
+    """Installs the channel used to keep the caches in this process coherent with the other processes. None means no sharing."""
+    global g_channel_lock
+    global g_channel
+
+    with g_channel_lock:
+        g_channel = channel
+
+def retrieve_invalidation_channel():
+    """Returns the installed invalidation channel, or None."""
+    global g_channel
+    return g_channel
+
+def invalidate(cache_name, key):
+    """Removes the key from the named cache in this process and in every other process that shares the invalidation channel."""
+    global g_caches
+    global g_channel
+
+    cache = g_caches.get(cache_name)
+    if cache is not None:
+        cache.invalidate(key)
+
+    channel = g_channel
+    if channel is not None:
+        try:
+            channel.publish(cache_name, key)
+        except:
+            logging.getLogger().error("Failed to publish a cache invalidation.")
+
+def process_invalidations():
+    """Applies invalidations published by other processes. Cheap to call often, since the channel is polled at most once per interval."""
+    global g_caches
+    global g_channel
+    global g_channel_lock
+    global g_last_poll_time
+
+    channel = g_channel
+    if channel is None:
+        return
+
+    # Only one thread needs to poll, the others can use the cache as it is.
+    now = time.time()
+    if now - g_last_poll_time < INVALIDATION_POLL_INTERVAL_SECS:
+        return
+    if not g_channel_lock.acquire(blocking=False):
+        return
+    try:
+        g_last_poll_time = now
+        for cache_name, key in channel.poll():
+            cache = g_caches.get(cache_name)
+            if cache is not None:
+                cache.invalidate(key)
+    except:
+        # If we can't find out what changed then nothing in the cache can be trusted.
+        logging.getLogger().error("Failed to poll for cache invalidations.")
+        for cache in list(g_caches.values()):
+            cache.clear()
+    finally:
+        g_channel_lock.release()
+
+def retrieve_statistics():
+    """Returns a dictionary that maps each cache name to its counters."""
+    global g_caches_lock
+    global g_caches
+
+    with g_caches_lock:
+        caches = list(g_caches.values())
+    return { cache.name: cache.statistics() for cache in caches }
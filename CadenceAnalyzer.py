@@ -43,7 +43,7 @@ class CadenceAnalyzer(SensorAnalyzer.SensorAnalyzer):
     def analyze(self):
         """Called when all sensor readings have been processed."""
         results = SensorAnalyzer.SensorAnalyzer.analyze(self)
-        if len(self.readings) > 0:
+        if self.num_readings > 0:
             if self.is_foot_based_activity:
                 results[Keys.MAX_CADENCE] = self.max * 2.0
                 results[Keys.AVG_CADENCE] = self.avg * 2.0
@@ -25,27 +25,95 @@
 
 from __future__ import absolute_import
 import celery
+import celery.signals
 import datetime
-import random
+import os
+import threading
+import time
 
 import AnalysisScheduler
 import Config
 import DataMgr
 import Keys
+import Perf
 import UserMgr
 import Units
 
 celery_worker = celery.Celery(Keys.CELERY_PROJECT_NAME, include=['ActivityAnalyzer', 'ImportWorker', 'WorkoutPlanGenerator'])
 celery_worker.config_from_object('CeleryConfig')
 
+g_shared_lock = threading.Lock()
+g_shared_pid = None # Process that created the shared objects, they must not be reused after a fork
+g_shared_data_mgr = None
+g_shared_user_mgr = None
+g_task_start_times = {} # Maps the celery task ID to the time the task started, for the task latency histograms
+
+def reset_shared_managers_if_forked():
+    """Celery forks its worker processes, objects created by the parent (and their database connections) can't be reused by the child."""
+    global g_shared_pid
+    global g_shared_data_mgr
+    global g_shared_user_mgr
+
+    pid = os.getpid()
+    if g_shared_pid != pid:
+        g_shared_data_mgr = None
+        g_shared_user_mgr = None
+        g_shared_pid = pid
+
+def shared_data_mgr():
+    """Returns the DataMgr used by every task in this worker process, creating it the first time it's needed."""
+    global g_shared_lock
+    global g_shared_data_mgr
+
+    with g_shared_lock:
+        reset_shared_managers_if_forked()
+        if g_shared_data_mgr is None:
+            root_dir = os.path.dirname(os.path.abspath(__file__))
+            g_shared_data_mgr = DataMgr.DataMgr(config=Config.Config(), root_url="file://" + root_dir, analysis_scheduler=AnalysisScheduler.AnalysisScheduler(), import_scheduler=None)
+        return g_shared_data_mgr
+
+def shared_user_mgr():
+    """Returns the UserMgr used by every task in this worker process, creating it the first time it's needed."""
+    global g_shared_lock
+    global g_shared_user_mgr
+
+    with g_shared_lock:
+        reset_shared_managers_if_forked()
+        if g_shared_user_mgr is None:
+            g_shared_user_mgr = UserMgr.UserMgr(config=Config.Config(), session_mgr=None)
+        return g_shared_user_mgr
+
+@celery.signals.worker_init.connect
+def configure_metrics(**kwargs):
+    """The worker's configuration comes from the environment, so its latency histograms can be shared with the web servers' metrics page."""
+    """Pool processes forked from this one carry on sharing them."""
+    Perf.configure(Config.Config().get_metrics_dir())
+
+@celery.signals.worker_process_shutdown.connect
+def retire_metrics(**kwargs):
+    """Pool processes exit without running the exit handlers, so their final counts are handed over to the retired snapshot here."""
+    Perf.retire_snapshot()
+
+@celery.signals.task_prerun.connect
+def record_task_start(task_id=None, **kwargs):
+    """Called by celery before each task is run."""
+    global g_task_start_times
+    g_task_start_times[task_id] = time.perf_counter()
+
+@celery.signals.task_postrun.connect
+def record_task_end(task_id=None, task=None, state=None, **kwargs):
+    """Called by celery after each task is run, whether it succeeded or not."""
+    global g_task_start_times
+    start_time = g_task_start_times.pop(task_id, None)
+    if start_time is not None and task is not None:
+        Perf.record_latency(Perf.TASK_SECONDS_METRIC, { "task": task.name, "state": state }, time.perf_counter() - start_time)
+
 @celery_worker.task()
 def regenerate_heat_maps():
     print("Regenerating heat maps.")
 
-    analysis_scheduler = AnalysisScheduler.AnalysisScheduler()
-    config = Config.Config()
-    data_mgr = DataMgr.DataMgr(config=config, root_url="", analysis_scheduler=analysis_scheduler, import_scheduler=None)
-    user_mgr = UserMgr.UserMgr(config=config, session_mgr=None)
+    data_mgr = shared_data_mgr()
+    user_mgr = shared_user_mgr()
 
     # Select a random user.
     user_id, user_realname = user_mgr.retrieve_random_user()
@@ -63,30 +131,16 @@ def regenerate_heat_maps():
 
 @celery_worker.task()
 def check_for_unanalyzed_activities():
-    """Check for activities that need to be analyzed. Do one, if any are found."""
+    """Check for activities that need to be analyzed. Schedules a batch job to analyze all of them, if any are found."""
     print("Looking for unanalyzed activities.")
 
-    analysis_scheduler = AnalysisScheduler.AnalysisScheduler()
-    config = Config.Config()
-    data_mgr = DataMgr.DataMgr(config=config, root_url="", analysis_scheduler=analysis_scheduler, import_scheduler=None)
-    user_mgr = UserMgr.UserMgr(config=config, session_mgr=None)
+    data_mgr = shared_data_mgr()
 
-    # We need a randomly selected activity that is missing the summary section.
-    unanalyzed_activity_list = data_mgr.retrieve_unanalyzed_activity_list(64)
+    # The batch job holds a lease, so if the previous one is still running then this one will exit without doing anything.
+    unanalyzed_activity_list = data_mgr.retrieve_unanalyzed_activity_list(1)
     if len(unanalyzed_activity_list) > 0:
-        activity_id = str(random.choice(unanalyzed_activity_list))
-        print("Selected " + activity_id + " for analysis.")
-        complete_activity_data = data_mgr.retrieve_activity(activity_id)
-        if complete_activity_data:
-            print("Activity loaded.")
-            activity_user_id = user_mgr.retrieve_user_from_activity(complete_activity_data)
-            if activity_user_id:
-                print("Analyzing....")
-                data_mgr.schedule_activity_analysis(complete_activity_data, activity_user_id)
-            else:
-                print("The activity owner could not be determined.")
-        else:
-            print("The activity could not be loaded.")
+        print("Scheduling batch analysis....")
+        data_mgr.schedule_batch_analysis(None, True)
     else:
         print("None found")
 
@@ -96,10 +150,8 @@ def check_for_ungenerated_workout_plans():
     print("Looking for users with ungenerated workout plans.")
 
     now = datetime.datetime.utcnow()
-    analysis_scheduler = AnalysisScheduler.AnalysisScheduler()
-    config = Config.Config()
-    data_mgr = DataMgr.DataMgr(config=config, root_url="", analysis_scheduler=analysis_scheduler, import_scheduler=None)
-    user_mgr = UserMgr.UserMgr(config=config, session_mgr=None)
+    data_mgr = shared_data_mgr()
+    user_mgr = shared_user_mgr()
 
     # These users don't have any pending workouts.
     user_ids = data_mgr.retrieve_users_without_scheduled_workouts()
@@ -117,7 +169,7 @@ def check_for_ungenerated_workout_plans():
 def prune_deferred_tasks_list():
     """Checks for users that need their workout plan regenerated."""
     print("Pruning the deferred tasks list.")
-    data_mgr = DataMgr.DataMgr(config=Config.Config(), root_url="", analysis_scheduler=None, import_scheduler=None)
+    data_mgr = shared_data_mgr()
     data_mgr.prune_deferred_tasks_list()
 
 @celery_worker.on_after_configure.connect
@@ -125,5 +177,5 @@ def setup_periodic_tasks(**kwargs):
     print("Registering periodic tasks.")
     celery_worker.add_periodic_task(700.0, prune_deferred_tasks_list.s(), name='Removes completed tasks from the deferred tasks list.')
     celery_worker.add_periodic_task(600.0, check_for_ungenerated_workout_plans.s(), name='Check for workout plans that need to be re-generated.')
-    celery_worker.add_periodic_task(900.0, check_for_unanalyzed_activities.s(), name='Check for activities that need to be analyzed. Do one, if any are found.')
+    celery_worker.add_periodic_task(900.0, check_for_unanalyzed_activities.s(), name='Check for activities that need to be analyzed. Analyze them in batches, if any are found.')
     celery_worker.add_periodic_task(1000.0, regenerate_heat_maps.s(), name='.')
@@ -5,6 +5,7 @@ import ApiException
 import Keys
 
 import cherrypy
+import inspect
 import json
 import logging
 import traceback
@@ -113,6 +114,22 @@ class CherryPyFrontEnd(object):
             pass
         return self.error()
 
+    @cherrypy.expose
+    def metrics(self):
+        """Returns the metrics in the text exposition format, for a monitoring system such as Prometheus."""
+        try:
+            handled, response = self.backend.metrics(cherrypy.request.headers.get('Authorization'))
+            if not handled:
+                cherrypy.response.status = 401
+                return ""
+            cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+            return response
+        except:
+            self.log_error(traceback.format_exc())
+            self.log_error(sys.exc_info()[0])
+            self.log_error('Unhandled exception in ' + CherryPyFrontEnd.metrics.__name__)
+        return self.error()
+
     @cherrypy.expose
     def live(self, device_str):
         """Renders the map page for the current activity from a single device."""
@@ -558,9 +575,9 @@ class CherryPyFrontEnd(object):
     def ical(self, calendar_id):
         """Returns the ical calendar with the specified ID."""
         try:
-            handled, response = self.backend.ical(calendar_id)
-            if not handled:
-                cherrypy.response.status = 400
+            status, response, headers = self.backend.ical(calendar_id, cherrypy.request.headers.get('If-None-Match'), cherrypy.request.headers.get('If-Modified-Since'))
+            cherrypy.response.status = status
+            cherrypy.response.headers.update(headers)
             return response
         except App.RedirectException as e:
             raise cherrypy.HTTPRedirect(e.url)
@@ -706,6 +723,10 @@ class CherryPyFrontEnd(object):
             http_status = 500
             self.log_error("Untyped exception")
 
+        # Exported files are returned as generators, send them as they are formatted rather than all at once.
+        if inspect.isgenerator(response):
+            cherrypy.response.stream = True
+
         cherrypy.response.status = http_status
         return response
 
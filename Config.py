@@ -26,6 +26,7 @@
 
 import configparser
 import logging
+import os
 
 class Config(object):
     """Class that abstracts the configuration file."""
@@ -95,6 +96,9 @@ class Config(object):
     def get_google_maps_key(self):
         return self.get_str('Maps', 'Google Maps Key')
 
+    def get_map_index_file(self):
+        return self.get_str('Maps', 'Index File')
+
     def get_hostname(self):
         return self.get_str('Network', 'Host')
 
@@ -110,6 +114,12 @@ class Config(object):
     def get_num_servers(self):
         return self.get_int('Network', 'Num Servers')
 
+    def get_server_threads(self):
+        server_threads = self.get_int('Network', 'Server Threads')
+        if server_threads <= 0:
+            server_threads = 30
+        return server_threads
+
     def get_photos_dir(self):
         return self.get_str('Photos', 'Directory')
 
@@ -119,11 +129,87 @@ class Config(object):
     def get_import_max_file_size(self):
         return self.get_int('Import', 'Max File Size')
 
+    def get_upload_store(self):
+        store = self.get_str('Import', 'Upload Store')
+        if store is None or len(store) == 0:
+            store = 'database'
+        return store.lower()
+
+    def get_upload_dir(self):
+        return self.get_str('Import', 'Upload Directory')
+
+    def get_upload_compression(self):
+        compression = self.get_str('Import', 'Upload Compression')
+        if compression is None or len(compression) == 0:
+            compression = 'zstd'
+        return compression.lower()
+
     def get_database_url(self):
         database_url = self.get_str('Database', 'Database URL')
         if database_url is None or len(database_url) == 0:
             database_url = 'localhost:27017'
         return database_url
 
+    def get_database_max_pool_size(self):
+        max_pool_size = self.get_int('Database', 'Max Pool Size')
+        if max_pool_size <= 0:
+            max_pool_size = 100
+        return max_pool_size
+
+    def get_database_min_pool_size(self):
+        return self.get_int('Database', 'Min Pool Size')
+
     def get_broker_url(self):
         return self.get_str('Celery', 'Broker URL')
+
+    def get_api_rate_limiter(self):
+        rate_limiter = self.get_str('Api', 'Rate Limiter')
+        if rate_limiter is None or len(rate_limiter) == 0:
+            rate_limiter = 'database'
+        return rate_limiter.lower()
+
+    def get_analysis_engine(self):
+        engine = self.get_str('Analysis', 'Engine')
+        if engine is None or len(engine) == 0:
+            engine = 'iterative'
+        return engine.lower()
+
+    def get_analysis_batch_size(self):
+        batch_size = self.get_int('Analysis', 'Batch Size')
+        if batch_size <= 0:
+            batch_size = 16
+        return batch_size
+
+    def get_analysis_batch_workers(self):
+        batch_workers = self.get_int('Analysis', 'Batch Workers')
+        if batch_workers <= 0:
+            batch_workers = 4
+        return batch_workers
+
+    def get_cache_size(self):
+        cache_size = self.get_int('Cache', 'Max Items')
+        if cache_size <= 0:
+            cache_size = 10000
+        return cache_size
+
+    def get_cache_ttl(self):
+        cache_ttl = self.get_int('Cache', 'Time To Live')
+        if cache_ttl <= 0:
+            cache_ttl = 300
+        return cache_ttl
+
+    def get_cache_invalidation_channel(self):
+        channel = self.get_str('Cache', 'Invalidation Channel')
+        if channel is None or len(channel) == 0:
+            channel = 'database'
+        return channel.lower()
+
+    def get_metrics_dir(self):
+        """Processes that can't be given a configuration file, such as Celery workers, use the environment variable instead."""
+        metrics_dir = self.get_str('Monitoring', 'Metrics Dir')
+        if metrics_dir is None or len(metrics_dir) == 0:
+            metrics_dir = os.environ.get('OPENWORKOUT_METRICS_DIR', '')
+        return metrics_dir
+
+    def get_metrics_token(self):
+        return self.get_str('Monitoring', 'Metrics Token')
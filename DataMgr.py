@@ -37,10 +37,14 @@ import HeartRateCalculator
 import Importer
 import InputChecker
 import Keys
+import LiveFeed
 import MapSearch
 import MergeTool
+import RateLimiter
 import Summarizer
 import TrainingPaceCalculator
+import TrackSimplifier
+import TrainingRollups
 import Units
 import VO2MaxCalculator
 import celery
@@ -50,29 +54,43 @@ ONE_YEAR = (365.25 * 24.0 * 60.0 * 60.0)
 ONE_WEEK = (7.0 * 24.0 * 60.0 * 60.0)
 FOUR_WEEKS = (28.0 * 24.0 * 60.0 * 60.0)
 EIGHT_WEEKS = (56.0 * 24.0 * 60.0 * 60.0)
+DUPLICATE_SEARCH_WINDOW = (7.0 * 24.0 * 60.0 * 60.0) # How far back to look for activities that might overlap with a new one
+ROLLUP_METADATA_KEYS = [ Keys.ACTIVITY_TYPE_KEY, Keys.APP_DISTANCE_KEY, Keys.APP_DURATION_KEY ] # Metadata that changes what an activity adds to the training rollups
+MAX_ROLLUP_ATTEMPTS = 5 # How many times to retry an activity's rollup update when other updates keep changing its contribution first
+LIST_ACTIVITY_KEYS = [ Keys.ACTIVITY_ID_KEY, Keys.ACTIVITY_START_TIME_KEY, Keys.ACTIVITY_TYPE_KEY, Keys.ACTIVITY_NAME_KEY, Keys.ACTIVITY_TAGS_KEY, Keys.ACTIVITY_USER_ID_KEY, Keys.ACTIVITY_DEVICE_STR_KEY ] # Enough to list an activity, without its summary or sensor data
 
-g_api_key_rate_lock = threading.Lock()
-g_api_key_rates = {}
-g_last_api_reset = 0 # Timestamp of when g_api_key_rates was last cleared 
+g_rate_limiter_lock = threading.Lock()
+g_rate_limiter = None # Counts API key requests, shared by everything in this process
+g_rate_limiter_pid = None # Process that created the rate limiter, since the database one can't be shared across a fork
 
-def get_activities_sort_key(item):
-    # Was the start time provided? If not, look at the first location.
-    if Keys.ACTIVITY_START_TIME_KEY in item:
-        return item[Keys.ACTIVITY_START_TIME_KEY]
-    return 0
+g_map_search_lock = threading.Lock()
+g_map_searches = {} # Maps the root URL to a MapSearch object, so the geojson files are only loaded once per process
+
+def retrieve_map_search(root_url, index_file_name):
+    """Returns the MapSearch object for the given root URL, loading the map data the first time it's needed."""
+    global g_map_search_lock
+    global g_map_searches
+
+    with g_map_search_lock:
+        if root_url not in g_map_searches:
+            g_map_searches[root_url] = MapSearch.MapSearch(root_url + '/data/world.geo.json', root_url + '/data/us_states.geo.json', root_url + '/data/canada.geo.json', index_file_name)
+        return g_map_searches[root_url]
 
 class DataMgr(Importer.ActivityWriter):
     """Data store abstraction"""
 
-    def __init__(self, *, config, root_url, analysis_scheduler, import_scheduler):
+    def __init__(self, *, config, root_url, analysis_scheduler, import_scheduler, database=None):
         """Constructor"""
+        """The database is normally created from the config, but one can be provided, i.e. by the benchmarks."""
         assert config is not None
         self.config = config
         self.root_url = root_url
         self.analysis_scheduler = analysis_scheduler
         self.import_scheduler = import_scheduler
-        self.database = AppDatabase.MongoDatabase()
-        self.database.connect(config)
+        if database is None:
+            database = AppDatabase.MongoDatabase()
+            database.connect(config)
+        self.database = database
         self.map_search = None
         self.celery_worker = celery.Celery(Keys.CELERY_PROJECT_NAME)
         self.celery_worker.config_from_object('CeleryConfig')
@@ -109,20 +127,45 @@ class DataMgr(Importer.ActivityWriter):
         if self.analysis_scheduler is None:
             raise Exception("No analysis scheduler.")
 
-        activity[Keys.ACTIVITY_USER_ID_KEY] = activity_user_id
-        task_id, internal_task_id = self.analysis_scheduler.add_activity_to_analysis_queue(activity)
-        if [task_id, internal_task_id].count(None) == 0:
-            self.create_deferred_task(activity_user_id, Keys.ANALYSIS_TASK_KEY, task_id, internal_task_id, None)
+        if Keys.ACTIVITY_ID_KEY not in activity:
+            raise Exception("No activity ID.")
+
+        self.analyze_activity_by_id(activity[Keys.ACTIVITY_ID_KEY], activity_user_id)
 
     def analyze_activity_by_id(self, activity_id, activity_user_id):
-        """Schedules the specified activity for analysis."""
+        """Schedules the specified activity for analysis. Only the IDs are queued, the worker loads the activity itself."""
         if activity_id is None:
             raise Exception("No activity ID.")
         if activity_user_id is None:
             raise Exception("No activity user ID.")
+        if not InputChecker.is_hex_str(activity_user_id):
+            raise Exception("Invalid activity user ID.")
+        if self.analysis_scheduler is None:
+            raise Exception("No analysis scheduler.")
 
-        complete_activity_data = self.retrieve_activity(activity_id)
-        self.schedule_activity_analysis(complete_activity_data, activity_user_id)
+        analysis_engine = Keys.ANALYSIS_ENGINE_ITERATIVE
+        if self.config is not None:
+            analysis_engine = self.config.get_analysis_engine()
+        task_id, internal_task_id = self.analysis_scheduler.add_activity_to_analysis_queue(activity_id, activity_user_id, analysis_engine)
+        if [task_id, internal_task_id].count(None) == 0:
+            self.create_deferred_task(activity_user_id, Keys.ANALYSIS_TASK_KEY, task_id, internal_task_id, None)
+
+    def schedule_batch_analysis(self, user_id, only_unanalyzed):
+        """Schedules a job that analyzes the user's activities (or every user's activities, if the user ID is None) in batches."""
+        """If only_unanalyzed is TRUE then activities that already have a summary are skipped."""
+        if self.analysis_scheduler is None:
+            raise Exception("No analysis scheduler.")
+
+        analysis_engine = Keys.ANALYSIS_ENGINE_ITERATIVE
+        batch_size = 16
+        batch_workers = 4
+        if self.config is not None:
+            analysis_engine = self.config.get_analysis_engine()
+            batch_size = self.config.get_analysis_batch_size()
+            batch_workers = self.config.get_analysis_batch_workers()
+        task_id, internal_task_id = self.analysis_scheduler.add_batch_analysis_to_queue(user_id, only_unanalyzed, analysis_engine, batch_size, batch_workers)
+        if user_id is not None and [task_id, internal_task_id].count(None) == 0:
+            self.create_deferred_task(user_id, Keys.BATCH_ANALYSIS_TASK_KEY, task_id, internal_task_id, None)
 
     def schedule_personal_records_refresh(self, user_id):
         """Schedules the specified activity for analysis."""
@@ -199,28 +242,43 @@ class DataMgr(Importer.ActivityWriter):
             activity_end_time_sec = activity[Keys.ACTIVITY_END_TIME_KEY]
         return activity_start_time_sec, activity_end_time_sec
 
-    def is_duplicate_activity(self, user_id, start_time_sec, optional_activity_id):
+    def is_duplicate_activity(self, user_id, start_time_sec, optional_activity_id, fingerprint=None):
         """Inherited from ActivityWriter. Returns TRUE if the activity appears to be a duplicate of another activity. Returns FALSE otherwise."""
         if self.database is None:
             raise Exception("No database.")
 
         # If an activity ID was specified then do any documents already exist with this ID?
         if optional_activity_id is not None:
-            if self.database.retrieve_activity(optional_activity_id) is not None:
+            if self.database.activity_exists(optional_activity_id):
+                return True
+
+        # The fingerprint identifies the activity, so this is a single lookup on the user and fingerprint index.
+        if fingerprint is not None:
+            if len(self.database.retrieve_activity_ids_by_fingerprints(user_id, [ fingerprint ])) > 0:
                 return True
 
-        # Look through the user's activities for ones that overlap with the given start time.
-        activities = self.database.retrieve_user_activity_list(user_id, None, None, True)
+        # Activities that don't have a fingerprint (stored before fingerprints were added, and not analyzed since) can only be found by time.
+        # Look through the user's recent activities for ones that overlap with the given start time. This is a range scan
+        # on the user and start time index, rather than a scan of the user's entire history.
+        activities = self.database.retrieve_user_activity_times(user_id, start_time_sec - DUPLICATE_SEARCH_WINDOW, start_time_sec)
         for activity in activities:
 
-            if Keys.ACTIVITY_START_TIME_KEY in activity:
+            # Activities with a fingerprint were checked above, unless the new activity doesn't have one to compare.
+            if fingerprint is not None and activity.get(Keys.ACTIVITY_FINGERPRINT_KEY) is not None:
+                continue
+
+            # Older activities may not have an end time, in which case it needs to be computed from the activity's data.
+            if Keys.ACTIVITY_END_TIME_KEY not in activity:
+                activity = self.database.retrieve_activity(activity[Keys.ACTIVITY_ID_KEY])
+                if activity is None:
+                    continue
 
-                # Get the activity start and end times.
-                activity_start_time_sec, activity_end_time_sec = self.get_activity_start_and_end_times(activity)
+            # Get the activity start and end times.
+            activity_start_time_sec, activity_end_time_sec = self.get_activity_start_and_end_times(activity)
 
-                # We're looking for activities that start within the bounds of another activity.
-                if start_time_sec >= activity_start_time_sec and start_time_sec < activity_end_time_sec:
-                    return True
+            # We're looking for activities that start within the bounds of another activity.
+            if start_time_sec >= activity_start_time_sec and start_time_sec < activity_end_time_sec:
+                return True
 
         return False
 
@@ -300,6 +358,14 @@ class DataMgr(Importer.ActivityWriter):
             raise Exception("No events.")
         return self.database.create_activity_events(activity_id, events)
 
+    def create_activity_streams(self, device_str, activity_id, locations, sensor_readings_dict, events):
+        """Inherited from ActivityWriter. Adds a chunk of imported locations, sensor readings, and events to the database in one bulk operation."""
+        if self.database is None:
+            raise Exception("No database.")
+        if activity_id is None:
+            raise Exception("No activity ID.")
+        return self.database.create_activity_streams(device_str, activity_id, locations, sensor_readings_dict, events)
+
     def create_activity_metadata(self, activity_id, date_time, key, value, create_list):
         """Create method for activity metadata."""
         if self.database is None:
@@ -314,7 +380,13 @@ class DataMgr(Importer.ActivityWriter):
             raise Exception("No value.")
         if create_list is None:
             raise Exception("Missing parameter.")
-        return self.database.create_or_update_activity_metadata(activity_id, date_time, key, value, create_list)
+
+        result = self.database.create_or_update_activity_metadata(activity_id, date_time, key, value, create_list)
+
+        # The training rollups include totals for each activity type, and the distance and duration of manually entered activities.
+        if result and key in ROLLUP_METADATA_KEYS:
+            self.update_training_rollups([ activity_id ])
+        return result
 
     def create_activity_metadata_list(self, activity_id, key, values):
         """Create method for activity metadata."""
@@ -363,6 +435,16 @@ class DataMgr(Importer.ActivityWriter):
         values = [time.time() * 1000, battery_level]
         return self.database.create_or_update_activity_metadata_list(activity_id, Keys.APP_BATTERY_LEVEL_KEY, [values])
 
+    def create_activity_fingerprint(self, activity_id, fingerprint):
+        """Inherited from ActivityWriter. Stores the fingerprint that is used to detect duplicate uploads."""
+        if self.database is None:
+            raise Exception("No database.")
+        if activity_id is None:
+            raise Exception("No activity ID.")
+        if fingerprint is None:
+            raise Exception("No fingerprint.")
+        return self.database.update_activity_fingerprint(activity_id, fingerprint)
+
     def finish_activity(self, activity_id, end_time_ms):
         """Inherited from ActivityWriter. Called for post-processing."""
         if self.database is None:
@@ -395,8 +477,8 @@ class DataMgr(Importer.ActivityWriter):
             raise Exception("No user ID.")
         return self.database.retrieve_deferred_tasks(user_id)
 
-    def update_deferred_task(self, user_id, internal_task_id, activity_id, status):
-        """Returns a list of all incomplete tasks."""
+    def update_deferred_task(self, user_id, internal_task_id, activity_id, status, details=None):
+        """Updates the status of a task and, optionally, its details."""
         if self.database is None:
             raise Exception("No database.")
         if user_id is None:
@@ -405,7 +487,7 @@ class DataMgr(Importer.ActivityWriter):
             raise Exception("No internal task ID.")
         if status is None:
             raise Exception("No status.")
-        return self.database.update_deferred_task(user_id, internal_task_id, activity_id, status)
+        return self.database.update_deferred_task(user_id, internal_task_id, activity_id, status, details)
 
     def prune_deferred_tasks_list(self):
         """Removes all completed tasks from the list."""
@@ -423,6 +505,48 @@ class DataMgr(Importer.ActivityWriter):
             raise Exception("No file data")
         return self.database.create_uploaded_file(activity_id, file_data)
 
+    def create_pending_uploaded_file(self, file_data):
+        """Stores an uploaded file that has not yet been imported. Returns the ID the import worker uses to find it."""
+        if self.database is None:
+            raise Exception("No database.")
+        if file_data is None:
+            raise Exception("No file data")
+        return self.database.create_pending_uploaded_file(file_data)
+
+    def retrieve_pending_uploaded_file(self, uploaded_file_id):
+        """Retrieve method for an uploaded file that has not yet been imported."""
+        if self.database is None:
+            raise Exception("No database.")
+        if uploaded_file_id is None:
+            raise Exception("No uploaded file ID")
+        return self.database.retrieve_pending_uploaded_file(uploaded_file_id)
+
+    def open_pending_uploaded_file(self, uploaded_file_id):
+        """Returns a file-like object for reading an uploaded file that has not yet been imported, without reading all of it at once."""
+        if self.database is None:
+            raise Exception("No database.")
+        if uploaded_file_id is None:
+            raise Exception("No uploaded file ID")
+        return self.database.open_pending_uploaded_file(uploaded_file_id)
+
+    def attach_uploaded_file_to_activity(self, uploaded_file_id, activity_id):
+        """Associates a previously stored uploaded file with the activity that was imported from it."""
+        if self.database is None:
+            raise Exception("No database.")
+        if uploaded_file_id is None:
+            raise Exception("No uploaded file ID")
+        if activity_id is None:
+            raise Exception("No activity_id")
+        return self.database.attach_uploaded_file_to_activity(uploaded_file_id, activity_id)
+
+    def delete_pending_uploaded_file(self, uploaded_file_id):
+        """Delete method for an uploaded file that could not be imported."""
+        if self.database is None:
+            raise Exception("No database.")
+        if uploaded_file_id is None:
+            raise Exception("No uploaded file ID")
+        return self.database.delete_pending_uploaded_file(uploaded_file_id)
+
     def import_activity_from_file(self, username, user_id, uploaded_file_data, uploaded_file_name, desired_activity_id):
         """Imports the contents of a local file into the database. Desired activity ID is optional."""
         if self.import_scheduler is None:
@@ -553,7 +677,12 @@ class DataMgr(Importer.ActivityWriter):
             raise Exception("Bad parameter.")
         if activity_id is None:
             raise Exception("Bad parameter.")
-        return self.database.update_activity(device_str, activity_id, locations, sensor_readings_dict, metadata_list_dict)
+        if not self.database.update_activity(device_str, activity_id, locations, sensor_readings_dict, metadata_list_dict):
+            return False
+
+        # Wake anyone who is watching the activity live.
+        LiveFeed.notify(activity_id)
+        return True
 
     def is_activity_public(self, activity):
         """Helper function for returning whether or not an activity is publically visible."""
@@ -573,38 +702,49 @@ class DataMgr(Importer.ActivityWriter):
                 return False
         return True
 
-    def retrieve_user_activity_list(self, user_id, user_realname, start_time, end_time, num_results):
-        """Returns a list containing all of the user's activities, up to num_results. num_results can be None for all activiites."""
+    def retrieve_activity_list_page(self, user_id, user_realname, include_friends, start_time, end_time, before, num_results, list_keys=LIST_ACTIVITY_KEYS):
+        """Returns a list of the user's activities, and their friends' public activities if requested, most recent first, up to num_results."""
+        """Before is the (start time, activity ID) of the last activity on the previous page, or None to start with the most recent activity."""
+        """Activities are sorted, bounded, and limited by the database, in one query. Each activity's owner is added as REALNAME_KEY."""
+        """Only the keys needed to list the activities are returned, unless list_keys is None."""
         if self.database is None:
             raise Exception("No database.")
         if user_id is None or len(user_id) == 0:
             raise Exception("Bad parameter.")
 
-        activities = []
-
-        # List activities recorded on devices registered to the user.
-        devices = self.database.retrieve_user_devices(user_id)
-        devices = list(set(devices)) # De-duplicate
-        device_activities = self.database.retrieve_devices_activity_list(devices, start_time, end_time, False)
-        if device_activities is not None:
-            for device_activity in device_activities:
-                device_activity[Keys.REALNAME_KEY] = user_realname
-                self.update_activity_start_time(device_activity)
-            activities.extend(device_activities)
-
-        # List activities with no device that are associated with the user.
-        user_activities = self.database.retrieve_user_activity_list(user_id, start_time, end_time, False)
-        if user_activities is not None:
-            for user_activity in user_activities:
-                user_activity[Keys.REALNAME_KEY] = user_realname
-            activities.extend(user_activities)
-
-        # Sort and limit the list.
-        if len(activities) > 0:
-            activities = sorted(activities, key=get_activities_sort_key, reverse=True)[:num_results]
+        # The user's activities include those recorded on devices registered to the user.
+        devices = list(set(self.database.retrieve_user_devices(user_id))) # De-duplicate
+        owners = [ (user_id, devices, False) ]
+        realnames_by_user = { str(user_id): user_realname }
+        realnames_by_device = { device_str: user_realname for device_str in devices }
+
+        # Add the users they follow, whose activities are only included if they are public.
+        if include_friends:
+            for friend in self.database.retrieve_friends(user_id, include_devices=True):
+                friend_id = friend[Keys.DATABASE_ID_KEY]
+                friend_realname = friend.get(Keys.REALNAME_KEY)
+                friend_devices = list(set(friend.get(Keys.DEVICES_KEY, [])))
+                owners.append((friend_id, friend_devices, True))
+                realnames_by_user[str(friend_id)] = friend_realname
+                for device_str in friend_devices:
+                    realnames_by_device[device_str] = friend_realname
+
+        activities = self.database.retrieve_activity_list_page(owners, start_time, end_time, before, num_results, list_keys)
+        for activity in activities:
+            if Keys.ACTIVITY_USER_ID_KEY in activity:
+                activity[Keys.REALNAME_KEY] = realnames_by_user.get(str(activity[Keys.ACTIVITY_USER_ID_KEY]))
+            else:
+                activity[Keys.REALNAME_KEY] = realnames_by_device.get(activity.get(Keys.ACTIVITY_DEVICE_STR_KEY))
 
+            # Activities recorded before the start time was stored with the activity need it calculated, once.
+            if Keys.ACTIVITY_START_TIME_KEY not in activity and Keys.ACTIVITY_ID_KEY in activity:
+                self.update_activity_start_time(activity)
         return activities
 
+    def retrieve_user_activity_list(self, user_id, user_realname, start_time, end_time, num_results):
+        """Returns a list containing all of the user's activities, up to num_results. num_results can be None for all activiites."""
+        return self.retrieve_activity_list_page(user_id, user_realname, False, start_time, end_time, None, num_results, None)
+
     def retrieve_each_user_activity(self, user_id, context, cb_func, start_time, end_time, return_all_data):
         """Fires a callback for all of the user's activities. num_results can be None for all activiites."""
         if self.database is None:
@@ -629,27 +769,7 @@ class DataMgr(Importer.ActivityWriter):
 
     def retrieve_all_activities_visible_to_user(self, user_id, user_realname, start_time, end_time, num_results):
         """Returns a list containing all of the activities visible to the specified user, up to num_results. num_results can be None for all activiites."""
-        if self.database is None:
-            raise Exception("No database.")
-        if user_id is None or len(user_id) == 0:
-            raise Exception("Bad parameter.")
-
-        # Start with the user's own activities.
-        activities = self.retrieve_user_activity_list(user_id, user_realname, start_time, end_time, num_results)
-
-        # Add the activities of users they follow.
-        friends = self.database.retrieve_friends(user_id)
-        for friend in friends:
-            more_activities = self.retrieve_user_activity_list(friend[Keys.DATABASE_ID_KEY], friend[Keys.REALNAME_KEY], start_time, end_time, num_results)
-            for another_activity in more_activities:
-                if self.is_activity_public(another_activity):
-                    activities.append(another_activity)
-
-        # Sort and limit the list.
-        if len(activities) > 0:
-            activities = sorted(activities, key=get_activities_sort_key, reverse=True)[:num_results]
-
-        return activities
+        return self.retrieve_activity_list_page(user_id, user_realname, True, start_time, end_time, None, num_results, None)
 
     def delete_user_gear(self, user_id):
         """Deletes all user gear."""
@@ -688,6 +808,60 @@ class DataMgr(Importer.ActivityWriter):
             raise Exception("Bad parameter.")
         return self.database.retrieve_activity(activity_id)
 
+    def retrieve_activity_small(self, activity_id):
+        """Retrieve method for an activity, specified by the activity ID, without the location and sensor data."""
+        if self.database is None:
+            raise Exception("No database.")
+        if activity_id is None:
+            raise Exception("Bad parameter.")
+        return self.database.retrieve_activity_small(activity_id)
+
+    def retrieve_activity_for_analysis(self, activity_id):
+        """Retrieve method for an activity, limited to the fields used by the analysis workers."""
+        if self.database is None:
+            raise Exception("No database.")
+        if activity_id is None:
+            raise Exception("Bad parameter.")
+        return self.database.retrieve_activity_for_analysis(activity_id)
+
+    def retrieve_activities_for_batch_analysis(self, user_id, only_unanalyzed, checkpoint, limit):
+        """Returns the next activities to be analyzed by a batch job, starting after the checkpoint. User ID may be None, for every user's activities."""
+        if self.database is None:
+            raise Exception("No database.")
+        if limit is None or limit <= 0:
+            raise Exception("Bad parameter.")
+        return self.database.retrieve_activities_for_batch_analysis(user_id, only_unanalyzed, checkpoint, limit)
+
+    def acquire_batch_job(self, job_name, owner, lease_secs):
+        """Takes ownership of a batch job. Returns its checkpoint, or None if the job is already running somewhere else."""
+        if self.database is None:
+            raise Exception("No database.")
+        if job_name is None:
+            raise Exception("Bad parameter.")
+        if owner is None:
+            raise Exception("Bad parameter.")
+        return self.database.acquire_batch_job(job_name, owner, lease_secs)
+
+    def update_batch_job(self, job_name, owner, checkpoint, num_processed, num_failed, user_ids, lease_secs):
+        """Records a batch job's progress, so it can be resumed if it is interrupted. Returns FALSE if the owner no longer holds the job."""
+        if self.database is None:
+            raise Exception("No database.")
+        if job_name is None:
+            raise Exception("Bad parameter.")
+        if owner is None:
+            raise Exception("Bad parameter.")
+        return self.database.update_batch_job(job_name, owner, checkpoint, num_processed, num_failed, user_ids, lease_secs)
+
+    def delete_batch_job(self, job_name, owner):
+        """Removes a finished batch job. Returns FALSE if the owner no longer holds the job."""
+        if self.database is None:
+            raise Exception("No database.")
+        if job_name is None:
+            raise Exception("Bad parameter.")
+        if owner is None:
+            raise Exception("Bad parameter.")
+        return self.database.delete_batch_job(job_name, owner)
+
     def delete_activity(self, user_id, activity_id):
         """Delete the activity with the specified object ID."""
         if self.database is None:
@@ -697,11 +871,18 @@ class DataMgr(Importer.ActivityWriter):
         if activity_id is None:
             raise Exception("Bad parameter.")
 
+        # Whatever the activity added to the training rollups needs to be taken back out.
+        activity = self.database.retrieve_activity_small(activity_id)
+
         # Delete the activity as well as the cache of the PRs performed during that activity.
         result = self.database.delete_activity(activity_id)
 
         if result:
 
+            # Update the training rollups.
+            if activity is not None and Keys.ACTIVITY_ROLLUP_CONTRIBUTION_KEY in activity:
+                self.database.update_training_rollups(user_id, TrainingRollups.list_changes(activity[Keys.ACTIVITY_ROLLUP_CONTRIBUTION_KEY], None))
+
             # Delete the activity bests (there might not be any), so don't bother checking the return code.
             self.database.delete_activity_best_for_user(user_id, activity_id)
 
@@ -820,6 +1001,91 @@ class DataMgr(Importer.ActivityWriter):
             raise Exception("Bad parameter.")
         return self.database.retrieve_activity_locations(activity_id)
 
+    def retrieve_activity_locations_since(self, activity_id, cursor):
+        """Returns the locations written since the cursor was issued, and a cursor for the next call. A cursor of None reads every location."""
+        if self.database is None:
+            raise Exception("No database.")
+        if activity_id is None or len(activity_id) == 0:
+            raise Exception("Bad parameter.")
+        return self.database.retrieve_activity_stream_since(activity_id, Keys.ACTIVITY_LOCATIONS_KEY, cursor)
+
+    def retrieve_activity_latest_values(self, activity_id, stream_names):
+        """Returns a dictionary that maps each of the stream names to its most recent value, without reading the rest of the activity."""
+        if self.database is None:
+            raise Exception("No database.")
+        if activity_id is None or len(activity_id) == 0:
+            raise Exception("Bad parameter.")
+        if stream_names is None:
+            raise Exception("Bad parameter.")
+        return self.database.retrieve_activity_latest_values(activity_id, stream_names)
+
+    def retrieve_activity_locations_end_cursor(self, activity_id):
+        """Returns the cursor retrieve_activity_locations_since would return after reading every location, without reading them."""
+        if self.database is None:
+            raise Exception("No database.")
+        if activity_id is None or len(activity_id) == 0:
+            raise Exception("Bad parameter.")
+        return self.database.retrieve_activity_stream_end_cursor(activity_id, Keys.ACTIVITY_LOCATIONS_KEY)
+
+    def retrieve_activity_streams(self, activity_id, stream_names):
+        """Returns a dictionary that maps each of the stream names to its values, reading only those streams."""
+        if self.database is None:
+            raise Exception("No database.")
+        if activity_id is None or len(activity_id) == 0:
+            raise Exception("Bad parameter.")
+        if stream_names is None:
+            raise Exception("Bad parameter.")
+        return self.database.retrieve_activity_streams(activity_id, stream_names)
+
+    def create_activity_simplified_data(self, simplified):
+        """Create method for the simplified tracks and downsampled sensor readings of several activities, given as a dictionary of activity ID to data."""
+        if self.database is None:
+            raise Exception("No database.")
+        if simplified is None:
+            raise Exception("Bad parameter.")
+        return self.database.create_activity_simplified_data(simplified)
+
+    def retrieve_activity_track(self, activity_id, resolution):
+        """Returns the activity's locations, simplified for drawing at the given resolution. Uses the track that was stored"""
+        """when the activity was analyzed, if there is one, otherwise simplifies the full track."""
+        if self.database is None:
+            raise Exception("No database.")
+        if activity_id is None or len(activity_id) == 0:
+            raise Exception("Bad parameter.")
+        if not TrackSimplifier.is_valid_resolution(resolution):
+            raise Exception("Bad parameter.")
+
+        if resolution != Keys.TRACK_RESOLUTION_FULL:
+            tracks = self.database.retrieve_activity_simplified_data(activity_id, Keys.ACTIVITY_SIMPLIFIED_TRACKS_KEY, [ resolution ])
+            if tracks is not None and resolution in tracks:
+                return tracks[resolution]
+
+        locations = self.database.retrieve_activity_locations(activity_id)
+        if locations is None or resolution == Keys.TRACK_RESOLUTION_FULL:
+            return locations
+        return TrackSimplifier.simplify_track(locations, TrackSimplifier.TRACK_RESOLUTIONS[resolution])
+
+    def retrieve_activity_downsampled_sensor_data(self, activity_id, sensor_names):
+        """Returns a dictionary that maps each of the sensor names to its readings, downsampled for drawing charts."""
+        """Sensors that weren't downsampled when the activity was analyzed are read in full and downsampled now."""
+        if self.database is None:
+            raise Exception("No database.")
+        if activity_id is None or len(activity_id) == 0:
+            raise Exception("Bad parameter.")
+        if sensor_names is None:
+            raise Exception("Bad parameter.")
+
+        sensor_data = self.database.retrieve_activity_simplified_data(activity_id, Keys.ACTIVITY_DOWNSAMPLED_SENSORS_KEY, sensor_names)
+        if sensor_data is None:
+            sensor_data = {}
+        missing_names = [ name for name in sensor_names if name not in sensor_data ]
+        if missing_names:
+            streams = self.database.retrieve_activity_streams(activity_id, missing_names)
+            if streams is not None:
+                for name in streams:
+                    sensor_data[name] = TrackSimplifier.downsample_sensor_data(streams[name], TrackSimplifier.SENSOR_CHART_NUM_POINTS)
+        return sensor_data
+
     def delete_activity_sensor_readings(self, key, activity_id):
         """Returns all the sensor data for the specified sensor for the given activity."""
         if self.database is None:
@@ -884,7 +1150,23 @@ class DataMgr(Importer.ActivityWriter):
             raise Exception("Bad parameter.")
         if summary_data is None:
             raise Exception("Bad parameter.")
-        return self.database.create_activity_summary(activity_id, summary_data)
+
+        result = self.database.create_activity_summary(activity_id, summary_data)
+        if result:
+            self.update_training_rollups([ activity_id ])
+        return result
+
+    def create_activity_summaries(self, summaries):
+        """Create method for the summary data of several activities, given as a dictionary of activity ID to summary."""
+        if self.database is None:
+            raise Exception("No database.")
+        if summaries is None:
+            raise Exception("Bad parameter.")
+
+        result = self.database.create_activity_summaries(summaries)
+        if result:
+            self.update_training_rollups(list(summaries.keys()))
+        return result
 
     def retrieve_activity_summary(self, activity_id):
         """Retrieve method for activity summary data. Summary data is data computed from the raw data."""
@@ -958,7 +1240,11 @@ class DataMgr(Importer.ActivityWriter):
             raise Exception("Bad parameter.")
         if tags is None:
             raise Exception("Bad parameter.")
-        return self.database.create_tags_on_activity(activity, tags)
+
+        result = self.database.create_tags_on_activity(activity, tags)
+        if result and Keys.ACTIVITY_ID_KEY in activity:
+            self.update_training_rollups([ activity[Keys.ACTIVITY_ID_KEY] ])
+        return result
 
     def create_default_tags_on_activity(self, user_id, activity_type, activity_id):
         """Adds tags to an activity."""
@@ -972,7 +1258,10 @@ class DataMgr(Importer.ActivityWriter):
             if Keys.ACTIVITY_TYPE_KEY in default and default[Keys.ACTIVITY_TYPE_KEY] == activity_type:
                 tags = []
                 tags.append(default[Keys.GEAR_NAME_KEY])
-                return self.database.create_tags_on_activity_by_id(activity_id, tags)
+                result = self.database.create_tags_on_activity_by_id(activity_id, tags)
+                if result:
+                    self.update_training_rollups([ activity_id ])
+                return result
         return False
 
     def delete_tag_from_activity(self, activity, tag):
@@ -983,40 +1272,11 @@ class DataMgr(Importer.ActivityWriter):
             raise Exception("Bad parameter.")
         if tag is None:
             raise Exception("Bad parameter.")
-        return self.database.delete_tag_from_activity(activity, tag)
-
-    @staticmethod
-    def distance_for_activity(activity):
-        if Keys.APP_DISTANCE_KEY in activity:
-            return activity[Keys.APP_DISTANCE_KEY]
-        if Keys.ACTIVITY_SUMMARY_KEY in activity:
-            summary_data = activity[Keys.ACTIVITY_SUMMARY_KEY]
-            if Keys.LONGEST_DISTANCE in summary_data:
-                return summary_data[Keys.LONGEST_DISTANCE]
-        return 0.0
-
-    @staticmethod
-    def distance_for_tag_cb(tag_distances, activity, user_id):
-        if tag_distances is None:
-            return
-        if activity is None:
-            return
 
-        # Load tags associated with this activity.
-        activity_tags = None
-        if Keys.ACTIVITY_TAGS_KEY in activity:
-            activity_tags = activity[Keys.ACTIVITY_TAGS_KEY]
-
-        # No sense in proceeding if this activity does not have any tags.
-        if activity_tags is None:
-            return
-
-        # Retrieve distance for this activity.
-        distance = DataMgr.distance_for_activity(activity)
-
-        for distance_tag in tag_distances.keys():
-            if distance_tag in activity_tags:
-                tag_distances[distance_tag] = tag_distances[distance_tag] + distance
+        result = self.database.delete_tag_from_activity(activity, tag)
+        if result and Keys.ACTIVITY_ID_KEY in activity:
+            self.update_training_rollups([ activity[Keys.ACTIVITY_ID_KEY] ])
+        return result
 
     def distance_for_tags(self, user_id, tags):
         """Computes the distance (in meters) for activities with the combination of user and tag."""
@@ -1027,16 +1287,130 @@ class DataMgr(Importer.ActivityWriter):
         if tags is None:
             raise Exception("Bad parameter.")
 
-        # Initialize.
+        # The monthly rollups cover everything, with one document per month rather than one per activity.
+        totals = TrainingRollups.sum_rollups(self.retrieve_training_rollups(user_id, Keys.ROLLUP_PERIOD_MONTH, None, None))
+        tag_totals = totals[Keys.ROLLUP_TAGS_KEY]
+
         tag_distances = {}
         for tag in tags:
-            tag_distances[tag] = 0.0
-
-        # Retrieve each activity, tag_distances will be updated in the callback.
-        if not self.retrieve_each_user_activity(user_id, tag_distances, DataMgr.distance_for_tag_cb, None, None, False):
-            raise Exception("Error retrieving activities.")
+            tag_distances[tag] = float(tag_totals.get(tag, {}).get(Keys.ROLLUP_DISTANCE_KEY, 0.0))
         return tag_distances
 
+    def update_training_rollups(self, activity_ids):
+        """Brings the owners' training rollups up to date with the activities' current summaries, tags, and types. Each activity"""
+        """records what it has added to the rollups, so only the difference is applied. Returns TRUE on success, FALSE otherwise."""
+        if self.database is None:
+            raise Exception("No database.")
+        if activity_ids is None:
+            raise Exception("Bad parameter.")
+
+        result = True
+        user_increments = {}
+        for activity_id in activity_ids:
+            for _ in range(MAX_ROLLUP_ATTEMPTS):
+                activity = self.database.retrieve_activity_small(activity_id)
+                if activity is None:
+                    break
+                user_id, _, _ = self.get_activity_user(activity)
+                if user_id is None:
+                    break
+
+                old_contribution = activity.get(Keys.ACTIVITY_ROLLUP_CONTRIBUTION_KEY)
+                new_contribution = TrainingRollups.compute_contribution(activity)
+                increments = TrainingRollups.list_changes(old_contribution, new_contribution)
+                if not increments:
+                    break
+
+                # Only the update that replaces the contribution it read gets to apply the difference. If another update got there first
+                # then the activity is read again, so the difference is computed from what that update recorded.
+                if self.database.swap_activity_rollup_contribution(activity_id, old_contribution, new_contribution):
+                    TrainingRollups.merge_increments(user_increments.setdefault(str(user_id), {}), increments)
+                    break
+            else:
+                result = False
+
+        for user_id in user_increments:
+            result = self.database.update_training_rollups(user_id, user_increments[user_id]) and result
+        return result
+
+    def retrieve_training_rollups(self, user_id, period, start_time, end_time):
+        """Returns the user's daily, weekly, or monthly totals, for the periods that start at or after the start time and before the end time."""
+        """Either time may be None, for no bound."""
+        if self.database is None:
+            raise Exception("No database.")
+        if user_id is None:
+            raise Exception("Bad parameter.")
+        if period not in Keys.ROLLUP_PERIODS:
+            raise Exception("Bad parameter.")
+
+        rollups = self.database.retrieve_training_rollups(user_id, period, start_time, end_time)
+        return [ TrainingRollups.decode_rollup(rollup) for rollup in rollups ]
+
+    @staticmethod
+    def compute_training_rollups_cb(context, activity, user_id):
+        if activity is None or Keys.ACTIVITY_ID_KEY not in activity:
+            return
+
+        # Activities recorded on one of the user's devices and also tagged with the user's ID are visited twice.
+        activity_id = activity[Keys.ACTIVITY_ID_KEY]
+        contributions, increments = context
+        if activity_id in contributions:
+            return
+
+        contribution = TrainingRollups.compute_contribution(activity)
+        contributions[activity_id] = contribution
+        if contribution is not None:
+            TrainingRollups.merge_increments(increments, TrainingRollups.list_increments(contribution, 1))
+
+    def compute_training_rollups(self, user_id):
+        """Computes the user's rollups from scratch, from every one of the user's activities. Returns the contribution of each activity"""
+        """and the increments that build the rollups from nothing."""
+        contributions = {}
+        increments = {}
+        if not self.retrieve_each_user_activity(user_id, (contributions, increments), DataMgr.compute_training_rollups_cb, None, None, False):
+            raise Exception("Error retrieving the user's activities.")
+        return contributions, increments
+
+    def rebuild_training_rollups(self, user_id):
+        """Throws away the user's rollups and computes them again from every one of the user's activities. Returns TRUE on success, FALSE otherwise."""
+        if self.database is None:
+            raise Exception("No database.")
+        if user_id is None:
+            raise Exception("Bad parameter.")
+
+        contributions, increments = self.compute_training_rollups(user_id)
+        result = self.database.delete_training_rollups(user_id)
+        result = result and self.database.update_training_rollups(user_id, increments)
+        result = result and self.database.update_activity_rollup_contributions(contributions)
+        return result
+
+    def verify_training_rollups(self, user_id):
+        """Compares the user's stored rollups with ones computed from scratch. Returns a list of the (period, period start) tuples that don't match."""
+        if self.database is None:
+            raise Exception("No database.")
+        if user_id is None:
+            raise Exception("Bad parameter.")
+
+        _, increments = self.compute_training_rollups(user_id)
+        expected = {}
+        for (period, period_start), fields in increments.items():
+            expected[(period, period_start)] = TrainingRollups.decode_rollup(TrainingRollups.apply_increments({}, fields))
+
+        # Periods whose activities have all been removed may still be stored, with totals of zero.
+        mismatches = []
+        for period in Keys.ROLLUP_PERIODS:
+            for rollup in self.retrieve_training_rollups(user_id, period, None, None):
+                period_key = (period, rollup[Keys.ROLLUP_PERIOD_START_KEY])
+                del rollup[Keys.ROLLUP_PERIOD_KEY]
+                del rollup[Keys.ROLLUP_PERIOD_START_KEY]
+                if period_key in expected:
+                    if not TrainingRollups.rollups_match(expected.pop(period_key), rollup):
+                        mismatches.append(period_key)
+                elif rollup.get(Keys.ROLLUP_NUM_ACTIVITIES_KEY, 0) != 0:
+                    mismatches.append(period_key)
+        mismatches.extend(expected.keys())
+        return mismatches
+
     def create_activity_comment(self, activity_id, commenter_id, comment):
         """Create method for a comment on an activity."""
         if self.database is None:
@@ -1117,9 +1491,8 @@ class DataMgr(Importer.ActivityWriter):
 
         return goal_distance, goal_date
 
-    def refresh_personal_records_cache(self, user_id):
-        """Update method for a user's personal records. Caches the bests from the given activity and updates"""
-        """the personal record cache, if appropriate."""
+    def rebuild_personal_records(self, user_id):
+        """Rebuilds the user's personal records from the cached bests of each activity, removing the bests of activities that no longer exist."""
         if self.database is None:
             raise Exception("No database.")
         if user_id is None:
@@ -1131,31 +1504,40 @@ class DataMgr(Importer.ActivityWriter):
         # Load existing activity bests into the summarizer.
         all_activity_bests = self.database.retrieve_activity_bests_for_user(user_id)
 
-        # Cleanup the activity summary, removing any items that are no longer valid.
-        old_activity_bests = {}
-        for old_activity_id in all_activity_bests:
-            if self.activity_exists(old_activity_id):
+        # Cleanup the activity summary, removing any items that are no longer valid. One query, rather than one per activity.
+        existing_activity_ids = self.database.retrieve_existing_activity_ids(list(all_activity_bests.keys()))
+        if existing_activity_ids is None:
+            return False
+        deleted_activity_ids = [ activity_id for activity_id in all_activity_bests if activity_id not in existing_activity_ids ]
+        if len(deleted_activity_ids) > 0:
+            self.database.delete_activity_bests_for_user(user_id, deleted_activity_ids)
 
-                # Activity still exists, add its data to the summary.
-                old_activity_bests = all_activity_bests[old_activity_id]
-                if Keys.ACTIVITY_TYPE_KEY in old_activity_bests and Keys.ACTIVITY_START_TIME_KEY in old_activity_bests:
-                    old_activity_type = old_activity_bests[Keys.ACTIVITY_TYPE_KEY]
-                    old_activity_time = old_activity_bests[Keys.ACTIVITY_START_TIME_KEY]
-                    summarizer.add_activity_data(old_activity_id, old_activity_type, old_activity_time, old_activity_bests)
-            else:
+        # Add the data from each activity that still exists.
+        for activity_id in existing_activity_ids:
+            activity_bests = all_activity_bests[activity_id]
+            if Keys.ACTIVITY_TYPE_KEY in activity_bests and Keys.ACTIVITY_START_TIME_KEY in activity_bests:
+                summarizer.add_activity_data(activity_id, activity_bests[Keys.ACTIVITY_TYPE_KEY], activity_bests[Keys.ACTIVITY_START_TIME_KEY], activity_bests)
 
-                # Activity no longer exists, remove it's summary from the database.
-                self.database.delete_activity_best_for_user(user_id, old_activity_id)
+        # Create or update the personal records cache.
+        if len(summarizer.bests) > 0 and self.database.update_user_personal_records(user_id, summarizer.bests):
+            return True
+        return self.database.create_user_personal_records(user_id, summarizer.bests)
+
+    def refresh_personal_records_cache(self, user_id):
+        """Update method for a user's personal records. Rebuilds the personal record cache from the activity bests"""
+        """and schedules the analysis of any activities that haven't been analyzed."""
+        if self.database is None:
+            raise Exception("No database.")
+        if user_id is None:
+            raise Exception("Bad parameter.")
+
+        result = self.rebuild_personal_records(user_id)
 
         # Look for activities that haven't been analyzed at all.
         now = time.time()
         _ = self.analyze_unanalyzed_activities(user_id, now - SIX_MONTHS, now)
 
-        # Create or update the personal records cache.
-        if len(old_activity_bests) > 0:
-            return self.database.update_user_personal_records(user_id, summarizer.bests)
-        else:
-            return self.database.create_user_personal_records(user_id, summarizer.bests)
+        return result
 
     def update_activity_bests_and_personal_records_cache(self, user_id, activity_id, activity_type, activity_time, activity_bests, prune_activity_summary_cache):
         """Update method for a user's personal records. Caches the bests from the given activity and updates"""
@@ -1183,19 +1565,22 @@ class DataMgr(Importer.ActivityWriter):
         # Cleanup the activity summary, removing any items that are no longer valid.
         old_activity_bests = {}
         if prune_activity_summary_cache:
-            for old_activity_id in all_activity_bests:
-                if self.activity_exists(old_activity_id):
-
-                    # Activity still exists, add its data to the summary.
-                    old_activity_bests = all_activity_bests[old_activity_id]
-                    if Keys.ACTIVITY_TYPE_KEY in old_activity_bests and Keys.ACTIVITY_START_TIME_KEY in old_activity_bests:
-                        old_activity_type = old_activity_bests[Keys.ACTIVITY_TYPE_KEY]
-                        old_activity_time = old_activity_bests[Keys.ACTIVITY_START_TIME_KEY]
-                        summarizer.add_activity_data(old_activity_id, old_activity_type, old_activity_time, old_activity_bests)
-                else:
 
-                    # Activity no longer exists, remove it's summary from the database.
-                    self.database.delete_activity_best_for_user(user_id, old_activity_id)
+            # Remove the bests of activities that no longer exist. One query, rather than one per activity.
+            existing_activity_ids = self.database.retrieve_existing_activity_ids(list(all_activity_bests.keys()))
+            if existing_activity_ids is None:
+                existing_activity_ids = set(all_activity_bests.keys())
+            deleted_activity_ids = [ old_activity_id for old_activity_id in all_activity_bests if old_activity_id not in existing_activity_ids ]
+            if len(deleted_activity_ids) > 0:
+                self.database.delete_activity_bests_for_user(user_id, deleted_activity_ids)
+
+            # Add the data from each activity that still exists.
+            for old_activity_id in existing_activity_ids:
+                old_activity_bests = all_activity_bests[old_activity_id]
+                if Keys.ACTIVITY_TYPE_KEY in old_activity_bests and Keys.ACTIVITY_START_TIME_KEY in old_activity_bests:
+                    old_activity_type = old_activity_bests[Keys.ACTIVITY_TYPE_KEY]
+                    old_activity_time = old_activity_bests[Keys.ACTIVITY_START_TIME_KEY]
+                    summarizer.add_activity_data(old_activity_id, old_activity_type, old_activity_time, old_activity_bests)
         else:
             for old_activity_id in all_activity_bests:
 
@@ -1218,6 +1603,17 @@ class DataMgr(Importer.ActivityWriter):
         # Cache the summary data from this activity so we don't have to recompute everything again.
         return self.database.create_activity_bests(user_id, activity_id, activity_type, activity_time, activity_bests)
 
+    def create_activity_bests_in_bulk(self, user_id, activities_bests):
+        """Create method for the bests of several activities, given as a list of (activity ID, activity type, activity time, bests) tuples."""
+        """The personal records cache is not updated, use rebuild_personal_records once all of the bests have been written."""
+        if self.database is None:
+            raise Exception("No database.")
+        if user_id is None:
+            raise Exception("Bad parameter.")
+        if activities_bests is None:
+            raise Exception("Bad parameter.")
+        return self.database.create_activity_bests_in_bulk(user_id, activities_bests)
+
     def delete_all_user_personal_records(self, user_id):
         """Delete method for a user's personal record."""
         if self.database is None:
@@ -1273,6 +1669,14 @@ class DataMgr(Importer.ActivityWriter):
             raise Exception("Bad parameter.")
         return self.database.retrieve_planned_workouts_by_calendar_id(calendar_id)
 
+    def retrieve_planned_workouts_version_by_calendar_id(self, calendar_id):
+        """Returns a tuple of the plan version and last modified time for the calendar with the specified ID, or (None, None) if there is no such calendar."""
+        if self.database is None:
+            raise Exception("No database.")
+        if calendar_id is None:
+            raise Exception("Bad parameter.")
+        return self.database.retrieve_planned_workouts_version_by_calendar_id(calendar_id)
+
     def update_planned_workout(self, user_id, updated_workout_obj):
         """Update method for a workout."""
         if self.database is None:
@@ -1607,38 +2011,33 @@ class DataMgr(Importer.ActivityWriter):
             return self.database.update_user_doc(user)
         return False
 
+    def retrieve_rate_limiter(self):
+        """Returns the rate limiter for this process, creating it if necessary."""
+        global g_rate_limiter_lock
+        global g_rate_limiter
+        global g_rate_limiter_pid
+
+        with g_rate_limiter_lock:
+            pid = os.getpid()
+            if g_rate_limiter is None or g_rate_limiter_pid != pid:
+                if self.config.get_api_rate_limiter() == 'memory':
+                    g_rate_limiter = RateLimiter.MemoryRateLimiter()
+                else:
+                    g_rate_limiter = AppDatabase.DatabaseRateLimiter(self.database.rate_limits_collection)
+                g_rate_limiter_pid = pid
+            return g_rate_limiter
+
     def check_api_rate(self, api_key, max_rate):
-        """Verifies that the API key is not being overused."""
+        """Verifies that the API key is not being overused. The rate is the number of requests allowed in any 24 hour period."""
         """Returns TRUE if it is fine to process the request, FALSE otherwise."""
-        global g_api_key_rate_lock
-        global g_api_key_rates
-        global g_last_api_reset
-
         if self.database is None:
             raise Exception("No database.")
         if api_key is None:
             raise Exception("Bad parameter.")
+        if max_rate is None:
+            raise Exception("Bad parameter.")
 
-        result = True
-        g_api_key_rate_lock.acquire()
-
-        # Once a day we should reset the countesr. This algorithm is overly simplistic and
-        # could almost certainly be improved but is good enough for now.
-        now = time.time()
-        if now - g_last_api_reset > Units.SECS_PER_DAY:
-            g_api_key_rates = {}
-            g_last_api_reset = now
-
-        # Check and increment the request count.
-        try:
-            current_rate = g_api_key_rates[api_key]
-            result = current_rate <= max_rate
-            g_api_key_rates[api_key] = current_rate + 1
-        except:
-            g_api_key_rates[api_key] = 1
-        finally:
-            g_api_key_rate_lock.release()
-        return result
+        return self.retrieve_rate_limiter().check(str(api_key), max_rate, Units.SECS_PER_DAY)
 
     def list_unsynched_activities(self, user_id, last_sync_date):
         """Returns a list of activity IDs with last modified times greater than the date provided."""
@@ -1781,7 +2180,10 @@ class DataMgr(Importer.ActivityWriter):
             raise Exception("Bad parameter.")
 
         if self.map_search is None:
-            self.map_search = MapSearch.MapSearch(self.root_url + '/data/world.geo.json', self.root_url + '/data/us_states.geo.json', self.root_url + '/data/canada.geo.json')
+            index_file_name = self.config.get_map_index_file()
+            if len(index_file_name) == 0:
+                index_file_name = None
+            self.map_search = retrieve_map_search(self.root_url, index_file_name)
         if self.map_search is None:
             raise Exception("Internal error.")
 
@@ -1848,8 +2250,23 @@ class DataMgr(Importer.ActivityWriter):
         swimming_summary = summarizer.get_summary_dictionary(Keys.TYPE_POOL_SWIMMING_KEY)
         return cycling_bests, running_bests, swimming_bests, cycling_summary, running_summary, swimming_summary
 
+    def retrieve_top_records_for_user(self, user_id, activity_type, record_name, cutoff_time_lower, cutoff_time_higher, limit):
+        """Returns the user's best 'limit' performances for the given record, i.e. the best 5K in the last 90 days, as a list of"""
+        """(activity ID, start time, value) tuples, best first. Either cutoff time may be None."""
+        if self.database is None:
+            raise Exception("No database.")
+        if user_id is None:
+            raise Exception("Bad parameter.")
+        if activity_type is None:
+            raise Exception("Bad parameter.")
+        if record_name is None:
+            raise Exception("Bad parameter.")
+
+        lower_is_better = record_name in Keys.TIME_KEYS
+        return self.database.retrieve_top_records_for_user(user_id, activity_type, record_name, cutoff_time_lower, cutoff_time_higher, lower_is_better, limit)
+
     def analyze_unanalyzed_activities(self, user_id, start_time, end_time):
-        """Looks through the user's activities (within the given timeframe) and schedules any unanalyzed ones for analysis."""
+        """Looks through the user's activities (within the given timeframe) and, if any haven't been analyzed, schedules a batch job to analyze them."""
         if self.database is None:
             raise Exception("No database.")
         if user_id is None:
@@ -1870,7 +2287,10 @@ class DataMgr(Importer.ActivityWriter):
                 activity_time = activity[Keys.ACTIVITY_START_TIME_KEY]
                 if activity_time > start_time and activity_time <= end_time and activity_id not in all_activity_bests:
                     num_unanalyzed = num_unanalyzed + 1
-                    self.analyze_activity_by_id(activity_id, user_id)
+
+        # One job for all of them, rather than one task per activity.
+        if num_unanalyzed > 0:
+            self.schedule_batch_analysis(user_id, True)
 
         return num_unanalyzed
 
@@ -1889,27 +2309,26 @@ class DataMgr(Importer.ActivityWriter):
 
         bests = []
 
-        # Load cached summary data from all previous activities.
-        all_activity_bests = self.database.retrieve_activity_bests_for_user(user_id)
-        if all_activity_bests is not None:
-            best_value = None
-    
-            # Loop through each of the user's activities, the key is the activity ID.
-            for activity in user_activities:
-                if Keys.ACTIVITY_ID_KEY in activity:
-                    activity_id = activity[Keys.ACTIVITY_ID_KEY]
-
-                    # Check the list of bests for the activity ID.
-                    if activity_id in all_activity_bests:
-                        activity_bests = all_activity_bests[activity_id]
-                        if (Keys.ACTIVITY_TYPE_KEY in activity_bests) and (activity_bests[Keys.ACTIVITY_TYPE_KEY] == activity_type) and (key in activity_bests):
-                            current_value = activity_bests[key]
-                            if best_value is None or Summarizer.Summarizer.is_better(key, best_value, current_value):
-                                record = []
-                                record.append(current_value)
-                                record.append(activity_id)
-                                bests.append(record)
-                                best_value = current_value
+        # Load the cached value of this record from all previous activities of this type.
+        record_history = {}
+        for activity_id, _, value in self.database.retrieve_record_history_for_user(user_id, activity_type, key):
+            record_history[activity_id] = value
+        best_value = None
+
+        # Loop through each of the user's activities.
+        for activity in user_activities:
+            if Keys.ACTIVITY_ID_KEY in activity:
+                activity_id = activity[Keys.ACTIVITY_ID_KEY]
+
+                # Check the record history for the activity ID.
+                if activity_id in record_history:
+                    current_value = record_history[activity_id]
+                    if best_value is None or Summarizer.Summarizer.is_better(key, current_value, best_value):
+                        record = []
+                        record.append(current_value)
+                        record.append(activity_id)
+                        bests.append(record)
+                        best_value = current_value
 
         return bests
 
@@ -1929,11 +2348,23 @@ class DataMgr(Importer.ActivityWriter):
         if num_unanalyzed_activities > 0:
             raise Exception("Too many unanalyzed activities to sum activity intensities.")
 
-        # Initialize.
+        # Whole days come from the daily rollups. Activities on the partial days at either end of the range are read individually.
+        # The activity queries exclude both bounds, the rollups include the start of the first whole day.
+        first_day = TrainingRollups.period_start(Keys.ROLLUP_PERIOD_DAY, start_time)
+        if first_day <= start_time:
+            first_day = first_day + TrainingRollups.SECS_PER_DAY
+        last_day = TrainingRollups.period_start(Keys.ROLLUP_PERIOD_DAY, end_time)
         intensities = []
+        if first_day < last_day:
+            for rollup in self.retrieve_training_rollups(user_id, Keys.ROLLUP_PERIOD_DAY, first_day, last_day):
+                intensities.append(rollup.get(Keys.ROLLUP_INTENSITY_SCORE_KEY, 0.0))
+            ranges = [ (start_time, first_day), (last_day - 1, end_time) ]
+        else:
+            ranges = [ (start_time, end_time) ]
 
-        if not self.retrieve_each_user_activity(user_id, intensities, DataMgr.update_training_intensity_cb, start_time, end_time, False):
-            raise Exception("Error retrieving the user's activities.")
+        for range_start, range_end in ranges:
+            if not self.retrieve_each_user_activity(user_id, intensities, DataMgr.update_training_intensity_cb, range_start, range_end, False):
+                raise Exception("Error retrieving the user's activities.")
 
         return sum(intensities)
 
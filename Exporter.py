@@ -37,178 +37,116 @@ libmathdir = os.path.join(currentdir, 'LibMath', 'python')
 sys.path.insert(0, libmathdir)
 import distance
 
+EXPORT_CHUNK_POINTS = 1000 # Number of points formatted before a chunk of the file is handed to the caller
+
+def sensor_reading_time(reading):
+    """Sensor readings are stored as single item dictionaries that map the time to the value."""
+    return float(next(iter(reading)))
+
+def sensor_reading_value(reading):
+    """Returns the value from a sensor reading."""
+    return next(iter(reading.values()))
+
+def location_time(location):
+    """Returns the time of a location, in milliseconds since the epoch."""
+    return location[Keys.LOCATION_TIME_KEY]
+
+class StreamCursor(object):
+    """Walks one time sorted stream in step with the export's clock. Since the clock only moves forward, merging"""
+    """any number of streams is a single pass over each of them."""
+
+    def __init__(self, readings, time_fn):
+        super(StreamCursor, self).__init__()
+        self.readings = readings
+        self.time_fn = time_fn
+        self.index = 0
+
+    def seek(self, time_ms):
+        """Returns the first reading at or after the given time, or None if the stream ended before it."""
+        num_readings = len(self.readings)
+        while self.index < num_readings and self.time_fn(self.readings[self.index]) < time_ms:
+            self.index = self.index + 1
+        if self.index < num_readings:
+            return self.readings[self.index]
+        return None
+
 class Exporter(object):
     """Exporter for GPX and TCX data as well as CSV accelerometer data."""
+    """Each format is written by a generator that yields the file a chunk at a time, so a long activity can be"""
+    """streamed to the client without building the whole file in memory first."""
 
     def __init__(self):
         super(Exporter, self).__init__()
 
-    def nearest_sensor_reading(self, time_ms, current_reading, sensor_iter):
-        try:
-            if current_reading is None:
-                current_reading = next(sensor_iter)
-            else:
-                sensor_time = float(list(current_reading.keys())[0])
-                while sensor_time < time_ms:
-                    current_reading = next(sensor_iter)
-                    sensor_time = float(list(current_reading.keys())[0])
-        except StopIteration:
-            return None
-        return current_reading
-
-    def nearest_loc_reading(self, time_ms, current_reading, nearest_loc, loc_iter):
-        try:
-            if current_reading is None:
-                current_reading = next(loc_iter)
-            else:
-                sensor_time = current_reading[Keys.APP_AXIS_TIME]
-                while sensor_time < time_ms:
-                    current_reading = next(loc_iter)
-                    sensor_time = current_reading[Keys.APP_AXIS_TIME]
-        except StopIteration:
-            return None
-        return nearest_loc
-
-    def nearest_accel_reading(self, time_ms, current_reading, accel_iter):
-        try:
-            if current_reading is None:
-                current_reading = next(accel_iter)
-            else:
-                sensor_time = current_reading[Keys.APP_AXIS_TIME]
-                while sensor_time < time_ms:
-                    current_reading = next(accel_iter)
-                    sensor_time = current_reading[Keys.APP_AXIS_TIME]
-        except StopIteration:
-            return None
-        return current_reading
-
-    def export_as_csv(self, file_name, activity):
+    def create_sensor_cursors(self, activity):
+        """Returns cursors for the cadence, heart rate, temperature and power readings, in that order."""
+        cursors = []
+        for key in [Keys.APP_CADENCE_KEY, Keys.APP_HEART_RATE_KEY, Keys.APP_TEMP_KEY, Keys.APP_POWER_KEY]:
+            readings = []
+            if key in activity and activity[key]:
+                readings = activity[key]
+            cursors.append(StreamCursor(readings, sensor_reading_time))
+        return cursors
+
+    def stream_as_csv(self, activity):
         """Formats the activity data as CSV."""
         accel_readings = []
         locations = []
-        cadence_readings = []
-        hr_readings = []
-        temp_readings = []
-        power_readings = []
 
-        if Keys.APP_ACCELEROMETER_KEY in activity:
+        if Keys.APP_ACCELEROMETER_KEY in activity and activity[Keys.APP_ACCELEROMETER_KEY]:
             accel_readings = activity[Keys.APP_ACCELEROMETER_KEY]
-        if Keys.APP_LOCATIONS_KEY in activity:
+        if Keys.APP_LOCATIONS_KEY in activity and activity[Keys.APP_LOCATIONS_KEY]:
             locations = activity[Keys.APP_LOCATIONS_KEY]
-        if Keys.APP_CADENCE_KEY in activity:
-            cadence_readings = activity[Keys.APP_CADENCE_KEY]
-        if Keys.APP_HEART_RATE_KEY in activity:
-            hr_readings = activity[Keys.APP_HEART_RATE_KEY]
-        if Keys.APP_TEMP_KEY in activity:
-            temp_readings = activity[Keys.APP_TEMP_KEY]
-        if Keys.APP_POWER_KEY in activity:
-            power_readings = activity[Keys.APP_POWER_KEY]
-
-        accel_iter = iter(accel_readings)
-        location_iter = iter(locations)
-        cadence_iter = iter(cadence_readings)
-        hr_iter = iter(hr_readings)
-        temp_iter = iter(temp_readings)
-        power_iter = iter(power_readings)
-
-        nearest_accel = None
-        nearest_loc = None
-        nearest_cadence = None
-        nearest_hr = None
-        nearest_temp = None
-        nearest_power = None
-
-        buf = "time,latitude,longitude,altitude,cadence,hr,temp,power,x,y,z\r\n"
-        done = False
-        while not done:
-            try:
-                # Get the next location. If we have accelerometer data then we should key off of that
-                # timestamp since those are typically sampled at sub-second intervals.
-                if accel_readings:
-                    nearest_accel = next(accel_iter)
-                    current_time = nearest_accel[Keys.APP_AXIS_TIME]
-                    nearest_loc = self.nearest_loc_reading(current_time, nearest_accel, nearest_loc, location_iter)
-                else:
-                    nearest_loc = next(location_iter)
-                    current_time = nearest_loc[Keys.LOCATION_TIME_KEY]
-
-                # Get the next sensor readings.
-                nearest_cadence = self.nearest_sensor_reading(current_time, nearest_cadence, cadence_iter)
-                nearest_hr = self.nearest_sensor_reading(current_time, nearest_hr, hr_iter)
-                nearest_temp = self.nearest_sensor_reading(current_time, nearest_temp, temp_iter)
-                nearest_power = self.nearest_sensor_reading(current_time, nearest_power, power_iter)
-
-                # Write the next row.
-                buf += str(current_time)
-                buf += ","
-                if nearest_loc:
-                    buf += str(nearest_loc[Keys.LOCATION_LAT_KEY])
-                    buf += ","
-                    buf += str(nearest_loc[Keys.LOCATION_LON_KEY])
-                    buf += ","
-                    buf += str(nearest_loc[Keys.LOCATION_ALT_KEY])
-                    buf += ","
-                else:
-                    buf += ",,,"
-                if nearest_cadence:
-                    buf += str(nearest_cadence)
-                buf += ","
-                if nearest_hr:
-                    buf += str(nearest_hr)
-                buf += ","
-                if nearest_temp:
-                    buf += str(nearest_temp)
-                buf += ","
-                if nearest_power:
-                    buf += str(nearest_power)
-                buf += ","
-                if nearest_accel:
-                    buf += str(nearest_accel[Keys.APP_AXIS_NAME_X])
-                    buf += ","
-                    buf += str(nearest_accel[Keys.APP_AXIS_NAME_Y])
-                    buf += ","
-                    buf += str(nearest_accel[Keys.APP_AXIS_NAME_Z])
-                    buf += ","
-                else:
-                    buf += ",,,"
-                buf += "\r\n"
-            except StopIteration:
-                done = True
 
-        return buf
+        sensor_cursors = self.create_sensor_cursors(activity)
+        location_cursor = StreamCursor(locations, location_time)
 
-    def export_as_gpx(self, file_name, activity):
-        """Exports the activity in GPX format."""
-        locations = []
-        cadence_readings = []
-        hr_readings = []
-        temp_readings = []
-        power_readings = []
+        # If we have accelerometer data then we should key off of that timestamp since those are
+        # typically sampled at sub-second intervals.
+        if accel_readings:
+            clock = accel_readings
+        else:
+            clock = locations
+
+        rows = ["time,latitude,longitude,altitude,cadence,hr,temp,power,x,y,z\r\n"]
+        for point in clock:
+            if accel_readings:
+                nearest_accel = point
+                current_time = nearest_accel[Keys.APP_AXIS_TIME]
+                nearest_loc = location_cursor.seek(current_time)
+            else:
+                nearest_accel = None
+                nearest_loc = point
+                current_time = nearest_loc[Keys.LOCATION_TIME_KEY]
+
+            # Write the next row.
+            row = [str(current_time)]
+            if nearest_loc is not None:
+                row.extend([str(nearest_loc[Keys.LOCATION_LAT_KEY]), str(nearest_loc[Keys.LOCATION_LON_KEY]), str(nearest_loc[Keys.LOCATION_ALT_KEY])])
+            else:
+                row.extend(["", "", ""])
+            for cursor in sensor_cursors:
+                nearest_reading = cursor.seek(current_time)
+                if nearest_reading is not None:
+                    row.append(str(sensor_reading_value(nearest_reading)))
+                else:
+                    row.append("")
+            if nearest_accel is not None:
+                row.extend([str(nearest_accel[Keys.APP_AXIS_NAME_X]), str(nearest_accel[Keys.APP_AXIS_NAME_Y]), str(nearest_accel[Keys.APP_AXIS_NAME_Z])])
+            else:
+                row.extend(["", "", ""])
+            rows.append(",".join(row) + "\r\n")
 
-        if Keys.APP_LOCATIONS_KEY in activity:
-            locations = activity[Keys.APP_LOCATIONS_KEY]
-        if Keys.APP_CADENCE_KEY in activity:
-            cadence_readings = activity[Keys.APP_CADENCE_KEY]
-        if Keys.APP_HEART_RATE_KEY in activity:
-            hr_readings = activity[Keys.APP_HEART_RATE_KEY]
-        if Keys.APP_TEMP_KEY in activity:
-            temp_readings = activity[Keys.APP_TEMP_KEY]
-        if Keys.APP_POWER_KEY in activity:
-            power_readings = activity[Keys.APP_POWER_KEY]
-
-        location_iter = iter(locations)
-        if len(locations) == 0:
-            raise Exception("No locations for this activity.")
+            if len(rows) >= EXPORT_CHUNK_POINTS:
+                yield ''.join(rows)
+                rows = []
 
-        cadence_iter = iter(cadence_readings)
-        hr_iter = iter(hr_readings)
-        temp_iter = iter(temp_readings)
-        power_iter = iter(power_readings)
+        yield ''.join(rows)
 
-        nearest_cadence = None
-        nearest_hr = None
-        nearest_temp = None
-        nearest_power = None
+    def stream_as_gpx(self, file_name, activity):
+        """Exports the activity in GPX format."""
+        locations = activity[Keys.APP_LOCATIONS_KEY]
+        cadence_cursor, hr_cursor, _, _ = self.create_sensor_cursors(activity)
 
         writer = GpxWriter.GpxWriter()
         writer.create_gpx(file_name, "")
@@ -220,82 +158,47 @@ class Exporter(object):
         writer.write_type(activity[Keys.ACTIVITY_TYPE_KEY])
         writer.start_track_segment()
 
-        done = False
-        while not done:
-            try:
-                # Get the next location.
-                current_location = next(location_iter)
-                current_lat = current_location[Keys.LOCATION_LAT_KEY]
-                current_lon = current_location[Keys.LOCATION_LON_KEY]
-                current_alt = current_location[Keys.LOCATION_ALT_KEY]
-                current_time = current_location[Keys.LOCATION_TIME_KEY]
-
-                # Get the next sensor readings.
-                nearest_cadence = self.nearest_sensor_reading(current_time, nearest_cadence, cadence_iter)
-                nearest_hr = self.nearest_sensor_reading(current_time, nearest_hr, hr_iter)
-                nearest_temp = self.nearest_sensor_reading(current_time, nearest_temp, temp_iter)
-                nearest_power = self.nearest_sensor_reading(current_time, nearest_power, power_iter)
-
-                # Write the next location.
-                writer.start_trackpoint(current_lat, current_lon, current_alt, current_time)
-
-                # Write any associated sensor readings.
-                if nearest_cadence or nearest_hr:
-                    writer.start_extensions()
-                    writer.start_trackpoint_extensions()
-
-                    if nearest_cadence is not None:
-                        writer.store_cadence_rpm(list(nearest_cadence.values())[0])
-                    if nearest_hr is not None:
-                        writer.store_heart_rate_bpm(list(nearest_hr.values())[0])
-
-                    writer.end_trackpoint_extensions()
-                    writer.end_extensions()
-
-                writer.end_trackpoint()
-            except StopIteration:
-                done = True
+        for point_index, current_location in enumerate(locations):
+            current_lat = current_location[Keys.LOCATION_LAT_KEY]
+            current_lon = current_location[Keys.LOCATION_LON_KEY]
+            current_alt = current_location[Keys.LOCATION_ALT_KEY]
+            current_time = current_location[Keys.LOCATION_TIME_KEY]
 
-        writer.end_track_segment()
-        writer.end_track()
-        writer.close()
+            # Get the next sensor readings.
+            nearest_cadence = cadence_cursor.seek(current_time)
+            nearest_hr = hr_cursor.seek(current_time)
 
-        result = writer.buffer()
+            # Write the next location.
+            writer.start_trackpoint(current_lat, current_lon, current_alt, current_time)
 
-        return result
+            # Write any associated sensor readings.
+            if nearest_cadence is not None or nearest_hr is not None:
+                writer.start_extensions()
+                writer.start_trackpoint_extensions()
 
-    def export_as_tcx(self, file_name, activity):
-        """Exports the activity in TCX format."""
-        locations = []
-        cadence_readings = []
-        hr_readings = []
-        temp_readings = []
-        power_readings = []
+                if nearest_cadence is not None:
+                    writer.store_cadence_rpm(sensor_reading_value(nearest_cadence))
+                if nearest_hr is not None:
+                    writer.store_heart_rate_bpm(sensor_reading_value(nearest_hr))
 
-        if Keys.APP_LOCATIONS_KEY in activity:
-            locations = activity[Keys.APP_LOCATIONS_KEY]
-        if Keys.APP_CADENCE_KEY in activity:
-            cadence_readings = activity[Keys.APP_CADENCE_KEY]
-        if Keys.APP_HEART_RATE_KEY in activity:
-            hr_readings = activity[Keys.APP_HEART_RATE_KEY]
-        if Keys.APP_TEMP_KEY in activity:
-            temp_readings = activity[Keys.APP_TEMP_KEY]
-        if Keys.APP_POWER_KEY in activity:
-            power_readings = activity[Keys.APP_POWER_KEY]
-
-        location_iter = iter(locations)
-        if len(locations) == 0:
-            raise Exception("No locations for this activity.")
+                writer.end_trackpoint_extensions()
+                writer.end_extensions()
+
+            writer.end_trackpoint()
+
+            if (point_index + 1) % EXPORT_CHUNK_POINTS == 0:
+                yield writer.take()
+
+        writer.end_track_segment()
+        writer.end_track()
+        writer.close()
 
-        cadence_iter = iter(cadence_readings)
-        hr_iter = iter(hr_readings)
-        temp_iter = iter(temp_readings)
-        power_iter = iter(power_readings)
+        yield writer.take()
 
-        nearest_cadence = None
-        nearest_hr = None
-        nearest_temp = None
-        nearest_power = None
+    def stream_as_tcx(self, file_name, activity):
+        """Exports the activity in TCX format."""
+        locations = activity[Keys.APP_LOCATIONS_KEY]
+        cadence_cursor, hr_cursor, temp_cursor, power_cursor = self.create_sensor_cursors(activity)
 
         writer = TcxWriter.TcxWriter()
         writer.create_tcx(file_name)
@@ -316,82 +219,75 @@ class Exporter(object):
         # The lap ID is just the start time for the lap.
         writer.store_id(lap_start_time_ms / 1000)
 
+        writer.start_lap(lap_start_time_ms)
+        writer.store_lap_seconds(lap_time_sec)
+        writer.store_lap_distance(lap_distance_meters)
+        writer.store_lap_calories(0)
+        writer.start_track()
+
         prev_location = None
-        done = False
-        while not done:
-
-            writer.start_lap(lap_start_time_ms)
-            writer.store_lap_seconds(lap_time_sec)
-            writer.store_lap_distance(lap_distance_meters)
-            writer.store_lap_calories(0)
-            writer.start_track()
-
-            while not done:
-
-                try:
-                    # Get the next location.
-                    current_location = next(location_iter)
-                    current_lat = current_location[Keys.LOCATION_LAT_KEY]
-                    current_lon = current_location[Keys.LOCATION_LON_KEY]
-                    current_alt = current_location[Keys.LOCATION_ALT_KEY]
-                    current_time = current_location[Keys.LOCATION_TIME_KEY]
-
-                    # Get the next sensor readings.
-                    nearest_cadence = self.nearest_sensor_reading(current_time, nearest_cadence, cadence_iter)
-                    nearest_hr = self.nearest_sensor_reading(current_time, nearest_hr, hr_iter)
-                    nearest_temp = self.nearest_sensor_reading(current_time, nearest_temp, temp_iter)
-                    nearest_power = self.nearest_sensor_reading(current_time, nearest_power, power_iter)
-
-                    writer.start_trackpoint()
-                    writer.store_time(current_time)
-                    writer.store_position(current_lat, current_lon)
-                    writer.store_altitude_meters(current_alt)
-
-                    if prev_location is not None:
-                        prev_lat = prev_location[Keys.LOCATION_LAT_KEY]
-                        prev_lon = prev_location[Keys.LOCATION_LON_KEY]
-                        prev_alt = prev_location[Keys.LOCATION_ALT_KEY]
-                        meters_traveled = distance.haversine_distance(current_lat, current_lon, current_alt, prev_lat, prev_lon, prev_alt)
-                        writer.store_distance_meters(meters_traveled)
-
-                    if nearest_cadence is not None:
-                        writer.store_cadence_rpm(list(nearest_cadence.values())[0])
-                    if nearest_hr is not None:
-                        writer.store_heart_rate_bpm(list(nearest_hr.values())[0])
-
-                    if nearest_temp is not None or nearest_power is not None:
-                        writer.start_trackpoint_extensions()
-                        if nearest_temp is not None:
-                            pass
-                        if nearest_power is not None:
-                            writer.store_power_in_watts(list(nearest_power.values())[0])
-                        writer.end_trackpoint_extensions()
-
-                    writer.end_trackpoint()
-
-                    prev_location = current_location
-                except StopIteration:
-                    done = True
-
-            writer.end_track()
-            writer.end_lap()
+        for point_index, current_location in enumerate(locations):
+            current_lat = current_location[Keys.LOCATION_LAT_KEY]
+            current_lon = current_location[Keys.LOCATION_LON_KEY]
+            current_alt = current_location[Keys.LOCATION_ALT_KEY]
+            current_time = current_location[Keys.LOCATION_TIME_KEY]
+
+            # Get the next sensor readings.
+            nearest_cadence = cadence_cursor.seek(current_time)
+            nearest_hr = hr_cursor.seek(current_time)
+            nearest_temp = temp_cursor.seek(current_time)
+            nearest_power = power_cursor.seek(current_time)
+
+            writer.start_trackpoint()
+            writer.store_time(current_time)
+            writer.store_position(current_lat, current_lon)
+            writer.store_altitude_meters(current_alt)
+
+            if prev_location is not None:
+                prev_lat = prev_location[Keys.LOCATION_LAT_KEY]
+                prev_lon = prev_location[Keys.LOCATION_LON_KEY]
+                prev_alt = prev_location[Keys.LOCATION_ALT_KEY]
+                meters_traveled = distance.haversine_distance(current_lat, current_lon, current_alt, prev_lat, prev_lon, prev_alt)
+                writer.store_distance_meters(meters_traveled)
+
+            if nearest_cadence is not None:
+                writer.store_cadence_rpm(sensor_reading_value(nearest_cadence))
+            if nearest_hr is not None:
+                writer.store_heart_rate_bpm(sensor_reading_value(nearest_hr))
+
+            if nearest_temp is not None or nearest_power is not None:
+                writer.start_trackpoint_extensions()
+                if nearest_power is not None:
+                    writer.store_power_in_watts(sensor_reading_value(nearest_power))
+                writer.end_trackpoint_extensions()
+
+            writer.end_trackpoint()
+
+            prev_location = current_location
+
+            if (point_index + 1) % EXPORT_CHUNK_POINTS == 0:
+                yield writer.take()
 
+        writer.end_track()
+        writer.end_lap()
         writer.end_activity()
         writer.close()
 
-        result = writer.buffer()
+        yield writer.take()
 
-        return result
+    def export_stream(self, activity, file_name, file_type):
+        """Returns a generator that yields the activity, in the specified format, a chunk at a time."""
+        """Problems with the request are raised here, rather than part way through the response."""
+        if file_type == 'csv':
+            return self.stream_as_csv(activity)
+        if file_type not in ['gpx', 'tcx']:
+            raise Exception("Invalid file type specified.")
+        if Keys.APP_LOCATIONS_KEY not in activity or not activity[Keys.APP_LOCATIONS_KEY]:
+            raise Exception("No locations for this activity.")
+        if file_type == 'gpx':
+            return self.stream_as_gpx(file_name, activity)
+        return self.stream_as_tcx(file_name, activity)
 
     def export(self, activity, file_name, file_type):
         """Exports the activity in the specified format."""
-        buf = ""
-        if file_type == 'csv':
-            buf = self.export_as_csv(file_name, activity)
-        elif file_type == 'gpx':
-            buf = self.export_as_gpx(file_name, activity)
-        elif file_type == 'tcx':
-            buf = self.export_as_tcx(file_name, activity)
-        else:
-            raise Exception("Invalid file type specified.")
-        return buf
+        return ''.join(self.export_stream(activity, file_name, file_type))
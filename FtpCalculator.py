@@ -25,6 +25,7 @@
 
 import time
 import Keys
+import numpy as np
 
 class FtpCalculator(object):
     """Estimates functional threshold power and power training zones"""
@@ -75,20 +76,12 @@ class FtpCalculator(object):
     def compute_power_zone_distribution(self, ftp, powers):
         """Takes the list of power readings and determines how many belong in each power zone, based on the user's FTP."""
         zones = self.power_training_zones(ftp)
-        distribution = [0.0] * (len(zones) + 1)
-        for datum in powers:
-            value = float(list(datum.values())[0])
-            index = 0
-            found = False
-            for zone_cutoff in zones:
-                if value <= zone_cutoff:
-                    distribution[index] = distribution[index] + 1
-                    found = True
-                    break
-                index = index + 1
-            if not found:
-                distribution[index] = distribution[index] + 1
-        return distribution
+        values = np.array([ value for datum in powers for value in datum.values() ], dtype=float)
+
+        # Each reading belongs to the first zone whose cutoff it doesn't exceed, or to the last zone if it exceeds them all.
+        zone_indexes = np.searchsorted(zones, values, side='left')
+        distribution = np.bincount(zone_indexes, minlength=len(zones) + 1)
+        return [ float(count) for count in distribution ]
 
     def add_activity_data(self, activity_type, start_time, summary_data):
         """Looks for data that will help us determine the user's FTP. start_time is unix time (in seconds) and is used to compare against the cutoff time."""
@@ -101,6 +94,15 @@ class FtpCalculator(object):
         if activity_type not in Keys.CYCLING_ACTIVITIES:
             return
 
+        # Prefer the power curve, if it was computed, since it is computed from the time weighted power.
+        power_curve = summary_data.get(Keys.POWER_CURVE)
+        if isinstance(power_curve, dict):
+            if str(20 * 60) in power_curve:
+                self.best_20min.append(power_curve[str(20 * 60)])
+            if str(60 * 60) in power_curve:
+                self.best_1hr.append(power_curve[str(60 * 60)])
+            return
+
         if Keys.BEST_20_MIN_POWER in summary_data:
             self.best_20min.append(summary_data[Keys.BEST_20_MIN_POWER])
         if Keys.BEST_1_HOUR_POWER in summary_data:
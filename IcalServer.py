@@ -23,8 +23,41 @@
 # SOFTWARE.
 """Handles ical calendar requests."""
 
+import email.utils
+
+import Cache
 import IcsWriter
 
+CALENDARS_CACHE_NAME = "calendars"
+MAX_CACHED_CALENDARS = 1000 # Calendars can be large, so this is less than the other caches
+CALENDAR_CACHE_TTL_SECS = 3600 # Cached calendars are tagged with their plan version, so this only limits how long an unused calendar takes up memory
+CALENDAR_CONTENT_TYPE = "text/calendar; charset=utf-8"
+CALENDAR_CACHE_CONTROL = "private, no-cache" # Clients may keep a copy, but should check it with us before using it
+
+def format_etag(version):
+    """Returns the entity tag for the given plan version."""
+    return '"' + version + '"'
+
+def etag_matches(if_none_match, etag):
+    """Returns TRUE if the If-None-Match header value (a comma separated list of entity tags, or *) includes the entity tag."""
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag or candidate == "*":
+            return True
+    return False
+
+def not_modified_since(if_modified_since, last_modified):
+    """Returns TRUE if the plan hasn't changed since the time in the If-Modified-Since header value."""
+    try:
+        since = email.utils.parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since is None:
+        return False
+    return last_modified <= since.timestamp()
+
 class IcalServer(object):
     """Handles ical calendar requests."""
 
@@ -32,30 +65,59 @@ class IcalServer(object):
         self.user_mgr = user_mgr
         self.data_mgr = data_mgr
         self.root_url = root_url
+        self.calendar_cache = Cache.TtlCache(CALENDARS_CACHE_NAME, MAX_CACHED_CALENDARS, CALENDAR_CACHE_TTL_SECS) # Maps the calendar ID to (plan version, calendar)
         super(IcalServer, self).__init__()
 
-    def handle_request(self, calendar_id):
+    def create_calendar(self, workouts):
+        """Returns the calendar for the list of workouts, as a string."""
         calendar_name = "Planned Workouts"
-
-        workouts = self.data_mgr.retrieve_planned_workouts_by_calendar_id(calendar_id)
-        if workouts is None:
-            return False, ""
         ics_writer = IcsWriter.IcsWriter()
 
-        response  = "BEGIN:VCALENDAR\n"
-        response += "NAME:" + calendar_name + "\r\n"
-        response += "X-WR-CALNAME:" + calendar_name + "\r\n"
-        response += "VERSION:2.0\r\n" # iCal format version 2.0
-        response += "CALSCALE:GREGORIAN\r\n"
-        response += "METHOD:PUBLISH\r\n"
+        parts = []
+        parts.append("BEGIN:VCALENDAR\r\n")
+        parts.append("NAME:" + calendar_name + "\r\n")
+        parts.append("X-WR-CALNAME:" + calendar_name + "\r\n")
+        parts.append("VERSION:2.0\r\n") # iCal format version 2.0
+        parts.append("CALSCALE:GREGORIAN\r\n")
+        parts.append("METHOD:PUBLISH\r\n")
 
         for workout in workouts:
             start_time = workout.scheduled_time
             if start_time is not None:
-                summary  = workout.export_to_text(None).replace("\n", "\\n")
-                summary += "\\n"
-                summary += self.root_url + "/workout/" + str(workout.workout_id)
-                response += ics_writer.create_event(workout.workout_id, start_time, None, workout.type, summary)
+                summary = workout.export_to_text(None).replace("\n", "\\n") + "\\n" + self.root_url + "/workout/" + str(workout.workout_id)
+                parts.append(ics_writer.create_event(workout.workout_id, start_time, None, workout.type, summary))
 
-        response += "END:VCALENDAR\r\n"
-        return True, response
+        parts.append("END:VCALENDAR\r\n")
+        return "".join(parts)
+
+    def handle_request(self, calendar_id, if_none_match=None, if_modified_since=None):
+        """Returns a tuple of the HTTP status code, the calendar (empty unless the status is 200), and a dictionary of response headers."""
+        """The plan version is cached, so a client whose copy is up to date gets a 304 without the database being read."""
+        version, last_modified = self.data_mgr.retrieve_planned_workouts_version_by_calendar_id(calendar_id)
+        if version is None:
+            return 404, "", {}
+
+        etag = format_etag(version)
+        headers = { "ETag": etag, "Cache-Control": CALENDAR_CACHE_CONTROL, "Content-Type": CALENDAR_CONTENT_TYPE }
+        if last_modified is not None:
+            headers["Last-Modified"] = email.utils.formatdate(last_modified, usegmt=True)
+
+        # If-Modified-Since is only used by clients that don't send If-None-Match.
+        if if_none_match:
+            if etag_matches(if_none_match, etag):
+                return 304, "", headers
+        elif if_modified_since and last_modified is not None:
+            if not_modified_since(if_modified_since, last_modified):
+                return 304, "", headers
+
+        # Only build the calendar if the cached copy is from an older version of the plan.
+        found, cached = self.calendar_cache.get(calendar_id)
+        if found and cached[0] == version:
+            return 200, cached[1], headers
+
+        workouts = self.data_mgr.retrieve_planned_workouts_by_calendar_id(calendar_id)
+        if workouts is None:
+            return 404, "", {}
+        calendar = self.create_calendar(workouts)
+        self.calendar_cache.put(calendar_id, (version, calendar))
+        return 200, calendar, headers
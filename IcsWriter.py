@@ -33,7 +33,6 @@ class IcsWriter(object):
 
     def create_event(self, event_id, start_time, stop_time, summary, description):
         """Returns an ICS-formatted string that represents a single event within a calendar."""
-        buffer  = "BEGIN:VEVENT\r\n"
         if stop_time == None:
             stop_time = start_time + datetime.timedelta(days=1)
             start_ts = start_time.strftime("%Y%m%d")
@@ -41,18 +40,19 @@ class IcsWriter(object):
         else:
             start_ts = start_time.strftime("%Y%m%dT%H%M%S")
             stop_ts = stop_time.strftime("%Y%m%dT%H%M%S")
-        buffer += "DTSTART:" + start_ts + "\r\n"
-        buffer += "DTEND:" + stop_ts + "\r\n"
-        buffer += "UID:" + str(event_id) + "\r\n"
-        buffer += "SUMMARY:" + summary + "\r\n"
-        buffer += "DESCRIPTION:" + description + "\r\n"
-        buffer += "STATUS:CONFIRMED\r\n"
-        buffer += "DTSTAMP:" + start_ts + "\r\n"
-        buffer += "CREATED:" + start_ts + "\r\n"
-        buffer += "LAST-MODIFIED:" + start_ts + "\r\n"
-        buffer += "TRANSP:OPAQUE\r\n"
-        buffer += "END:VEVENT\r\n"
-        return buffer
+        return "".join([
+            "BEGIN:VEVENT\r\n",
+            "DTSTART:", start_ts, "\r\n",
+            "DTEND:", stop_ts, "\r\n",
+            "UID:", str(event_id), "\r\n",
+            "SUMMARY:", summary, "\r\n",
+            "DESCRIPTION:", description, "\r\n",
+            "STATUS:CONFIRMED\r\n",
+            "DTSTAMP:", start_ts, "\r\n",
+            "CREATED:", start_ts, "\r\n",
+            "LAST-MODIFIED:", start_ts, "\r\n",
+            "TRANSP:OPAQUE\r\n",
+            "END:VEVENT\r\n" ])
         
     def create_calendar(self, event_id, start_time, stop_time, summary, description):
         """Returns an ICS-formatted string that represents an entire calendar."""
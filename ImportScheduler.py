@@ -23,8 +23,11 @@
 # SOFTWARE.
 """Schedules computationally expensive import tasks"""
 
+import base64
+import json
 import logging
 import sys
+import time
 import traceback
 import uuid
 
@@ -41,24 +44,45 @@ class ImportScheduler(object):
 
     def add_file_to_queue(self, username, user_id, uploaded_file_data, uploaded_file_name, desired_activity_id, data_mgr):
         """Adds the activity ID to the list of activities to be analyzed. Activity ID is optional."""
-        from bson.json_util import dumps
+        """The file itself is stored in the database, only its ID is sent through the broker."""
         from ImportWorker import import_activity
 
         import Keys
+        import Perf
 
+        uploaded_file_id = None
         try:
+            # Data to import is expected to be Base 64 encoded. This is because, at this point, we don't distinguish between
+            # text and binary files.
+            uploaded_file_data = uploaded_file_data.replace(" ", "+") # Some JS base64 encoders replace plus with space, so we need to undo that.
+            decoded_file_data = base64.b64decode(uploaded_file_data)
+            uploaded_file_id = data_mgr.create_pending_uploaded_file(decoded_file_data)
+            if uploaded_file_id is None:
+                self.log_error("Unable to store the uploaded file.")
+                return None
+
             params = {}
             params['username'] = username
             params['user_id'] = user_id
-            params['uploaded_file_data'] = uploaded_file_data
+            params[Keys.UPLOADED_FILE_ID_KEY] = uploaded_file_id
             params['uploaded_file_name'] = uploaded_file_name
             params['desired_activity_id'] = desired_activity_id
+            params[Keys.TASK_ENQUEUE_TIME_KEY] = time.time()
+            params_str = json.dumps(params)
+            Perf.record_metric("import task message size", len(params_str))
 
             internal_task_id = uuid.uuid4()
-            import_task = import_activity.delay(dumps(params), internal_task_id)
+            import_task = import_activity.delay(params_str, internal_task_id)
             data_mgr.create_deferred_task(user_id, Keys.IMPORT_TASK_KEY, import_task.task_id, internal_task_id, uploaded_file_name)
             return internal_task_id
         except:
             self.log_error(traceback.format_exc())
             self.log_error(sys.exc_info()[0])
+
+            # The task wasn't queued (or can't be tracked), so nothing will import the stored file.
+            if uploaded_file_id is not None:
+                try:
+                    data_mgr.delete_pending_uploaded_file(uploaded_file_id)
+                except:
+                    self.log_error("Unable to delete the uploaded file: " + str(uploaded_file_id))
         return None
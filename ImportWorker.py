@@ -25,18 +25,18 @@
 """Performs the computationally expensive import tasks. Implements a celery worker."""
 
 from __future__ import absolute_import
-from CeleryWorker import celery_worker
-import base64
+from CeleryWorker import celery_worker, shared_data_mgr
 import json
 import logging
 import os
+import shutil
 import sys
+import time
 import traceback
 import uuid
-import Config
-import DataMgr
 import Importer
 import Keys
+import Perf
 
 def log_error(log_str):
     """Writes an error message to the log file."""
@@ -46,17 +46,25 @@ def log_error(log_str):
 @celery_worker.task(ignore_result=True)
 def import_activity(import_str, internal_task_id):
     local_file_name = ""
+    start_time = time.time()
+    data_mgr = None
+    uploaded_file_id = None
+    attached = False
 
     try:
         import_obj = json.loads(import_str)
         username = import_obj['username']
         user_id = import_obj['user_id']
-        uploaded_file_data = import_obj['uploaded_file_data']
         uploaded_file_name = import_obj['uploaded_file_name']
         desired_activity_id = import_obj['desired_activity_id']
-        data_mgr = DataMgr.DataMgr(config=Config.Config(), root_url="", analysis_scheduler=None, import_scheduler=None)
+        data_mgr = shared_data_mgr()
+        uploaded_file_id = import_obj[Keys.UPLOADED_FILE_ID_KEY]
         importer = Importer.Importer(data_mgr)
 
+        # How long did the task wait in the queue?
+        if Keys.TASK_ENQUEUE_TIME_KEY in import_obj:
+            Perf.record_metric("import task queue latency", start_time - import_obj[Keys.TASK_ENQUEUE_TIME_KEY])
+
         # Generate a random name for the local file.
         print("Generating local file name...")
         root_dir = os.path.dirname(os.path.abspath(__file__))
@@ -68,17 +76,13 @@ def import_activity(import_str, internal_task_id):
         local_file_name = os.path.join(upload_path, str(uuid.uuid4()))
         local_file_name = local_file_name + uploaded_file_ext
 
-        # Decode and write the file.
+        # Read the file from the database and write it to a local file.
         print("Writing the data to a local file...")
-        with open(local_file_name, 'wb') as local_file:
-
-            # Data to import is expected to be Base 64 encoded. This is because, at this point, we don't distinguish between
-            # text and binary files.
-            print("Base64 decoding...")
-            uploaded_file_data = uploaded_file_data.replace(" ", "+") # Some JS base64 encoders replace plus with space, so we need to undo that.
-            decoded_file_data = base64.b64decode(uploaded_file_data)
-            print("Writing...")
-            local_file.write(decoded_file_data)
+        uploaded_file = data_mgr.open_pending_uploaded_file(uploaded_file_id)
+        if uploaded_file is None:
+            raise Exception("The uploaded file could not be found.")
+        with uploaded_file, open(local_file_name, 'wb') as local_file:
+            shutil.copyfileobj(uploaded_file, local_file)
 
         # Update the status of the analysis in the database.
         print("Updating status...")
@@ -91,9 +95,9 @@ def import_activity(import_str, internal_task_id):
         # The import was successful, do more stuff.
         if success:
 
-            # Save the file to the database.
+            # The file is already in the database, associate it with the new activity.
             print("Saving the file to the database...")
-            data_mgr.create_uploaded_file(activity_id, decoded_file_data)
+            attached = data_mgr.attach_uploaded_file_to_activity(uploaded_file_id, activity_id)
 
             # Update the status of the analysis in the database.
             print("Updating status...")
@@ -105,13 +109,24 @@ def import_activity(import_str, internal_task_id):
             # Update the status of the analysis in the database.
             print("Import was not successful.")
             data_mgr.update_deferred_task(user_id, internal_task_id, activity_id, Keys.TASK_STATUS_ERROR)
+
+        # How long did it take from the upload to the end of the import?
+        if Keys.TASK_ENQUEUE_TIME_KEY in import_obj:
+            Perf.record_metric("import task end-to-end latency", time.time() - import_obj[Keys.TASK_ENQUEUE_TIME_KEY])
     except:
         log_error("Exception when importing activity data: " + str(import_str))
         log_error(traceback.format_exc())
         log_error(sys.exc_info()[0])
     finally:
+        # Nothing refers to the uploaded file unless it was attached to the new activity, so don't keep it around.
+        if uploaded_file_id is not None and not attached:
+            try:
+                data_mgr.delete_pending_uploaded_file(uploaded_file_id)
+            except:
+                log_error("Unable to delete the uploaded file: " + str(uploaded_file_id))
+
         # Remove the local file.
-        if len(local_file_name) > 0:
+        if len(local_file_name) > 0 and os.path.exists(local_file_name):
             print("Removing local file...")
             os.remove(local_file_name)
 
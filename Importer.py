@@ -23,24 +23,79 @@
 # SOFTWARE.
 """Parses GPX, TCX, and FIT files, passing the contents to a ActivityWriter object."""
 
+import array
 import calendar
 import csv
 import datetime
 import fitparse
-import gpxpy
 import logging
 import os
 import traceback
 import sys
-from lxml import objectify
+from lxml import etree
 
+import ActivityHasher
 import Keys
 
+IMPORT_CHUNK_SIZE = 8192 # Number of points to buffer before handing them to the activity writer
+
+def unix_time_ms_from_iso8601(ts_str):
+    """Fast path for the ISO 8601 timestamps found in GPX and TCX files, i.e. 2019-07-14T12:34:56.789Z. Returns milliseconds since the epoch."""
+    ts_str = ts_str.strip()
+    try:
+        if ts_str[4] != '-' or ts_str[7] != '-' or ts_str[10] not in 'T ' or ts_str[13] != ':' or ts_str[16] != ':':
+            raise ValueError(ts_str)
+        secs = calendar.timegm((int(ts_str[0:4]), int(ts_str[5:7]), int(ts_str[8:10]), int(ts_str[11:13]), int(ts_str[14:16]), int(ts_str[17:19]), 0, 0, 0))
+        ms = 0
+        index = 19
+
+        # Optional fractional seconds.
+        if len(ts_str) > index and ts_str[index] == '.':
+            end_index = index + 1
+            while end_index < len(ts_str) and ts_str[end_index].isdigit():
+                end_index = end_index + 1
+            fraction = ts_str[index + 1:end_index]
+            if len(fraction) > 0:
+                ms = int((fraction + "00")[0:3])
+            index = end_index
+
+        # Optional time zone offset. No time zone is treated as UTC.
+        tz_str = ts_str[index:]
+        if len(tz_str) > 0 and tz_str != 'Z':
+            sign = -1 if tz_str[0] == '-' else 1
+            tz_str = tz_str[1:].replace(':', '')
+            secs = secs - sign * (int(tz_str[0:2]) * 3600 + int(tz_str[2:4] or 0) * 60)
+        return secs * 1000 + ms
+    except (IndexError, ValueError):
+        pass
+
+    # Something unusual, let the standard library deal with it.
+    dt_obj = datetime.datetime.fromisoformat(ts_str.replace('Z', '+00:00'))
+    if dt_obj.tzinfo is None:
+        dt_obj = dt_obj.replace(tzinfo=datetime.timezone.utc)
+    return int(dt_obj.timestamp() * 1000)
+
+def local_name(element):
+    """Returns the element's tag without the XML namespace, or None if the element is a comment or processing instruction."""
+    tag = element.tag
+    if not isinstance(tag, str):
+        return None
+    return tag.rpartition('}')[2]
+
+def release_element(element):
+    """Frees an element, and any siblings before it, once it has been processed, so the parsed tree doesn't grow with the file."""
+    element.clear()
+    parent = element.getparent()
+    if parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]
+
 class ActivityWriter(object):
     """Base class for any class that handles data read from the Importer."""
 
-    def is_duplicate_activity(self, user_id, start_time, optional_activity_id):
-        """Inherited from ActivityWriter. Returns TRUE if the activity appears to be a duplicate of another activity. Returns FALSE otherwise."""
+    def is_duplicate_activity(self, user_id, start_time, optional_activity_id, fingerprint=None):
+        """Returns TRUE if the activity appears to be a duplicate of another activity. Returns FALSE otherwise."""
+        """Called before the activity is created, with its fingerprint (see ActivityHasher.compute_fingerprint) if the file has one."""
         return False
 
     def create_activity(self, username, user_id, stream_name, stream_description, activity_type, start_time, desired_activity_id):
@@ -71,10 +126,134 @@ class ActivityWriter(object):
         """Pure virtual method for processing multiple event readings. 'events' is an array of dictionaries in which each dictionary describes an event."""
         pass
 
+    def create_activity_streams(self, device_str, activity_id, locations, sensor_readings_dict, events):
+        """Processes a chunk of imported data. 'locations' is an array of arrays in the form [time, lat, lon, alt], 'sensor_readings_dict' maps the sensor type to an array of [time, value] arrays."""
+        """Writers that can store everything at once should override this, by default the data is passed to the individual methods."""
+        if locations:
+            self.create_activity_locations(device_str, activity_id, locations)
+        for sensor_type in sensor_readings_dict:
+            if sensor_readings_dict[sensor_type]:
+                self.create_activity_sensor_readings(activity_id, sensor_type, sensor_readings_dict[sensor_type])
+        if events:
+            self.create_activity_events(activity_id, events)
+
+    def create_activity_fingerprint(self, activity_id, fingerprint):
+        """Called once the whole file has been read with a string that identifies the activity (see ActivityHasher.compute_fingerprint)."""
+        pass
+
     def finish_activity(self, activity_id, end_time):
         """Pure virtual method for any post-processing."""
         pass
 
+class FingerprintWriter(ActivityWriter):
+    """Activity writer that discards everything except the fingerprint. Used to check a batch of files for duplicates with a single query before importing them."""
+
+    def __init__(self):
+        ActivityWriter.__init__(self)
+        self.fingerprint = None
+
+    def is_duplicate_activity(self, user_id, start_time, optional_activity_id, fingerprint=None):
+        """Inherited from ActivityWriter."""
+        return False
+
+    def create_activity(self, username, user_id, stream_name, stream_description, activity_type, start_time, desired_activity_id):
+        """Inherited from ActivityWriter."""
+        return "", desired_activity_id
+
+    def create_activity_track(self, device_str, activity_id, track_name, track_description):
+        """Inherited from ActivityWriter."""
+        pass
+
+    def create_activity_streams(self, device_str, activity_id, locations, sensor_readings_dict, events):
+        """Inherited from ActivityWriter."""
+        pass
+
+    def create_activity_fingerprint(self, activity_id, fingerprint):
+        """Inherited from ActivityWriter."""
+        self.fingerprint = fingerprint
+
+class ActivityStreamBuffer(object):
+    """Accumulates imported location and sensor data in compact arrays, handing it to the activity writer in chunks."""
+
+    def __init__(self, activity_writer, chunk_size=IMPORT_CHUNK_SIZE):
+        self.activity_writer = activity_writer
+        self.chunk_size = chunk_size
+        self.device_str = None
+        self.activity_id = None
+        self.activity_created = False
+        self.location_times = array.array('q')
+        self.location_lats = array.array('d')
+        self.location_lons = array.array('d')
+        self.location_alts = array.array('d')
+        self.sensor_times = {}
+        self.sensor_values = {}
+        self.events = []
+        self.num_buffered = 0
+        self.hasher = ActivityHasher.ActivityHasher(None)
+        super(ActivityStreamBuffer, self).__init__()
+
+    def set_activity(self, device_str, activity_id):
+        """Called once the activity has been created. Until then, everything is buffered."""
+        self.device_str = device_str
+        self.activity_id = activity_id
+        self.activity_created = True
+
+    def append_location(self, time_ms, lat, lon, alt):
+        self.location_times.append(int(time_ms))
+        self.location_lats.append(lat)
+        self.location_lons.append(lon)
+        self.location_alts.append(alt)
+        self.hasher.add_location(time_ms, lat, lon, alt)
+        self.num_buffered = self.num_buffered + 1
+        if self.activity_created and self.num_buffered >= self.chunk_size:
+            self.flush()
+
+    def append_sensor_reading(self, sensor_type, time_ms, value):
+        if sensor_type not in self.sensor_times:
+            self.sensor_times[sensor_type] = array.array('q')
+            self.sensor_values[sensor_type] = array.array('d')
+        self.sensor_times[sensor_type].append(int(time_ms))
+        self.sensor_values[sensor_type].append(value)
+        self.num_buffered = self.num_buffered + 1
+        if self.activity_created and self.num_buffered >= self.chunk_size:
+            self.flush()
+
+    def append_event(self, event):
+        self.events.append(event)
+
+    def fingerprint(self, activity_type, start_time_sec, end_time_sec):
+        """Returns the fingerprint of everything that has been added to the buffer, flushed or not."""
+        return ActivityHasher.compute_fingerprint(activity_type, start_time_sec, end_time_sec, self.hasher.digest())
+
+    def flush(self):
+        """Hands everything that has been buffered to the activity writer, one chunk at a time."""
+        if not self.activity_created:
+            return
+
+        offset = 0
+        while True:
+            end = offset + self.chunk_size
+            locations = [ list(location) for location in zip(self.location_times[offset:end], self.location_lats[offset:end], self.location_lons[offset:end], self.location_alts[offset:end]) ]
+            sensor_readings_dict = {}
+            for sensor_type in self.sensor_times:
+                readings = [ list(reading) for reading in zip(self.sensor_times[sensor_type][offset:end], self.sensor_values[sensor_type][offset:end]) ]
+                if readings:
+                    sensor_readings_dict[sensor_type] = readings
+            events = self.events if offset == 0 else []
+            if not (locations or sensor_readings_dict or events):
+                break
+            self.activity_writer.create_activity_streams(self.device_str, self.activity_id, locations, sensor_readings_dict, events)
+            offset = end
+
+        self.location_times = array.array('q')
+        self.location_lats = array.array('d')
+        self.location_lons = array.array('d')
+        self.location_alts = array.array('d')
+        self.sensor_times = {}
+        self.sensor_values = {}
+        self.events = []
+        self.num_buffered = 0
+
 class Importer(object):
     """Importer for GPX and TCX location files."""
 
@@ -137,6 +316,28 @@ class Importer(object):
 
         return Keys.TYPE_UNSPECIFIED_ACTIVITY_KEY
 
+    def read_fingerprint(self, import_func, *args):
+        """Reads the file with the given import method, without storing anything, and returns its fingerprint. Returns None if this importer is already only reading fingerprints."""
+        if isinstance(self.activity_writer, FingerprintWriter):
+            return None
+        fingerprint_writer = FingerprintWriter()
+        import_func(Importer(fingerprint_writer), *args)
+        return fingerprint_writer.fingerprint
+
+    def create_buffered_activity(self, buffer, username, user_id, activity_name, activity_description, activity_type, start_time_sec, end_time_sec, desired_activity_id):
+        """Called once the whole file has been read into the buffer. Checks the fingerprint against the user's existing activities, then creates the activity."""
+        """Result is {device_id, activity_id, fingerprint}."""
+        fingerprint = buffer.fingerprint(activity_type, start_time_sec, end_time_sec)
+
+        # Make sure this is not a duplicate activity.
+        if self.activity_writer.is_duplicate_activity(user_id, start_time_sec, desired_activity_id, fingerprint):
+            raise Exception("Duplicate activity.")
+
+        # Indicate the start of the activity.
+        device_str, activity_id = self.activity_writer.create_activity(username, user_id, activity_name, activity_description, activity_type, start_time_sec, desired_activity_id)
+        buffer.set_activity(device_str, activity_id)
+        return device_str, activity_id, fingerprint
+
     def import_gpx_file(self, username, user_id, file_name, desired_activity_id):
         """Imports the specified GPX file."""
         """Caller can request an activity ID by specifying a value to desired_activity_id."""
@@ -145,110 +346,133 @@ class Importer(object):
         if not os.path.isfile(file_name):
             raise Exception("File does not exist.")
 
-        # The GPX parser requires a file handle and not a file name.
-        with open(file_name, 'r') as gpx_file:
-
-            # Parse the file.
-            gpx = gpxpy.parse(gpx_file)
-
-            # Figure out the sport type.
-            activity_type = Keys.TYPE_UNSPECIFIED_ACTIVITY_KEY
-            if len(gpx.tracks) > 0:
-                activity_type = Importer.normalize_activity_type(gpx.tracks[0].type, None, file_name)
+        buffer = ActivityStreamBuffer(self.activity_writer)
 
-            start_time_unix = 0
-            if gpx.time is not None:
+        gpx_name = None
+        gpx_description = None
+        activity_type = Keys.TYPE_UNSPECIFIED_ACTIVITY_KEY
+        start_time_unix = 0
+        end_time_unix = 0 # We'll store the most recent timecode here.
+        device_str = ""
+        activity_id = ""
+        header_read = False
+        num_tracks = 0
+        track_created = False
 
-                # Find the start timestamp.
-                start_time_tuple = gpx.time.timetuple()
-                start_time_unix = calendar.timegm(start_time_tuple)
+        # Duplicates are found by their fingerprint, which covers every location. Rather than holding the whole file until the fingerprint is known,
+        # the file is read twice: once to compute the fingerprint without storing anything, then again to write it in chunks as it's read.
+        fingerprint = self.read_fingerprint(Importer.import_gpx_file, username, user_id, file_name, None)
 
+        def create_activity():
             # Make sure this is not a duplicate activity.
-            if self.activity_writer.is_duplicate_activity(user_id, start_time_unix, desired_activity_id):
+            if self.activity_writer.is_duplicate_activity(user_id, start_time_unix, desired_activity_id, fingerprint):
                 raise Exception("Duplicate activity.")
 
             # Indicate the start of the activity.
-            device_str, activity_id = self.activity_writer.create_activity(username, user_id, gpx.name, gpx.description, activity_type, start_time_unix, desired_activity_id)
-
-            # We'll store the most recent timecode here.
-            end_time_unix = 0
-
-            locations = []
-            cadences = []
-            heart_rate_readings = []
-            power_readings = []
-            temperature_readings = []
-
-            for track in gpx.tracks:
-                self.activity_writer.create_activity_track(device_str, activity_id, track.name, track.description)
-                for segment in track.segments:
-                    for point in segment.points:
-
-                        # Read the timestamp. Discard any garbage by splitting after the (possible) plus sign.
-                        dt_str = str(point.time).split('+')[0] + " UTC"
-                        if dt_str.find('.') > 1:
-                            dt_obj = datetime.datetime.strptime(dt_str, "%Y-%m-%d %H:%M:%S.%f %Z")
-                        else:
-                            dt_obj = datetime.datetime.strptime(dt_str, "%Y-%m-%d %H:%M:%S %Z")
-                        dt_tuple = dt_obj.timetuple()
-                        dt_unix = calendar.timegm(dt_tuple) * 1000
-
-                        # Is this the most recent timestamp we've seen?
-                        if dt_unix > end_time_unix:
-                            end_time_unix = dt_unix
-
-                        # Store the location.
-                        location = []
-                        location.append(dt_unix)
-                        location.append(float(point.latitude))
-                        location.append(float(point.longitude))
-                        location.append(float(point.elevation))
-                        locations.append(location)
-
-                        # Look for other attributes.
-                        extensions = point.extensions
-                        if 'power' in extensions:
-                            reading = []
-                            reading.append(dt_unix)
-                            reading.append(float(extensions['power']))
-                            power_readings.append(reading)
-                        if 'gpxtpx:TrackPointExtension' in extensions:
-                            gpxtpx_extensions = extensions['gpxtpx:TrackPointExtension']
-                            if 'gpxtpx:hr' in gpxtpx_extensions:
-                                reading = []
-                                reading.append(dt_unix)
-                                reading.append(float(gpxtpx_extensions['gpxtpx:hr']))
-                                heart_rate_readings.append(reading)
-                            if 'gpxtpx:cad' in gpxtpx_extensions:
-                                reading = []
-                                reading.append(dt_unix)
-                                reading.append(float(gpxtpx_extensions['gpxtpx:cad']))
-                                cadences.append(reading)
-                            if 'gpxtpx:atemp' in gpxtpx_extensions:
-                                reading = []
-                                reading.append(dt_unix)
-                                reading.append(float(gpxtpx_extensions['gpxtpx:atemp']))
-                                temperature_readings.append(reading)
-
-            # Write all the locations at once.
-            if locations:
-                self.activity_writer.create_activity_locations(device_str, activity_id, locations)
-
-            # Write all the sensor readings at once.
-            if cadences:
-                self.activity_writer.create_activity_sensor_readings(activity_id, Keys.APP_CADENCE_KEY, cadences)
-            if heart_rate_readings:
-                self.activity_writer.create_activity_sensor_readings(activity_id, Keys.APP_HEART_RATE_KEY, heart_rate_readings)
-            if power_readings:
-                self.activity_writer.create_activity_sensor_readings(activity_id, Keys.APP_POWER_KEY, power_readings)
-            if temperature_readings:
-                self.activity_writer.create_activity_sensor_readings(activity_id, Keys.APP_TEMP_KEY, temperature_readings)
-
-            # Let it be known that we are finished with this activity.
-            self.activity_writer.finish_activity(activity_id, end_time_unix)
-            return True, device_str, activity_id
-
-        return False, "", ""
+            device_str, activity_id = self.activity_writer.create_activity(username, user_id, gpx_name, gpx_description, activity_type, start_time_unix, desired_activity_id)
+            buffer.set_activity(device_str, activity_id)
+            return device_str, activity_id
+
+        def read_header(root):
+            # Returns the name, description, and start time from the file header.
+            descriptions = read_descriptions(root)
+            start_time_unix = 0
+            if descriptions.get('time'):
+                start_time_unix = int(unix_time_ms_from_iso8601(descriptions['time']) / 1000)
+            return descriptions.get('name'), descriptions.get('desc'), start_time_unix
+
+        def read_descriptions(element):
+            # Returns the name, description, time, and type that are direct children of the element.
+            descriptions = {}
+            for child in element:
+                child_name = local_name(child)
+                if child_name in [ 'name', 'desc', 'time', 'type' ]:
+                    descriptions[child_name] = child.text
+                elif child_name == 'metadata':
+                    descriptions.update(read_descriptions(child))
+            return descriptions
+
+        # Parse the file incrementally. Everything that precedes an element has already been parsed when its start event arrives,
+        # so the file header (GPX 1.1 metadata or GPX 1.0 root level elements) and track descriptions are read from the parsed siblings.
+        tags = [ '{*}trk', '{*}trkseg', '{*}trkpt' ]
+        context = etree.iterparse(file_name, events=('start', 'end'), tag=tags, remove_blank_text=True, huge_tree=True)
+        for event, element in context:
+            name = local_name(element)
+
+            if event == 'start':
+                if name == 'trk':
+                    num_tracks = num_tracks + 1
+                    track_created = False
+                    if not header_read:
+                        gpx_name, gpx_description, start_time_unix = read_header(element.getparent())
+                        header_read = True
+                elif name == 'trkseg' and not track_created:
+                    descriptions = read_descriptions(element.getparent())
+
+                    # The sport type is taken from the first track.
+                    if not buffer.activity_created:
+                        if num_tracks == 1:
+                            activity_type = Importer.normalize_activity_type(descriptions.get('type'), None, file_name)
+                        device_str, activity_id = create_activity()
+                    self.activity_writer.create_activity_track(device_str, activity_id, descriptions.get('name'), descriptions.get('desc'))
+                    track_created = True
+                continue
+
+            if name != 'trkpt':
+                continue
+
+            # Read the timestamp, location, and other attributes, such as those in the Garmin TrackPointExtension.
+            time_ms = None
+            altitude = 0.0
+            readings = []
+            for child in element:
+                child_name = local_name(child)
+                if child_name == 'time':
+                    if child.text:
+                        time_ms = unix_time_ms_from_iso8601(child.text)
+                elif child_name == 'ele':
+                    if child.text:
+                        altitude = float(child.text)
+                elif child_name == 'extensions':
+                    for extension in child.iter('{*}power', '{*}hr', '{*}cad', '{*}atemp'):
+                        if extension.text:
+                            readings.append((local_name(extension), float(extension.text)))
+            lat = float(element.get('lat'))
+            lon = float(element.get('lon'))
+            release_element(element)
+
+            if time_ms is None:
+                continue
+
+            # Is this the most recent timestamp we've seen?
+            if time_ms > end_time_unix:
+                end_time_unix = time_ms
+
+            # Store the location and sensor readings.
+            buffer.append_location(time_ms, lat, lon, altitude)
+            for extension_name, value in readings:
+                if extension_name == 'power':
+                    buffer.append_sensor_reading(Keys.APP_POWER_KEY, time_ms, value)
+                elif extension_name == 'hr':
+                    buffer.append_sensor_reading(Keys.APP_HEART_RATE_KEY, time_ms, value)
+                elif extension_name == 'cad':
+                    buffer.append_sensor_reading(Keys.APP_CADENCE_KEY, time_ms, value)
+                elif extension_name == 'atemp':
+                    buffer.append_sensor_reading(Keys.APP_TEMP_KEY, time_ms, value)
+
+        # A file without any track segments still results in an (empty) activity.
+        if not buffer.activity_created:
+            if not header_read and context.root is not None:
+                gpx_name, gpx_description, start_time_unix = read_header(context.root)
+            device_str, activity_id = create_activity()
+
+        # Write anything that's still buffered.
+        buffer.flush()
+
+        # Let it be known that we are finished with this activity.
+        self.activity_writer.create_activity_fingerprint(activity_id, buffer.fingerprint(activity_type, start_time_unix, int(end_time_unix / 1000)))
+        self.activity_writer.finish_activity(activity_id, end_time_unix)
+        return True, device_str, activity_id
 
     def import_tcx_file(self, username, user_id, file_name, original_file_name, desired_activity_id):
         """Imports the specified TCX file."""
@@ -258,122 +482,121 @@ class Importer(object):
         if not os.path.isfile(file_name):
             raise Exception("File does not exist.")
 
-        # Parse the file.
-        tree = objectify.parse(file_name)
-        if tree is None:
-            raise Exception("Invalid TCX file (no tree node).")
+        buffer = ActivityStreamBuffer(self.activity_writer)
 
-        # Get the first node in the XML tree.
-        root = tree.getroot()
-        if root is None:
-            raise Exception("Invalid TCX file (no root node).")
-
-        # The interesting stuff starts with an activity.
-        activity = root.Activities.Activity
-        activity_type = activity.attrib['Sport']
+        # Since we don't have anything else, use the file name as the name of the activity.
+        activity_name = os.path.splitext(os.path.basename(original_file_name))[0]
 
-        # Find the start timestamp.
+        activity_type = None
+        num_activities = 0
         start_time_unix = 0
-        if hasattr(activity, 'Id'):
-
-            # The start time may or may not have milliseconds.
-            start_time_obj = None
-            try:
-                start_time_obj = datetime.datetime.strptime(str(activity.Id), "%Y-%m-%dT%H:%M:%S.%fZ")
-            except ValueError:
-                start_time_obj = datetime.datetime.strptime(str(activity.Id), "%Y-%m-%dT%H:%M:%SZ")
-            if start_time_obj is not None:
-                start_time_tuple = start_time_obj.timetuple()
-                start_time_unix = calendar.timegm(start_time_tuple)
+        end_time_unix = 0 # We'll store the most recent timecode here.
+        device_str = ""
+        activity_id = ""
 
-        # Make sure this is not a duplicate activity.
-        if self.activity_writer.is_duplicate_activity(user_id, start_time_unix, desired_activity_id):
-            raise Exception("Duplicate activity.")
+        # Read the file once without storing anything to compute the fingerprint, so the import itself can write in chunks (see import_gpx_file).
+        fingerprint = self.read_fingerprint(Importer.import_tcx_file, username, user_id, file_name, original_file_name, None)
 
-        # Since we don't have anything else, use the file name as the name of the activity.
-        activity_name = os.path.splitext(os.path.basename(original_file_name))[0]
+        def create_activity():
+            # Make sure this is not a duplicate activity.
+            if self.activity_writer.is_duplicate_activity(user_id, start_time_unix, desired_activity_id, fingerprint):
+                raise Exception("Duplicate activity.")
 
-        # Figure out the type of the activity.
-        normalized_activity_type = Importer.normalize_activity_type(activity_type, None, activity_name)
+            # Figure out the type of the activity.
+            normalized_activity_type = Importer.normalize_activity_type(activity_type, None, activity_name)
 
-        # Indicate the start of the activity.
-        device_str, activity_id = self.activity_writer.create_activity(username, user_id, activity_name, "", normalized_activity_type, start_time_unix, desired_activity_id)
+            # Indicate the start of the activity.
+            device_str, activity_id = self.activity_writer.create_activity(username, user_id, activity_name, "", normalized_activity_type, start_time_unix, desired_activity_id)
+            buffer.set_activity(device_str, activity_id)
+            return device_str, activity_id
+
+        # Parse the file incrementally. The interesting stuff starts with an activity, only the first one is imported.
+        tags = [ '{*}Activity', '{*}Lap', '{*}Id', '{*}Trackpoint' ]
+        for event, element in etree.iterparse(file_name, events=('start', 'end'), tag=tags, remove_blank_text=True, huge_tree=True):
+            name = local_name(element)
+
+            if event == 'start':
+                if name == 'Activity':
+                    num_activities = num_activities + 1
+                    if num_activities == 1:
+                        activity_type = element.get('Sport')
+                elif name == 'Lap' and num_activities == 1 and not buffer.activity_created:
+                    device_str, activity_id = create_activity()
+                continue
 
-        # We'll store the most recent timecode here.
-        end_time_unix = 0
+            if num_activities != 1:
+                continue
 
-        locations = []
-        cadences = []
-        heart_rate_readings = []
-        power_readings = []
-
-        if hasattr(activity, 'Lap'):
-            for lap in activity.Lap:
-                if hasattr(lap, 'Track'):
-                    for track in lap.Track:
-                        if hasattr(track, 'Trackpoint'):
-                            for point in track.Trackpoint:
-
-                                # Read the timestamp, which may or may not have milliseconds.
-                                try:
-                                    dt_obj = datetime.datetime.strptime(str(point.Time), "%Y-%m-%dT%H:%M:%S.%fZ")
-                                except ValueError:
-                                    dt_obj = datetime.datetime.strptime(str(point.Time), "%Y-%m-%dT%H:%M:%SZ")
-                                dt_tuple = dt_obj.timetuple()
-                                dt_unix = calendar.timegm(dt_tuple) * 1000
-                                dt_unix = dt_unix + dt_obj.microsecond / 1000
-
-                                # Is this the most recent timestamp we've seen?
-                                if dt_unix > end_time_unix:
-                                    end_time_unix = dt_unix
-
-                                # Store the location.
-                                if hasattr(point, 'Position'):
-                                    location = []
-                                    location.append(dt_unix)
-                                    location.append(float(point.Position.LatitudeDegrees))
-                                    location.append(float(point.Position.LongitudeDegrees))
-                                    if hasattr(point, 'AltitudeMeters'):
-                                        location.append(float(point.AltitudeMeters))
-                                    else:
-                                        location.append(0.0)
-                                    locations.append(location)
-
-                                # Look for other attributes.
-                                if hasattr(point, 'Cadence'):
-                                    reading = []
-                                    reading.append(dt_unix)
-                                    reading.append(float(point.Cadence))
-                                    cadences.append(reading)
-                                if hasattr(point, 'HeartRateBpm'):
-                                    reading = []
-                                    reading.append(dt_unix)
-                                    reading.append(float(point.HeartRateBpm.Value))
-                                    heart_rate_readings.append(reading)
-                                if hasattr(point, 'Extensions'):
-                                    elements = point.Extensions
-                                    children = elements.getchildren()
-                                    if len(children) > 0:
-                                        subelement = children[0]
-                                        if hasattr(subelement, 'Watts'):
-                                            reading = []
-                                            reading.append(dt_unix)
-                                            reading.append(float(subelement.Watts))
-                                            power_readings.append(reading)
-
-        # Write all the locations at once.
-        if locations:
-            self.activity_writer.create_activity_locations(device_str, activity_id, locations)
+            if name == 'Id':
+
+                # Find the start timestamp.
+                if element.text:
+                    start_time_unix = int(unix_time_ms_from_iso8601(element.text) / 1000)
+
+            elif name == 'Trackpoint':
+
+                time_ms = None
+                location = None
+                altitude = 0.0
+                cadence = None
+                heart_rate = None
+                power = None
+                for child in element:
+                    child_name = local_name(child)
+                    if child_name == 'Time':
+                        if child.text:
+                            time_ms = unix_time_ms_from_iso8601(child.text)
+                    elif child_name == 'Position':
+                        lat = child.find('{*}LatitudeDegrees')
+                        lon = child.find('{*}LongitudeDegrees')
+                        if lat is not None and lon is not None:
+                            location = (float(lat.text), float(lon.text))
+                    elif child_name == 'AltitudeMeters':
+                        if child.text:
+                            altitude = float(child.text)
+                    elif child_name == 'Cadence':
+                        if child.text:
+                            cadence = float(child.text)
+                    elif child_name == 'HeartRateBpm':
+                        value = child.find('{*}Value')
+                        if value is not None and value.text:
+                            heart_rate = float(value.text)
+                    elif child_name == 'Extensions':
+                        watts = next(child.iter('{*}Watts'), None)
+                        if watts is not None and watts.text:
+                            power = float(watts.text)
+                release_element(element)
+
+                if time_ms is None:
+                    continue
+
+                # Is this the most recent timestamp we've seen?
+                if time_ms > end_time_unix:
+                    end_time_unix = time_ms
+
+                # Store the location and any other attributes.
+                if location is not None:
+                    buffer.append_location(time_ms, location[0], location[1], altitude)
+                if cadence is not None:
+                    buffer.append_sensor_reading(Keys.APP_CADENCE_KEY, time_ms, cadence)
+                if heart_rate is not None:
+                    buffer.append_sensor_reading(Keys.APP_HEART_RATE_KEY, time_ms, heart_rate)
+                if power is not None:
+                    buffer.append_sensor_reading(Keys.APP_POWER_KEY, time_ms, power)
+
+        if num_activities == 0:
+            raise Exception("Invalid TCX file (no activity).")
+
+        # An activity without any laps still results in an (empty) activity.
+        if not buffer.activity_created:
+            device_str, activity_id = create_activity()
 
-        # Write all the sensor readings at once.
-        if cadences:
-            self.activity_writer.create_activity_sensor_readings(activity_id, Keys.APP_CADENCE_KEY, cadences)
-        if heart_rate_readings:
-            self.activity_writer.create_activity_sensor_readings(activity_id, Keys.APP_HEART_RATE_KEY, heart_rate_readings)
-        if power_readings:
-            self.activity_writer.create_activity_sensor_readings(activity_id, Keys.APP_POWER_KEY, power_readings)
+        # Write anything that's still buffered.
+        buffer.flush()
 
         # Let it be known that we are finished with this activity.
+        normalized_activity_type = Importer.normalize_activity_type(activity_type, None, activity_name)
+        self.activity_writer.create_activity_fingerprint(activity_id, buffer.fingerprint(normalized_activity_type, start_time_unix, int(end_time_unix / 1000)))
         self.activity_writer.finish_activity(activity_id, end_time_unix)
         return True, device_str, activity_id
 
@@ -391,23 +614,18 @@ class Importer(object):
         start_time_unix = 0
         end_time_unix = 0
 
-        locations = []
-        cadences = []
-        heart_rate_readings = []
-        power_readings = []
-        temperatures = []
-        events = []
+        # The sport type is usually at the end of the file, so the activity can't be created until everything has been read.
+        buffer = ActivityStreamBuffer(self.activity_writer)
 
+        # Read one message at a time, rather than having the parser build a list of every message in the file.
         fit_file = fitparse.FitFile(file_name, data_processor=fitparse.StandardUnitsDataProcessor())
-        for message in fit_file.messages:
+        for message in fit_file.get_messages():
 
             if not hasattr(message, 'fields'):
                 continue
 
-            fields = message.fields
-
             message_data = {}
-            for field in fields:
+            for field in message.fields:
                 message_data[field.name] = field.value
 
             if 'sport' in message_data and isinstance(message_data['sport'], str):
@@ -418,8 +636,7 @@ class Importer(object):
                 continue
 
             dt_obj = message_data['timestamp']
-            dt_tuple = dt_obj.timetuple()
-            dt_unix_seconds = calendar.timegm(dt_tuple)
+            dt_unix_seconds = calendar.timegm(dt_obj.timetuple())
             dt_unix = dt_unix_seconds * 1000
 
             # Update start and end times.
@@ -432,40 +649,21 @@ class Importer(object):
                 continue
 
             # Look for location and sensor data.
-            if 'position_long' in message_data and 'position_lat' in message_data and message_data['position_lat'] is not None and message_data['position_long'] is not None:
-                location = []
-                location.append(dt_unix)
-                location.append(float(message_data['position_lat']))
-                location.append(float(message_data['position_long']))
-                if 'enhanced_altitude' in message_data:
-                    location.append(float(message_data['enhanced_altitude']))
-                locations.append(location)
-            if 'cadence' in message_data and message_data['cadence'] is not None:
-                reading = []
-                reading.append(dt_unix)
-                reading.append(float(message_data['cadence']))
-                cadences.append(reading)
-            if 'heart_rate' in message_data and message_data['heart_rate'] is not None:
-                reading = []
-                reading.append(dt_unix)
-                reading.append(float(message_data['heart_rate']))
-                heart_rate_readings.append(reading)
-            if 'power' in message_data and message_data['power'] is not None:
-                reading = []
-                reading.append(dt_unix)
-                reading.append(float(message_data['power']))
-                power_readings.append(reading)
-            if 'temperature' in message_data and message_data['temperature'] is not None:
-                reading = []
-                reading.append(dt_unix)
-                reading.append(float(message_data['temperature']))
-                temperatures.append(reading)
-            if 'event' in message_data and message_data['event'] is not None:
-                events.append(message_data)
-
-        # Make sure this is not a duplicate activity.
-        if self.activity_writer.is_duplicate_activity(user_id, start_time_unix, desired_activity_id):
-            raise Exception("Duplicate activity.")
+            if message_data.get('position_lat') is not None and message_data.get('position_long') is not None:
+                altitude = message_data.get('enhanced_altitude')
+                if altitude is None:
+                    altitude = 0.0
+                buffer.append_location(dt_unix, float(message_data['position_lat']), float(message_data['position_long']), float(altitude))
+            if message_data.get('cadence') is not None:
+                buffer.append_sensor_reading(Keys.APP_CADENCE_KEY, dt_unix, float(message_data['cadence']))
+            if message_data.get('heart_rate') is not None:
+                buffer.append_sensor_reading(Keys.APP_HEART_RATE_KEY, dt_unix, float(message_data['heart_rate']))
+            if message_data.get('power') is not None:
+                buffer.append_sensor_reading(Keys.APP_POWER_KEY, dt_unix, float(message_data['power']))
+            if message_data.get('temperature') is not None:
+                buffer.append_sensor_reading(Keys.APP_TEMP_KEY, dt_unix, float(message_data['temperature']))
+            if message_data.get('event') is not None:
+                buffer.append_event(message_data)
 
         # Since we don't have anything else, use the file name as the name of the activity.
         activity_name = os.path.splitext(os.path.basename(original_file_name))[0]
@@ -473,27 +671,15 @@ class Importer(object):
         # Figure out the type of the activity.
         normalized_activity_type = Importer.normalize_activity_type(activity_type, sub_activity_type, activity_name)
 
-        # Indicate the start of the activity.
-        device_str, activity_id = self.activity_writer.create_activity(username, user_id, activity_name, "", normalized_activity_type, start_time_unix, desired_activity_id)
+        # Create the activity.
+        device_str, activity_id, fingerprint = self.create_buffered_activity(buffer, username, user_id, activity_name, "", normalized_activity_type, start_time_unix, end_time_unix, desired_activity_id)
 
-        # Write all the locations at once.
-        if locations:
-            self.activity_writer.create_activity_locations(device_str, activity_id, locations)
-
-        # Write all the sensor readings at once.
-        if cadences:
-            self.activity_writer.create_activity_sensor_readings(activity_id, Keys.APP_CADENCE_KEY, cadences)
-        if heart_rate_readings:
-            self.activity_writer.create_activity_sensor_readings(activity_id, Keys.APP_HEART_RATE_KEY, heart_rate_readings)
-        if power_readings:
-            self.activity_writer.create_activity_sensor_readings(activity_id, Keys.APP_POWER_KEY, power_readings)
-        if temperatures:
-            self.activity_writer.create_activity_sensor_readings(activity_id, Keys.APP_TEMP_KEY, temperatures)
-        if events:
-            self.activity_writer.create_activity_events(activity_id, events)
+        # Write everything, in chunks.
+        buffer.flush()
 
-        # Let it be known that we are finished with this activity.
-        self.activity_writer.finish_activity(activity_id, end_time_unix)
+        # Let it be known that we are finished with this activity. The end time is in seconds, the writer expects milliseconds.
+        self.activity_writer.create_activity_fingerprint(activity_id, fingerprint)
+        self.activity_writer.finish_activity(activity_id, end_time_unix * 1000)
         return True, device_str, activity_id
 
     def import_accelerometer_csv_file(self, username, user_id, file_name, desired_activity_id):
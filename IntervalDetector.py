@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2017 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Finds the intervals (i.e. repeats run or ridden faster than the recoveries between them) in an activity's speed graph."""
+"""The smoothed speed is split into stretches of steady speed by seeded binary segmentation, which finds the best split of each of"""
+"""O(n) stretches from running sums, in O(n log n) time overall. Stretches are then sorted into fast and slow by the speed that best"""
+"""separates them, and runs of fast stretches are the intervals."""
+
+import bisect
+import math
+import numpy as np
+
+SMOOTHING_WINDOW = 5 # Number of readings averaged together to take out location jitter
+MIN_SEGMENT_SECS = 20.0 # Shortest stretch of steady speed that is considered, shorter changes are noise
+MIN_INTERVAL_SECS = 10.0 # Shortest effort that is reported as an interval
+PENALTY_FACTOR = 3.0 # How much a split has to improve the fit, in units of the noise variance times the log of the number of readings
+MIN_MOVING_SPEED = 0.5 # Meters per second, stretches slower than this are stops and are neither intervals nor recoveries
+MIN_SPEED_RATIO = 1.15 # How much faster the fast stretches have to be than the slow ones for them to be intervals
+MIN_SLOW_FRACTION = 0.1 # Least fraction of the moving time that has to be slow, so speeding up and slowing down around stops isn't mistaken for recoveries
+
+def smooth(values, window):
+    """Centered moving average. The ends are averaged over the readings that are available, so the result is the same length as the input."""
+    num_values = len(values)
+    if num_values == 0 or window <= 1:
+        return np.array(values, dtype=float)
+    sums = np.concatenate(([ 0.0 ], np.cumsum(values, dtype=float)))
+    indexes = np.arange(num_values)
+    starts = np.maximum(indexes - window // 2, 0)
+    ends = np.minimum(indexes + window - window // 2, num_values)
+    return (sums[ends] - sums[starts]) / (ends - starts)
+
+def estimate_noise_variance(values, block_len):
+    """Estimates the noise variance from the differences between the means of adjacent blocks of readings. Readings in the speed graph"""
+    """are already averages, so each is correlated with its neighbors, and this measures how much that noise moves the mean of a"""
+    """stretch, which is what matters when deciding whether to split it. Scaled to a single reading. The median ignores the few blocks"""
+    """on either side of a change in speed."""
+    num_blocks = len(values) // block_len
+    if num_blocks < 2:
+        return float(np.var(values))
+    block_means = np.mean(np.reshape(values[:num_blocks * block_len], (num_blocks, block_len)), axis=1)
+    sigma = np.median(np.abs(np.diff(block_means))) / (0.6745 * math.sqrt(2.0))
+    return float(sigma * sigma * block_len)
+
+def find_change_points(values, min_segment_len, penalty):
+    """Seeded binary segmentation. Every stretch in a fixed set of overlapping stretches, halving in length from the whole graph down"""
+    """to twice the minimum segment length, is split where doing so most reduces the squared error of fitting each side with its own"""
+    """mean. Splits that reduce it by more than the penalty are then taken narrowest stretch first, skipping any stretch that contains"""
+    """a split that was already taken. Short stretches find changes that are close together (i.e. short intervals with short"""
+    """recoveries), which splitting the whole graph in two at a time can miss. Returns the sorted indexes at which the stretches start."""
+    num_values = len(values)
+    sums = np.concatenate(([ 0.0 ], np.cumsum(values)))
+    squared_sums = np.concatenate(([ 0.0 ], np.cumsum(np.square(values))))
+
+    def cost(starts, ends):
+        segment_sums = sums[ends] - sums[starts]
+        return squared_sums[ends] - squared_sums[starts] - segment_sums * segment_sums / (ends - starts)
+
+    # Each layer's stretches are the same length, so a whole layer is evaluated at once. The number of values examined in each
+    # layer is about twice the number of readings, and there are log(n) layers.
+    candidate_starts = []
+    candidate_ends = []
+    candidate_splits = []
+    candidate_gains = []
+    length = num_values
+    while length >= 2 * min_segment_len:
+        shift = max(1, length // 2)
+        starts = np.arange(0, num_values - length + 1, shift)
+        if starts[-1] != num_values - length:
+            starts = np.append(starts, num_values - length)
+        ends = starts + length
+        splits = starts[:, np.newaxis] + np.arange(min_segment_len, length - min_segment_len + 1)[np.newaxis, :]
+        gains = cost(starts, ends)[:, np.newaxis] - cost(starts[:, np.newaxis], splits) - cost(splits, ends[:, np.newaxis])
+        best = np.argmax(gains, axis=1)
+        rows = np.arange(len(starts))
+        candidate_starts.append(starts)
+        candidate_ends.append(ends)
+        candidate_splits.append(splits[rows, best])
+        candidate_gains.append(gains[rows, best])
+        length = length // 2
+
+    change_points = [ 0 ]
+    if not candidate_starts:
+        return change_points
+    starts = np.concatenate(candidate_starts)
+    ends = np.concatenate(candidate_ends)
+    splits = np.concatenate(candidate_splits)
+    significant = np.concatenate(candidate_gains) > penalty
+
+    # Narrowest over threshold. Candidates are already ordered from widest to narrowest, so walk them backwards. Every split is at
+    # least the minimum segment length from the ends of its stretch, so a stretch that doesn't contain a split that was already
+    # taken can't be too close to one either.
+    taken = []
+    for index in reversed(np.flatnonzero(significant).tolist()):
+        position = bisect.bisect_right(taken, starts[index])
+        if position < len(taken) and taken[position] < ends[index]:
+            continue
+        taken.insert(position, int(splits[index]))
+    change_points.extend(taken)
+    return change_points
+
+def separate_fast_segments(means, weights):
+    """Finds the speed that best separates the fast stretches from the slow ones, i.e. that maximizes the between class variance"""
+    """(Otsu's method), weighting each stretch by its duration. Returns the threshold, or None if there aren't two distinct classes."""
+    """Means and weights are numpy arrays with one entry for each stretch."""
+    if len(means) < 2:
+        return None
+
+    order = np.argsort(means)
+    sorted_means = means[order]
+    sorted_weights = weights[order]
+    total_weight = np.sum(sorted_weights)
+    slow_weights = np.cumsum(sorted_weights)[:-1]
+    slow_sums = np.cumsum(sorted_means * sorted_weights)[:-1]
+    fast_weights = total_weight - slow_weights
+    fast_sums = np.sum(sorted_means * sorted_weights) - slow_sums
+    slow_means = slow_sums / slow_weights
+    fast_means = fast_sums / fast_weights
+    between_variances = slow_weights * fast_weights * np.square(fast_means - slow_means)
+    between_variances[slow_weights < MIN_SLOW_FRACTION * total_weight] = -1.0
+    best = int(np.argmax(between_variances))
+    if between_variances[best] < 0.0:
+        return None
+
+    # Steady efforts with a bit of drift aren't intervals.
+    if fast_means[best] < MIN_SPEED_RATIO * slow_means[best]:
+        return None
+    return (sorted_means[best] + sorted_means[best + 1]) / 2.0
+
+def detect_intervals(speed_times, speeds, distance_buf):
+    """Returns the intervals found in the speed graph, as a list of (start time, end time, duration, distance, average speed) tuples,"""
+    """with times and durations in milliseconds, distance in meters, and speed in meters per second. The distance buffer is a list"""
+    """of [time, total distance] pairs and is used to compute each interval's distance."""
+    num_speeds = len(speeds)
+    if num_speeds < 2 or len(speed_times) != num_speeds:
+        return []
+
+    times = np.array(speed_times, dtype=float)
+    raw_speeds = np.array(speeds, dtype=float)
+    smoothed_speeds = smooth(raw_speeds, SMOOTHING_WINDOW)
+
+    # Segment lengths are given in time, but the segmentation works in readings.
+    sample_period_ms = float(np.median(np.diff(times)))
+    if sample_period_ms <= 0.0:
+        return []
+    min_segment_len = max(2, int(math.ceil(MIN_SEGMENT_SECS * 1000.0 / sample_period_ms)))
+
+    # Split the speed graph into stretches of steady speed.
+    penalty = PENALTY_FACTOR * estimate_noise_variance(smoothed_speeds, min_segment_len) * math.log(num_speeds)
+    starts = np.array(find_change_points(smoothed_speeds, min_segment_len, penalty))
+    ends = np.append(starts[1:], num_speeds)
+    sums = np.add.reduceat(smoothed_speeds, starts)
+    means = sums / (ends - starts)
+
+    # Sort the stretches where the athlete was moving into fast and slow.
+    moving = means >= MIN_MOVING_SPEED
+    threshold = separate_fast_segments(means[moving], (ends - starts)[moving].astype(float))
+    if threshold is None:
+        return []
+    is_fast = moving & (means > threshold)
+
+    # Adjacent fast stretches are one interval.
+    distance_times = np.array([ rec[0] for rec in distance_buf ], dtype=float)
+    distances = np.array([ rec[1] for rec in distance_buf ], dtype=float)
+    intervals = []
+    segment_index = 0
+    num_segments = len(starts)
+    while segment_index < num_segments:
+        if not is_fast[segment_index]:
+            segment_index = segment_index + 1
+            continue
+        first_index = int(starts[segment_index])
+        while segment_index < num_segments and is_fast[segment_index]:
+            segment_index = segment_index + 1
+        last_index = int(ends[segment_index - 1]) - 1
+
+        start_time = speed_times[first_index]
+        end_time = speed_times[last_index]
+        duration = end_time - start_time
+        if duration < MIN_INTERVAL_SECS * 1000.0:
+            continue
+        length = 0.0
+        if len(distances) > 0:
+            length = float(np.interp(end_time, distance_times, distances) - np.interp(start_time, distance_times, distances))
+        avg_speed = float(np.mean(raw_speeds[first_index:last_index + 1]))
+        intervals.append((start_time, end_time, duration, length, avg_speed))
+    return intervals
@@ -54,6 +54,52 @@ SESSION_TOKEN_KEY = "cookie"
 SESSION_USER_KEY = "user"
 SESSION_EXPIRY_KEY = "expiry"
 
+# Keys associated with cache invalidation.
+CACHE_INVALIDATION_NAME_KEY = "cache" # Name of the cache that holds the invalidated item
+CACHE_INVALIDATION_ITEM_KEY = "key" # Key of the invalidated item
+CACHE_INVALIDATION_ORIGIN_KEY = "origin" # Process that published the invalidation
+CACHE_INVALIDATION_TIME_KEY = "time" # When the invalidation was published
+
+# Keys associated with API rate limiting.
+RATE_LIMIT_KEY_KEY = "key" # API key being counted
+RATE_LIMIT_WINDOW_KEY = "window" # Start time (unix secs) of the window being counted
+RATE_LIMIT_COUNT_KEY = "count" # Number of requests counted in the window
+RATE_LIMIT_EXPIRY_KEY = "expiry" # When the count is no longer needed
+
+# Keys associated with batch jobs, i.e. re-analyzing a user's activities.
+BATCH_JOB_NAME_KEY = "name" # Identifies the job, so an interrupted job can be resumed
+BATCH_JOB_CHECKPOINT_KEY = "checkpoint" # Position of the last activity that was processed, None if nothing has been processed yet
+BATCH_JOB_NUM_PROCESSED_KEY = "num processed" # Number of activities processed so far
+BATCH_JOB_USERS_KEY = "users" # Users whose personal records need to be rebuilt when the job finishes
+BATCH_JOB_LEASE_EXPIRY_KEY = "lease expiry" # Time (secs) after which another worker may take over the job
+BATCH_JOB_OWNER_KEY = "owner" # Token identifying the worker that holds the lease, only that worker may update or delete the job
+BATCH_JOB_NUM_FAILED_KEY = "num failed" # Number of activities that could not be analyzed
+
+# Keys associated with training rollups, i.e. per-user daily, weekly, and monthly totals.
+ROLLUP_PERIOD_KEY = "period" # Length of the period being totaled, one of the values below
+ROLLUP_PERIOD_DAY = "day"
+ROLLUP_PERIOD_WEEK = "week" # Weeks start on Monday
+ROLLUP_PERIOD_MONTH = "month"
+ROLLUP_PERIODS = [ ROLLUP_PERIOD_DAY, ROLLUP_PERIOD_WEEK, ROLLUP_PERIOD_MONTH ]
+ROLLUP_PERIOD_START_KEY = "period start" # Start time (UTC unix secs) of the period
+ROLLUP_NUM_ACTIVITIES_KEY = "num activities"
+ROLLUP_DISTANCE_KEY = "distance" # Meters
+ROLLUP_DURATION_KEY = "duration" # Seconds
+ROLLUP_INTENSITY_SCORE_KEY = "intensity score"
+ROLLUP_ACTIVITY_TYPES_KEY = "activity types" # Totals for each activity type
+ROLLUP_TAGS_KEY = "tags" # Totals for each tag, including gear
+
+# Keys associated with stored blobs, i.e. uploaded files.
+BLOB_DIGEST_KEY = "digest" # SHA-256 of the uncompressed contents, identical uploads are only stored once
+BLOB_REFERENCES_KEY = "references" # Number of uploads that share the blob, it's deleted when this reaches zero
+BLOB_NAME_KEY = "name" # Name of the compressed contents in the blob store, not set until they've been written
+BLOB_COMPRESSION_KEY = "compression" # How the contents were compressed, one of the values below
+BLOB_COMPRESSION_NONE = "none"
+BLOB_COMPRESSION_GZIP = "gzip"
+BLOB_COMPRESSION_ZSTD = "zstd"
+BLOB_SIZE_KEY = "size" # Uncompressed size, in bytes
+BLOB_STORED_SIZE_KEY = "stored size" # Compressed size, in bytes
+
 # Celery.
 CELERY_PROJECT_NAME = "openworkoutweb_worker"
 
@@ -162,6 +208,7 @@ USER_SETTINGS_LAST_UPDATED_KEY = "last updated" # Time when the user settings wh
 
 # Personal records.
 RECORD_NAME_KEY = "record_name"
+RECORD_VALUE_KEY = "record_value"
 PERSONAL_RECORDS_KEY = "records"
 
 # Workout training intensity distribution.
@@ -188,6 +235,8 @@ WORKOUT_INTERVALS_KEY = "intervals"
 WORKOUT_COOLDOWN_KEY = "cooldown"
 WORKOUT_SCHEDULED_TIME_KEY = "scheduled time"
 WORKOUT_LAST_SCHEDULED_WORKOUT_TIME_KEY = "last scheduled workout time"
+WORKOUT_PLAN_VERSION_KEY = "plan version" # Changes every time the list of workouts changes, used to tell when a calendar feed is out of date
+WORKOUT_PLAN_LAST_MODIFIED_KEY = "plan last modified" # Unix time of the last change to the list of workouts
 WORKOUT_ESTIMATED_INTENSITY_KEY = "estimated intensity score"
 
 # Workout types.
@@ -235,6 +284,8 @@ UPLOADED_FILE_NAME_KEY = "uploaded_file_name"
 UPLOADED_FILE_DATA_KEY = "uploaded_file_data"
 UPLOADED_FILE1_DATA_KEY = "uploaded_file1_data"
 UPLOADED_FILE2_DATA_KEY = "uploaded_file2_data"
+UPLOADED_FILE_ID_KEY = "uploaded_file_id" # Database ID of an uploaded file, used to hand the file to the import worker
+UPLOADED_FILE_DIGEST_KEY = "uploaded_file_digest" # Digest of the blob that holds an uploaded file's contents
 
 # Keys associated with adding a new race.
 RACE_ID_KEY = "race_id"
@@ -314,15 +365,38 @@ ACTIVITY_TAGS_KEY = "tags" # A list of activities
 ACTIVITY_SUMMARY_KEY = "summary_data"
 ACTIVITY_EXPORT_FORMAT_KEY = "export_format"
 ACTIVITY_NUM_POINTS = "num_points" 
+ACTIVITY_CURSOR_KEY = "cursor" # Position in a live activity's track, so the next request only returns new points
+ACTIVITY_WAIT_KEY = "wait" # Number of seconds a live track request may wait for new points
+ACTIVITY_IS_LIVE_KEY = "live" # TRUE if the activity has been updated recently
+ACTIVITY_RETRY_MS_KEY = "retry_ms" # How long the client should wait before asking for more live data
+ACTIVITY_RESOLUTION_KEY = "resolution" # How much of an activity's track or sensor data to return, one of the resolutions below
+ACTIVITY_ZOOM_KEY = "zoom" # Map zoom level an activity's track will be drawn at, used to choose the resolution
+ACTIVITY_SIMPLIFIED_TRACKS_KEY = "simplified tracks" # Maps each of the stored resolutions to the track, simplified for drawing at that resolution
+ACTIVITY_DOWNSAMPLED_SENSORS_KEY = "downsampled sensors" # Maps each sensor to its readings, downsampled for drawing charts
+TRACK_RESOLUTION_LOW = "low"
+TRACK_RESOLUTION_MEDIUM = "medium"
+TRACK_RESOLUTION_HIGH = "high"
+TRACK_RESOLUTION_FULL = "full" # Every point that was recorded
 ACTIVITY_LOCATION_DESCRIPTION_KEY = "location_description" # Political description of the activity location (i.e., Florida)
 ACTIVITY_INTERVALS_KEY = "intervals" # Intervals that were computed from the workout
 ACTIVITY_PHOTO_ID_KEY = "photo id" # Unique identifier for a specific photo
 ACTIVITY_PHOTO_IDS_KEY = "photo ids" # Unique identifier for activity photos
 ACTIVITY_PHOTOS_KEY = "photos" # List of all photo IDs
 ACTIVITY_LAST_UPDATED_KEY = "last updated" # Time when the activity was last updated
+ACTIVITY_FINGERPRINT_KEY = "activity_fingerprint" # Type, start time, duration, and hash of an activity, used to detect duplicate uploads
 ACTIVITY_LAPS_KEY = "laps" # List of lap metadata
+ACTIVITY_ROLLUP_CONTRIBUTION_KEY = "rollup contribution" # What the activity has added to the user's training rollups, so it can be taken back out
+ACTIVITY_WRITE_SEQUENCE_KEY = "write sequence" # Number of the most recent write to the activity's buckets
 ACTIVITY_LAP_START_TIME = "lap start time" # Time (ms) when the lap started
 
+# Keys associated with bucketed activity data (locations, sensor readings, etc. that are appended while the activity is in progress).
+ACTIVITY_BUCKET_STREAM_KEY = "stream" # Name of the data stream stored in the bucket, i.e. locations, heart rate, etc.
+ACTIVITY_BUCKET_START_KEY = "bucket_start" # Start of the time span (ms) covered by the bucket
+ACTIVITY_BUCKET_COUNT_KEY = "count" # Number of values stored in the bucket
+ACTIVITY_BUCKET_VALUES_KEY = "values" # Values stored in the bucket, in the same form as they would be stored in the activity document
+ACTIVITY_BUCKET_SEQUENCES_KEY = "sequences" # Number of the write that stored each value, see ACTIVITY_WRITE_SEQUENCE_KEY
+ACTIVITY_BUCKET_LAST_SEQUENCE_KEY = "last_sequence" # Number of the most recent write to the bucket
+
 # Keys used to summarize activity data.
 BEST_SPEED = "Best Speed" # Highest speed seen during the activity
 BEST_PACE = "Best Pace" # Fastest pace seen during the activity
@@ -350,6 +424,7 @@ STEPS_PER_MINUTE = "Steps Per Minute" # Cadence for foot based activity
 AVG_STEPS_PER_MINUTE = "Average Steps Per Minute" # Average cadence for foot based activity
 NORMALIZED_POWER = "Normalized Power" # Normalized power
 THRESHOLD_POWER = "Threshold Power" # Functional Threshold Power (FTP)
+POWER_CURVE = "Power Curve" # Mean-maximal power curve, maps a duration (in seconds, as a string) to the best average power held for that long
 VARIABILITY_INDEX = "Variability Index"
 LONGEST_DISTANCE = "Longest Distance" # Longest distance, when summarizing activities
 TOTAL_DISTANCE = "Total Distance" # Distance for an activity
@@ -464,14 +539,24 @@ TASK_ACTIVITY_ID_KEY = "activity id"
 TASK_TYPE_KEY = "task type"
 TASK_DETAILS_KEY = "task details"
 TASK_STATUS_KEY = "task status"
+TASK_ENQUEUE_TIME_KEY = "enqueue time" # Time (secs) at which the task was handed to the broker, used to measure end-to-end latency
 IMPORT_TASK_KEY = "import"
 ANALYSIS_TASK_KEY = "analysis"
+BATCH_ANALYSIS_TASK_KEY = "batch analysis"
 WORKOUT_PLAN_TASK_KEY = "workout plan"
 TASK_STATUS_QUEUED = "Queued"
 TASK_STATUS_STARTED = "Started"
 TASK_STATUS_FINISHED = "Finished"
 TASK_STATUS_ERROR = "Error"
 
+# Analysis engines.
+ANALYSIS_ENGINE_KEY = "analysis engine" # Sent with each analysis task, since the workers don't read the configuration file
+ANALYSIS_ENGINE_ITERATIVE = "iterative" # Feeds the analyzers one reading at a time
+ANALYSIS_ENGINE_VECTORIZED = "vectorized" # Converts the activity to NumPy arrays and analyzes them in bulk
+ANALYSIS_ONLY_UNANALYZED_KEY = "only unanalyzed" # Sent with batch analysis tasks, TRUE to skip activities that already have a summary
+ANALYSIS_BATCH_SIZE_KEY = "batch size" # Sent with batch analysis tasks, number of activities analyzed before the results are written
+ANALYSIS_BATCH_WORKERS_KEY = "batch workers" # Sent with batch analysis tasks, number of activities analyzed at the same time
+
 # Things associated with deferred tasks.
 LOCAL_FILE_NAME = "local file name"
 
@@ -484,6 +569,10 @@ START_TIME_KEY = "start_time"
 END_TIME_KEY = "end_time"
 START_DATE_KEY = "start"
 END_DATE_KEY = "end"
+LIMIT_KEY = "limit" # Maximum number of items in a page of results
+PAGE_CURSOR_KEY = "cursor" # Where the page of results starts, as returned in NEXT_PAGE_CURSOR_KEY with the previous page
+NEXT_PAGE_CURSOR_KEY = "next_cursor" # Where the next page of results starts, or null if this is the last page
+ACTIVITY_LIST_KEY = "activities"
 CODE_KEY = "code" # Used for sync, values are specified below
 USER_AGE_IN_YEARS = "age in years" # Some API functions request the user's age in years
 
@@ -512,6 +601,6 @@ GOAL_THAT_REQUIRE_A_BIKE = [ GOAL_SPRINT_TRIATHLON_KEY, GOAL_OLYMPIC_TRIATHLON_K
 INTENSITY_SCORES = [ INTENSITY_SCORE, ESTIMATED_INTENSITY_SCORE, TOTAL_INTENSITY_SCORE ]
 
 UNSUMMARIZABLE_KEYS = [ APP_SPEED_VARIANCE_KEY, APP_DISTANCES_KEY, APP_LOCATIONS_KEY, ACTIVITY_START_TIME_KEY, ACTIVITY_TYPE_KEY, ACTIVITY_HASH_KEY, \
-    ACTIVITY_LOCATION_DESCRIPTION_KEY, ACTIVITY_INTERVALS_KEY, MILE_SPLITS, KM_SPLITS ]
+    ACTIVITY_LOCATION_DESCRIPTION_KEY, ACTIVITY_INTERVALS_KEY, MILE_SPLITS, KM_SPLITS, POWER_CURVE ]
 
 DAYS_OF_WEEK = ["Sunday", "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday"]
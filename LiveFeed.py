@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2017 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Lets requests for live activity data wait for new data to arrive, instead of repeatedly asking for it."""
+
+import threading
+
+DEFAULT_THREAD_POOL_SIZE = 10 # CherryPy's default, used if the server doesn't say how many threads it has
+WAITER_SHARE = 4 # Waiting requests each hold a server thread, so at most one in this many threads may be waiting
+
+g_lock = threading.Lock()
+g_activities = {} # Maps the activity ID to [condition, version, number of waiters], only while somebody is waiting on the activity
+g_num_waiters = 0
+g_max_waiters = DEFAULT_THREAD_POOL_SIZE // WAITER_SHARE
+
+def set_thread_pool_size(thread_pool_size):
+    """Called at startup with the number of threads the server uses to handle requests, so waiting requests can't use them all up."""
+    global g_lock
+    global g_max_waiters
+
+    with g_lock:
+        g_max_waiters = thread_pool_size // WAITER_SHARE
+
+def acquire_waiter():
+    """Reserves one of the waiting slots. Returns FALSE if they're all in use, in which case the caller should answer right away."""
+    global g_lock
+    global g_num_waiters
+    global g_max_waiters
+
+    with g_lock:
+        if g_num_waiters >= g_max_waiters:
+            return False
+        g_num_waiters = g_num_waiters + 1
+    return True
+
+def release_waiter():
+    """Frees a slot reserved by acquire_waiter."""
+    global g_lock
+    global g_num_waiters
+
+    with g_lock:
+        g_num_waiters = g_num_waiters - 1
+
+def notify(activity_id):
+    """Called when new data has been written for the activity. Wakes everything waiting on it, in this process."""
+    global g_lock
+    global g_activities
+
+    activity_id = str(activity_id).lower()
+    with g_lock:
+        entry = g_activities.get(activity_id)
+        if entry is not None:
+            entry[1] = entry[1] + 1
+            entry[0].notify_all()
+
+def wait(activity_id, timeout_secs):
+    """Blocks until notify is called for the activity, or the timeout expires. Returns TRUE if notified."""
+    """Data written by other processes does not cause a notification, so callers should check for new data each time this returns."""
+    global g_lock
+    global g_activities
+
+    activity_id = str(activity_id).lower()
+    with g_lock:
+        entry = g_activities.get(activity_id)
+        if entry is None:
+            entry = [threading.Condition(g_lock), 0, 0]
+            g_activities[activity_id] = entry
+        version = entry[1]
+        entry[2] = entry[2] + 1
+        try:
+            return entry[0].wait_for(lambda: entry[1] != version, timeout_secs)
+        finally:
+            entry[2] = entry[2] - 1
+            if entry[2] == 0:
+                del g_activities[activity_id]
@@ -5,6 +5,7 @@ import inspect
 import os
 import sys
 import InputChecker
+import IntervalDetector
 import Keys
 import LocationHeatMap
 import SensorAnalyzer
@@ -15,15 +16,8 @@ currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentfram
 libmathdir = os.path.join(currentdir, 'LibMath', 'python')
 sys.path.insert(0, libmathdir)
 import distance
-import peaks
-import signals
 import statistics
 
-# Stuff we need for kmeans
-from sklearn.cluster import KMeans
-from scipy.spatial.distance import cdist
-import numpy as np
-
 
 class LocationAnalyzer(SensorAnalyzer.SensorAnalyzer):
     """Class for performing calculations on a location track."""
@@ -62,18 +56,33 @@ class LocationAnalyzer(SensorAnalyzer.SensorAnalyzer):
         else:
             self.speed_window_size = 11
 
+        # Distances (in meters) for which we'll look for the fastest segment, shortest to longest.
+        self.record_distances = [ [Keys.BEST_1K, 1000.0], [Keys.BEST_MILE, Units.METERS_PER_MILE], [Keys.BEST_5K, 5000.0], [Keys.BEST_10K, 10000.0] ]
+        if self.activity_type == Keys.TYPE_RUNNING_KEY:
+            self.record_distances.append([Keys.BEST_15K, 15000.0])
+            self.record_distances.append([Keys.BEST_HALF_MARATHON, Units.METERS_PER_HALF_MARATHON])
+            self.record_distances.append([Keys.BEST_MARATHON, Units.METERS_PER_MARATHON])
+        elif self.activity_type == Keys.TYPE_CYCLING_KEY:
+            self.record_distances.append([Keys.BEST_METRIC_CENTURY, 100000.0])
+            self.record_distances.append([Keys.BEST_CENTURY, Units.METERS_PER_MILE * 100.0])
+
+        # Indexes into distance_buf used by update_speeds. They only ever move forward, which keeps the work done for each point constant.
+        self.next_window_end_index = 0 # The next point to be considered as the end of a window
+        self.speed_window_start_index = 0 # First point that is no more than speed_window_size seconds before the end of the window
+        self.speed_window_end_index = 0 # One past the last point that is at least speed_window_size seconds before the end of the window
+        self.record_start_indexes = [0] * len(self.record_distances) # For each record distance, the point at or just before where the segment starts
+
     def update_average_speed(self, date_time_ms):
         """Computes the average speed of the workout. Called by 'append_location'."""
         elapsed_milliseconds = date_time_ms - self.start_time_ms
         if elapsed_milliseconds > 0:
             self.avg_speed = self.total_distance / (elapsed_milliseconds / 1000.0)
 
-    def do_record_check(self, record_name, seconds, meters, record_meters):
+    def do_record_check(self, record_name, seconds):
         """Looks up the existing record and, if necessary, updates it."""
-        if int(meters) == int(record_meters):
-            old_value = self.get_best_time(record_name)
-            if old_value is None or seconds < old_value:
-                self.bests[record_name] = seconds
+        old_value = self.get_best_time(record_name)
+        if old_value is None or seconds < old_value:
+            self.bests[record_name] = seconds
 
     def do_split_check(self, seconds, split_meters, split_buf):
         """Helper function for computing split times."""
@@ -84,87 +93,72 @@ class LocationAnalyzer(SensorAnalyzer.SensorAnalyzer):
         else:
             split_buf[whole_units_traveled] = seconds
 
-    def update_speeds(self):
-        """Computes the average speed over the last mile. Called by 'append_location'."""
+    def update_speed_window(self, end_index):
+        """Computes the current speed, i.e. the average speed over the speed window that ends at the specified point."""
+        end_time_ms, end_distance = self.distance_buf[end_index]
 
         # This will be recomputed here, so zero it out.
         self.current_speed = 0.0
 
-        # Loop through the list, in reverse order, updating the current speed, and all "bests".
-        for time_distance_node in reversed(self.distance_buf):
-
-            # Convert time from ms to seconds - seconds from this point to the end of the activity.
-            current_time_ms = time_distance_node[0]
-            total_seconds = (self.last_time_ms - current_time_ms) / 1000.0
-            if total_seconds <= 0.0:
-                continue
-
-            # Distance travelled from this point to the end of the activity.
-            current_distance = time_distance_node[1]
-            total_meters = self.total_distance - current_distance
-
-            # Current speed is the average of the last ten seconds.
-            if int(total_seconds) == self.speed_window_size:
-
-                self.current_speed = total_meters / total_seconds
-
-                if Keys.BEST_SPEED not in self.bests or self.current_speed > self.bests[Keys.BEST_SPEED]:
-                    self.bests[Keys.BEST_SPEED] = self.current_speed
-                if current_time_ms > self.last_speed_buf_update_time:
-                    self.speed_times.append(current_time_ms)
-                    self.speed_graph.append(self.current_speed)
-                    self.last_speed_buf_update_time = current_time_ms
-
-            # Is this a new kilometer record for this activity?
-            if total_meters < 1000:
-                continue
-            self.do_record_check(Keys.BEST_1K, total_seconds, total_meters, 1000)
-
-            # Is this a new mile record for this activity?
-            if total_meters < Units.METERS_PER_MILE:
-                continue
-            self.do_record_check(Keys.BEST_MILE, total_seconds, total_meters, Units.METERS_PER_MILE)
-
-            # Is this a new 5K record for this activity?
-            if total_meters < 5000:
-                continue
-            self.do_record_check(Keys.BEST_5K, total_seconds, total_meters, 5000)
-
-            # Is this a new 10K record for this activity?
-            if total_meters < 10000:
-                continue
-            self.do_record_check(Keys.BEST_10K, total_seconds, total_meters, 10000)
-
-            # Running-specific records:
-            if self.activity_type == Keys.TYPE_RUNNING_KEY:
-
-                # Is this a new 15K record for this activity?
-                if total_meters < 15000:
-                    continue
-                self.do_record_check(Keys.BEST_15K, total_seconds, total_meters, 15000)
-
-                # Is this a new half marathon record for this activity?
-                if total_meters < Units.METERS_PER_HALF_MARATHON:
-                    continue
-                self.do_record_check(Keys.BEST_HALF_MARATHON, total_seconds, total_meters, Units.METERS_PER_HALF_MARATHON)
-
-                # Is this a new marathon record for this activity?
-                if total_meters < Units.METERS_PER_MARATHON:
-                    continue
-                self.do_record_check(Keys.BEST_MARATHON, total_seconds, total_meters, Units.METERS_PER_MARATHON)
-
-            # Cycling-specific records:
-            if self.activity_type == Keys.TYPE_CYCLING_KEY:
-
-                # Is this a new metric century record for this activity?
-                if total_meters < 100000:
-                    continue
-                self.do_record_check(Keys.BEST_METRIC_CENTURY, total_seconds, total_meters, 100000)
-
-                # Is this a new century record for this activity?
-                if total_meters < Units.METERS_PER_MILE * 100.0:
-                    continue
-                self.do_record_check(Keys.BEST_CENTURY, total_seconds, total_meters, Units.METERS_PER_MILE * 100.0)
+        # Move the trailing index past anything that is now too old to be in the window.
+        while self.speed_window_start_index < end_index and int((end_time_ms - self.distance_buf[self.speed_window_start_index][0]) / 1000.0) > self.speed_window_size:
+            self.speed_window_start_index = self.speed_window_start_index + 1
+
+        # Move the leading index past anything that is now old enough to be in the window.
+        while self.speed_window_end_index < end_index and int((end_time_ms - self.distance_buf[self.speed_window_end_index][0]) / 1000.0) >= self.speed_window_size:
+            self.speed_window_end_index = self.speed_window_end_index + 1
+
+        # Every point in between is exactly speed_window_size seconds (when truncated) before the end of the window.
+        # With one second data there will usually be just one of them.
+        for window_index in range(self.speed_window_end_index - 1, self.speed_window_start_index - 1, -1):
+            current_time_ms, current_distance = self.distance_buf[window_index]
+            total_seconds = (end_time_ms - current_time_ms) / 1000.0
+            self.current_speed = (end_distance - current_distance) / total_seconds
+
+            if Keys.BEST_SPEED not in self.bests or self.current_speed > self.bests[Keys.BEST_SPEED]:
+                self.bests[Keys.BEST_SPEED] = self.current_speed
+            if current_time_ms > self.last_speed_buf_update_time:
+                self.speed_times.append(current_time_ms)
+                self.speed_graph.append(self.current_speed)
+                self.last_speed_buf_update_time = current_time_ms
+
+    def update_record_windows(self, end_index):
+        """Looks for the fastest segment of each record distance that ends at the specified point."""
+        end_time_ms, end_distance = self.distance_buf[end_index]
+        first_distance = self.distance_buf[0][1]
+
+        for record_index, (record_name, record_meters) in enumerate(self.record_distances):
+
+            # Where would the segment have to start? Since the distances are sorted, if this one doesn't fit then none of the longer ones will either.
+            start_distance = end_distance - record_meters
+            if start_distance < first_distance:
+                break
+
+            # Move the trailing index to the last point that is at or before the start of the segment.
+            start_index = self.record_start_indexes[record_index]
+            while start_index + 1 < end_index and self.distance_buf[start_index + 1][1] <= start_distance:
+                start_index = start_index + 1
+            self.record_start_indexes[record_index] = start_index
+
+            # Interpolate the time at which we were exactly the record distance from the end of the segment.
+            current_time_ms, current_distance = self.distance_buf[start_index]
+            start_time_ms = current_time_ms
+            if current_distance < start_distance:
+                next_time_ms, next_distance = self.distance_buf[start_index + 1]
+                start_time_ms = current_time_ms + (next_time_ms - current_time_ms) * (start_distance - current_distance) / (next_distance - current_distance)
+
+            total_seconds = (end_time_ms - start_time_ms) / 1000.0
+            if total_seconds > 0.0:
+                self.do_record_check(record_name, total_seconds)
+
+    def update_speeds(self):
+        """Computes the current speed and updates all "bests" for each point added since the last call. Called after 'append_location'."""
+        """Each index used here only moves forward, so the work done for each point is constant, regardless of the length of the activity."""
+        num_points = len(self.distance_buf)
+        while self.next_window_end_index < num_points:
+            self.update_speed_window(self.next_window_end_index)
+            self.update_record_windows(self.next_window_end_index)
+            self.next_window_end_index = self.next_window_end_index + 1
 
     def append_location(self, date_time_ms, latitude, longitude, altitude, horizontal_accuracy, vertical_accuracy):
         """Adds another location to the analyzer. Locations should be sent in order."""
@@ -225,37 +219,6 @@ class LocationAnalyzer(SensorAnalyzer.SensorAnalyzer):
 
             self.append_location(date_time, latitude, longitude, altitude, horizontal_accuracy, vertical_accuracy)
     
-    def examine_interval_peak(self, start_index, end_index):
-        """Examines a line of near-constant pace/speed."""
-        if start_index >= end_index:
-            return None
-
-        # How long (in seconds) was this block?
-        start_time = self.speed_times[start_index]
-        end_time = self.speed_times[end_index]
-        line_duration_seconds = end_time - start_time
-        line_length_meters = 0
-        line_avg_speed = 0.0
-
-        # Don't consider anything less than ten seconds.
-        if line_duration_seconds > 10:
-            speeds = self.speed_graph[start_index:end_index - 1]
-            start_distance_rec = None
-            end_distance_rec = None
-            for rec in self.distance_buf:
-                if rec[0] == start_time:
-                    start_distance_rec = rec
-                if rec[0] == end_time:
-                    end_distance_rec = rec
-                    break
-            line_length_meters = 0.0
-            if start_distance_rec is not None and end_distance_rec is not None:
-                line_length_meters = end_distance_rec[1] - start_distance_rec[1]
-            line_avg_speed = statistics.mean(speeds)
-            self.speed_blocks.append(line_avg_speed)
-
-        return start_time, end_time, line_duration_seconds, line_length_meters, line_avg_speed
-
     def analyze(self):
         """Called when all location readings have been processed."""
 
@@ -270,68 +233,11 @@ class LocationAnalyzer(SensorAnalyzer.SensorAnalyzer):
             results[Keys.APP_SPEED_VARIANCE_KEY] = speed_variance
             results[Keys.ACTIVITY_INTERVALS_KEY] = [] # This will get overriden if interval efforts are found.
 
-            # Don't look for peaks unless the variance was high. Cutoff selected via experimentation.
+            # Don't look for intervals unless the variance was high. Cutoff selected via experimentation.
             if speed_variance > 0.25:
-
-                # Smooth the speed graph to take out some of the location data jitter.
-                smoothed_graph = signals.smooth(self.speed_graph, 4)
-                if len(smoothed_graph) > 1:
-        
-                    # Find peaks in the speed graph. We're looking for intervals.
-                    peak_list = peaks.find_peaks_in_numeric_array_over_stddev(smoothed_graph, 0.3)
-
-                    # Examine the lines between the peaks. Extract pertinant data, such as avg speed/pace and set it aside.
-                    # This data is used later when generating the report.
-                    filtered_interval_list = []
-                    for peak in peak_list:
-                        interval = self.examine_interval_peak(peak.left_trough.x, peak.right_trough.x)
-                        if interval is not None:
-                            filtered_interval_list.append(interval)
-
-                    # Do a k-means analysis on the computed speed/pace blocks so we can get rid of any outliers.
-                    significant_intervals = []
-                    num_speed_blocks = len(self.speed_blocks)
-                    if num_speed_blocks >= 2:
-
-                        # Make the data two dimensional because this is needed for the k means algorithm.
-                        x1 = np.array(self.speed_blocks)
-                        x2 = np.array([1] * num_speed_blocks)
-                        X = np.array(list(zip(x1, x2))).reshape(num_speed_blocks, 2)
-
-                        # Determine the maximum value of k.
-                        max_k = 10
-                        if num_speed_blocks < max_k:
-                            max_k = num_speed_blocks
-
-                        # Run k means for each possible k.
-                        best_k = 0
-                        best_labels = []
-                        steepest_slope = 0
-                        distortions = []
-                        for k in range(1, max_k):
-                            kmeans_model = KMeans(n_clusters=k, n_init=10).fit(X)
-                            distances = cdist(X, kmeans_model.cluster_centers_, 'euclidean')
-                            distances_sum = sum(np.min(distances, axis = 1))
-                            distortion = distances_sum / X.shape[0]
-                            distortions.append(distortion)
-
-                            # Use the elbow method to find the best value for k.
-                            if len(distortions) >= 2 and k >= 2:
-                                slope = (distortions[k-1] + distortions[k-2]) / 2
-
-                                if best_k == 0 or slope > steepest_slope:
-                                    best_k = k
-                                    best_labels = kmeans_model.labels_
-                                    steepest_slope = slope
-
-                        # Save off the significant peaks.
-                        interval_index = 0
-                        for label in best_labels:
-                            if label >= 1:
-                                significant_intervals.append(filtered_interval_list[interval_index])
-                            interval_index = interval_index + 1
-
-                    results[Keys.ACTIVITY_INTERVALS_KEY] = significant_intervals
+                intervals = IntervalDetector.detect_intervals(self.speed_times, self.speed_graph, self.distance_buf)
+                self.speed_blocks = [ interval[4] for interval in intervals ]
+                results[Keys.ACTIVITY_INTERVALS_KEY] = intervals
 
         # Insert the location into the analysis dictionary so that it gets cached.
         results[Keys.LONGEST_DISTANCE] = self.total_distance
@@ -25,7 +25,9 @@
 
 import inspect
 import os
+import pickle
 import sys
+import urllib.parse
 import GeoJsonReader
 
 # Locate and load the statistics module (the functions we're using in are made obsolete in Python 3, but we want to work in Python 2, also)
@@ -34,97 +36,161 @@ libmathdir = os.path.join(currentdir, 'LibMath', 'python')
 sys.path.insert(0, libmathdir)
 import graphics
 
-class MapSearch(object):
-    """Given a lat/lon, searches world maps to determine the political entity containing that position."""
+GRID_CELL_SIZE_DEGREES = 2.0 # Size of each cell in the region index
+INDEX_FILE_VERSION = 1 # Increment whenever the structure of the saved index changes
+
+def extract_rings(coordinates):
+    """Flattens GeoJSON Polygon and MultiPolygon coordinates into a list of rings, each of which is a list of [lon, lat] points."""
+    rings = []
+    if isinstance(coordinates, list) and len(coordinates) > 0:
+        first = coordinates[0]
+        if isinstance(first, list) and len(first) >= 2 and not isinstance(first[0], list):
+            rings.append(coordinates)
+        else:
+            for item in coordinates:
+                rings.extend(extract_rings(item))
+    return rings
+
+def describe_source(url):
+    """Returns something that will change when the file referred to by the URL changes. Only local files can be checked."""
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == 'file' and os.path.isfile(parsed.path):
+        return (url, os.path.getmtime(parsed.path), os.path.getsize(parsed.path))
+    return (url, None, None)
+
+class RegionIndex(object):
+    """Uniform grid over the bounding boxes of a set of named polygons."""
+    """Only polygons whose bounding box contains the point need the (expensive) point-in-polygon test."""
+
+    def __init__(self, cell_size=GRID_CELL_SIZE_DEGREES):
+        self.cell_size = cell_size
+        self.rings = [] # Entries are (name, ring, min lon, min lat, max lon, max lat)
+        self.cells = {} # Maps (column, row) to the indexes of the rings whose bounding box overlaps the cell
+        super(RegionIndex, self).__init__()
+
+    def cell(self, lon, lat):
+        """Returns the grid cell containing the point."""
+        return (int(lon // self.cell_size), int(lat // self.cell_size))
+
+    def add_region(self, name, coordinates):
+        """Adds each polygon ring of the named region to the index."""
+        for ring in extract_rings(coordinates):
+            lons = [point[0] for point in ring]
+            lats = [point[1] for point in ring]
+            min_lon, min_lat, max_lon, max_lat = min(lons), min(lats), max(lons), max(lats)
+            ring_index = len(self.rings)
+            self.rings.append((name, ring, min_lon, min_lat, max_lon, max_lat))
+
+            min_col, min_row = self.cell(min_lon, min_lat)
+            max_col, max_row = self.cell(max_lon, max_lat)
+            for col in range(min_col, max_col + 1):
+                for row in range(min_row, max_row + 1):
+                    key = (col, row)
+                    if key not in self.cells:
+                        self.cells[key] = []
+                    self.cells[key].append(ring_index)
+
+    def candidates(self, lat, lon):
+        """Returns the (name, ring) pairs whose bounding box contains the point, in the order in which they were added."""
+        candidates = []
+        for ring_index in self.cells.get(self.cell(lon, lat), []):
+            name, ring, min_lon, min_lat, max_lon, max_lat = self.rings[ring_index]
+            if min_lon <= lon <= max_lon and min_lat <= lat <= max_lat:
+                candidates.append((name, ring))
+        return candidates
+
+    def search(self, lat, lon):
+        """Returns the name of the first region containing the point, or None if not found."""
+        for name, ring in self.candidates(lat, lon):
+            if graphics.is_point_in_poly_array(lon, lat, ring):
+                return name
+        return None
 
-    def __init__(self, world_data_url, us_data_url, canadian_data_url):
-        self.world_data = GeoJsonReader.GeoJsonReader()
-        self.world_data.read(world_data_url)
-        self.world_coordinates = self.world_data.name_to_coordinate_map()
+    def is_in_region(self, name, lat, lon):
+        """Returns True if the point is within the named region."""
+        for candidate_name, ring in self.candidates(lat, lon):
+            if candidate_name == name and graphics.is_point_in_poly_array(lon, lat, ring):
+                return True
+        return False
 
-        self.us_data = GeoJsonReader.GeoJsonReader()
-        self.us_data.read(us_data_url)
-        self.us_coordinates = self.us_data.name_to_coordinate_map()
+class MapSearch(object):
+    """Given a lat/lon, searches world maps to determine the political entity containing that position."""
 
-        self.canadian_data = GeoJsonReader.GeoJsonReader()
-        self.canadian_data.read(canadian_data_url)
-        self.canadian_coordinates = self.canadian_data.name_to_coordinate_map()
+    def __init__(self, world_data_url, us_data_url, canadian_data_url, index_file_name=None):
+        self.world_index = None
+        self.us_index = None
+        self.canadian_index = None
 
-        self.last_country = None
-        self.last_us_state = None
-        self.last_canadian_province = None
+        # Parsing the geojson is slow, so use the saved index if it's still valid.
+        sources = [ describe_source(world_data_url), describe_source(us_data_url), describe_source(canadian_data_url) ]
+        if not (index_file_name and self.load_index(index_file_name, sources)):
+            self.world_index = self.build_index(world_data_url)
+            self.us_index = self.build_index(us_data_url)
+            self.canadian_index = self.build_index(canadian_data_url)
+            if index_file_name:
+                self.save_index(index_file_name, sources)
 
         super(MapSearch, self).__init__()
 
-    def is_in_region(self, region, lat, lon):
-        """Returns True if the specified lat and lon is within the bounds of the given polygon."""
-        if isinstance(region, list):
-            if graphics.is_point_in_poly_array(lon, lat, region):
-                return True
-            for subregion in region:
-                if self.is_in_region(subregion, lat, lon):
-                    return True
+    @staticmethod
+    def build_index(data_url):
+        """Reads the geojson file and indexes each of its regions."""
+        data = GeoJsonReader.GeoJsonReader()
+        data.read(data_url)
+        index = RegionIndex()
+        for name, coordinates in data.name_to_coordinate_map().items():
+            index.add_region(name, coordinates)
+        return index
+
+    def load_index(self, index_file_name, sources):
+        """Loads a previously saved index. Returns False if there isn't one, or if it was built from different data."""
+        try:
+            with open(index_file_name, 'rb') as index_file:
+                saved = pickle.load(index_file)
+            if saved['version'] != INDEX_FILE_VERSION or saved['sources'] != sources:
+                return False
+            self.world_index = saved['world']
+            self.us_index = saved['us']
+            self.canadian_index = saved['canada']
+            return True
+        except:
+            pass
         return False
 
+    def save_index(self, index_file_name, sources):
+        """Saves the index so the next process doesn't need to parse the geojson files."""
+        saved = { 'version': INDEX_FILE_VERSION, 'sources': sources, 'world': self.world_index, 'us': self.us_index, 'canada': self.canadian_index }
+        try:
+            temp_file_name = index_file_name + '.' + str(os.getpid())
+            with open(temp_file_name, 'wb') as index_file:
+                pickle.dump(saved, index_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_file_name, index_file_name)
+        except:
+            pass
+
     def is_in_country(self, country_name, lat, lon):
         """Returns True if the specified lat and lon is within the bounds of the given country."""
-        coordinate_list = self.world_coordinates[country_name]
-        return self.is_in_region(coordinate_list, lat, lon)
+        return self.world_index.is_in_region(country_name, lat, lon)
 
     def which_country(self, lat, lon):
-        """Given a lat/lon, returns the name of the country in which it falls, or empty string if not found."""
-
-        # Test against the last country we used, since there's a good chance it'll be in the same one.
-        if self.last_country:
-            if self.is_in_country(self.last_country, lat, lon):
-                return self.last_country
-
-        # Loop through each country until we find a match.
-        for country_name in self.world_coordinates.keys():
-            if self.is_in_country(country_name, lat, lon):
-                self.last_country = country_name
-                return country_name
-        return None
+        """Given a lat/lon, returns the name of the country in which it falls, or None if not found."""
+        return self.world_index.search(lat, lon)
 
     def is_in_us_state(self, state_name, lat, lon):
         """Returns True if the specified lat and lon is within the bounds of the given US state."""
-        coordinate_list = self.us_coordinates[state_name]
-        return self.is_in_region(coordinate_list, lat, lon)
+        return self.us_index.is_in_region(state_name, lat, lon)
 
     def which_us_state(self, lat, lon):
-        """Given a lat/lon, returns the name of the US state in which it falls, or empty string if not found."""
-
-        # Test against the last state we used, since there's a good chance it'll be in the same one.
-        if self.last_us_state:
-            if self.is_in_us_state(self.last_us_state, lat, lon):
-                return self.last_us_state
-
-        # Loop through each state until we find a match.
-        for state_name in self.us_coordinates.keys():
-            if self.is_in_us_state(state_name, lat, lon):
-                self.last_us_state = state_name
-                return state_name
-        return None
+        """Given a lat/lon, returns the name of the US state in which it falls, or None if not found."""
+        return self.us_index.search(lat, lon)
 
     def is_in_canadian_province(self, province_name, lat, lon):
-        """Returns True if the specified lat and lon is within the bounds of the given US state."""
-        coordinate_list = self.canadian_coordinates[province_name]
-        return self.is_in_region(coordinate_list, lat, lon)
+        """Returns True if the specified lat and lon is within the bounds of the given Canadian province."""
+        return self.canadian_index.is_in_region(province_name, lat, lon)
 
     def which_canadian_province(self, lat, lon):
-        """Given a lat/lon, returns the name of the Canadian province in which it falls, or empty string if not found."""
-
-        # Test against the last province we used, since there's a good chance it'll be in the same one.
-        if self.last_canadian_province:
-            if self.is_in_canadian_province(self.last_canadian_province, lat, lon):
-                return self.last_canadian_province
-
-        # Loop through each province until we find a match.
-        for province_name in self.canadian_coordinates.keys():
-            if self.is_in_canadian_province(province_name, lat, lon):
-                self.last_canadian_province = province_name
-                return province_name
-        return None
+        """Given a lat/lon, returns the name of the Canadian province in which it falls, or None if not found."""
+        return self.canadian_index.search(lat, lon)
 
     def search_map(self, lat, lon):
         """Given a lat/lon, returns an array containing the place description, from most significant to least significant, i.e. ['United States', 'Florida']"""
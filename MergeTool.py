@@ -44,7 +44,7 @@ class ActivityWriterForMerging(Importer.ActivityWriter):
     def __init__(self):
         super(Importer.ActivityWriter, self).__init__()
 
-    def is_duplicate_activity(self, user_id, start_time, optional_activity_id):
+    def is_duplicate_activity(self, user_id, start_time, optional_activity_id, fingerprint=None):
         """Inherited from ActivityWriter. Returns TRUE if the activity appears to be a duplicate of another activity. Returns FALSE otherwise."""
         return False
 
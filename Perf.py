@@ -21,38 +21,475 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
-"""Performance monitoring tools."""
+"""Performance monitoring tools. Latencies are kept as histograms with fixed, log spaced buckets so that percentiles can be estimated and"""
+"""histograms from different processes can be added together. Recording a latency only appends it to a queue, which needs no lock,"""
+"""so threads don't contend with each other. The queued values are added to the histogram in batches."""
 
-import timeit
+import atexit
+import collections
+import functools
+import json
+import numpy
+import os
+import re
 import threading
+import time
 
-g_stats_lock = threading.Lock()
-g_stats_count = {}
-g_stats_time = {}
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+FUNCTION_SECONDS_METRIC = "openworkout_function_seconds" # Functions with the statistics decorator, labeled by function name
+API_SECONDS_METRIC = "openworkout_api_request_seconds" # API requests, labeled by verb and request
+TASK_SECONDS_METRIC = "openworkout_celery_task_seconds" # Celery tasks, labeled by task name and final state
+DATABASE_SECONDS_METRIC = "openworkout_mongodb_command_seconds" # Database commands, labeled by command and collection
+ANALYSIS_SECONDS_METRIC = "openworkout_analysis_seconds" # Activity analysis, labeled by activity type and analysis engine
+METRIC_PREFIX = "openworkout_" # Prepended to the names of the metrics recorded with record_metric
+DRAIN_THRESHOLD = 1024 # Number of queued values that causes the recording thread to add them to the histogram
+DEFAULT_FLUSH_INTERVAL_SECS = 15.0 # How often each process writes its histograms in multi-process mode
+SNAPSHOT_FILE_EXTENSION = ".json"
+RETIRED_SNAPSHOT_NAME = "retired" + SNAPSHOT_FILE_EXTENSION # Totals of the processes that have exited, so their counts outlive their files
+
+# Bucket upper bounds, in seconds. Each bucket is sqrt(2) times as wide as the one before it, from 50 microseconds up to about 100 seconds,
+# so a percentile estimated from the buckets is within about 20% of the real value. Anything slower goes in the last, unbounded, bucket.
+BUCKET_BOUNDS = tuple(0.00005 * (2.0 ** (i / 2.0)) for i in range(42))
+BUCKET_BOUNDS_ARRAY = numpy.array(BUCKET_BOUNDS)
+NUM_BUCKETS = len(BUCKET_BOUNDS) + 1
+SUM_INDEX = NUM_BUCKETS # A histogram is a list of the bucket counts followed by the sum of the observed values
+
+g_series_lock = threading.Lock()
+g_series = {} # Maps (metric name, labels) to the LatencySeries
+g_metrics_lock = threading.Lock()
+g_metrics = {} # Maps the metric name to [count, total, max]
+g_flusher_lock = threading.Lock()
+g_metrics_dir = None # Directory shared by all of the processes in multi-process mode, None otherwise
+g_flush_interval_secs = DEFAULT_FLUSH_INTERVAL_SECS
+g_flusher = None
+g_snapshot_lock = threading.Lock() # Keeps the flusher from writing the snapshot after the process has retired it
+g_process_start_ms = int(time.time() * 1000) # Part of the snapshot's file name, so a new process that reuses the pid doesn't overwrite it
+g_retired = False
+
+def create_histogram():
+    """Returns an empty histogram."""
+    return [0] * NUM_BUCKETS + [0.0]
+
+class LatencySeries(object):
+    """The histogram for one metric name and set of labels."""
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels # Tuple of (label name, label value) pairs, sorted by label name
+        self.pending = collections.deque() # Values that haven't been added to the histogram, appending to a deque is thread safe
+        self.lock = threading.Lock() # Held while adding the pending values to the histogram
+        self.histogram = create_histogram()
+
+    def observe(self, secs):
+        """Records a single duration, in seconds."""
+        pending = self.pending
+        pending.append(secs)
+        if len(pending) >= DRAIN_THRESHOLD:
+            self.drain(False)
+
+    def drain(self, wait=True):
+        """Adds the pending values to the histogram. When not waiting, and another thread is already doing this, then there's nothing to do."""
+        if not self.lock.acquire(blocking=wait):
+            return
+        try:
+            popleft = self.pending.popleft
+            values = [ popleft() for _ in range(len(self.pending)) ]
+            if len(values) > 0:
+                values = numpy.array(values)
+                counts = numpy.bincount(numpy.searchsorted(BUCKET_BOUNDS_ARRAY, values, side='left'), minlength=NUM_BUCKETS)
+                histogram = self.histogram
+                for i, count in enumerate(counts.tolist()):
+                    histogram[i] += count
+                histogram[SUM_INDEX] += float(values.sum())
+        finally:
+            self.lock.release()
+
+    def copy_histogram(self):
+        """Returns a copy of the histogram, including everything recorded so far."""
+        self.drain()
+        with self.lock:
+            return list(self.histogram)
+
+    def reset(self):
+        """Discards everything recorded so far. The queue is cleared rather than replaced because decorated functions hold a reference to it."""
+        self.pending.clear()
+        self.lock = threading.Lock()
+        self.histogram = create_histogram()
+
+def retrieve_series(name, labels):
+    """Returns the series with the given name and labels, creating it if necessary. Labels are a dictionary of label names to values, or None."""
+    global g_series_lock
+    global g_series
+
+    if labels:
+        labels = tuple(sorted((str(k), str(v)) for k, v in labels.items()))
+    else:
+        labels = ()
+    key = (name, labels)
+
+    series = g_series.get(key)
+    if series is None:
+        with g_series_lock:
+            series = g_series.get(key)
+            if series is None:
+                series = LatencySeries(name, labels)
+                g_series[key] = series
+    return series
+
+def record_latency(name, labels, secs):
+    """Records a single duration, in seconds, in the histogram with the given name and labels."""
+    retrieve_series(name, labels).observe(secs)
 
 def statistics(function):
     """Function decorator for usage and timing statistics."""
+    series = retrieve_series(FUNCTION_SECONDS_METRIC, { "function": function.__name__ })
+    pending = series.pending
+    perf_counter = time.perf_counter
 
+    # This is the same as series.observe(), but without the overhead of another function call.
+    @functools.wraps(function)
     def wrapper(*args, **kwargs):
-        global g_stats_lock
-        global g_stats_count
-        global g_stats_time
+        start = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            pending.append(perf_counter() - start)
+            if len(pending) >= DRAIN_THRESHOLD:
+                series.drain(False)
+
+    return wrapper
+
+def record_metric(name, value):
+    """Records a single observation of a named value, such as a message size or a latency."""
+    global g_metrics_lock
+    global g_metrics
+
+    g_metrics_lock.acquire()
+    try:
+        if name in g_metrics:
+            metric = g_metrics[name]
+            metric[0] = metric[0] + 1
+            metric[1] = metric[1] + value
+            if value > metric[2]:
+                metric[2] = value
+        else:
+            g_metrics[name] = [1, value, value]
+    finally:
+        g_metrics_lock.release()
+
+def retrieve_metrics():
+    """Returns a copy of the recorded metrics, as a dictionary that maps the metric name to [count, total, max]."""
+    global g_metrics_lock
+    global g_metrics
+
+    g_metrics_lock.acquire()
+    try:
+        return { name: list(metric) for name, metric in g_metrics.items() }
+    finally:
+        g_metrics_lock.release()
+
+def add_histograms(totals, series):
+    """Adds each histogram in series to the histogram with the same key in totals."""
+    for key, histogram in list(series.items()):
+        total = totals.get(key)
+        if total is None:
+            totals[key] = list(histogram)
+        else:
+            for i in range(NUM_BUCKETS + 1):
+                total[i] += histogram[i]
+
+def retrieve_histograms():
+    """Returns a copy of this process's histograms, as a dictionary that maps (metric name, labels) to the histogram."""
+    global g_series_lock
+    global g_series
+
+    with g_series_lock:
+        all_series = list(g_series.values())
+    return { (series.name, series.labels): series.copy_histogram() for series in all_series }
+
+def format_snapshot(histograms, metrics):
+    """Converts histograms and metrics, in the forms returned by retrieve_histograms() and retrieve_metrics(), to a form that can be written as JSON."""
+    return { "histograms": [ [ key[0], [ list(label) for label in key[1] ], histogram ] for key, histogram in histograms.items() ], "metrics": metrics }
+
+def create_snapshot():
+    """Returns this process's histograms and metrics in a form that can be written as JSON and merged with the other processes'."""
+    snapshot = format_snapshot(retrieve_histograms(), retrieve_metrics())
+    snapshot["pid"] = os.getpid()
+    snapshot["start_ms"] = g_process_start_ms
+    return snapshot
+
+def merge_snapshots(snapshots):
+    """Adds together the histograms and metrics from each snapshot. Returns a tuple of the histograms, in the form returned by retrieve_histograms(),"""
+    """and the metrics, in the form returned by retrieve_metrics()."""
+    histograms = {}
+    metrics = {}
+    for snapshot in snapshots:
+        for name, labels, histogram in snapshot.get("histograms", []):
+            key = (name, tuple(tuple(label) for label in labels))
+            add_histograms(histograms, { key: histogram })
+        for name, metric in snapshot.get("metrics", {}).items():
+            if name in metrics:
+                total = metrics[name]
+                total[0] = total[0] + metric[0]
+                total[1] = total[1] + metric[1]
+                total[2] = max(total[2], metric[2])
+            else:
+                metrics[name] = list(metric)
+    return histograms, metrics
+
+def histogram_count(histogram):
+    """Returns the number of observations in the histogram."""
+    return sum(histogram[:NUM_BUCKETS])
 
-        start = timeit.default_timer()
-        result = function(*args, **kwargs)
-        end = timeit.default_timer()
-        execution_time = end - start
+def estimate_quantile(histogram, quantile):
+    """Estimates the value below which the given fraction (0.0 to 1.0) of the observations fall, by interpolating within the bucket that contains it."""
+    count = histogram_count(histogram)
+    if count == 0:
+        return 0.0
 
-        g_stats_lock.acquire()
+    rank = quantile * count
+    cumulative = 0
+    for i in range(NUM_BUCKETS):
+        bucket_count = histogram[i]
+        if bucket_count > 0 and cumulative + bucket_count >= rank:
+            if i >= len(BUCKET_BOUNDS):
+                return BUCKET_BOUNDS[-1] # Unbounded, so this is the best we can say
+            lower = 0.0
+            if i > 0:
+                lower = BUCKET_BOUNDS[i - 1]
+            upper = BUCKET_BOUNDS[i]
+            return lower + (upper - lower) * ((rank - cumulative) / bucket_count)
+        cumulative += bucket_count
+    return BUCKET_BOUNDS[-1]
+
+def summarize_histogram(histogram):
+    """Returns a dictionary of the count, average, and 50th, 95th, and 99th percentiles of the histogram."""
+    count = histogram_count(histogram)
+    avg = 0.0
+    if count > 0:
+        avg = histogram[SUM_INDEX] / count
+    return { "count": count, "avg": avg, "p50": estimate_quantile(histogram, 0.50), "p95": estimate_quantile(histogram, 0.95), "p99": estimate_quantile(histogram, 0.99) }
+
+def retrieve_latency_summaries():
+    """Returns a dictionary that maps (metric name, labels) to the summary of the histogram, for every process that shares the metrics directory."""
+    histograms, _ = retrieve_all()
+    return { key: summarize_histogram(histogram) for key, histogram in histograms.items() }
+
+def format_labels(labels, extra_label=None):
+    """Formats the labels in the text exposition format, i.e. {verb="GET",request="login"}."""
+    labels = list(labels)
+    if extra_label is not None:
+        labels.append(extra_label)
+    if len(labels) == 0:
+        return ""
+    escaped = []
+    for label_name, label_value in labels:
+        label_value = label_value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(label_name + '="' + label_value + '"')
+    return "{" + ",".join(escaped) + "}"
+
+def metric_name(name):
+    """Converts the name passed to record_metric into one that is valid in the text exposition format."""
+    return METRIC_PREFIX + re.sub('[^a-zA-Z0-9_]', '_', name.strip()).lower()
+
+def render_exposition():
+    """Returns the histograms and metrics in the Prometheus text exposition format."""
+    histograms, metrics = retrieve_all()
+    bound_strs = [ "%.6g" % bound for bound in BUCKET_BOUNDS ] + [ "+Inf" ]
+    lines = []
+
+    last_name = None
+    for key in sorted(histograms.keys()):
+        name, labels = key
+        histogram = histograms[key]
+        if name != last_name:
+            lines.append("# TYPE " + name + " histogram")
+            last_name = name
+        cumulative = 0
+        for i in range(NUM_BUCKETS):
+            cumulative += histogram[i]
+            lines.append(name + "_bucket" + format_labels(labels, ("le", bound_strs[i])) + " " + str(cumulative))
+        lines.append(name + "_sum" + format_labels(labels) + " " + repr(float(histogram[SUM_INDEX])))
+        lines.append(name + "_count" + format_labels(labels) + " " + str(cumulative))
+
+    for name in sorted(metrics.keys()):
+        count, total, max_value = metrics[name]
+        exposed_name = metric_name(name)
+        lines.append("# TYPE " + exposed_name + " summary")
+        lines.append(exposed_name + "_sum " + repr(float(total)))
+        lines.append(exposed_name + "_count " + str(count))
+        lines.append("# TYPE " + exposed_name + "_max gauge")
+        lines.append(exposed_name + "_max " + repr(float(max_value)))
+
+    return "\n".join(lines) + "\n"
+
+def snapshot_base_name():
+    """Returns the name of the file that holds this process's histograms in multi-process mode. Pids are reused, so the name includes the start time."""
+    return str(os.getpid()) + "-" + str(g_process_start_ms) + SNAPSHOT_FILE_EXTENSION
+
+def write_json_file(file_name, contents):
+    """The file is replaced in one step so readers never see half of it."""
+    temp_file_name = file_name + ".tmp"
+    with open(temp_file_name, 'w') as temp_file:
+        json.dump(contents, temp_file)
+    os.replace(temp_file_name, file_name)
+
+def read_json_file(file_name):
+    """Returns the contents of a snapshot file, or None if it doesn't exist (i.e. it was removed since listing the directory) or isn't one of ours."""
+    try:
+        with open(file_name, 'r') as snapshot_file:
+            return json.load(snapshot_file)
+    except (IOError, ValueError):
+        pass
+    return None
+
+def write_snapshot():
+    """Writes this process's histograms to the metrics directory."""
+    with g_snapshot_lock:
+        metrics_dir = g_metrics_dir
+        if metrics_dir is None or g_retired:
+            return
+        write_json_file(os.path.join(metrics_dir, snapshot_base_name()), create_snapshot())
+
+def retire_snapshot():
+    """Called when the process exits. Adds its final counts to the retired snapshot, which holds the totals of every process that has exited,"""
+    """and removes its own file, so files don't pile up as worker processes are recycled."""
+    global g_retired
+
+    with g_snapshot_lock:
+        metrics_dir = g_metrics_dir
+        if metrics_dir is None or g_retired:
+            return
+        g_retired = True
+
+        own_file_name = os.path.join(metrics_dir, snapshot_base_name())
+        if fcntl is None:
+            write_json_file(own_file_name, create_snapshot()) # Without a lock the retired snapshot can't be shared, so leave the file
+            return
+
+        retired_file_name = os.path.join(metrics_dir, RETIRED_SNAPSHOT_NAME)
+        with open(retired_file_name + ".lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            retired = read_json_file(retired_file_name) or {}
+            histograms, metrics = merge_snapshots([ retired, create_snapshot() ])
+
+            # Readers skip the files listed here, so this process's counts aren't included twice until its file is removed.
+            retired_names = [ name for name in retired.get("retired", []) if os.path.exists(os.path.join(metrics_dir, name)) ]
+            snapshot = format_snapshot(histograms, metrics)
+            snapshot["retired"] = retired_names + [ snapshot_base_name() ]
+            write_json_file(retired_file_name, snapshot)
+        if os.path.exists(own_file_name):
+            os.remove(own_file_name)
+
+def read_snapshots():
+    """Returns the snapshots written by the other processes that share the metrics directory, including the retired snapshot."""
+    metrics_dir = g_metrics_dir
+    if metrics_dir is None:
+        return []
+
+    # The retired snapshot is read last. A process that's retiring adds itself to it before removing its own file, so whichever
+    # order the two happen in relative to this, the process is counted exactly once.
+    own_file_name = snapshot_base_name()
+    snapshots = {}
+    for file_name in os.listdir(metrics_dir):
+        if not file_name.endswith(SNAPSHOT_FILE_EXTENSION) or file_name == own_file_name or file_name == RETIRED_SNAPSHOT_NAME:
+            continue
+        snapshot = read_json_file(os.path.join(metrics_dir, file_name))
+        if snapshot is not None:
+            snapshots[file_name] = snapshot
+    retired = read_json_file(os.path.join(metrics_dir, RETIRED_SNAPSHOT_NAME))
+    if retired is not None:
+        for file_name in retired.get("retired", []):
+            snapshots.pop(file_name, None)
+        snapshots[RETIRED_SNAPSHOT_NAME] = retired
+    return list(snapshots.values())
+
+def retrieve_all():
+    """Returns a tuple of the histograms and metrics for this process, plus every other process that shares the metrics directory."""
+    if g_metrics_dir is None:
+        return retrieve_histograms(), retrieve_metrics()
+    return merge_snapshots([ create_snapshot() ] + read_snapshots())
+
+def flush_periodically(stop_event, interval_secs):
+    """Thread function for the multi-process mode, writes this process's histograms until told to stop."""
+    while not stop_event.wait(interval_secs):
         try:
-            g_stats_count[function.__name__] = g_stats_count[function.__name__] + 1
-            g_stats_time[function.__name__] = g_stats_time[function.__name__] + execution_time
+            write_snapshot()
         except:
-            g_stats_count[function.__name__] = 1
-            g_stats_time[function.__name__] = execution_time
-        finally:
-            g_stats_lock.release()
+            pass # Try again next time, i.e. if the directory was temporarily unavailable
 
-        return result
+def start_flusher():
+    """Starts the thread that writes this process's histograms. Caller must hold g_flusher_lock."""
+    global g_flusher
 
-    return wrapper
+    stop_event = threading.Event()
+    thread = threading.Thread(target=flush_periodically, args=(stop_event, g_flush_interval_secs), name="metrics flusher", daemon=True)
+    thread.start()
+    g_flusher = (thread, stop_event)
+
+def stop_flusher():
+    """Stops the thread that writes this process's histograms, if it is running. Caller must hold g_flusher_lock."""
+    global g_flusher
+
+    if g_flusher is not None:
+        g_flusher[1].set()
+        g_flusher = None
+
+def configure(metrics_dir, flush_interval_secs=DEFAULT_FLUSH_INTERVAL_SECS):
+    """Enables the multi-process mode, for when requests or tasks are spread across several processes (WSGI and Celery workers, for example)."""
+    """Each process periodically writes its histograms to a file in the directory, and the totals include every file in the directory."""
+    """An empty directory name disables the multi-process mode."""
+    global g_flusher_lock
+    global g_metrics_dir
+    global g_flush_interval_secs
+
+    with g_flusher_lock:
+        stop_flusher()
+        if metrics_dir is None or len(metrics_dir) == 0:
+            g_metrics_dir = None
+            return
+        os.makedirs(metrics_dir, exist_ok=True)
+        g_metrics_dir = metrics_dir
+        g_flush_interval_secs = flush_interval_secs
+        start_flusher()
+
+def reset_after_fork():
+    """A forked child starts with a copy of its parent's counts, which the parent is already reporting, and without the parent's threads."""
+    global g_series_lock
+    global g_series
+    global g_metrics_lock
+    global g_metrics
+    global g_flusher_lock
+    global g_flusher
+    global g_snapshot_lock
+    global g_process_start_ms
+    global g_retired
+
+    g_series_lock = threading.Lock()
+    for series in g_series.values():
+        series.reset()
+    g_metrics_lock = threading.Lock()
+    g_metrics = {}
+    g_flusher_lock = threading.Lock()
+    g_flusher = None
+    g_snapshot_lock = threading.Lock()
+    g_process_start_ms = int(time.time() * 1000)
+    g_retired = False
+    if g_metrics_dir is not None:
+        start_flusher()
+
+def flush_at_exit():
+    """Retires the final counts, so the work done by a process that exits (i.e. a recycled worker) is still included in the totals."""
+    """Processes that exit without running the exit handlers, such as celery's pool processes, need to call retire_snapshot themselves."""
+    try:
+        retire_snapshot()
+    except:
+        pass
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_after_fork)
+atexit.register(flush_at_exit)
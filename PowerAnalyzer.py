@@ -6,6 +6,18 @@ import IntensityCalculator
 import Keys
 import SensorAnalyzer
 import Units
+import numpy as np
+
+# Power is assumed to be held between readings, but not across long gaps (i.e. sensor dropouts or auto-pause).
+MAX_POWER_HOLD_MS = 5000
+
+# Window used to smooth the data for the normalized power calculation.
+NORMALIZED_POWER_WINDOW_SECS = 30
+
+# Durations (in seconds) at which the mean-maximal power curve is computed and stored. Roughly log spaced, since the curve
+# flattens out as the duration grows, and computing (and storing) every second of a long ride is quadratic in its length.
+POWER_CURVE_DURATIONS = [ 1, 2, 3, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 240, 300, 420, 600, 720, 900, 1200, 1800, 2400, 3600, \
+    5400, 7200, 10800, 14400, 18000, 21600, 28800, 36000, 43200, 64800, 86400 ]
 
 class PowerAnalyzer(SensorAnalyzer.SensorAnalyzer):
     """Class for performing calculations on power data."""
@@ -14,10 +26,14 @@ class PowerAnalyzer(SensorAnalyzer.SensorAnalyzer):
         SensorAnalyzer.SensorAnalyzer.__init__(self, Keys.APP_POWER_KEY, Units.get_power_units_str(), activity_type)
         self.data_mgr = data_mgr
         self.user_mgr = user_mgr
-        self.np_buf = []
-        self.current_30_sec_buf = []
-        self.current_30_sec_buf_start_time = 0
         self.activity_user_id = activity_user_id
+        self.record_windows = [ [Keys.BEST_5_SEC_POWER, 5], [Keys.BEST_12_MIN_POWER, 720], [Keys.BEST_20_MIN_POWER, 1200], [Keys.BEST_1_HOUR_POWER, 3600] ]
+        self.energy_sums = [ 0.0 ] # Prefix sums of the energy (in joules) expended, with one entry per whole second of the activity
+        self.partial_energy = 0.0 # Energy expended during the current (incomplete) second
+        self.last_reading_time = None
+        self.last_reading_value = 0.0
+        self.np_sum = 0.0 # Sum of the smoothed power values raised to the fourth power, for the normalized power calculation
+        self.np_count = 0
 
     def do_power_record_check(self, record_name, watts):
         """Looks up the existing record and, if necessary, updates it."""
@@ -25,86 +41,89 @@ class PowerAnalyzer(SensorAnalyzer.SensorAnalyzer):
         if old_value is None or watts > old_value:
             self.bests[record_name] = watts
 
+    def end_second(self):
+        """Called each time another whole second of power data has been accumulated. Updates the rolling bests and the normalized power sums."""
+        self.energy_sums.append(self.energy_sums[-1] + self.partial_energy)
+        self.partial_energy = 0.0
+
+        num_secs = len(self.energy_sums) - 1
+        for record_name, window_secs in self.record_windows:
+            if num_secs < window_secs:
+                break
+            self.do_power_record_check(record_name, (self.energy_sums[-1] - self.energy_sums[-1 - window_secs]) / window_secs)
+
+        if num_secs >= NORMALIZED_POWER_WINDOW_SECS:
+            smoothed_power = (self.energy_sums[-1] - self.energy_sums[-1 - NORMALIZED_POWER_WINDOW_SECS]) / NORMALIZED_POWER_WINDOW_SECS
+            self.np_sum = self.np_sum + pow(smoothed_power, 4)
+            self.np_count = self.np_count + 1
+
+    def accumulate_energy(self, from_time, to_time, watts):
+        """Adds the energy from holding the specified power between the two times (in milliseconds), splitting it on whole second boundaries."""
+        while from_time < to_time:
+            next_second_time = self.start_time + (len(self.energy_sums) * 1000)
+            segment_end_time = min(to_time, next_second_time)
+            self.partial_energy = self.partial_energy + (watts * (segment_end_time - from_time) / 1000.0)
+            from_time = segment_end_time
+            if segment_end_time == next_second_time:
+                self.end_second()
+
     def append_sensor_value(self, date_time, value):
         """Adds another reading to the analyzer."""
         SensorAnalyzer.SensorAnalyzer.append_sensor_value(self, date_time, value)
 
-        sum_of_readings = 0.0
-        num_readings = 0
-        duration = self.end_time - self.start_time
-
-        # Update the buffers needed for the normalized power calculation.
-        if date_time - self.current_30_sec_buf_start_time > 30000:
-            if len(self.current_30_sec_buf) > 0:
-                avg_norm_power = sum(self.current_30_sec_buf) / len(self.current_30_sec_buf)
-                self.np_buf.append(avg_norm_power)
-                self.current_30_sec_buf = []
-            self.current_30_sec_buf_start_time = date_time
-        self.current_30_sec_buf.append(value)
-
-        # Search for best efforts.
-        for reading in reversed(self.readings):
-            reading_time = reading[0]
-            sum_of_readings = sum_of_readings + reading[1]
-            num_readings = num_readings + 1
-            curr_time_diff = (self.end_time - reading_time) / 1000
-
-            if curr_time_diff == 5:
-                average_power = sum_of_readings / num_readings
-                self.do_power_record_check(Keys.BEST_5_SEC_POWER, average_power)
-                if duration < 720:
-                    return
-            elif curr_time_diff == 720:
-                average_power = sum_of_readings / num_readings
-                self.do_power_record_check(Keys.BEST_12_MIN_POWER, average_power)
-                if duration < 1200:
-                    return
-            elif curr_time_diff == 1200:
-                average_power = sum_of_readings / num_readings
-                self.do_power_record_check(Keys.BEST_20_MIN_POWER, average_power)
-                if duration < 3600:
-                    return
-            elif curr_time_diff == 3600:
-                average_power = sum_of_readings / num_readings
-                self.do_power_record_check(Keys.BEST_1_HOUR_POWER, average_power)
-            elif curr_time_diff > 3600:
-                return
+        # Time weight the previous reading, which is held until this one (or until it is considered stale).
+        if self.last_reading_time is not None and date_time > self.last_reading_time:
+            hold_end_time = min(date_time, self.last_reading_time + MAX_POWER_HOLD_MS)
+            self.accumulate_energy(self.last_reading_time, hold_end_time, self.last_reading_value)
+            self.accumulate_energy(hold_end_time, date_time, 0.0)
+        if self.last_reading_time is None or date_time > self.last_reading_time:
+            self.last_reading_time = date_time
+            self.last_reading_value = value
+
+    def compute_power_curve(self):
+        """Returns the mean-maximal power curve, i.e., the best average power for each of the standard durations that fits in the activity."""
+        """The curve is a dictionary that maps the duration, in seconds and as a string (so it can be stored as is), to the power."""
+        energy_sums = np.array(self.energy_sums, dtype=float)
+        num_secs = len(energy_sums) - 1
+        curve = {}
+        for window_secs in POWER_CURVE_DURATIONS:
+            if window_secs > num_secs:
+                break
+            best_energy = np.max(energy_sums[window_secs:] - energy_sums[:-window_secs])
+            curve[str(window_secs)] = float(best_energy) / window_secs
+        return curve
 
     def analyze(self):
         """Called when all sensor readings have been processed."""
         results = SensorAnalyzer.SensorAnalyzer.analyze(self)
-        if len(self.readings) > 0:
+        if self.num_readings > 0:
             
             results[Keys.MAX_POWER] = self.max
             results[Keys.AVG_POWER] = self.avg
 
             #
-            # Compute normalized power.
+            # Compute the mean-maximal power curve.
             #
 
-            if len(self.np_buf) > 1:
+            if len(self.energy_sums) > 1:
+                results[Keys.POWER_CURVE] = self.compute_power_curve()
 
-                # Throw away the first 30 second average.
-                self.np_buf.pop(0)
-
-                # Needs this for the variability index calculation.
-                ap = sum(self.np_buf) / len(self.np_buf)
-
-                # Raise all items to the fourth power.
-                for idx, item in enumerate(self.np_buf):
-                    item = pow(item, 4)
-                    self.np_buf[idx] = item
+            #
+            # Compute normalized power.
+            #
 
-                # Average the values that were raised to the fourth.
-                ap2 = sum(self.np_buf) / len(self.np_buf)
+            if self.np_count > 0:
 
-                # Take the fourth root.
-                np = pow(ap2, 0.25)
-                results[Keys.NORMALIZED_POWER] = np
+                # Take the fourth root of the average of the smoothed values raised to the fourth.
+                normalized_power = pow(self.np_sum / self.np_count, 0.25)
+                results[Keys.NORMALIZED_POWER] = normalized_power
 
                 # Compute the variability index (VI = NP / AP).
-                vi  = np / ap
-                results[Keys.VARIABILITY_INDEX] = vi
+                num_secs = len(self.energy_sums) - 1
+                ap = self.energy_sums[-1] / num_secs
+                if ap > 0.0:
+                    vi = normalized_power / ap
+                    results[Keys.VARIABILITY_INDEX] = vi
 
                 # Additional calculations if we have the user's FTP.
                 if self.activity_user_id and self.data_mgr:
@@ -116,7 +135,7 @@ class PowerAnalyzer(SensorAnalyzer.SensorAnalyzer):
                         # Compute the intensity score.
                         t = (self.end_time - self.start_time) / 1000.0
                         calc = IntensityCalculator.IntensityCalculator()
-                        intensity_score = calc.calculate_intensity_score_from_power(t, np, ftp)
+                        intensity_score = calc.calculate_intensity_score_from_power(t, normalized_power, ftp)
                         results[Keys.INTENSITY_SCORE] = intensity_score
 
             #
@@ -124,7 +143,7 @@ class PowerAnalyzer(SensorAnalyzer.SensorAnalyzer):
             #
 
             ftp_calc = FtpCalculator.FtpCalculator()
-            ftp_calc.add_activity_data(self.activity_type, self.start_time, self.bests)
+            ftp_calc.add_activity_data(self.activity_type, self.start_time, results)
             estimated_ftp = ftp_calc.estimate_ftp()
             if estimated_ftp:
                 results[Keys.THRESHOLD_POWER] = estimated_ftp
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2017 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Sliding window rate limiting, for API keys."""
+
+import collections
+import threading
+import time
+
+def retrieve_window_start(now, window_secs):
+    """Returns the start time of the fixed window that contains the given time."""
+    return int(now // window_secs) * window_secs
+
+def estimate_count(current_count, previous_count, now, window_start, window_secs):
+    """Sliding window estimate: all of the current window's requests plus the part of the previous window's requests"""
+    """that still falls within one window length of now, assuming the previous window's requests were evenly spaced."""
+    previous_weight = 1.0 - ((now - window_start) / window_secs)
+    return current_count + (previous_count * previous_weight)
+
+class RateLimiter(object):
+    """Base class for rate limiters. Each call to check() counts as one request."""
+
+    def __init__(self):
+        super(RateLimiter, self).__init__()
+
+    def check(self, key, limit, window_secs, now=None):
+        """Counts a request against the key. Returns TRUE if the request is within the limit, FALSE otherwise."""
+        return True
+
+class MemoryRateLimiter(RateLimiter):
+    """Keeps the counts in this process. Suitable for tests and for deployments with only one process."""
+
+    def __init__(self, max_keys=100000):
+        self.lock = threading.Lock()
+        self.counts = collections.OrderedDict() # Maps the key to [window start, current count, previous count], least recently used first
+        self.max_keys = max_keys
+        super(MemoryRateLimiter, self).__init__()
+
+    def check(self, key, limit, window_secs, now=None):
+        """Counts a request against the key. Returns TRUE if the request is within the limit, FALSE otherwise."""
+        if now is None:
+            now = time.time()
+        window_start = retrieve_window_start(now, window_secs)
+
+        with self.lock:
+            counts = self.counts.get(key)
+            if counts is None:
+                counts = [window_start, 0, 0]
+                self.counts[key] = counts
+            else:
+                self.counts.move_to_end(key)
+
+            # Roll the window forward. If more than one window has passed then the previous window was empty.
+            if counts[0] != window_start:
+                if counts[0] == window_start - window_secs:
+                    counts[2] = counts[1]
+                else:
+                    counts[2] = 0
+                counts[0] = window_start
+                counts[1] = 0
+
+            # Rejected requests aren't counted, so a client that backs off will get back in.
+            if estimate_count(counts[1], counts[2], now, window_start, window_secs) >= limit:
+                return False
+            counts[1] = counts[1] + 1
+
+            # Keys that haven't been used in a while are the first to go.
+            while len(self.counts) > self.max_keys:
+                self.counts.popitem(last=False)
+        return True
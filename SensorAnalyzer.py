@@ -15,8 +15,6 @@ class SensorAnalyzer(object):
         self.max = 0.0 # Maximum sensor value
         self.avg = 0.0 # Average sensor value
         self.sum = 0.0 # Used in computing the average
-        self.readings = [] # All the readings
-        self.value_readings = [] # All the readings, just the value part
         self.num_readings = 0 # Cached for efficiency
         self.bests = {} # Best times within the current activity (best mile, best 20 minute power, etc.)
 
@@ -45,8 +43,6 @@ class SensorAnalyzer(object):
         self.end_time = date_time
 
         self.num_readings = self.num_readings + 1
-        self.readings.append([date_time, value])
-        self.value_readings.append(value)
         self.update_maximum_value(date_time, value)
         self.update_average_value(value)
 
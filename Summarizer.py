@@ -35,6 +35,7 @@ class Summarizer(object):
         self.bests = {} # Best ever times (best mile, best 20 minute power, etc.), dictionary of key/value pairs
         self.annual_bests = {} # Best times for each year  (best mile, best 20 minute power, etc.), dictionary of dictionaries of key/value pairs
         self.summaries = {} # Summary data (total distance, etc.)
+        self.power_curves = {} # Best power for each duration, across all activities, dictionary of dictionaries that map the duration to a [watts, activity id] pair
 
         self.ftp_calc = FtpCalculator.FtpCalculator()
         self.hr_calc = HeartRateCalculator.HeartRateCalculator()
@@ -106,6 +107,22 @@ class Summarizer(object):
         norm_activity_type = self.normalize_activity_type(activity_type)
         self.summaries[norm_activity_type] = summary_dictionary
 
+    def get_power_curve(self, activity_type):
+        """Returns the mean-maximal power curve (as a dictionary that maps the duration to a [watts, activity id] pair) that corresponds to the given activity type."""
+        norm_activity_type = self.normalize_activity_type(activity_type)
+        if norm_activity_type in self.power_curves:
+            return self.power_curves[norm_activity_type]
+        return {}
+
+    def add_power_curve(self, activity_id, activity_type, power_curve):
+        """Merges an activity's mean-maximal power curve into the best curve for the activity type."""
+        best_curve = self.get_power_curve(activity_type)
+        for duration, watts in power_curve.items():
+            if duration not in best_curve or watts > best_curve[duration][0]:
+                best_curve[duration] = [ watts, activity_id ]
+        norm_activity_type = self.normalize_activity_type(activity_type)
+        self.power_curves[norm_activity_type] = best_curve
+
     def get_best_time(self, activity_type, record_name):
         """Returns the time associated with the specified record, or None if not found."""
         record_set = self.get_record_dictionary(activity_type)
@@ -225,5 +242,7 @@ class Summarizer(object):
         """Submits an activity's metadata for summary analysis."""
         for key in summary_data:
             self.add_activity_datum(activity_id, activity_type, start_time, key, summary_data[key])
+        if isinstance(summary_data.get(Keys.POWER_CURVE), dict):
+            self.add_power_curve(activity_id, activity_type, summary_data[Keys.POWER_CURVE])
         self.ftp_calc.add_activity_data(activity_type, start_time, summary_data)
         self.hr_calc.add_activity_data(start_time, summary_data)
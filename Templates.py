@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2017 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Process wide template lookup, so that each page template is parsed and compiled once instead of on every request."""
+
+import logging
+import os
+import threading
+
+from mako.lookup import TemplateLookup
+
+TEMPLATE_FILE_EXTENSION = '.html'
+
+g_lookup_lock = threading.Lock()
+g_lookup = None # The mako lookup, which keeps the compiled templates in memory
+g_html_dir = None
+
+def create_lookup(html_dir, module_dir, filesystem_checks):
+    """Creates the lookup. Should be called once, at startup. With filesystem checks turned on the template files are"""
+    """checked for changes each time they are used, which is handy when editing them, otherwise they are only read once."""
+    global g_lookup_lock
+    global g_lookup
+    global g_html_dir
+
+    with g_lookup_lock:
+        g_lookup = TemplateLookup(directories=[html_dir], module_directory=module_dir, filesystem_checks=filesystem_checks)
+        g_html_dir = html_dir
+    return g_lookup
+
+def retrieve_template(template_file_name):
+    """Returns the compiled template for the given file name, which is relative to the HTML directory."""
+    global g_lookup
+
+    lookup = g_lookup
+    if lookup is None:
+        raise Exception("Template lookup not created.")
+    return lookup.get_template(template_file_name)
+
+def render(template_file_name, **kwargs):
+    """Renders the given template with the given arguments."""
+    return retrieve_template(template_file_name).render(**kwargs)
+
+def warm():
+    """Compiles every template in the HTML directory so the first request for each page doesn't have to."""
+    """Returns the number of templates that were compiled. Templates that fail to compile are logged and skipped."""
+    global g_html_dir
+
+    if g_html_dir is None:
+        raise Exception("Template lookup not created.")
+
+    num_compiled = 0
+    for file_name in sorted(os.listdir(g_html_dir)):
+        if not file_name.endswith(TEMPLATE_FILE_EXTENSION):
+            continue
+        try:
+            retrieve_template(file_name)
+            num_compiled = num_compiled + 1
+        except:
+            logging.getLogger().error("Failed to compile template " + file_name + ".")
+    return num_compiled
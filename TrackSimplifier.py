@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2017 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Reduces an activity's track and sensor readings to the points needed to draw them, so pages don't have to download every reading."""
+"""Tracks are simplified with the Douglas-Peucker algorithm, measuring each point against where it would have been had the athlete"""
+"""moved between the points on either side of it at a constant speed (the synchronized distance), so times along the simplified"""
+"""track stay accurate, not just its shape. Sensor readings are downsampled to a fixed number of points with Largest Triangle Three"""
+"""Buckets, using buckets of equal duration so that stops don't take points away from the rest of the chart."""
+
+import math
+import Keys
+import numpy as np
+
+EARTH_RADIUS_METERS = 6372797.560856 # Same radius as the LibMath haversine calculation
+METERS_PER_PIXEL_AT_ZOOM_ZERO = 156543.03392 # Web Mercator, at the equator
+MIN_ALTITUDE_TOLERANCE_METERS = 5.0 # Altitude is noisier than position, and only drawn on the elevation chart
+TRACK_RESOLUTIONS = { Keys.TRACK_RESOLUTION_LOW: 12, Keys.TRACK_RESOLUTION_MEDIUM: 14, Keys.TRACK_RESOLUTION_HIGH: 16 } # Map zoom level each stored track is simplified for
+SENSOR_CHART_NUM_POINTS = 1000 # Readings per sensor chart, about one per pixel
+DOWNSAMPLED_SENSOR_KEYS = [ Keys.APP_CURRENT_SPEED_KEY, Keys.APP_HEART_RATE_KEY, Keys.APP_CADENCE_KEY, Keys.APP_POWER_KEY, Keys.APP_TEMP_KEY, Keys.APP_THREAT_COUNT_KEY, Keys.APP_BATTERY_LEVEL_KEY ]
+
+def meters_per_pixel(zoom, latitude):
+    """Returns the width of a map pixel, in meters, at the given zoom level and latitude."""
+    return METERS_PER_PIXEL_AT_ZOOM_ZERO * math.cos(math.radians(latitude)) / math.pow(2.0, zoom)
+
+def resolution_for_zoom(zoom):
+    """Returns the least detailed stored resolution that looks the same as the full track at the given zoom level."""
+    for resolution, resolution_zoom in sorted(TRACK_RESOLUTIONS.items(), key=lambda item: item[1]):
+        if zoom <= resolution_zoom:
+            return resolution
+    return Keys.TRACK_RESOLUTION_FULL
+
+def is_valid_resolution(resolution):
+    """Returns TRUE if the string names one of the resolutions that can be requested."""
+    return resolution in TRACK_RESOLUTIONS or resolution == Keys.TRACK_RESOLUTION_FULL
+
+def valid_locations(locations):
+    """Leaves out the locations the map pages don't draw, i.e. those with a missing or implausible horizontal accuracy."""
+    result = []
+    for location in locations:
+        if Keys.LOCATION_HORIZONTAL_ACCURACY_KEY in location:
+            accuracy = location[Keys.LOCATION_HORIZONTAL_ACCURACY_KEY]
+            if accuracy <= 0.0 or accuracy >= 50.0:
+                continue
+        result.append(location)
+    return result
+
+def simplify_indexes(times, points, tolerance):
+    """Douglas-Peucker, splitting every segment that needs it at once rather than one segment at a time, so the work is done in"""
+    """a few passes over the arrays instead of a loop over the points. The result is the same, since whether a segment is split"""
+    """only depends on its end points. Points is an N by 3 array of coordinates in meters. Returns the indexes of the points to keep."""
+    num_points = len(times)
+    keep = np.zeros(num_points, dtype=bool)
+    keep[0] = True
+    keep[-1] = True
+    undecided = ~keep # Points in segments that may still need splitting
+    tolerance_squared = tolerance * tolerance
+
+    while True:
+        indexes = np.flatnonzero(undecided)
+        if len(indexes) == 0:
+            break
+
+        # The segment each undecided point is in, identified by its first point.
+        kept = np.flatnonzero(keep)
+        segments = np.searchsorted(kept, indexes, side="right") - 1
+        firsts = kept[segments]
+        lasts = kept[segments + 1]
+
+        # Where each point would be if the athlete had gone from the start to the end of its segment at a constant speed.
+        durations = times[lasts] - times[firsts]
+        fractions = np.divide(times[indexes] - times[firsts], durations, out=np.zeros(len(indexes)), where=durations > 0)
+        expected = points[firsts] + fractions[:, np.newaxis] * (points[lasts] - points[firsts])
+        distances_squared = np.sum(np.square(points[indexes] - expected), axis=1)
+
+        # Split each segment at the point that is farthest from where it's expected to be, if it's far enough away to notice.
+        # Segments that don't need splitting are done.
+        segment_starts = np.flatnonzero(np.diff(segments, prepend=-1))
+        segment_maxes = np.maximum.reduceat(distances_squared, segment_starts)
+        segment_lengths = np.diff(np.append(segment_starts, len(indexes)))
+        farthest = np.flatnonzero((distances_squared == np.repeat(segment_maxes, segment_lengths)) & (distances_squared > tolerance_squared))
+        _, first_farthest = np.unique(segments[farthest], return_index=True)
+        keep[indexes[farthest[first_farthest]]] = True
+        undecided[indexes[np.repeat(segment_maxes <= tolerance_squared, segment_lengths)]] = False
+        undecided[keep] = False
+    return np.flatnonzero(keep)
+
+def track_points(locations):
+    """Converts the locations that the map pages would draw to times and coordinates in meters, in time order."""
+    """Returns the locations, the times, the horizontal coordinates, the altitudes, and the average latitude."""
+    locations = valid_locations(locations)
+    times = np.array([ location[Keys.LOCATION_TIME_KEY] for location in locations ], dtype=float)
+    lats = np.radians(np.array([ location[Keys.LOCATION_LAT_KEY] for location in locations ], dtype=float))
+    lons = np.radians(np.array([ location[Keys.LOCATION_LON_KEY] for location in locations ], dtype=float))
+    alts = np.nan_to_num(np.array([ location.get(Keys.LOCATION_ALT_KEY, 0.0) for location in locations ], dtype=float))
+
+    # Locations are stored in time order, but nothing enforces it.
+    if np.any(np.diff(times) < 0):
+        order = np.argsort(times, kind="stable")
+        locations = [ locations[i] for i in order ]
+        times, lats, lons, alts = times[order], lats[order], lons[order], alts[order]
+
+    # An activity covers a small enough area that a flat projection, centered on the track, is accurate to well under a pixel.
+    mean_lat = 0.0
+    if len(locations) > 0:
+        mean_lat = float(np.mean(lats))
+        lats = lats - lats[0]
+        lons = lons - lons[0]
+    coordinates = np.column_stack((lons * math.cos(mean_lat) * EARTH_RADIUS_METERS, lats * EARTH_RADIUS_METERS))
+    return locations, times, coordinates, alts, math.degrees(mean_lat)
+
+def simplify_track_points(locations, times, coordinates, alts, latitude, zoom):
+    """Simplifies a track that has already been converted by track_points."""
+    if len(locations) <= 2:
+        return locations
+
+    # Altitude is scaled so that its tolerance is the larger of the map tolerance and what can be seen on the elevation chart.
+    tolerance = meters_per_pixel(zoom, latitude)
+    altitude_scale = tolerance / max(tolerance, MIN_ALTITUDE_TOLERANCE_METERS)
+    points = np.column_stack((coordinates, alts * altitude_scale))
+    return [ locations[i] for i in simplify_indexes(times, points, tolerance) ]
+
+def simplify_track(locations, zoom):
+    """Returns the locations that are needed to draw the track at the given map zoom level, i.e. so that no location is"""
+    """moved by more than a pixel. Locations that wouldn't be drawn are left out, and the rest are returned unchanged."""
+    return simplify_track_points(*track_points(locations), zoom)
+
+def downsample_indexes(times, values, num_points):
+    """Largest Triangle Three Buckets. The first and last readings are always kept, and the readings in between are split into"""
+    """buckets of equal duration. From each bucket, keep the reading that makes the largest triangle with the reading kept from"""
+    """the previous bucket and the average of the next bucket. Returns the indexes of the readings to keep, in order."""
+    num_readings = len(times)
+    if num_readings <= num_points or num_points < 3:
+        return np.arange(num_readings)
+
+    # Find where each bucket starts. Empty buckets (i.e. while the sensor wasn't reporting) are skipped.
+    edges = np.linspace(times[0], times[-1], num_points - 1)
+    starts = np.searchsorted(times, edges[:-1], side="left")
+    starts[0] = 1
+    starts = np.unique(starts[starts < num_readings - 1])
+    ends = np.append(starts[1:], num_readings - 1)
+
+    # The average of each bucket, and for the last bucket, the last reading.
+    lengths = ends - starts
+    next_times = np.append((np.add.reduceat(times, starts) / lengths)[1:], times[-1]).tolist()
+    next_values = np.append((np.add.reduceat(values, starts) / lengths)[1:], values[-1]).tolist()
+
+    # Each choice depends on the one before it, and the buckets are small, so this part is faster with plain lists.
+    time_list = times.tolist()
+    value_list = values.tolist()
+    kept = [ 0 ]
+    for bucket_index, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+        prev_time = time_list[kept[-1]]
+        prev_value = value_list[kept[-1]]
+        dt = prev_time - next_times[bucket_index]
+        dv = next_values[bucket_index] - prev_value
+
+        # Twice the area of the triangle formed with the last kept reading and the next bucket's average.
+        best_index = start
+        best_area = -1.0
+        for i in range(start, end):
+            area = abs(dt * (value_list[i] - prev_value) - (prev_time - time_list[i]) * dv)
+            if area > best_area:
+                best_area = area
+                best_index = i
+        kept.append(best_index)
+    kept.append(num_readings - 1)
+    return np.array(kept)
+
+def downsample_sensor_data(data, num_points):
+    """Returns at most num_points of the sensor readings, chosen to keep the chart's shape. The readings are single item"""
+    """{ time: value } dictionaries, as they are stored in the database, and are returned unchanged."""
+    data = [ datum for datum in data if len(datum) == 1 ]
+    if len(data) <= num_points:
+        return data
+
+    times, values = zip(*[ item for datum in data for item in datum.items() ])
+    times = np.array(times, dtype=float)
+    values = np.nan_to_num(np.array(values, dtype=float))
+    if np.any(np.diff(times) < 0):
+        order = np.argsort(times, kind="stable")
+        data = [ data[i] for i in order ]
+        times, values = times[order], values[order]
+    return [ data[i] for i in downsample_indexes(times, values, num_points) ]
+
+def create_simplified_data(locations, sensor_data):
+    """Simplifies the track for each of the stored resolutions, and downsamples each sensor's readings for its chart."""
+    """Returns a dictionary that can be stored with the activity, in the same form it will be read back."""
+    tracks = {}
+    if locations is not None and len(locations) > 0:
+        points = track_points(locations)
+        for resolution, zoom in TRACK_RESOLUTIONS.items():
+            tracks[resolution] = simplify_track_points(*points, zoom)
+    sensors = {}
+    for sensor_type, readings in sensor_data.items():
+        if sensor_type in DOWNSAMPLED_SENSOR_KEYS and readings is not None and len(readings) > 0:
+            sensors[sensor_type] = downsample_sensor_data(readings, SENSOR_CHART_NUM_POINTS)
+    return { Keys.ACTIVITY_SIMPLIFIED_TRACKS_KEY: tracks, Keys.ACTIVITY_DOWNSAMPLED_SENSORS_KEY: sensors }
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2017 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Per-user daily, weekly, and monthly training totals. Each activity's contribution is added to the periods that contain it when the"""
+"""activity is analyzed and taken back out when it changes or is deleted, so range queries read one document per period rather than one per activity."""
+
+import calendar
+import datetime
+
+import Keys
+
+SECS_PER_DAY = 24 * 60 * 60
+TOTAL_KEYS = [ Keys.ROLLUP_NUM_ACTIVITIES_KEY, Keys.ROLLUP_DISTANCE_KEY, Keys.ROLLUP_DURATION_KEY, Keys.ROLLUP_INTENSITY_SCORE_KEY ]
+TAG_TOTAL_KEYS = [ Keys.ROLLUP_NUM_ACTIVITIES_KEY, Keys.ROLLUP_DISTANCE_KEY, Keys.ROLLUP_DURATION_KEY ]
+
+def period_start(period, timestamp):
+    """Returns the start time (UTC unix secs) of the day, week, or month that contains the timestamp."""
+    day = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).date()
+    if period == Keys.ROLLUP_PERIOD_WEEK:
+        day = day - datetime.timedelta(days=day.weekday())
+    elif period == Keys.ROLLUP_PERIOD_MONTH:
+        day = day.replace(day=1)
+    elif period != Keys.ROLLUP_PERIOD_DAY:
+        raise Exception("Bad parameter.")
+    return calendar.timegm(day.timetuple())
+
+def encode_field_name(name):
+    """Tags are chosen by the user, so they may contain characters that can't be used in a database field name."""
+    return str(name).replace('%', '%25').replace('.', '%2E').replace('$', '%24')
+
+def decode_field_name(name):
+    """Reverses encode_field_name."""
+    return name.replace('%24', '$').replace('%2E', '.').replace('%25', '%')
+
+def distance_for_activity(activity):
+    """Returns the distance (meters) of the activity, either as entered by the user or as computed by the analysis."""
+    if Keys.APP_DISTANCE_KEY in activity:
+        return activity[Keys.APP_DISTANCE_KEY]
+    if Keys.ACTIVITY_SUMMARY_KEY in activity:
+        summary_data = activity[Keys.ACTIVITY_SUMMARY_KEY]
+        if Keys.LONGEST_DISTANCE in summary_data:
+            return summary_data[Keys.LONGEST_DISTANCE]
+    return 0.0
+
+def compute_contribution(activity):
+    """Returns what the activity adds to the rollups, or None if it can't be counted yet, i.e. it hasn't been analyzed (or, for manually"""
+    """entered activities, been given a distance) or doesn't have a start time. This is stored with the activity so that the same amounts"""
+    """can be subtracted when the activity changes."""
+    if Keys.ACTIVITY_START_TIME_KEY not in activity:
+        return None
+    if Keys.ACTIVITY_SUMMARY_KEY not in activity and Keys.APP_DISTANCE_KEY not in activity:
+        return None
+
+    start_time = activity[Keys.ACTIVITY_START_TIME_KEY]
+    summary_data = activity.get(Keys.ACTIVITY_SUMMARY_KEY, {})
+
+    duration = summary_data.get(Keys.APP_DURATION_KEY, activity.get(Keys.APP_DURATION_KEY))
+    if duration is None:
+        end_time = activity.get(Keys.ACTIVITY_END_TIME_KEY, 0)
+        duration = max(end_time - start_time, 0)
+
+    contribution = {}
+    contribution[Keys.ACTIVITY_START_TIME_KEY] = start_time
+    contribution[Keys.ACTIVITY_TYPE_KEY] = activity.get(Keys.ACTIVITY_TYPE_KEY, Keys.TYPE_UNSPECIFIED_ACTIVITY_KEY)
+    contribution[Keys.ACTIVITY_TAGS_KEY] = sorted(set(activity.get(Keys.ACTIVITY_TAGS_KEY, [])))
+    contribution[Keys.ROLLUP_DISTANCE_KEY] = float(distance_for_activity(activity))
+    contribution[Keys.ROLLUP_DURATION_KEY] = float(duration)
+    contribution[Keys.ROLLUP_INTENSITY_SCORE_KEY] = float(summary_data.get(Keys.INTENSITY_SCORE, 0.0))
+    return contribution
+
+def list_increments(contribution, sign):
+    """Returns the amounts that add (sign is 1) or remove (sign is -1) the contribution, as a dictionary that maps (period, period start)"""
+    """to a dictionary of field name to amount. Nested fields use dotted names, i.e. 'tags.Commute.distance'."""
+    totals = {}
+    totals[Keys.ROLLUP_NUM_ACTIVITIES_KEY] = sign
+    totals[Keys.ROLLUP_DISTANCE_KEY] = sign * contribution[Keys.ROLLUP_DISTANCE_KEY]
+    totals[Keys.ROLLUP_DURATION_KEY] = sign * contribution[Keys.ROLLUP_DURATION_KEY]
+    totals[Keys.ROLLUP_INTENSITY_SCORE_KEY] = sign * contribution[Keys.ROLLUP_INTENSITY_SCORE_KEY]
+
+    fields = dict(totals)
+    type_prefix = Keys.ROLLUP_ACTIVITY_TYPES_KEY + "." + encode_field_name(contribution[Keys.ACTIVITY_TYPE_KEY]) + "."
+    for key in TOTAL_KEYS:
+        fields[type_prefix + key] = totals[key]
+    for tag in contribution[Keys.ACTIVITY_TAGS_KEY]:
+        tag_prefix = Keys.ROLLUP_TAGS_KEY + "." + encode_field_name(tag) + "."
+        for key in TAG_TOTAL_KEYS:
+            fields[tag_prefix + key] = totals[key]
+
+    start_time = contribution[Keys.ACTIVITY_START_TIME_KEY]
+    return { (period, period_start(period, start_time)): dict(fields) for period in Keys.ROLLUP_PERIODS }
+
+def merge_increments(increments, more_increments):
+    """Adds the second set of increments to the first. Returns the first."""
+    for period_key, fields in more_increments.items():
+        merged_fields = increments.setdefault(period_key, {})
+        for field, amount in fields.items():
+            merged_fields[field] = merged_fields.get(field, 0) + amount
+    return increments
+
+def list_changes(old_contribution, new_contribution):
+    """Returns the increments that replace the old contribution with the new one. Either may be None."""
+    increments = {}
+    if old_contribution == new_contribution:
+        return increments
+    if old_contribution is not None:
+        merge_increments(increments, list_increments(old_contribution, -1))
+    if new_contribution is not None:
+        merge_increments(increments, list_increments(new_contribution, 1))
+    return increments
+
+def apply_increments(rollup, fields):
+    """Applies a dictionary of dotted field names to amounts to a rollup document, the way the database's increment operator would."""
+    for field, amount in fields.items():
+        path = field.split('.')
+        parent = rollup
+        for name in path[:-1]:
+            parent = parent.setdefault(name, {})
+        parent[path[-1]] = parent.get(path[-1], 0) + amount
+    return rollup
+
+def decode_rollup(rollup):
+    """Returns the rollup with the activity type and tag names decoded. Types and tags whose activities have all been removed are left out."""
+    decoded = {}
+    for key in [ Keys.ROLLUP_PERIOD_KEY, Keys.ROLLUP_PERIOD_START_KEY ] + TOTAL_KEYS:
+        if key in rollup:
+            decoded[key] = rollup[key]
+    for group_key in [ Keys.ROLLUP_ACTIVITY_TYPES_KEY, Keys.ROLLUP_TAGS_KEY ]:
+        groups = {}
+        for name, totals in rollup.get(group_key, {}).items():
+            if totals.get(Keys.ROLLUP_NUM_ACTIVITIES_KEY, 0) > 0:
+                groups[decode_field_name(name)] = totals
+        decoded[group_key] = groups
+    return decoded
+
+def sum_rollups(rollups):
+    """Adds up a list of decoded rollups, i.e. to get the totals for a date range."""
+    result = { key: 0 for key in TOTAL_KEYS }
+    result[Keys.ROLLUP_ACTIVITY_TYPES_KEY] = {}
+    result[Keys.ROLLUP_TAGS_KEY] = {}
+    for rollup in rollups:
+        for key in TOTAL_KEYS:
+            result[key] = result[key] + rollup.get(key, 0)
+        for group_key in [ Keys.ROLLUP_ACTIVITY_TYPES_KEY, Keys.ROLLUP_TAGS_KEY ]:
+            for name, totals in rollup.get(group_key, {}).items():
+                group_totals = result[group_key].setdefault(name, {})
+                for key, value in totals.items():
+                    group_totals[key] = group_totals.get(key, 0) + value
+    return result
+
+def rollups_match(expected, actual, tolerance=1e-6):
+    """Compares two decoded rollups, allowing for the rounding error that builds up from adding and subtracting floating point amounts."""
+    def values_match(expected_value, actual_value):
+        if isinstance(expected_value, dict) or isinstance(actual_value, dict):
+            if not isinstance(expected_value, dict) or not isinstance(actual_value, dict):
+                return False
+            if set(expected_value.keys()) != set(actual_value.keys()):
+                return False
+            return all(values_match(expected_value[key], actual_value[key]) for key in expected_value)
+        if isinstance(expected_value, str) or isinstance(actual_value, str):
+            return expected_value == actual_value
+        return abs(expected_value - actual_value) <= tolerance * max(1.0, abs(expected_value))
+    return values_match(expected, actual)
@@ -36,12 +36,15 @@ MIN_PASSWORD_LEN  = 8
 class UserMgr(object):
     """Class for managing user accounts"""
 
-    def __init__(self, *, config, session_mgr):
+    def __init__(self, *, config, session_mgr, database=None):
         """Constructor"""
+        """The database is normally created from the config, but one can be provided, i.e. by the benchmarks."""
         assert config is not None
         self.session_mgr = session_mgr
-        self.database = AppDatabase.MongoDatabase()
-        self.database.connect(config)
+        if database is None:
+            database = AppDatabase.MongoDatabase()
+            database.connect(config)
+        self.database = database
         super(UserMgr, self).__init__()
 
     def terminate(self):
@@ -445,6 +448,10 @@ class UserMgr(object):
 
         # What's in the database?
         result = self.database.retrieve_user_setting(user_id, key)
+        return self.normalize_user_setting(key, result)
+
+    def normalize_user_setting(self, key, result):
+        """Substitutes the default value for a setting that isn't in the database, and converts strings to lowercase."""
 
         # These are the default values:
         if result is None:
@@ -469,10 +476,20 @@ class UserMgr(object):
         if keys is None or len(keys) == 0:
             raise Exception("Bad parameter.")
 
-        results = []
+        # Read the stored settings all at once. The computed settings are handled one at a time.
+        computed_keys = [ Keys.ESTIMATED_MAX_HEART_RATE_KEY, Keys.ESTIMATED_CYCLING_FTP_KEY ]
+        stored_keys = [ key for key in keys if key not in computed_keys ]
+        stored_values = {}
+        if len(stored_keys) > 0:
+            for stored_setting in self.database.retrieve_user_settings(user_id, stored_keys):
+                stored_values.update(stored_setting)
 
+        results = []
         for key in keys:
-            result = self.retrieve_user_setting(user_id, key)
+            if key in computed_keys:
+                result = self.retrieve_user_setting(user_id, key)
+            else:
+                result = self.normalize_user_setting(key, stored_values.get(key.lower()))
             results.append({key:result})
         return results
 
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2017 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Alternate analysis engine. Converts the activity to NumPy arrays once and computes the analyzers' state from them in bulk,"""
+"""instead of feeding the analyzers one reading at a time. The analyzers then produce their summaries as usual."""
+
+import Keys
+import LocationAnalyzer
+import PowerAnalyzer
+import SensorAnalyzerFactory
+import Units
+import numpy as np
+
+EARTH_RADIUS_METERS = 6372797.560856 # Same radius as the LibMath haversine calculation
+
+def location_arrays(locations):
+    """Converts a list of location dictionaries to arrays of time, latitude, longitude, and altitude, leaving out the locations"""
+    """that the location analyzer would reject (see InputChecker.is_valid_location)."""
+    times = np.array([ location[Keys.LOCATION_TIME_KEY] for location in locations ])
+    lats = np.array([ location[Keys.LOCATION_LAT_KEY] for location in locations ], dtype=float)
+    lons = np.array([ location[Keys.LOCATION_LON_KEY] for location in locations ], dtype=float)
+    alts = np.array([ location[Keys.LOCATION_ALT_KEY] for location in locations ], dtype=float)
+    horizontal_accuracies = np.array([ location.get(Keys.LOCATION_HORIZONTAL_ACCURACY_KEY, 0.0) for location in locations ], dtype=float)
+
+    # Zero is treated as missing, and a missing accuracy (NaN) is treated as acceptable.
+    valid = (lats != 0.0) & (lats >= -90.0) & (lats <= 90.0) & (lons != 0.0) & (lons >= -180.0) & (lons <= 180.0)
+    valid = valid & ~((horizontal_accuracies < 0.0) | (horizontal_accuracies >= 50.0))
+    return times[valid], lats[valid], lons[valid], alts[valid]
+
+def sensor_arrays(data):
+    """Converts a list of single item { time: value } dictionaries, as they are stored in the database, to arrays of time and value."""
+    items = [ item for datum in data for item in datum.items() ]
+    if len(items) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=float)
+    times, values = zip(*items)
+    times = np.array(times, dtype=float).astype(np.int64)
+    values = np.array(values, dtype=float)
+    return times, values
+
+def haversine_distances(lats, lons, alts):
+    """Returns the distance (in meters) between each pair of consecutive points, computed the same way as LibMath's haversine_distance."""
+    radius = (EARTH_RADIUS_METERS + alts[:-1]) - alts[1:]
+    lat_h = np.sin(np.radians(lats[1:] - lats[:-1]) * 0.5)
+    lat_h = lat_h * lat_h
+    lon_h = np.sin(np.radians(lons[1:] - lons[:-1]) * 0.5)
+    lon_h = lon_h * lon_h
+    tmp = np.cos(np.radians(lats[1:])) * np.cos(np.radians(lats[:-1]))
+    return 2.0 * np.arcsin(np.sqrt(lat_h + tmp * lon_h)) * radius
+
+def compute_splits(seconds, distances, split_meters):
+    """Returns the split times, matching LocationAnalyzer.do_split_check."""
+    """Each point either starts a new split or overwrites the latest one, so the split list grows by at most one entry per point."""
+    indexes = np.arange(len(distances))
+    whole_units_traveled = (distances / split_meters).astype(np.int64)
+    split_counts = np.minimum(np.minimum.accumulate(whole_units_traveled + 1 - indexes) + indexes, indexes + 1)
+    last_indexes = np.append(np.flatnonzero(np.diff(split_counts)), len(distances) - 1)
+    return seconds[last_indexes].tolist()
+
+def load_location_analyzer(analyzer, times, lats, lons, alts):
+    """Computes the location analyzer's state from the (already validated) arrays, as if each location had been passed to"""
+    """append_location and update_speeds in turn. Returns FALSE, without changing the analyzer, if the times aren't in order."""
+    num_locations = len(times)
+    if num_locations == 0:
+        return True
+    if np.any(np.diff(times) < 0):
+        return False
+
+    analyzer.start_time_ms = times[0].item()
+    analyzer.last_time_ms = times[-1].item()
+    analyzer.last_lat = lats[-1].item()
+    analyzer.last_lon = lons[-1].item()
+    analyzer.last_alt = alts[-1].item()
+    if num_locations == 1:
+        return True
+
+    # Distances and climbing. The running totals are cumulative sums so they are added up in the same order as before.
+    distance_times = times[1:]
+    distances = np.cumsum(haversine_distances(lats, lons, alts))
+    verticals = np.diff(alts)
+    analyzer.total_distance = distances[-1].item()
+    analyzer.total_vertical = np.cumsum(np.where(verticals > 0.0, verticals, 0.0))[-1].item()
+    analyzer.distance_buf = [ [ time_ms, distance ] for time_ms, distance in zip(distance_times.tolist(), distances.tolist()) ]
+    elapsed_milliseconds = analyzer.last_time_ms - analyzer.start_time_ms
+    if elapsed_milliseconds > 0:
+        analyzer.avg_speed = analyzer.total_distance / (elapsed_milliseconds / 1000.0)
+
+    # Splits.
+    split_seconds = distance_times - times[0]
+    analyzer.km_splits = compute_splits(split_seconds, distances, 1000)
+    analyzer.mile_splits = compute_splits(split_seconds, distances, Units.METERS_PER_MILE)
+
+    # Speed windows. For each point, the window is made of the earlier points that are exactly speed_window_size seconds
+    # (when truncated to whole seconds) before it. Since the times are sorted, the edges of the windows can be found with a binary search.
+    num_points = len(distance_times)
+    indexes = np.arange(num_points)
+    window_size_ms = analyzer.speed_window_size * 1000
+    window_starts = np.minimum(np.searchsorted(distance_times, distance_times - (window_size_ms + 1000), side='right'), indexes)
+    window_ends = np.minimum(np.searchsorted(distance_times, distance_times - window_size_ms, side='right'), indexes)
+    window_counts = window_ends - window_starts
+
+    # Every point in every window is a candidate for the best speed.
+    num_pairs = int(np.sum(window_counts))
+    if num_pairs > 0:
+        pair_ends = np.repeat(indexes, window_counts)
+        pair_offsets = np.arange(num_pairs) - np.repeat(np.cumsum(window_counts) - window_counts, window_counts)
+        pair_starts = np.repeat(window_starts, window_counts) + pair_offsets
+        pair_speeds = (distances[pair_ends] - distances[pair_starts]) / ((distance_times[pair_ends] - distance_times[pair_starts]) / 1000.0)
+        analyzer.bests[Keys.BEST_SPEED] = np.max(pair_speeds).item()
+
+        # The speed graph gets the newest point in each window, unless it was already graphed for an earlier window.
+        graph_ends = indexes[window_counts > 0]
+        graph_starts = window_ends[graph_ends] - 1
+        graph_times = distance_times[graph_starts]
+        previous_graph_times = np.maximum.accumulate(np.append(0, graph_times[:-1]))
+        is_new = graph_times > previous_graph_times
+        graph_ends = graph_ends[is_new]
+        graph_starts = graph_starts[is_new]
+        graph_speeds = (distances[graph_ends] - distances[graph_starts]) / ((distance_times[graph_ends] - distance_times[graph_starts]) / 1000.0)
+        analyzer.speed_times = distance_times[graph_starts].tolist()
+        analyzer.speed_graph = graph_speeds.tolist()
+
+    # The current speed comes from the oldest point in the last point's window.
+    analyzer.current_speed = 0.0
+    if window_counts[-1] > 0:
+        start_index = window_starts[-1]
+        analyzer.current_speed = ((distances[-1] - distances[start_index]) / ((distance_times[-1] - distance_times[start_index]) / 1000.0)).item()
+
+    # Record distances. For each point, find where the segment of the record distance that ends there would have started,
+    # and interpolate the time at which we were there.
+    for record_index, (record_name, record_meters) in enumerate(analyzer.record_distances):
+        start_distances = distances - record_meters
+        ends = indexes[start_distances >= distances[0]]
+        if len(ends) == 0:
+            break
+        start_distances = start_distances[ends]
+        starts = np.maximum(np.minimum(ends - 1, np.searchsorted(distances, start_distances, side='right') - 1), 0)
+        start_times = distance_times[starts].astype(float)
+        is_between = distances[starts] < start_distances
+        between_starts = starts[is_between]
+        current_times = distance_times[between_starts]
+        current_distances = distances[between_starts]
+        start_times[is_between] = current_times + (distance_times[between_starts + 1] - current_times) * (start_distances[is_between] - current_distances) / (distances[between_starts + 1] - current_distances)
+        total_seconds = (distance_times[ends] - start_times) / 1000.0
+        total_seconds = total_seconds[total_seconds > 0.0]
+        if len(total_seconds) > 0:
+            analyzer.bests[record_name] = np.min(total_seconds).item()
+        analyzer.record_start_indexes[record_index] = int(starts[-1])
+
+    # Leave the incremental state where update_speeds would have left it, in case more locations are appended.
+    analyzer.speed_window_start_index = int(window_starts[-1])
+    analyzer.speed_window_end_index = int(window_ends[-1])
+    analyzer.next_window_end_index = num_points
+    if len(analyzer.speed_times) > 0:
+        analyzer.last_speed_buf_update_time = analyzer.speed_times[-1]
+    return True
+
+def create_location_analyzer(activity_type, locations):
+    """Creates a location analyzer and loads it with the activity's locations."""
+    analyzer = LocationAnalyzer.LocationAnalyzer(activity_type)
+    times, lats, lons, alts = location_arrays(locations)
+    if not load_location_analyzer(analyzer, times, lats, lons, alts):
+        analyzer.append_locations(locations)
+        analyzer.update_speeds()
+    return analyzer
+
+def load_sensor_analyzer(analyzer, times, values):
+    """Computes the sensor analyzer's maximum and average, as if each reading had been passed to append_sensor_value in turn."""
+    """The individual readings aren't kept, none of the analyzers need them once the summary values are known."""
+    num_readings = len(values)
+    if num_readings == 0:
+        return
+    analyzer.start_time = times[0].item()
+    analyzer.end_time = times[-1].item()
+    analyzer.num_readings = num_readings
+    analyzer.sum = np.cumsum(values)[-1].item()
+    analyzer.avg = analyzer.sum / num_readings
+
+    # The first occurrence of the maximum, as long as it's greater than zero, which is where the maximum starts.
+    max_index = int(np.argmax(np.where(np.isnan(values), -np.inf, values)))
+    if values[max_index] > analyzer.max:
+        analyzer.max = values[max_index].item()
+        analyzer.max_time = times[max_index].item()
+
+def load_power_analyzer(analyzer, times, values):
+    """Computes the power analyzer's per second energy totals, rolling bests, and normalized power sums."""
+    load_sensor_analyzer(analyzer, times, values)
+    if len(values) == 0:
+        return
+
+    # Readings that don't move time forward don't count towards the energy totals.
+    previous_times = np.maximum.accumulate(np.append(times[0] - 1, times[:-1]))
+    is_used = times > previous_times
+    reading_times = times[is_used]
+    reading_watts = values[is_used]
+
+    # Each reading is held until the next one, or until it's considered stale. This is the energy expended up to each reading.
+    hold_end_times = np.minimum(reading_times[1:], reading_times[:-1] + PowerAnalyzer.MAX_POWER_HOLD_MS)
+    reading_energy = np.append(0.0, np.cumsum(reading_watts[:-1] * (hold_end_times - reading_times[:-1]) / 1000.0))
+
+    # The energy expended up to the end of each whole second.
+    num_secs = int((reading_times[-1] - analyzer.start_time) // 1000)
+    second_end_times = analyzer.start_time + 1000 * np.arange(1, num_secs + 1, dtype=np.int64)
+    second_readings = np.searchsorted(reading_times, second_end_times, side='right') - 1
+    held_until = np.minimum(second_end_times, reading_times[second_readings] + PowerAnalyzer.MAX_POWER_HOLD_MS)
+    energy_sums = np.append(0.0, reading_energy[second_readings] + reading_watts[second_readings] * (held_until - reading_times[second_readings]) / 1000.0)
+    analyzer.energy_sums = energy_sums.tolist()
+    analyzer.partial_energy = (reading_energy[-1] - energy_sums[-1]).item()
+    analyzer.last_reading_time = reading_times[-1].item()
+    analyzer.last_reading_value = reading_watts[-1].item()
+
+    for record_name, window_secs in analyzer.record_windows:
+        if num_secs < window_secs:
+            break
+        analyzer.do_power_record_check(record_name, np.max((energy_sums[window_secs:] - energy_sums[:-window_secs]) / window_secs).item())
+
+    if num_secs >= PowerAnalyzer.NORMALIZED_POWER_WINDOW_SECS:
+        window_secs = PowerAnalyzer.NORMALIZED_POWER_WINDOW_SECS
+        smoothed_power = (energy_sums[window_secs:] - energy_sums[:-window_secs]) / window_secs
+        analyzer.np_sum = np.cumsum(np.power(smoothed_power, 4))[-1].item()
+        analyzer.np_count = len(smoothed_power)
+
+def create_sensor_analyzer(sensor_type, data, activity_type, activity_user_id, data_mgr, user_mgr):
+    """Creates a sensor analyzer object of the specified type and loads it with the given data."""
+    """Accelerometer data has its own format and analysis, so it's still loaded one reading at a time."""
+    if sensor_type == Keys.APP_ACCELEROMETER_KEY:
+        return SensorAnalyzerFactory.create_with_data(sensor_type, data, activity_type, activity_user_id, data_mgr, user_mgr)
+
+    analyzer = SensorAnalyzerFactory.create(sensor_type, activity_type, activity_user_id, data_mgr, user_mgr)
+    if analyzer is not None:
+        times, values = sensor_arrays(data)
+        if sensor_type == Keys.APP_POWER_KEY:
+            load_power_analyzer(analyzer, times, values)
+        else:
+            load_sensor_analyzer(analyzer, times, values)
+    return analyzer
@@ -2,7 +2,7 @@
 """Handles the generation of a workout plan. Implements a celery worker."""
 
 from __future__ import absolute_import
-from CeleryWorker import celery_worker
+from CeleryWorker import celery_worker, shared_data_mgr, shared_user_mgr
 import argparse
 import datetime
 import json
@@ -36,10 +36,14 @@ except ModuleNotFoundError:
 class WorkoutPlanGenerator(object):
     """Class for performing the computationally expensive workout plan generation tasks."""
 
-    def __init__(self, config, user_obj):
+    def __init__(self, config, user_obj, data_mgr=None, user_mgr=None):
         self.user_obj = user_obj
-        self.data_mgr = DataMgr.DataMgr(config=config, root_url="", analysis_scheduler=AnalysisScheduler.AnalysisScheduler(), import_scheduler=None)
-        self.user_mgr = UserMgr.UserMgr(config=config, session_mgr=None)
+        if data_mgr is None:
+            data_mgr = DataMgr.DataMgr(config=config, root_url="", analysis_scheduler=AnalysisScheduler.AnalysisScheduler(), import_scheduler=None)
+        if user_mgr is None:
+            user_mgr = UserMgr.UserMgr(config=config, session_mgr=None)
+        self.data_mgr = data_mgr
+        self.user_mgr = user_mgr
         super(WorkoutPlanGenerator, self).__init__()
 
     def log_info(self, log_str):
@@ -614,7 +618,7 @@ def generate_workout_plan_for_user(user_str, internal_task_id):
     print("Starting workout plan generation...")
 
     user_obj = json.loads(user_str)
-    generator = WorkoutPlanGenerator(Config.Config(), user_obj)
+    generator = WorkoutPlanGenerator(Config.Config(), user_obj, shared_data_mgr(), shared_user_mgr())
     generator.generate_plan_for_user(g_model)
 
     print("Workout plan generation finished.")
@@ -626,7 +630,7 @@ def generate_workout_plan_from_inputs(inputs, internal_task_id):
 
     print("Starting workout plan generation...")
 
-    generator = WorkoutPlanGenerator(Config.Config(), None)
+    generator = WorkoutPlanGenerator(Config.Config(), None, shared_data_mgr(), shared_user_mgr())
     generator.generate_plan_from_inputs(g_model, inputs)
 
     print("Workout plan generation finished.")
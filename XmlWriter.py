@@ -50,6 +50,12 @@ class XmlWriter(object):
     def buffer(self):
         return ''.join(self.strs)
 
+    def take(self):
+        """Returns everything written to the buffer since the last call and empties it, so a long document can be streamed in pieces."""
+        buf = ''.join(self.strs)
+        self.strs = []
+        return buf
+
     def close(self):
         self.file = None
         self.strs = []
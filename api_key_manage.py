@@ -44,7 +44,7 @@ def list_keys(username):
 def revoke_key(key):
     db = AppDatabase.MongoDatabase()
     db.connect(None)
-    user_id, _, _ = db.retrieve_user_from_api_key(key)
+    user_id, _, _, _ = db.retrieve_user_from_api_key(key)
     return db.delete_api_key(user_id, key)
 
 if __name__ == "__main__":
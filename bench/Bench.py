@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2017 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Times the hot paths (imports, analysis, re-analysis, personal record refreshes, live updates, exports, map searches and page rendering)"""
+"""against an in-memory database, using synthetic activities. Results are written as JSON so that runs from different commits can be compared."""
+
+import argparse
+import contextlib
+import datetime
+import inspect
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import ActivityAnalyzer
+import AnalysisScheduler
+import App
+import Config
+import DataMgr
+import Dirs
+import Exporter
+import Importer
+import Keys
+import MapSearch
+import SessionMgr
+import Summarizer
+import UserMgr
+import Generators
+import MemoryDatabase
+
+ERROR_LOG = os.path.join(tempfile.gettempdir(), 'bench_error.log') # Default log location, outside of the source tree
+RESULTS_FORMAT_VERSION = 1
+BENCH_USERNAME = "bench@example.com"
+BENCH_REALNAME = "Bench User"
+DEFAULT_THRESHOLD = 0.1 # Fractional slowdown that counts as a regression
+ACTIVITIES = [ ("run", Keys.TYPE_RUNNING_KEY), ("ride", Keys.TYPE_CYCLING_KEY), ("swim", Keys.TYPE_OPEN_WATER_SWIMMING_KEY), ("lift", Keys.TYPE_PULL_UP_KEY) ]
+ENGINES = [ Keys.ANALYSIS_ENGINE_ITERATIVE, Keys.ANALYSIS_ENGINE_VECTORIZED ]
+
+g_error_log = ERROR_LOG # Where errors are being logged, see --log
+
+class BenchSessionMgr(SessionMgr.SessionMgr):
+    """Every request comes from the benchmark user."""
+
+    def __init__(self, username):
+        self.username = username
+        super(BenchSessionMgr, self).__init__()
+
+    def get_logged_in_username(self):
+        """Returns the username associated with the current session."""
+        return self.username
+
+class BenchAnalysisScheduler(AnalysisScheduler.AnalysisScheduler):
+    """Counts analysis requests instead of sending them to a worker, the analysis scenario runs the analyzer directly."""
+
+    def __init__(self):
+        self.num_queued = 0
+        super(BenchAnalysisScheduler, self).__init__()
+
+    def add_activity_to_analysis_queue(self, activity_id, activity_user_id, analysis_engine):
+        self.num_queued = self.num_queued + 1
+        return None, None
+
+    def add_personal_records_analysis_to_queue(self, user_id):
+        self.num_queued = self.num_queued + 1
+        return None, None
+
+    def add_batch_analysis_to_queue(self, user_id, only_unanalyzed, analysis_engine, batch_size, batch_workers):
+        self.num_queued = self.num_queued + 1
+        return None, None
+
+class Environment(object):
+    """Data and user managers backed by a fresh in-memory database, with one user who has one device."""
+
+    def __init__(self):
+        self.config = Config.Config()
+        self.root_url = "file://" + parentdir
+        self.database = MemoryDatabase.MemoryDatabase()
+        self.data_mgr = DataMgr.DataMgr(config=self.config, root_url=self.root_url, analysis_scheduler=BenchAnalysisScheduler(), import_scheduler=None, database=self.database)
+        self.user_mgr = UserMgr.UserMgr(config=self.config, session_mgr=BenchSessionMgr(BENCH_USERNAME), database=self.database)
+        self.user_id = self.database.create_user(BENCH_USERNAME, BENCH_REALNAME, "not a real hash")
+        self.device_str = str(uuid.uuid4())
+        self.database.create_user_device(self.user_id, self.device_str)
+
+        # The map data is loaded once per process, the first activity analyzed shouldn't pay for it.
+        DataMgr.retrieve_map_search(self.root_url, None)
+
+    def add_activity(self, synthetic):
+        """Stores a synthetic activity, as if it had been uploaded. Returns the activity ID."""
+        activity_id = str(uuid.uuid4())
+        self.database.create_complete_activity(Generators.to_activity_document(synthetic, activity_id, self.user_id, self.device_str))
+        return activity_id
+
+    def analyze(self, activity_id, analysis_engine):
+        """Runs the analysis, the same way the worker would. Returns the time it took, not including loading the activity."""
+        analyzer = ActivityAnalyzer.ActivityAnalyzer(None, str(uuid.uuid4()), analysis_engine, self.data_mgr, self.user_mgr)
+        if not analyzer.load_activity(activity_id, self.user_id):
+            raise Exception("Failed to load activity " + activity_id + ".")
+
+        # The analyzer reports its progress on stdout.
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start_time = time.perf_counter()
+            analyzer.perform_analysis()
+            elapsed_time = time.perf_counter() - start_time
+
+        # Errors are logged rather than raised, so make sure it got all the way through.
+        if self.database.retrieve_activity_summary(activity_id) is None:
+            raise Exception("Analysis of activity " + activity_id + " failed, see " + g_error_log + ".")
+        return elapsed_time
+
+def bench_import(options):
+    """Imports GPX and TCX files written from synthetic activities, and any FIT files in the given directory since there's nothing to write those."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        files = []
+        for index, (name, activity_type) in enumerate(ACTIVITIES[:2]):
+            synthetic = Generators.generate(activity_type, options.duration, options.seed + index)
+            for file_ext, writer_func in [ ('.gpx', Generators.write_gpx_file), ('.tcx', Generators.write_tcx_file) ]:
+                file_name = os.path.join(temp_dir, name + file_ext)
+                writer_func(synthetic, file_name)
+                files.append(("import" + file_ext.replace('.', '_') + "_" + name, file_name, file_ext, len(synthetic.locations)))
+        if options.fit_dir:
+            for file_name in sorted(os.listdir(options.fit_dir)):
+                if file_name.lower().endswith('.fit'):
+                    files.append(("import_fit_" + os.path.splitext(file_name)[0], os.path.join(options.fit_dir, file_name), '.fit', 1))
+
+        for measurement_name, file_name, file_ext, num_items in files:
+            env = Environment()
+            importer = Importer.Importer(env.data_mgr)
+            start_time = time.perf_counter()
+            success, _, _ = importer.import_activity_from_file(BENCH_USERNAME, env.user_id, file_name, os.path.basename(file_name), file_ext, str(uuid.uuid4()))
+            elapsed_time = time.perf_counter() - start_time
+            if not success:
+                raise Exception("Failed to import " + file_name + ".")
+            yield measurement_name, elapsed_time, num_items
+
+def bench_analysis(options):
+    """Runs the full activity analysis with each engine on each kind of activity."""
+    for index, (name, activity_type) in enumerate(ACTIVITIES):
+        synthetic = Generators.generate(activity_type, options.duration, options.seed + index)
+        for analysis_engine in ENGINES:
+            env = Environment()
+            activity_id = env.add_activity(synthetic)
+            yield "analysis_" + analysis_engine + "_" + name, env.analyze(activity_id, analysis_engine), synthetic.num_points()
+
+def bench_summarizer(options):
+    """Rebuilds the personal records from a long history of activity bests, both through the data manager and with the summarizer on its own."""
+    env = Environment()
+
+    # Analyze one of each kind of activity to get realistic bests, then give the user a long history of them.
+    templates = []
+    for index, (_, activity_type) in enumerate(ACTIVITIES):
+        activity_id = env.add_activity(Generators.generate(activity_type, min(options.duration, 1800), options.seed + index))
+        env.analyze(activity_id, Keys.ANALYSIS_ENGINE_ITERATIVE)
+        templates.append(env.database.retrieve_activity_bests_for_user(env.user_id)[MemoryDatabase.normalize_activity_id(activity_id)])
+    now = time.time()
+    for i in range(options.activities):
+        bests = dict(templates[i % len(templates)])
+        activity_time = int(now - (options.activities - i) * 86400)
+        activity_id = str(uuid.uuid4())
+        env.database.create_complete_activity({ Keys.ACTIVITY_ID_KEY: activity_id, Keys.ACTIVITY_TYPE_KEY: bests[Keys.ACTIVITY_TYPE_KEY], Keys.ACTIVITY_USER_ID_KEY: env.user_id, \
+            Keys.ACTIVITY_DEVICE_STR_KEY: env.device_str, Keys.ACTIVITY_START_TIME_KEY: activity_time })
+        env.database.create_activity_bests(env.user_id, activity_id, bests[Keys.ACTIVITY_TYPE_KEY], activity_time, bests)
+    all_bests = env.database.retrieve_activity_bests_for_user(env.user_id)
+
+    start_time = time.perf_counter()
+    summarizer = Summarizer.Summarizer()
+    for activity_id, bests in all_bests.items():
+        summarizer.add_activity_data(activity_id, bests[Keys.ACTIVITY_TYPE_KEY], bests[Keys.ACTIVITY_START_TIME_KEY], bests)
+    yield "summarizer_add_activity_data", time.perf_counter() - start_time, len(all_bests)
+
+    start_time = time.perf_counter()
+    if not env.data_mgr.refresh_personal_records_cache(env.user_id):
+        raise Exception("Failed to refresh the personal records.")
+    yield "summarizer_refresh_personal_records", time.perf_counter() - start_time, len(all_bests)
+
+def bench_reanalysis(options):
+    """Re-analyzes a user's activities one at a time, the way the per-activity tasks do, and then as a batch job."""
+    env = Environment()
+    activity_ids = []
+    num_points = 0
+    for i in range(options.reanalyze):
+        _, activity_type = ACTIVITIES[i % len(ACTIVITIES)]
+        synthetic = Generators.generate(activity_type, min(options.duration, 900), options.seed + i)
+        activity_ids.append(env.add_activity(synthetic))
+        num_points = num_points + synthetic.num_points()
+
+    elapsed_time = 0.0
+    for activity_id in activity_ids:
+        elapsed_time = elapsed_time + env.analyze(activity_id, Keys.ANALYSIS_ENGINE_ITERATIVE)
+    yield "reanalysis_one_at_a_time", elapsed_time, num_points
+
+    analyzer = ActivityAnalyzer.BatchAnalyzer(env.user_id, False, None, Keys.ANALYSIS_ENGINE_ITERATIVE, env.config.get_analysis_batch_size(), env.config.get_analysis_batch_workers(), env.data_mgr, env.user_mgr)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start_time = time.perf_counter()
+        success = analyzer.run()
+        elapsed_time = time.perf_counter() - start_time
+    if not success:
+        raise Exception("Batch analysis failed, see " + g_error_log + ".")
+    yield "reanalysis_batch", elapsed_time, num_points
+
+def bench_live_ingest(options):
+    """Sends a ride to the data manager in small pieces, the way the phone app does during a live activity."""
+    synthetic = Generators.generate_ride(options.duration, options.seed)
+    chunks = list(synthetic.chunks(options.chunk_secs))
+    env = Environment()
+    activity_id = str(uuid.uuid4())
+    start_time = time.perf_counter()
+    for locations, sensor_readings in chunks:
+        if not env.data_mgr.update_moving_activity(env.device_str, activity_id, locations, sensor_readings, None):
+            raise Exception("Failed to update the live activity.")
+    yield "live_ingest_ride", time.perf_counter() - start_time, len(chunks)
+
+def bench_export(options):
+    """Exports a ride as GPX and TCX, and a lifting session's accelerometer data as CSV."""
+    ride = Generators.to_activity_document(Generators.generate_ride(options.duration, options.seed), str(uuid.uuid4()), "", "")
+    lift = Generators.to_activity_document(Generators.generate_lift(options.duration, options.seed), str(uuid.uuid4()), "", "")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for file_type, activity in [ ('gpx', ride), ('tcx', ride), ('csv', lift) ]:
+            if file_type == 'csv':
+                num_items = len(activity[Keys.APP_ACCELEROMETER_KEY])
+            else:
+                num_items = len(activity[Keys.ACTIVITY_LOCATIONS_KEY])
+            exporter = Exporter.Exporter()
+            start_time = time.perf_counter()
+            exporter.export(activity, os.path.join(temp_dir, "export." + file_type), file_type)
+            yield "export_" + file_type, time.perf_counter() - start_time, num_items
+
+def bench_map_search(options):
+    """Loads the map data and looks up random points, half of them in North America so the state and province searches get used."""
+    root_url = "file://" + parentdir
+    start_time = time.perf_counter()
+    map_search = MapSearch.MapSearch(root_url + '/data/world.geo.json', root_url + '/data/us_states.geo.json', root_url + '/data/canada.geo.json', None)
+    yield "map_search_load", time.perf_counter() - start_time, 1
+
+    rng = random.Random(options.seed)
+    points = []
+    for i in range(options.points):
+        if i % 2 == 0:
+            points.append((rng.uniform(-60.0, 70.0), rng.uniform(-180.0, 180.0)))
+        else:
+            points.append((rng.uniform(25.0, 55.0), rng.uniform(-125.0, -65.0)))
+    start_time = time.perf_counter()
+    for lat, lon in points:
+        map_search.search_map(lat, lon)
+    yield "map_search_lookup", time.perf_counter() - start_time, len(points)
+
+def bench_page_render(options):
+    """Renders the activity and device pages for an analyzed ride, as the logged in owner."""
+    env = Environment()
+    activity_id = env.add_activity(Generators.generate_ride(options.duration, options.seed))
+    env.analyze(activity_id, Keys.ANALYSIS_ENGINE_ITERATIVE)
+
+    # The app writes temporary files and compiled templates under its root directory, so give it one of its own.
+    with tempfile.TemporaryDirectory() as root_dir:
+        for dir_name in [ Dirs.HTML_DIR, Dirs.MEDIA_DIR ]:
+            os.symlink(os.path.join(parentdir, dir_name), os.path.join(root_dir, dir_name))
+        app = App.App(env.config, env.user_mgr, env.data_mgr, root_dir, "", "", False, False)
+        for page_name, page_func in [ ("activity", lambda: app.activity(activity_id)), ("device", lambda: app.device(env.device_str)), ("my_activities", app.my_activities) ]:
+            start_time = time.perf_counter()
+            for _ in range(options.renders):
+                page = page_func()
+            elapsed_time = time.perf_counter() - start_time
+            if env.user_mgr.get_logged_in_username() is None or BENCH_REALNAME not in page:
+                raise Exception("Failed to render the " + page_name + " page.")
+            yield "page_render_" + page_name, elapsed_time, options.renders
+
+SCENARIOS = { "import": bench_import, "analysis": bench_analysis, "summarizer": bench_summarizer, "reanalysis": bench_reanalysis, "live_ingest": bench_live_ingest, "export": bench_export, "map_search": bench_map_search, "page_render": bench_page_render }
+
+def retrieve_commit():
+    """Returns the current commit, marked if there are uncommitted changes, if this is a git checkout."""
+    try:
+        return subprocess.check_output([ "git", "describe", "--always", "--dirty" ], cwd=parentdir, stderr=subprocess.DEVNULL).decode().strip()
+    except:
+        return ""
+
+def run_scenarios(scenario_names, options):
+    """Runs each scenario the requested number of times. Returns a dictionary of measurement name to timings."""
+    results = {}
+    for scenario_name in scenario_names:
+        print("Running " + scenario_name + "...")
+        for _ in range(options.repeat):
+            for measurement_name, elapsed_time, num_items in SCENARIOS[scenario_name](options):
+                result = results.setdefault(measurement_name, { "scenario": scenario_name, "items": num_items, "runs": [] })
+                result["runs"].append(elapsed_time)
+
+    for result in results.values():
+        result["min_secs"] = min(result["runs"])
+        result["median_secs"] = statistics.median(result["runs"])
+        result["items_per_sec"] = result["items"] / result["median_secs"] if result["median_secs"] > 0 else 0.0
+    return results
+
+def print_results(results):
+    """Prints a table of the median times."""
+    print("{:<48} {:>12} {:>10} {:>14}".format("Measurement", "Median (s)", "Items", "Items/sec"))
+    for measurement_name in sorted(results):
+        result = results[measurement_name]
+        print("{:<48} {:>12.4f} {:>10} {:>14.1f}".format(measurement_name, result["median_secs"], result["items"], result["items_per_sec"]))
+
+def compare_results(baseline, current, threshold):
+    """Compares the median times of each measurement that is in both sets of results. Returns the names of the measurements that got slower by more than the threshold."""
+    regressions = []
+    print("{:<48} {:>12} {:>12} {:>8}".format("Measurement", "Before (s)", "After (s)", "Change"))
+    for measurement_name in sorted(set(baseline) | set(current)):
+        if measurement_name not in baseline:
+            print("{:<48} {:>12} {:>12.4f} {:>8}".format(measurement_name, "-", current[measurement_name]["median_secs"], "new"))
+            continue
+        if measurement_name not in current:
+            print("{:<48} {:>12.4f} {:>12} {:>8}".format(measurement_name, baseline[measurement_name]["median_secs"], "-", "missing"))
+            continue
+
+        before = baseline[measurement_name]["median_secs"]
+        after = current[measurement_name]["median_secs"]
+        change = (after - before) / before if before > 0 else 0.0
+        flag = ""
+        if change > threshold:
+            flag = " REGRESSION"
+            regressions.append(measurement_name)
+        elif change < -threshold:
+            flag = " faster"
+        print("{:<48} {:>12.4f} {:>12.4f} {:>+7.1f}%{}".format(measurement_name, before, after, change * 100.0, flag))
+    return regressions
+
+def load_results(file_name):
+    """Reads a results file written by a previous run."""
+    with open(file_name, 'r') as in_file:
+        results = json.load(in_file)
+    if results.get("version") != RESULTS_FORMAT_VERSION:
+        raise Exception(file_name + " was written by an incompatible version of the benchmarks.")
+    return results
+
+def main():
+    """Entry point for the benchmarks."""
+    global g_error_log
+
+    # Parse the command line arguments.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", type=str, action="store", default=",".join(SCENARIOS), help="Comma separated list of scenarios to run, from: " + ", ".join(SCENARIOS), required=False)
+    parser.add_argument("--duration", type=int, action="store", default=3600, help="Length of each synthetic activity, in seconds", required=False)
+    parser.add_argument("--seed", type=int, action="store", default=1, help="Seed for the synthetic activities", required=False)
+    parser.add_argument("--repeat", type=int, action="store", default=3, help="Number of times to run each scenario, the median time is reported", required=False)
+    parser.add_argument("--activities", type=int, action="store", default=1000, help="Number of activities in the personal records history", required=False)
+    parser.add_argument("--reanalyze", type=int, action="store", default=32, help="Number of activities in the reanalysis scenario", required=False)
+    parser.add_argument("--points", type=int, action="store", default=1000, help="Number of map search lookups", required=False)
+    parser.add_argument("--renders", type=int, action="store", default=20, help="Number of times to render each page", required=False)
+    parser.add_argument("--chunk-secs", type=int, action="store", default=10, help="Seconds of data in each live update", required=False)
+    parser.add_argument("--fit-dir", type=str, action="store", default="", help="Directory of FIT files to include in the import scenario", required=False)
+    parser.add_argument("--output", type=str, action="store", default="", help="File to write the results to, as JSON", required=False)
+    parser.add_argument("--baseline", type=str, action="store", default="", help="Results file to compare against", required=False)
+    parser.add_argument("--results", type=str, action="store", default="", help="Compare this results file against the baseline instead of running the benchmarks", required=False)
+    parser.add_argument("--threshold", type=float, action="store", default=DEFAULT_THRESHOLD, help="Fractional slowdown that counts as a regression", required=False)
+    parser.add_argument("--log", type=str, action="store", default=ERROR_LOG, help="File to write the error log to", required=False)
+
+    try:
+        args = parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    # Setup the logger.
+    g_error_log = args.log
+    logging.basicConfig(filename=g_error_log, filemode='w', level=logging.DEBUG, format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    # Run the benchmarks, or read the results of a previous run.
+    if args.results:
+        results = load_results(args.results)
+    else:
+        scenario_names = [ name.strip() for name in args.scenarios.split(",") if name.strip() ]
+        for scenario_name in scenario_names:
+            if scenario_name not in SCENARIOS:
+                parser.error("Unknown scenario: " + scenario_name)
+        results = {}
+        results["version"] = RESULTS_FORMAT_VERSION
+        results["commit"] = retrieve_commit()
+        results["time"] = datetime.datetime.utcnow().isoformat() + "Z"
+        results["python"] = platform.python_version()
+        results["platform"] = platform.platform()
+        results["options"] = vars(args)
+        results["measurements"] = run_scenarios(scenario_names, args)
+        print_results(results["measurements"])
+        if args.output:
+            with open(args.output, 'w') as out_file:
+                json.dump(results, out_file, indent=4, sort_keys=True)
+
+    # Compare against an earlier run.
+    if args.baseline:
+        baseline = load_results(args.baseline)
+        print("\nComparing against " + baseline.get("commit", "") + ":")
+        regressions = compare_results(baseline["measurements"], results["measurements"], args.threshold)
+        if regressions:
+            print("\n" + str(len(regressions)) + " regression(s) over " + "{:.0f}%".format(args.threshold * 100.0) + ".")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
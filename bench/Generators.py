@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2017 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Deterministic synthetic activities for the benchmarks. The same seed always produces the same activity."""
+
+import inspect
+import math
+import os
+import random
+import sys
+import time
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import Keys
+
+DEFAULT_START_TIME_MS = 1600000000000
+METERS_PER_DEGREE_LAT = 111320.0
+START_LAT = 39.95 # Somewhere with map data, so the location lookups have something to find
+START_LON = -75.16
+START_ALT = 40.0
+
+class SyntheticActivity(object):
+    """Raw data for one activity, in the same form the API and the importer pass it to the data manager."""
+
+    def __init__(self, activity_type, start_time_ms):
+        self.activity_type = activity_type
+        self.start_time_ms = start_time_ms
+        self.locations = [] # List of [time_ms, lat, lon, alt, horizontal accuracy, vertical accuracy]
+        self.sensor_readings = {} # Maps the sensor type to a list of [time_ms, value]
+        self.accelerometer = [] # List of [time_ms, x, y, z]
+        super(SyntheticActivity, self).__init__()
+
+    def end_time_ms(self):
+        """Returns the time of the last reading of any kind."""
+        end_time_ms = self.start_time_ms
+        if self.locations:
+            end_time_ms = max(end_time_ms, self.locations[-1][0])
+        if self.accelerometer:
+            end_time_ms = max(end_time_ms, self.accelerometer[-1][0])
+        for readings in self.sensor_readings.values():
+            if readings:
+                end_time_ms = max(end_time_ms, readings[-1][0])
+        return end_time_ms
+
+    def num_points(self):
+        """Returns the total number of readings of every kind."""
+        return len(self.locations) + len(self.accelerometer) + sum(len(readings) for readings in self.sensor_readings.values())
+
+    def chunks(self, chunk_secs):
+        """Splits the activity into the pieces a phone would upload during a live activity. Yields (locations, sensor readings dict) tuples."""
+        chunk_ms = int(chunk_secs * 1000)
+        chunk_start_ms = self.start_time_ms
+        end_time_ms = self.end_time_ms()
+        location_index = 0
+        sensor_indexes = dict.fromkeys(self.sensor_readings, 0)
+        while chunk_start_ms <= end_time_ms:
+            chunk_end_ms = chunk_start_ms + chunk_ms
+            locations = []
+            while location_index < len(self.locations) and self.locations[location_index][0] < chunk_end_ms:
+                locations.append(self.locations[location_index])
+                location_index = location_index + 1
+            sensor_readings = {}
+            for sensor_type, readings in self.sensor_readings.items():
+                start_index = sensor_indexes[sensor_type]
+                end_index = start_index
+                while end_index < len(readings) and readings[end_index][0] < chunk_end_ms:
+                    end_index = end_index + 1
+                if end_index > start_index:
+                    sensor_readings[sensor_type] = readings[start_index:end_index]
+                sensor_indexes[sensor_type] = end_index
+            if locations:
+                yield locations, sensor_readings
+            chunk_start_ms = chunk_end_ms
+
+class Effort(object):
+    """Intensity over time, between zero and one: a steady base with slow swells, a few hard surges, and the occasional stop."""
+
+    def __init__(self, rng, base, swell, surge_probability, stop_probability):
+        self.rng = rng
+        self.base = base
+        self.swell = swell
+        self.surge_probability = surge_probability
+        self.stop_probability = stop_probability
+        self.surge_secs = 0
+        self.stop_secs = 0
+        super(Effort, self).__init__()
+
+    def next(self, elapsed_secs):
+        """Returns the intensity for the next one second sample."""
+        if self.stop_secs > 0:
+            self.stop_secs = self.stop_secs - 1
+            return 0.0
+        if self.rng.random() < self.stop_probability:
+            self.stop_secs = self.rng.randint(5, 60) # Traffic lights, water stops, etc.
+            return 0.0
+        if self.surge_secs == 0 and self.rng.random() < self.surge_probability:
+            self.surge_secs = self.rng.randint(20, 240)
+        intensity = self.base + self.swell * math.sin(elapsed_secs / 600.0) + self.rng.uniform(-0.03, 0.03)
+        if self.surge_secs > 0:
+            self.surge_secs = self.surge_secs - 1
+            intensity = intensity + 0.25
+        return min(max(intensity, 0.05), 1.0)
+
+class GpsReceiver(object):
+    """Adds realistic receiver error to a true position: a slowly wandering bias (the part that makes tracks look offset from the road) plus per fix noise."""
+
+    def __init__(self, rng, bias_meters, noise_meters, accuracy_meters):
+        self.rng = rng
+        self.bias_meters = bias_meters
+        self.noise_meters = noise_meters
+        self.accuracy_meters = accuracy_meters
+        self.bias_north = 0.0
+        self.bias_east = 0.0
+        super(GpsReceiver, self).__init__()
+
+    def fix(self, time_ms, lat, lon, alt):
+        """Returns [time_ms, lat, lon, alt, horizontal accuracy, vertical accuracy] for the given true position."""
+        self.bias_north = 0.98 * self.bias_north + self.rng.gauss(0.0, self.bias_meters * 0.2)
+        self.bias_east = 0.98 * self.bias_east + self.rng.gauss(0.0, self.bias_meters * 0.2)
+        north = self.bias_north + self.rng.gauss(0.0, self.noise_meters)
+        east = self.bias_east + self.rng.gauss(0.0, self.noise_meters)
+        meters_per_degree_lon = METERS_PER_DEGREE_LAT * math.cos(math.radians(lat))
+        horizontal_accuracy = self.accuracy_meters * self.rng.uniform(0.7, 1.5)
+        vertical_accuracy = horizontal_accuracy * 1.5
+        return [ time_ms, lat + (north / METERS_PER_DEGREE_LAT), lon + (east / meters_per_degree_lon), alt + self.rng.gauss(0.0, self.noise_meters * 1.5), horizontal_accuracy, vertical_accuracy ]
+
+class HeartRate(object):
+    """Heart rate that follows the effort with a lag, and drifts upward as the activity goes on."""
+
+    def __init__(self, rng, resting_hr, max_hr):
+        self.rng = rng
+        self.resting_hr = resting_hr
+        self.max_hr = max_hr
+        self.hr = resting_hr + 20.0
+        super(HeartRate, self).__init__()
+
+    def next(self, intensity, elapsed_secs):
+        """Returns the heart rate for the next one second sample."""
+        drift = min(elapsed_secs / 3600.0, 2.0) * 4.0
+        target = self.resting_hr + (self.max_hr - self.resting_hr) * (0.45 + 0.5 * intensity) + drift
+        self.hr = self.hr + (target - self.hr) * 0.05
+        return int(round(min(self.hr + self.rng.uniform(-1.0, 1.0), self.max_hr)))
+
+def generate_moving_activity(activity_type, duration_secs, seed, start_time_ms, top_speed, effort, receiver, heart_rate, cadence_func, power_func):
+    """Moves along a gently curving route with rolling hills, one sample per second (with the odd dropped or late sample)."""
+    rng = random.Random(seed)
+    activity = SyntheticActivity(activity_type, start_time_ms)
+    lat = START_LAT
+    lon = START_LON
+    heading = rng.uniform(0.0, 2.0 * math.pi)
+    cadence = []
+    power = []
+    hr = []
+
+    time_ms = start_time_ms
+    for elapsed_secs in range(duration_secs):
+        intensity = effort.next(elapsed_secs)
+        grade = 0.04 * math.sin(elapsed_secs / 420.0) + 0.02 * math.sin(elapsed_secs / 97.0)
+        speed = top_speed * intensity * (1.0 - 3.0 * grade) if intensity > 0.0 else 0.0
+
+        # Move the true position.
+        heading = heading + rng.gauss(0.0, 0.03)
+        meters_per_degree_lon = METERS_PER_DEGREE_LAT * math.cos(math.radians(lat))
+        lat = lat + (speed * math.cos(heading)) / METERS_PER_DEGREE_LAT
+        lon = lon + (speed * math.sin(heading)) / meters_per_degree_lon
+        alt = START_ALT + 60.0 * math.sin(elapsed_secs / 420.0) + 15.0 * math.sin(elapsed_secs / 97.0)
+
+        # Receivers occasionally miss a fix, and timestamps aren't exactly one second apart.
+        if receiver is not None and rng.random() > 0.005:
+            activity.locations.append(receiver.fix(time_ms, lat, lon, alt))
+        if heart_rate is not None:
+            hr.append([time_ms, heart_rate.next(intensity, elapsed_secs)])
+        if cadence_func is not None:
+            cadence.append([time_ms, cadence_func(rng, intensity)])
+        if power_func is not None:
+            power.append([time_ms, power_func(rng, intensity, grade)])
+        time_ms = time_ms + 1000 + rng.choice([0, 0, 0, 0, 0, 0, 0, 0, 7, -7])
+
+    if hr:
+        activity.sensor_readings[Keys.APP_HEART_RATE_KEY] = hr
+    if cadence:
+        activity.sensor_readings[Keys.APP_CADENCE_KEY] = cadence
+    if power:
+        activity.sensor_readings[Keys.APP_POWER_KEY] = power
+    return activity
+
+def run_cadence(rng, intensity):
+    """Steps per minute."""
+    if intensity <= 0.0:
+        return 0
+    return int(round(160.0 + 20.0 * intensity + rng.uniform(-2.0, 2.0)))
+
+def ride_cadence(rng, intensity):
+    """Crank revolutions per minute. Riders coast now and again."""
+    if intensity <= 0.0 or rng.random() < 0.05:
+        return 0
+    return int(round(75.0 + 20.0 * intensity + rng.uniform(-3.0, 3.0)))
+
+def ride_power(rng, intensity, grade):
+    """Watts, which go up on the climbs and drop to zero when coasting."""
+    if intensity <= 0.0 or rng.random() < 0.05:
+        return 0
+    return int(round(max(0.0, 260.0 * intensity * (1.0 + 4.0 * grade) + rng.gauss(0.0, 15.0))))
+
+def generate_run(duration_secs, seed, start_time_ms=DEFAULT_START_TIME_MS):
+    """An outdoor run with GPS, heart rate and cadence."""
+    rng = random.Random(seed)
+    effort = Effort(rng, 0.7, 0.1, 0.002, 0.0005)
+    receiver = GpsReceiver(rng, 2.0, 1.5, 5.0)
+    heart_rate = HeartRate(rng, 50, 190)
+    return generate_moving_activity(Keys.TYPE_RUNNING_KEY, duration_secs, seed, start_time_ms, 4.5, effort, receiver, heart_rate, run_cadence, None)
+
+def generate_ride(duration_secs, seed, start_time_ms=DEFAULT_START_TIME_MS):
+    """An outdoor ride with GPS, heart rate, cadence and power."""
+    rng = random.Random(seed)
+    effort = Effort(rng, 0.65, 0.15, 0.003, 0.001)
+    receiver = GpsReceiver(rng, 2.0, 1.0, 4.0)
+    heart_rate = HeartRate(rng, 50, 185)
+    return generate_moving_activity(Keys.TYPE_CYCLING_KEY, duration_secs, seed, start_time_ms, 12.0, effort, receiver, heart_rate, ride_cadence, ride_power)
+
+def generate_swim(duration_secs, seed, start_time_ms=DEFAULT_START_TIME_MS):
+    """An open water swim. The watch is underwater for half of each stroke, so the GPS is much noisier than on land."""
+    rng = random.Random(seed)
+    effort = Effort(rng, 0.75, 0.05, 0.001, 0.0)
+    receiver = GpsReceiver(rng, 6.0, 4.0, 15.0)
+    heart_rate = HeartRate(rng, 50, 175)
+    return generate_moving_activity(Keys.TYPE_OPEN_WATER_SWIMMING_KEY, duration_secs, seed, start_time_ms, 1.2, effort, receiver, heart_rate, None, None)
+
+def generate_lift(duration_secs, seed, start_time_ms=DEFAULT_START_TIME_MS, sample_rate_hz=20):
+    """Sets of pull ups recorded by a wrist accelerometer: each rep is one cycle on the y axis, with rest between sets, plus heart rate."""
+    rng = random.Random(seed)
+    activity = SyntheticActivity(Keys.TYPE_PULL_UP_KEY, start_time_ms)
+    heart_rate = HeartRate(rng, 50, 180)
+    hr = []
+
+    elapsed_secs = 0.0
+    while elapsed_secs < duration_secs:
+
+        # One set.
+        num_reps = rng.randint(5, 12)
+        rep_secs = rng.uniform(2.0, 3.0)
+        set_secs = num_reps * rep_secs
+        num_samples = int(set_secs * sample_rate_hz)
+        for i in range(num_samples):
+            t = i / float(sample_rate_hz)
+            phase = 2.0 * math.pi * t / rep_secs
+            time_ms = start_time_ms + int((elapsed_secs + t) * 1000.0)
+            x = 0.05 * math.sin(phase * 0.5) + rng.gauss(0.0, 0.03)
+            y = 0.6 * math.sin(phase) + rng.gauss(0.0, 0.05)
+            z = -1.0 + 0.1 * math.cos(phase) + rng.gauss(0.0, 0.03)
+            activity.accelerometer.append([time_ms, x, y, z])
+        elapsed_secs = elapsed_secs + set_secs
+
+        # Rest, with the arm hanging still. Watches sample less often when nothing is happening.
+        rest_secs = rng.uniform(60.0, 120.0)
+        for i in range(int(rest_secs * 2.0)):
+            time_ms = start_time_ms + int((elapsed_secs + i * 0.5) * 1000.0)
+            activity.accelerometer.append([time_ms, rng.gauss(0.0, 0.01), rng.gauss(0.0, 0.01), -1.0 + rng.gauss(0.0, 0.01)])
+        elapsed_secs = elapsed_secs + rest_secs
+
+    for second in range(int(elapsed_secs)):
+        intensity = 0.6 if (second % 100) < 30 else 0.2
+        hr.append([start_time_ms + second * 1000, heart_rate.next(intensity, second)])
+    activity.sensor_readings[Keys.APP_HEART_RATE_KEY] = hr
+    return activity
+
+def merge_sensor_readings(synthetic):
+    """Returns a dictionary that maps each reading time to a dictionary of sensor type to value, for writing files that store everything per point."""
+    merged = {}
+    for sensor_type, readings in synthetic.sensor_readings.items():
+        for reading in readings:
+            merged.setdefault(reading[0], {})[sensor_type] = reading[1]
+    return merged
+
+def format_time(time_ms):
+    """Returns an ISO 8601 UTC timestamp, with milliseconds."""
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(time_ms // 1000)) + ".{:03d}Z".format(time_ms % 1000)
+
+def write_gpx_file(synthetic, file_name):
+    """Writes the activity as a GPX file, with heart rate and cadence extensions, the way a typical watch would export it."""
+    sensor_readings = merge_sensor_readings(synthetic)
+    with open(file_name, 'w') as out_file:
+        out_file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        out_file.write('<gpx version="1.1" creator="Bench" xmlns="http://www.topografix.com/GPX/1/1" xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1">\n')
+        out_file.write('<metadata><name>Synthetic</name><time>' + format_time(synthetic.start_time_ms) + '</time></metadata>\n')
+        out_file.write('<trk><name>Synthetic</name><type>' + synthetic.activity_type.lower() + '</type><trkseg>\n')
+        for location in synthetic.locations:
+            out_file.write('<trkpt lat="{:.7f}" lon="{:.7f}"><ele>{:.1f}</ele><time>{}</time>'.format(location[1], location[2], location[3], format_time(location[0])))
+            readings = sensor_readings.get(location[0], {})
+            if Keys.APP_HEART_RATE_KEY in readings or Keys.APP_CADENCE_KEY in readings:
+                out_file.write('<extensions><gpxtpx:TrackPointExtension>')
+                if Keys.APP_HEART_RATE_KEY in readings:
+                    out_file.write('<gpxtpx:hr>{}</gpxtpx:hr>'.format(readings[Keys.APP_HEART_RATE_KEY]))
+                if Keys.APP_CADENCE_KEY in readings:
+                    out_file.write('<gpxtpx:cad>{}</gpxtpx:cad>'.format(readings[Keys.APP_CADENCE_KEY]))
+                out_file.write('</gpxtpx:TrackPointExtension></extensions>')
+            out_file.write('</trkpt>\n')
+        out_file.write('</trkseg></trk></gpx>\n')
+
+def write_tcx_file(synthetic, file_name):
+    """Writes the activity as a TCX file, with heart rate, cadence and power."""
+    sensor_readings = merge_sensor_readings(synthetic)
+    sport = "Biking" if synthetic.activity_type in Keys.CYCLING_ACTIVITIES else "Running"
+    with open(file_name, 'w') as out_file:
+        out_file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        out_file.write('<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2" xmlns:ns3="http://www.garmin.com/xmlschemas/ActivityExtension/v2">\n')
+        out_file.write('<Activities><Activity Sport="' + sport + '"><Id>' + format_time(synthetic.start_time_ms) + '</Id><Lap><Track>\n')
+        for location in synthetic.locations:
+            out_file.write('<Trackpoint><Time>{}</Time><Position><LatitudeDegrees>{:.7f}</LatitudeDegrees><LongitudeDegrees>{:.7f}</LongitudeDegrees></Position>'.format(format_time(location[0]), location[1], location[2]))
+            out_file.write('<AltitudeMeters>{:.1f}</AltitudeMeters>'.format(location[3]))
+            readings = sensor_readings.get(location[0], {})
+            if Keys.APP_HEART_RATE_KEY in readings:
+                out_file.write('<HeartRateBpm><Value>{}</Value></HeartRateBpm>'.format(readings[Keys.APP_HEART_RATE_KEY]))
+            if Keys.APP_CADENCE_KEY in readings:
+                out_file.write('<Cadence>{}</Cadence>'.format(readings[Keys.APP_CADENCE_KEY]))
+            if Keys.APP_POWER_KEY in readings:
+                out_file.write('<Extensions><ns3:TPX><ns3:Watts>{}</ns3:Watts></ns3:TPX></Extensions>'.format(readings[Keys.APP_POWER_KEY]))
+            out_file.write('</Trackpoint>\n')
+        out_file.write('</Track></Lap></Activity></Activities></TrainingCenterDatabase>\n')
+
+GENERATORS = { Keys.TYPE_RUNNING_KEY: generate_run, Keys.TYPE_CYCLING_KEY: generate_ride, Keys.TYPE_OPEN_WATER_SWIMMING_KEY: generate_swim, Keys.TYPE_PULL_UP_KEY: generate_lift }
+
+def generate(activity_type, duration_secs, seed, start_time_ms=DEFAULT_START_TIME_MS):
+    """Generates an activity of the given type, which must be one of the types in GENERATORS."""
+    if activity_type not in GENERATORS:
+        raise Exception("Bad parameter.")
+    return GENERATORS[activity_type](duration_secs, seed, start_time_ms)
+
+def to_activity_document(synthetic, activity_id, user_id, device_str):
+    """Converts the activity to the form it's returned from the database in, i.e. what the analyzer and exporter expect."""
+    activity = {}
+    activity[Keys.ACTIVITY_ID_KEY] = activity_id
+    activity[Keys.ACTIVITY_TYPE_KEY] = synthetic.activity_type
+    activity[Keys.ACTIVITY_USER_ID_KEY] = user_id
+    activity[Keys.ACTIVITY_DEVICE_STR_KEY] = device_str
+    activity[Keys.ACTIVITY_NAME_KEY] = synthetic.activity_type
+    activity[Keys.ACTIVITY_START_TIME_KEY] = int(synthetic.start_time_ms / 1000)
+    activity[Keys.ACTIVITY_VISIBILITY_KEY] = Keys.ACTIVITY_VISIBILITY_PUBLIC
+    if synthetic.locations:
+        activity[Keys.ACTIVITY_LOCATIONS_KEY] = [ { Keys.LOCATION_TIME_KEY: location[0], Keys.LOCATION_LAT_KEY: location[1], Keys.LOCATION_LON_KEY: location[2], Keys.LOCATION_ALT_KEY: location[3], \
+            Keys.LOCATION_HORIZONTAL_ACCURACY_KEY: location[4], Keys.LOCATION_VERTICAL_ACCURACY_KEY: location[5] } for location in synthetic.locations ]
+    for sensor_type, readings in synthetic.sensor_readings.items():
+        activity[sensor_type] = [ { str(reading[0]): float(reading[1]) } for reading in readings ]
+    if synthetic.accelerometer:
+        activity[Keys.APP_ACCELEROMETER_KEY] = [ { Keys.APP_AXIS_TIME: reading[0], Keys.APP_AXIS_NAME_X: reading[1], Keys.APP_AXIS_NAME_Y: reading[2], Keys.APP_AXIS_NAME_Z: reading[3] } for reading in synthetic.accelerometer ]
+    return activity
@@ -0,0 +1,742 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2017 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""In-memory stand-in for the parts of AppDatabase.MongoDatabase that the managers use, so the benchmarks measure the"""
+"""application code and not a database server. Documents are stored as they'd be returned from MongoDatabase, i.e. with"""
+"""the bucketed time series already merged back into the activity."""
+
+import copy
+import inspect
+import os
+import sys
+import threading
+import time
+import uuid
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import Database
+import Keys
+import TrainingRollups
+
+STREAM_KEYS = [ Keys.APP_LOCATIONS_KEY, Keys.APP_ACCELEROMETER_KEY, Keys.APP_CURRENT_SPEED_KEY, Keys.APP_HEART_RATE_KEY, Keys.APP_CADENCE_KEY, Keys.APP_POWER_KEY ]
+ANALYSIS_KEYS = [ Keys.ACTIVITY_ID_KEY, Keys.ACTIVITY_TYPE_KEY, Keys.ACTIVITY_USER_ID_KEY, Keys.ACTIVITY_DEVICE_STR_KEY, Keys.ACTIVITY_START_TIME_KEY, Keys.ACTIVITY_END_TIME_KEY, \
+    Keys.APP_LOCATIONS_KEY, Keys.APP_ACCELEROMETER_KEY, Keys.APP_CADENCE_KEY, Keys.APP_HEART_RATE_KEY, Keys.APP_POWER_KEY, Keys.APP_TEMP_KEY, Keys.APP_THREAT_COUNT_KEY, Keys.APP_BATTERY_LEVEL_KEY ]
+
+def normalize_activity_id(activity_id):
+    """Same as AppDatabase.normalize_activity_id."""
+    return str(activity_id).lower()
+
+def retrieve_value_time(value):
+    """Returns the time of a stored location, accelerometer reading, or time/value pair."""
+    if Keys.LOCATION_TIME_KEY in value:
+        return float(value[Keys.LOCATION_TIME_KEY])
+    return float(list(value.keys())[0])
+
+def append_time_series(activity, key, values):
+    """Appends to one of the activity's streams, keeping it in time order as MongoDatabase.merge_activity_buckets would."""
+    if not values:
+        return
+    existing = activity.get(key)
+    if not isinstance(existing, list):
+        existing = []
+        activity[key] = existing
+    in_order = len(existing) == 0 or retrieve_value_time(existing[-1]) <= retrieve_value_time(values[0])
+    existing.extend(values)
+    if not in_order:
+        existing.sort(key=retrieve_value_time)
+
+class MemoryDatabase(Database.Database):
+    """Keeps everything in dictionaries. Activities are returned as shallow copies, so callers can add keys without changing what's stored."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.users = {} # Maps the user ID to the user document
+        self.activities = {} # Maps the activity ID to the activity document, in the order they were created
+        self.activity_bests = {} # Maps the user ID to a dictionary of activity ID to bests
+        self.personal_records = {} # Maps the user ID to the personal records
+        self.tasks = {} # Maps the user ID to the list of deferred tasks
+        self.batch_jobs = {} # Maps the job name to the job document
+        self.rollups = {} # Maps (user ID, period, period start) to the rollup document
+        super(MemoryDatabase, self).__init__()
+
+    def connect(self, config):
+        """Nothing to connect to."""
+        return True
+
+    def copy_activity(self, activity, include_keys=None, exclude_keys=None):
+        """Returns a copy of the activity document, limited to the given keys (if any)."""
+        if include_keys is not None:
+            return { k: v for k, v in activity.items() if k in include_keys }
+        if exclude_keys is not None:
+            return { k: v for k, v in activity.items() if k not in exclude_keys }
+        return dict(activity)
+
+    def find_activity(self, activity_id):
+        """Returns the stored activity document, or None."""
+        return self.activities.get(normalize_activity_id(activity_id))
+
+    #
+    # User management methods
+    #
+
+    def create_user(self, username, realname, passhash):
+        """Create method for a user. Returns the user ID, which MongoDatabase leaves to the caller to look up."""
+        if username is None or len(username) == 0:
+            raise Exception("Bad parameter.")
+        with self.lock:
+            user_id = uuid.uuid4().hex[:24] # Same form as a Mongo object ID
+            self.users[user_id] = { Keys.DATABASE_ID_KEY: user_id, Keys.USERNAME_KEY: username, Keys.REALNAME_KEY: realname, Keys.HASH_KEY: passhash, \
+                Keys.DEVICES_KEY: [], Keys.FRIENDS_KEY: [], Keys.DEFAULT_PRIVACY_KEY: Keys.ACTIVITY_VISIBILITY_PUBLIC }
+            return user_id
+
+    def retrieve_user(self, username):
+        """Retrieve method for a user."""
+        for user in self.users.values():
+            if user[Keys.USERNAME_KEY] == username:
+                return user[Keys.DATABASE_ID_KEY], user[Keys.HASH_KEY], user[Keys.REALNAME_KEY]
+        return None, None, None
+
+    def retrieve_user_from_id(self, user_id):
+        """Retrieve method for a user."""
+        user = self.users.get(str(user_id))
+        if user is not None:
+            return user[Keys.USERNAME_KEY], user[Keys.REALNAME_KEY]
+        return None, None
+
+    def retrieve_user_doc_from_id(self, user_id):
+        """Retrieve method for a user."""
+        return self.users.get(str(user_id))
+
+    def create_user_device(self, user_id, device_str):
+        """Create method for a device."""
+        user = self.users.get(str(user_id))
+        if user is None:
+            return False
+        if device_str not in user[Keys.DEVICES_KEY]:
+            user[Keys.DEVICES_KEY].append(device_str)
+        return True
+
+    def retrieve_user_devices(self, user_id):
+        """Retrieve method for a device."""
+        user = self.users.get(str(user_id))
+        if user is not None:
+            return list(user[Keys.DEVICES_KEY])
+        return []
+
+    def retrieve_user_from_device(self, device_str):
+        """Finds the user associated with the device."""
+        for user in self.users.values():
+            if device_str in user[Keys.DEVICES_KEY]:
+                return user
+        return None
+
+    #
+    # Friend management methods
+    #
+
+    def create_friend(self, user_id, target_id):
+        """Adds the users to each other's friends lists."""
+        user = self.users.get(str(user_id))
+        target_user = self.users.get(str(target_id))
+        if user is None or target_user is None:
+            return False
+        if target_id not in user[Keys.FRIENDS_KEY]:
+            user[Keys.FRIENDS_KEY].append(target_id)
+        if user_id not in target_user[Keys.FRIENDS_KEY]:
+            target_user[Keys.FRIENDS_KEY].append(user_id)
+        return True
+
+    def retrieve_friends(self, user_id, include_devices=False):
+        """Returns the user ids for all users that are friends with the user who has the specified id."""
+        result_keys = [ Keys.DATABASE_ID_KEY, Keys.USERNAME_KEY, Keys.REALNAME_KEY ]
+        if include_devices:
+            result_keys.append(Keys.DEVICES_KEY)
+        return [ { k: copy.copy(user[k]) for k in result_keys } for user in self.users.values() if user_id in user[Keys.FRIENDS_KEY] ]
+
+    #
+    # User settings methods
+    #
+
+    def update_user_setting(self, user_id, key, value, update_time):
+        """Create/update method for user preferences."""
+        user = self.users.get(str(user_id))
+        if user is None:
+            return False
+        user[key.lower()] = copy.deepcopy(value)
+        return True
+
+    def retrieve_user_setting(self, user_id, key):
+        """Retrieve method for user preferences. Returns a copy, since callers modify lists and dictionaries before saving them again."""
+        user = self.users.get(str(user_id))
+        if user is None:
+            return None
+        return copy.deepcopy(user.get(key.lower()))
+
+    def retrieve_user_settings(self, user_id, keys):
+        """Retrieve method for user preferences."""
+        user = self.users.get(str(user_id))
+        if user is None:
+            return []
+        return [ { key: copy.deepcopy(user[key]) } for key in set(k.lower() for k in keys) if key in user ]
+
+    def retrieve_gear(self, user_id):
+        """Retrieve method for the user's gear. The benchmark users don't have any."""
+        return []
+
+    def retrieve_gear_defaults(self, user_id):
+        """Retrieve method for the gear that is associated with each activity type by default. The benchmark users don't have any."""
+        return []
+
+    #
+    # Personal record management methods
+    #
+
+    def create_user_personal_records(self, user_id, records):
+        """Create method for a user's personal record."""
+        self.personal_records[str(user_id)] = records
+        return True
+
+    def update_user_personal_records(self, user_id, records):
+        """Update method for a user's personal record."""
+        self.personal_records[str(user_id)] = records
+        return True
+
+    def retrieve_user_personal_records(self, user_id):
+        """Retrieve method for a user's personal records."""
+        return self.personal_records.get(str(user_id), {})
+
+    #
+    # Activity bests management methods
+    #
+
+    def create_activity_bests(self, user_id, activity_id, activity_type, activity_time, bests):
+        """Create method for a user's personal records for a given activity. Replaces anything previously stored for the activity."""
+        bests[Keys.ACTIVITY_TYPE_KEY] = activity_type
+        bests[Keys.ACTIVITY_START_TIME_KEY] = activity_time
+        with self.lock:
+            user_bests = self.activity_bests.setdefault(str(user_id), {})
+            user_bests[normalize_activity_id(activity_id)] = dict(bests)
+        return True
+
+    def create_activity_bests_in_bulk(self, user_id, activities_bests):
+        """Create method for a user's personal records for several activities."""
+        for activity_id, activity_type, activity_time, bests in activities_bests:
+            self.create_activity_bests(user_id, activity_id, activity_type, activity_time, bests)
+        return True
+
+    def retrieve_activity_bests_for_user(self, user_id):
+        """Retrieve method for a user's activity records."""
+        user_bests = self.activity_bests.get(str(user_id), {})
+        return { activity_id: dict(bests) for activity_id, bests in user_bests.items() }
+
+    def retrieve_bounded_activity_bests_for_user(self, user_id, cutoff_time_lower, cutoff_time_higher):
+        """Retrieve method for a user's activity records. Only activities that started within the specified time range will be returned."""
+        user_bests = self.activity_bests.get(str(user_id), {})
+        return { activity_id: dict(bests) for activity_id, bests in user_bests.items() if cutoff_time_lower <= bests[Keys.ACTIVITY_START_TIME_KEY] < cutoff_time_higher }
+
+    def list_records(self, user_id, activity_type, record_name):
+        """Returns (activity ID, start time, value) tuples for every activity of the given type that has the record."""
+        user_bests = self.activity_bests.get(str(user_id), {})
+        return [ (activity_id, bests[Keys.ACTIVITY_START_TIME_KEY], bests[record_name]) for activity_id, bests in user_bests.items() \
+            if bests[Keys.ACTIVITY_TYPE_KEY] == activity_type and record_name in bests ]
+
+    def retrieve_record_history_for_user(self, user_id, activity_type, record_name):
+        """Returns a list of (activity ID, start time, value) tuples for the given record, in order of activity start time."""
+        return sorted(self.list_records(user_id, activity_type, record_name), key=lambda record: record[1])
+
+    def retrieve_top_records_for_user(self, user_id, activity_type, record_name, cutoff_time_lower, cutoff_time_higher, lower_is_better, limit):
+        """Returns a list of (activity ID, start time, value) tuples for the best 'limit' performances of the given record, best first."""
+        records = [ record for record in self.list_records(user_id, activity_type, record_name) \
+            if (cutoff_time_lower is None or record[1] >= cutoff_time_lower) and (cutoff_time_higher is None or record[1] < cutoff_time_higher) ]
+        records.sort(key=lambda record: record[2], reverse=not lower_is_better)
+        return records[:limit]
+
+    def delete_activity_best_for_user(self, user_id, activity_id):
+        """Delete method for a user's personal records for a given activity."""
+        self.activity_bests.get(str(user_id), {}).pop(normalize_activity_id(activity_id), None)
+        return True
+
+    def delete_activity_bests_for_user(self, user_id, activity_ids):
+        """Delete method for a user's personal records for several activities."""
+        for activity_id in activity_ids:
+            self.delete_activity_best_for_user(user_id, activity_id)
+        return True
+
+    #
+    # Activity management methods
+    #
+
+    def list_activities(self, activities, start_time, end_time, return_all_data):
+        """Applies the same time bounds and projection as the MongoDatabase activity list methods."""
+        results = []
+        exclude_keys = None if return_all_data else STREAM_KEYS
+        for activity in activities:
+            if start_time is not None and end_time is not None:
+                activity_time = activity.get(Keys.ACTIVITY_START_TIME_KEY)
+                if activity_time is None or not start_time < activity_time < end_time:
+                    continue
+            results.append(self.copy_activity(activity, exclude_keys=exclude_keys))
+        return results
+
+    def retrieve_user_activity_list(self, user_id, start_time, end_time, return_all_data):
+        """Retrieves the list of activities associated with the specified user."""
+        activities = [ activity for activity in self.activities.values() if activity.get(Keys.ACTIVITY_USER_ID_KEY) == user_id ]
+        return self.list_activities(activities, start_time, end_time, return_all_data)
+
+    def retrieve_user_activity_times(self, user_id, start_time, end_time):
+        """Returns the activity ID, start time, end time (if known), and fingerprint (if any) of each of the user's activities that started within the given time range (inclusive)."""
+        results = []
+        for activity in self.activities.values():
+            if activity.get(Keys.ACTIVITY_USER_ID_KEY) == user_id and start_time <= activity.get(Keys.ACTIVITY_START_TIME_KEY, -1) <= end_time:
+                results.append(self.copy_activity(activity, include_keys=[ Keys.ACTIVITY_ID_KEY, Keys.ACTIVITY_START_TIME_KEY, Keys.ACTIVITY_END_TIME_KEY, Keys.ACTIVITY_FINGERPRINT_KEY ]))
+        return results
+
+    def retrieve_activity_ids_by_fingerprints(self, user_id, fingerprints):
+        """Returns a dictionary that maps each of the given fingerprints that matches one of the user's activities to that activity's ID."""
+        fingerprints = set(fingerprints)
+        matches = {}
+        for activity in self.activities.values():
+            if activity.get(Keys.ACTIVITY_USER_ID_KEY) == user_id and activity.get(Keys.ACTIVITY_FINGERPRINT_KEY) in fingerprints:
+                matches[activity[Keys.ACTIVITY_FINGERPRINT_KEY]] = activity[Keys.ACTIVITY_ID_KEY]
+        return matches
+
+    def retrieve_devices_activity_list(self, devices, start_time, end_time, return_all_data):
+        """Retrieves the list of activities associated with the specified devices."""
+        activities = [ activity for activity in self.activities.values() if activity.get(Keys.ACTIVITY_DEVICE_STR_KEY) in devices ]
+        return self.list_activities(activities, start_time, end_time, return_all_data)
+
+    def retrieve_activity_list_page(self, owners, start_time, end_time, before, num_results, list_keys):
+        """Retrieves the activities belonging to the given owners, in the same order as MongoDatabase: most recent first, then by activity ID,"""
+        """with activities that have no start time at the end."""
+        def list_sort_key(activity):
+            activity_time = activity.get(Keys.ACTIVITY_START_TIME_KEY)
+            return (activity_time is not None, activity_time or 0, activity[Keys.ACTIVITY_ID_KEY])
+
+        matched = []
+        for activity in self.activities.values():
+            for user_id, devices, public_only in owners:
+                if activity.get(Keys.ACTIVITY_USER_ID_KEY) != str(user_id) and activity.get(Keys.ACTIVITY_DEVICE_STR_KEY) not in devices:
+                    continue
+                if public_only and activity.get(Keys.ACTIVITY_VISIBILITY_KEY) == Keys.ACTIVITY_VISIBILITY_PRIVATE:
+                    continue
+                matched.append(activity)
+                break
+        matched = self.list_activities(matched, start_time, end_time, True)
+        if before is not None:
+            before_key = (before[0] is not None, before[0] or 0, before[1])
+            matched = [ activity for activity in matched if list_sort_key(activity) < before_key ]
+        matched = sorted(matched, key=list_sort_key, reverse=True)[:num_results]
+        if list_keys is None:
+            return [ self.copy_activity(activity, exclude_keys=STREAM_KEYS) for activity in matched ]
+        return [ self.copy_activity(activity, include_keys=list_keys) for activity in matched ]
+
+    def retrieve_each_user_activity(self, user_id, context, callback_func, start_time, end_time, return_all_data):
+        """Retrieves each user activity and calls the callback function for each one."""
+        for activity in self.retrieve_user_activity_list(user_id, start_time, end_time, return_all_data):
+            callback_func(context, activity, user_id)
+        return True
+
+    def retrieve_each_device_activity(self, user_id, device_str, context, callback_func, start_time, end_time, return_all_data):
+        """Retrieves each device activity and calls the callback function for each one."""
+        for activity in self.retrieve_devices_activity_list([ device_str ], start_time, end_time, return_all_data):
+            callback_func(context, activity, user_id)
+        return True
+
+    def retrieve_most_recent_activity_for_device(self, device_str, return_all_data):
+        """Retrieves the most recently created activity for the specified device."""
+        for activity in reversed(list(self.activities.values())):
+            if activity.get(Keys.ACTIVITY_DEVICE_STR_KEY) == device_str:
+                return self.copy_activity(activity, exclude_keys=None if return_all_data else STREAM_KEYS)
+        return None
+
+    def create_activity(self, activity_id, activity_name, date_time, device_str):
+        """Create method for an activity."""
+        activity_id = normalize_activity_id(activity_id)
+        with self.lock:
+            self.activities[activity_id] = { Keys.ACTIVITY_ID_KEY: activity_id, Keys.ACTIVITY_NAME_KEY: str(activity_name), Keys.ACTIVITY_START_TIME_KEY: date_time, \
+                Keys.ACTIVITY_DEVICE_STR_KEY: device_str, Keys.ACTIVITY_VISIBILITY_KEY: Keys.ACTIVITY_VISIBILITY_PUBLIC, Keys.ACTIVITY_LOCATIONS_KEY: [] }
+        return True
+
+    def create_complete_activity(self, activity):
+        """Create method for an activity, i.e. one made by the synthetic activity generators."""
+        activity = dict(activity)
+        activity[Keys.ACTIVITY_ID_KEY] = normalize_activity_id(activity[Keys.ACTIVITY_ID_KEY])
+        with self.lock:
+            self.activities[activity[Keys.ACTIVITY_ID_KEY]] = activity
+        return True
+
+    def retrieve_activity(self, activity_id):
+        """Retrieve method for an activity, specified by the activity ID."""
+        activity = self.find_activity(activity_id)
+        if activity is not None:
+            return self.copy_activity(activity)
+        return None
+
+    def retrieve_activity_for_analysis(self, activity_id):
+        """Retrieve method for an activity, specified by the activity ID, limited to the fields used by the analysis workers."""
+        activity = self.find_activity(activity_id)
+        if activity is None:
+            return None
+        result = self.copy_activity(activity, include_keys=ANALYSIS_KEYS)
+        if Keys.APP_CURRENT_SPEED_KEY in activity:
+            result[Keys.APP_CURRENT_SPEED_KEY] = []
+        return result
+
+    def retrieve_activity_small(self, activity_id):
+        """Retrieve method for an activity, without the time series data."""
+        activity = self.find_activity(activity_id)
+        if activity is not None:
+            return self.copy_activity(activity, exclude_keys=STREAM_KEYS)
+        return None
+
+    def activity_exists(self, activity_id):
+        """Determines whether or not there is a document corresonding to the activity ID."""
+        return normalize_activity_id(activity_id) in self.activities
+
+    def retrieve_existing_activity_ids(self, activity_ids):
+        """Returns the subset of the given activity IDs that still have an activity document."""
+        return set([activity_id for activity_id in activity_ids if self.find_activity(activity_id) is not None])
+
+    def retrieve_activities_for_batch_analysis(self, user_id, only_unanalyzed, checkpoint, limit):
+        """Returns the next 'limit' activities after the checkpoint, in the order they were created. The checkpoint is the activity ID."""
+        results = []
+        with self.lock:
+            activity_ids = list(self.activities.keys())
+        if checkpoint is not None:
+            activity_ids = activity_ids[activity_ids.index(checkpoint) + 1:]
+        for activity_id in activity_ids:
+            activity = self.activities[activity_id]
+            if user_id is not None and activity.get(Keys.ACTIVITY_USER_ID_KEY) != str(user_id):
+                continue
+            if only_unanalyzed and Keys.ACTIVITY_SUMMARY_KEY in activity:
+                continue
+            result = self.copy_activity(activity, include_keys=[ Keys.ACTIVITY_ID_KEY, Keys.ACTIVITY_USER_ID_KEY, Keys.ACTIVITY_DEVICE_STR_KEY ])
+            result[Keys.BATCH_JOB_CHECKPOINT_KEY] = activity_id
+            results.append(result)
+            if len(results) >= limit:
+                break
+        return results
+
+    def delete_activity(self, activity_id):
+        """Delete method for an activity, specified by the activity ID."""
+        with self.lock:
+            return self.activities.pop(normalize_activity_id(activity_id), None) is not None
+
+    def update_activity_fingerprint(self, activity_id, fingerprint):
+        """Stores the fingerprint that is used to detect duplicate uploads."""
+        activity = self.find_activity(activity_id)
+        if activity is None:
+            return False
+        activity[Keys.ACTIVITY_FINGERPRINT_KEY] = fingerprint
+        return True
+
+    def create_tags_on_activity(self, activity, tags):
+        """Replaces the activity's tags."""
+        return self.create_tags_on_activity_by_id(activity[Keys.ACTIVITY_ID_KEY], tags)
+
+    def create_tags_on_activity_by_id(self, activity_id, tags):
+        """Replaces the activity's tags."""
+        activity = self.find_activity(activity_id)
+        if activity is None:
+            return False
+        activity[Keys.ACTIVITY_TAGS_KEY] = tags
+        return True
+
+    #
+    # Activity data methods
+    #
+
+    def find_or_create_device_activity(self, device_str, activity_id, first_time_ms):
+        """Makes sure there is a document for the activity, creating it if it does not already exist."""
+        activity = self.find_activity(activity_id)
+        if activity is not None and activity.get(Keys.ACTIVITY_DEVICE_STR_KEY) == device_str:
+            return activity
+        self.create_activity(activity_id, "", first_time_ms / 1000, device_str)
+        return self.find_activity(activity_id)
+
+    def update_activity_last_updated_time(self, activity, end_time_ms):
+        """Updates the activity's last updated time, and end time (if provided)."""
+        activity[Keys.ACTIVITY_LAST_UPDATED_KEY] = time.time()
+        if end_time_ms is not None:
+            activity[Keys.ACTIVITY_END_TIME_KEY] = max(activity.get(Keys.ACTIVITY_END_TIME_KEY, 0), int(end_time_ms / 1000))
+        return True
+
+    def update_activity(self, device_str, activity_id, locations, sensor_readings_dict, metadata_list_dict):
+        """Updates locations, sensor readings, and metadata associated with a moving activity."""
+        if not locations:
+            return False
+        with self.lock:
+            activity = self.find_or_create_device_activity(device_str, activity_id, locations[0][0])
+            location_values = []
+            for location in locations:
+                location_values.append({ Keys.LOCATION_TIME_KEY: location[0], Keys.LOCATION_LAT_KEY: location[1], Keys.LOCATION_LON_KEY: location[2], Keys.LOCATION_ALT_KEY: location[3], \
+                    Keys.LOCATION_HORIZONTAL_ACCURACY_KEY: location[4], Keys.LOCATION_VERTICAL_ACCURACY_KEY: location[5] })
+            append_time_series(activity, Keys.ACTIVITY_LOCATIONS_KEY, location_values)
+            for readings_dict in [ sensor_readings_dict, metadata_list_dict ]:
+                if readings_dict:
+                    for reading_type in readings_dict:
+                        append_time_series(activity, reading_type, [ { str(value[0]): float(value[1]) } for value in readings_dict[reading_type] ])
+            return self.update_activity_last_updated_time(activity, max(location[0] for location in locations))
+
+    def create_activity_locations(self, device_str, activity_id, locations):
+        """Adds several locations to the database. 'locations' is an array of arrays in the form [time, lat, lon, alt]."""
+        if not locations:
+            return False
+        with self.lock:
+            activity = self.find_or_create_device_activity(device_str, activity_id, locations[0][0])
+            append_time_series(activity, Keys.ACTIVITY_LOCATIONS_KEY, [ { Keys.LOCATION_TIME_KEY: location[0], Keys.LOCATION_LAT_KEY: location[1], Keys.LOCATION_LON_KEY: location[2], Keys.LOCATION_ALT_KEY: location[3] } for location in locations ])
+            return self.update_activity_last_updated_time(activity, max(location[0] for location in locations))
+
+    def retrieve_activity_locations(self, activity_id):
+        """Returns all the locations for the specified activity."""
+        activity = self.find_activity(activity_id)
+        if activity is not None and Keys.ACTIVITY_LOCATIONS_KEY in activity:
+            return list(activity[Keys.ACTIVITY_LOCATIONS_KEY])
+        return None
+
+    def retrieve_activity_streams(self, activity_id, stream_names):
+        """Returns a dictionary that maps each of the stream names to its values."""
+        activity = self.find_activity(activity_id)
+        if activity is None:
+            return None
+        return { name: list(activity[name]) for name in stream_names if name in activity }
+
+    def create_activity_sensor_reading(self, activity_id, date_time, sensor_type, value):
+        """Create method for a piece of sensor data, such as a heart rate or power meter reading."""
+        activity = self.find_activity(activity_id)
+        if activity is None:
+            return False
+        with self.lock:
+            append_time_series(activity, sensor_type, [ { str(date_time): float(value) } ])
+            return self.update_activity_last_updated_time(activity, None)
+
+    def create_activity_streams(self, device_str, activity_id, locations, sensor_readings_dict, events):
+        """Adds a chunk of imported data, i.e. locations, sensor readings, and events."""
+        with self.lock:
+            if locations:
+                activity = self.find_or_create_device_activity(device_str, activity_id, locations[0][0])
+            else:
+                activity = self.find_activity(activity_id)
+            if activity is None:
+                return False
+
+            end_time_ms = None
+            if locations:
+                append_time_series(activity, Keys.ACTIVITY_LOCATIONS_KEY, [ { Keys.LOCATION_TIME_KEY: location[0], Keys.LOCATION_LAT_KEY: location[1], Keys.LOCATION_LON_KEY: location[2], Keys.LOCATION_ALT_KEY: location[3] } for location in locations ])
+                end_time_ms = max(location[0] for location in locations)
+            for sensor_type in sensor_readings_dict:
+                append_time_series(activity, sensor_type, [ { str(value[0]): float(value[1]) } for value in sensor_readings_dict[sensor_type] ])
+            if events:
+                activity.setdefault(Keys.APP_EVENTS_KEY, []).extend(events)
+            return self.update_activity_last_updated_time(activity, end_time_ms)
+
+    def create_or_update_activity_metadata(self, activity_id, date_time, key, value, create_list):
+        """Create method for a piece of metaadata. When dealing with a list, will append values."""
+        activity = self.find_activity(activity_id)
+        if activity is None:
+            return False
+        try:
+            if key not in [ Keys.ACTIVITY_NAME_KEY, Keys.ACTIVITY_TYPE_KEY, Keys.ACTIVITY_DESCRIPTION_KEY ]:
+                value = float(value)
+        except ValueError:
+            pass
+        with self.lock:
+            if create_list is True:
+                append_time_series(activity, key, [ { str(date_time): value } ])
+            else:
+                activity[key] = value
+            activity[Keys.ACTIVITY_LAST_UPDATED_KEY] = time.time()
+        return True
+
+    def create_or_update_activity_metadata_list(self, activity_id, key, values):
+        """Create method for a list of metaadata values."""
+        activity = self.find_activity(activity_id)
+        if activity is None:
+            return False
+        with self.lock:
+            append_time_series(activity, key, [ { str(value[0]): float(value[1]) } for value in values ])
+            activity[Keys.ACTIVITY_LAST_UPDATED_KEY] = time.time()
+        return True
+
+    #
+    # Activity summary methods
+    #
+
+    def create_activity_summary(self, activity_id, summary_data):
+        """Create method for activity summary data. Summary data is data computed from the raw data."""
+        activity = self.find_activity(activity_id)
+        if activity is None:
+            return False
+        activity[Keys.ACTIVITY_SUMMARY_KEY] = summary_data
+        activity[Keys.ACTIVITY_LAST_UPDATED_KEY] = time.time()
+        return True
+
+    def create_activity_summaries(self, summaries):
+        """Create method for the summary data of several activities."""
+        result = True
+        for activity_id, summary_data in summaries.items():
+            result = self.create_activity_summary(activity_id, summary_data) and result
+        return result
+
+    def create_activity_simplified_data(self, simplified):
+        """Create method for the simplified tracks and downsampled sensor readings of several activities."""
+        for activity_id, data in simplified.items():
+            activity = self.find_activity(activity_id)
+            if activity is not None:
+                activity.update(data)
+        return True
+
+    def retrieve_activity_simplified_data(self, activity_id, key, names):
+        """Returns a dictionary of the named simplified tracks or downsampled sensor readings, None if nothing was stored."""
+        activity = self.find_activity(activity_id)
+        if activity is None or key not in activity:
+            return None
+        return { name: activity[key][name] for name in names if name in activity[key] }
+
+    def update_activity_rollup_contributions(self, contributions):
+        """Records what each activity has added to its owner's training rollups."""
+        for activity_id, contribution in contributions.items():
+            activity = self.find_activity(activity_id)
+            if activity is None:
+                continue
+            if contribution is None:
+                activity.pop(Keys.ACTIVITY_ROLLUP_CONTRIBUTION_KEY, None)
+            else:
+                activity[Keys.ACTIVITY_ROLLUP_CONTRIBUTION_KEY] = contribution
+        return True
+
+    def swap_activity_rollup_contribution(self, activity_id, old_contribution, new_contribution):
+        """Replaces what the activity has added to its owner's training rollups, but only if it is still the old contribution."""
+        with self.lock:
+            activity = self.find_activity(activity_id)
+            if activity is None or activity.get(Keys.ACTIVITY_ROLLUP_CONTRIBUTION_KEY) != old_contribution:
+                return False
+            if new_contribution is None:
+                activity.pop(Keys.ACTIVITY_ROLLUP_CONTRIBUTION_KEY, None)
+            else:
+                activity[Keys.ACTIVITY_ROLLUP_CONTRIBUTION_KEY] = copy.deepcopy(new_contribution)
+            return True
+
+    def retrieve_activity_summary(self, activity_id):
+        """Retrieve method for activity summary data."""
+        activity = self.find_activity(activity_id)
+        if activity is not None:
+            return activity.get(Keys.ACTIVITY_SUMMARY_KEY)
+        return None
+
+    #
+    # Deferred task management methods
+    #
+
+    def create_deferred_task(self, user_id, task_type, celery_task_id, internal_task_id, details, status):
+        """Create method for tracking a deferred task, such as a file import or activity analysis."""
+        task = { Keys.TASK_CELERY_ID_KEY: str(celery_task_id), Keys.TASK_INTERNAL_ID_KEY: str(internal_task_id), Keys.TASK_TYPE_KEY: task_type, Keys.TASK_DETAILS_KEY: details, Keys.TASK_STATUS_KEY: status }
+        with self.lock:
+            self.tasks.setdefault(str(user_id), []).append(task)
+        return True
+
+    def retrieve_deferred_tasks(self, user_id):
+        """Retrieve method for returning all the deferred tasks for a given user."""
+        return self.tasks.get(str(user_id), [])
+
+    def update_deferred_task(self, user_id, internal_task_id, activity_id, status, details=None):
+        """Updated method for deferred task status."""
+        for task in self.tasks.get(str(user_id), []):
+            if task[Keys.TASK_INTERNAL_ID_KEY] == str(internal_task_id):
+                if activity_id is not None:
+                    activity_id = normalize_activity_id(activity_id)
+                task[Keys.TASK_ACTIVITY_ID_KEY] = activity_id
+                task[Keys.TASK_STATUS_KEY] = status
+                if details is not None:
+                    task[Keys.TASK_DETAILS_KEY] = details
+                return True
+        return False
+
+    #
+    # Training rollup methods
+    #
+
+    def update_training_rollups(self, user_id, increments):
+        """Adds to the user's rollups, creating any that don't exist yet."""
+        with self.lock:
+            for (period, period_start), fields in increments.items():
+                rollup = self.rollups.setdefault((str(user_id), period, period_start), { Keys.ROLLUP_PERIOD_KEY: period, Keys.ROLLUP_PERIOD_START_KEY: period_start })
+                TrainingRollups.apply_increments(rollup, fields)
+        return True
+
+    def retrieve_training_rollups(self, user_id, period, start_time, end_time):
+        """Returns the user's rollups for the given period length, in order, for periods that start within the time bounds."""
+        with self.lock:
+            rollups = [ copy.deepcopy(rollup) for (rollup_user_id, rollup_period, period_start), rollup in self.rollups.items() \
+                if rollup_user_id == str(user_id) and rollup_period == period and (start_time is None or period_start >= start_time) and (end_time is None or period_start < end_time) ]
+        return sorted(rollups, key=lambda rollup: rollup[Keys.ROLLUP_PERIOD_START_KEY])
+
+    def delete_training_rollups(self, user_id):
+        """Delete method for all of the user's rollups."""
+        with self.lock:
+            for key in [ key for key in self.rollups if key[0] == str(user_id) ]:
+                del self.rollups[key]
+        return True
+
+    #
+    # Batch job management methods
+    #
+
+    def acquire_batch_job(self, job_name, owner, lease_secs):
+        """Takes ownership of the named job, creating it if it doesn't exist. Returns None if another worker holds the job."""
+        now = time.time()
+        with self.lock:
+            job = self.batch_jobs.get(job_name)
+            if job is None:
+                job = { Keys.BATCH_JOB_NAME_KEY: job_name, Keys.BATCH_JOB_CHECKPOINT_KEY: None, Keys.BATCH_JOB_NUM_PROCESSED_KEY: 0, Keys.BATCH_JOB_NUM_FAILED_KEY: 0, Keys.BATCH_JOB_USERS_KEY: [] }
+                self.batch_jobs[job_name] = job
+            elif job[Keys.BATCH_JOB_LEASE_EXPIRY_KEY] >= now:
+                return None
+            job[Keys.BATCH_JOB_OWNER_KEY] = owner
+            job[Keys.BATCH_JOB_LEASE_EXPIRY_KEY] = now + lease_secs
+            return dict(job)
+
+    def update_batch_job(self, job_name, owner, checkpoint, num_processed, num_failed, user_ids, lease_secs):
+        """Records the job's progress and extends its lease. Returns FALSE if the job is no longer held by the given owner."""
+        with self.lock:
+            job = self.batch_jobs.get(job_name)
+            if job is None or job[Keys.BATCH_JOB_OWNER_KEY] != owner:
+                return False
+            job[Keys.BATCH_JOB_CHECKPOINT_KEY] = checkpoint
+            job[Keys.BATCH_JOB_NUM_PROCESSED_KEY] = num_processed
+            job[Keys.BATCH_JOB_NUM_FAILED_KEY] = num_failed
+            job[Keys.BATCH_JOB_USERS_KEY] = list(set(job[Keys.BATCH_JOB_USERS_KEY]) | set(user_ids))
+            job[Keys.BATCH_JOB_LEASE_EXPIRY_KEY] = time.time() + lease_secs
+        return True
+
+    def delete_batch_job(self, job_name, owner):
+        """Removes a finished job. Returns FALSE if the job is no longer held by the given owner."""
+        with self.lock:
+            job = self.batch_jobs.get(job_name)
+            if job is None or job[Keys.BATCH_JOB_OWNER_KEY] != owner:
+                return False
+            self.batch_jobs.pop(job_name)
+        return True
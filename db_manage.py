@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# 
+# # MIT License
+# 
+# Copyright (c) 2022 Michael J Simms
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Database maintenance: builds indexes, migrates old data (including activity bests, to one document per record, and uploaded files, to the blob store), verifies that queries are served by indexes, and rebuilds the training rollups."""
+
+import argparse
+import sys
+
+import AppDatabase
+import Config
+import DataMgr
+import Keys
+
+def connect(config_file_name):
+    config = Config.Config()
+    if len(config_file_name) > 0:
+        config.load(config_file_name)
+    db = AppDatabase.MongoDatabase()
+    db.connect(config)
+    return config, db
+
+def list_user_ids(db):
+    user_ids = []
+    db.enumerate_all_users(lambda user: user_ids.append(str(user[Keys.DATABASE_ID_KEY])))
+    return user_ids
+
+if __name__ == "__main__":
+
+    # Parse command line options.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, action="store", default="", help="The configuration file.", required=False)
+    parser.add_argument("--create-indexes", action="store_true", default=False, help="Creates the indexes used by the application's queries.", required=False)
+    parser.add_argument("--normalize-activity-ids", action="store_true", default=False, help="Converts activity IDs to their canonical (lower case) form.", required=False)
+    parser.add_argument("--migrate-bests", action="store_true", default=False, help="Moves activity bests stored in the users' records documents into the activity bests collection.", required=False)
+    parser.add_argument("--migrate-uploads", action="store_true", default=False, help="Moves the contents of files uploaded before the blob store was added into it.", required=False)
+    parser.add_argument("--verify-indexes", action="store_true", default=False, help="Fails if any of the application's queries would require a collection scan.", required=False)
+    parser.add_argument("--rebuild-rollups", action="store_true", default=False, help="Regenerates every user's training rollups from their activities.", required=False)
+    parser.add_argument("--verify-rollups", action="store_true", default=False, help="Fails if any user's training rollups differ from ones regenerated from their activities.", required=False)
+
+    try:
+        args = parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    # Connecting also creates the indexes and normalizes the activity IDs, but do it again in case that failed silently.
+    config, db = connect(args.config)
+
+    if args.create_indexes:
+        db.create_indexes()
+        print("Indexes created.")
+    if args.normalize_activity_ids:
+        num_updated = db.normalize_activity_ids()
+        print("Updated " + str(num_updated) + " activity IDs.")
+    if args.migrate_bests:
+        num_migrated = db.migrate_activity_bests()
+        print("Migrated the bests of " + str(num_migrated) + " activities.")
+    if args.migrate_uploads:
+        num_migrated = db.migrate_uploaded_files()
+        print("Migrated " + str(num_migrated) + " uploaded files.")
+    if args.verify_indexes:
+        failures = db.verify_indexes()
+        for failure in failures:
+            print("Collection scan: " + failure)
+        if failures:
+            sys.exit(1)
+        print("All queries are served by indexes.")
+    if args.rebuild_rollups or args.verify_rollups:
+        data_mgr = DataMgr.DataMgr(config=config, root_url="", analysis_scheduler=None, import_scheduler=None, database=db)
+        user_ids = list_user_ids(db)
+        if args.rebuild_rollups:
+            for user_id in user_ids:
+                if not data_mgr.rebuild_training_rollups(user_id):
+                    print("Failed to rebuild the training rollups for user " + user_id + ".")
+                    sys.exit(1)
+            print("Rebuilt the training rollups for " + str(len(user_ids)) + " users.")
+        if args.verify_rollups:
+            num_mismatches = 0
+            for user_id in user_ids:
+                for period, period_start in data_mgr.verify_training_rollups(user_id):
+                    print("Mismatch: user " + user_id + ", " + period + " starting " + str(period_start))
+                    num_mismatches = num_mismatches + 1
+            if num_mismatches > 0:
+                sys.exit(1)
+            print("All training rollups match the activities.")
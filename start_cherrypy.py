@@ -34,6 +34,7 @@ import AppFactory
 import CherryPyFrontEnd
 import Config
 import DatabaseException
+import LiveFeed
 import SessionMgr
 
 from cherrypy import tools
@@ -132,10 +133,15 @@ def main():
         reload_feature = ReloadFeature(cherrypy.engine)
         reload_feature.subscribe()
 
+        # Requests waiting on live data hold a server thread, so they're limited to a share of the pool.
+        server_threads = config.get_server_threads()
+        LiveFeed.set_thread_pool_size(server_threads)
+
         cherrypy.tools.web_auth = cherrypy.Tool('before_handler', CherryPyFrontEnd.do_auth_check)
         cherrypy.config.update({
             'server.socket_host': config.get_bindname(),
             'server.socket_port': config.get_bindport(),
+            'server.thread_pool': server_threads,
             'requests.show_tracebacks': False,
             'error_page.404': g_front_end.error_404,
             'log.access_file': ACCESS_LOG})
@@ -39,6 +39,7 @@ import Config
 import DatabaseException
 import Dirs
 import InputChecker
+import LiveFeed
 import SessionMgr
 
 from urllib.parse import parse_qs
@@ -169,6 +170,10 @@ def handle_error(start_response, error_code):
     g_session_mgr.clear_current_session() # Housekeeping
     return [content]
 
+def handle_error_401(start_response):
+    """Renders the error page."""
+    return handle_error(start_response, '401 Unauthorized')
+
 def handle_error_403(start_response):
     """Renders the error page."""
     return handle_error(start_response, '403 Forbidden')
@@ -335,6 +340,21 @@ def stats(env, start_response):
         log_error(sys.exc_info()[0])
     return handle_error_500(start_response)
 
+def metrics(env, start_response):
+    """Returns the metrics in the text exposition format, for a monitoring system such as Prometheus."""
+    global g_front_end
+
+    try:
+        handled, response = g_front_end.backend.metrics(env.get('HTTP_AUTHORIZATION'))
+        if not handled:
+            return handle_error_401(start_response)
+        return handle_dynamic_page_request(env, start_response, response, 'text/plain; version=0.0.4; charset=utf-8')
+    except:
+        # Log the error and then fall through to the error page response.
+        log_error(traceback.format_exc())
+        log_error(sys.exc_info()[0])
+    return handle_error_500(start_response)
+
 @do_session_check
 def live(env, start_response):
     """Renders the map page for the current activity from a single device."""
@@ -806,9 +826,14 @@ def ical(env, start_response):
     try:
         calendar_id = env['PATH_INFO']
         calendar_id = calendar_id[1:]
-        handled, response = g_front_end.backend.ical(calendar_id)
-        if handled:
-            return handle_dynamic_page_request(env, start_response, response)
+        status, response, headers = g_front_end.backend.ical(calendar_id, env.get('HTTP_IF_NONE_MATCH'), env.get('HTTP_IF_MODIFIED_SINCE'))
+        if status == 304:
+            start_response('304 Not Modified', list(headers.items()))
+            return []
+        if status == 200:
+            start_response('200 OK', list(headers.items()))
+            return [response.encode('utf-8')]
+        return handle_error_404(start_response)
     except App.RedirectException as e:
         return handle_redirect_exception(e.url, start_response)
     except:
@@ -900,7 +925,7 @@ def index(env, start_response):
     """Renders the index page."""
     return login(env, start_response)
 
-def create_server(port_num):
+def create_server(port_num, thread_pool_size):
     """Returns a cherrypy server object."""
 
     # Instantiate a new server object.
@@ -909,7 +934,7 @@ def create_server(port_num):
     # Configure the server object.
     server.socket_host = "0.0.0.0"
     server.socket_port = port_num
-    server.thread_pool = 30
+    server.thread_pool = thread_pool_size
 
     # Subscribe this server.
     server.subscribe()
@@ -958,6 +983,7 @@ def main():
         cherrypy.tree.graft(media, "/media")
         cherrypy.tree.graft(photos, "/photos")
         cherrypy.tree.graft(stats, "/stats")
+        cherrypy.tree.graft(metrics, "/metrics")
         cherrypy.tree.graft(error, "/error")
         cherrypy.tree.graft(live, "/live")
         cherrypy.tree.graft(live_user, "/live_user")
@@ -1011,8 +1037,10 @@ def main():
         num_servers = config.get_num_servers()
         if num_servers <= 0:
             num_servers = 1
+        server_threads = config.get_server_threads()
+        LiveFeed.set_thread_pool_size(server_threads)
         for i in range(0, num_servers):
-            servers.append(create_server(port_num + i))
+            servers.append(create_server(port_num + i, server_threads))
 
         cherrypy.config.update(cherrypy_config)
         cherrypy.engine.start()
@@ -26,6 +26,7 @@
 
 import argparse
 import functools
+import inspect
 import json
 import os
 import signal
@@ -161,6 +162,20 @@ def stats():
         g_app.log_error('Unhandled exception in ' + stats.__name__)
     return error()
 
+@g_flask_app.route('/metrics')
+def metrics():
+    """Returns the metrics in the text exposition format, for a monitoring system such as Prometheus."""
+    try:
+        handled, response = g_app.metrics(flask.request.headers.get('Authorization'))
+        if not handled:
+            return "", 401
+        return flask.Response(response, content_type='text/plain; version=0.0.4; charset=utf-8')
+    except:
+        g_app.log_error(traceback.format_exc())
+        g_app.log_error(sys.exc_info()[0])
+        g_app.log_error('Unhandled exception in ' + metrics.__name__)
+    return error()
+
 @g_flask_app.route('/live/<device_str>')
 def live(device_str):
     """Renders the map page for the current activity from a single device."""
@@ -577,8 +592,8 @@ def ical(calendar_id):
     global g_app
     result = ""
     try:
-        _, response = g_app.ical(calendar_id)
-        return response
+        status, response, headers = g_app.ical(calendar_id, flask.request.headers.get('If-None-Match'), flask.request.headers.get('If-Modified-Since'))
+        return response, status, headers
     except:
         result = g_app.render_error()
     return result
@@ -678,6 +693,10 @@ def api(version, method):
         code = 500
     except:
         code = 500
+
+    # Exported files are returned as generators, send them as they are formatted rather than all at once.
+    if inspect.isgenerator(response):
+        response = flask.Response(response)
     return response, code
 
 @g_flask_app.route('/google_maps')
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2022 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Checks the personal record history and top-N queries against a brute force search of the same bests, and the migration of bests out of the records documents."""
+
+import argparse
+import inspect
+import os
+import random
+import sys
+import time
+import uuid
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+sys.path.insert(0, os.path.join(parentdir, "bench"))
+import Config
+import DataMgr
+import Keys
+import MemoryDatabase
+
+START_TIME = 1600000000
+DAY_SECS = 86400
+
+def generate_bests(num_activities, seed):
+    """Returns a list of (activity ID, activity type, start time, bests) tuples, alternating runs (with a 5K time) and rides (with a 20 minute power)."""
+    rng = random.Random(seed)
+    activities_bests = []
+    for i in range(num_activities):
+        start_time = START_TIME + i * DAY_SECS
+        if i % 2 == 0:
+            activities_bests.append((str(uuid.uuid4()), Keys.TYPE_RUNNING_KEY, start_time, { Keys.BEST_5K: rng.uniform(1100.0, 1600.0) }))
+        else:
+            activities_bests.append((str(uuid.uuid4()), Keys.TYPE_CYCLING_KEY, start_time, { Keys.BEST_20_MIN_POWER: rng.uniform(150.0, 300.0) }))
+    return activities_bests
+
+def brute_force_history(activities_bests, activity_type, record_name):
+    """Every value of the record, in order of start time."""
+    history = []
+    for activity_id, current_type, start_time, bests in activities_bests:
+        if current_type == activity_type and record_name in bests:
+            history.append((activity_id, start_time, bests[record_name]))
+    history.sort(key=lambda record: record[1])
+    return history
+
+def brute_force_top_records(activities_bests, activity_type, record_name, cutoff_time_lower, cutoff_time_higher, limit):
+    """The best 'limit' values of the record, best first. Times are better when they're lower, everything else is better when it's higher."""
+    records = [ record for record in brute_force_history(activities_bests, activity_type, record_name) \
+        if (cutoff_time_lower is None or record[1] >= cutoff_time_lower) and (cutoff_time_higher is None or record[1] < cutoff_time_higher) ]
+    records.sort(key=lambda record: record[2], reverse=record_name not in Keys.TIME_KEYS)
+    return records[:limit]
+
+def top_record_queries(activities_bests):
+    """Returns the (activity type, record name, lower cutoff, upper cutoff, limit) combinations to check."""
+    end_time = activities_bests[-1][2]
+    queries = []
+    for activity_type, record_name in [ (Keys.TYPE_RUNNING_KEY, Keys.BEST_5K), (Keys.TYPE_CYCLING_KEY, Keys.BEST_20_MIN_POWER) ]:
+        queries.append((activity_type, record_name, None, None, 5))
+        queries.append((activity_type, record_name, end_time - 90 * DAY_SECS, None, 3))
+        queries.append((activity_type, record_name, START_TIME + 10 * DAY_SECS, START_TIME + 40 * DAY_SECS, 10))
+        queries.append((activity_type, record_name, None, START_TIME, 5)) # Nothing before the first activity
+    queries.append((Keys.TYPE_RUNNING_KEY, Keys.BEST_20_MIN_POWER, None, None, 5)) # Nobody runs with a power meter
+    return queries
+
+def test_data_mgr():
+    """Top records through the data manager, which decides whether lower is better, and the progression built from the record history."""
+    database = MemoryDatabase.MemoryDatabase()
+    data_mgr = DataMgr.DataMgr(config=Config.Config(), root_url="file://" + parentdir, analysis_scheduler=None, import_scheduler=None, database=database)
+    user_id = database.create_user("user@example.com", "User", "not a real hash")
+    activities_bests = generate_bests(200, 1)
+    database.create_activity_bests_in_bulk(user_id, [ (activity_id, activity_type, start_time, dict(bests)) for activity_id, activity_type, start_time, bests in activities_bests ])
+
+    for activity_type, record_name, cutoff_time_lower, cutoff_time_higher, limit in top_record_queries(activities_bests):
+        expected = brute_force_top_records(activities_bests, activity_type, record_name, cutoff_time_lower, cutoff_time_higher, limit)
+        assert data_mgr.retrieve_top_records_for_user(user_id, activity_type, record_name, cutoff_time_lower, cutoff_time_higher, limit) == expected
+
+    # The progression only includes activities that improved on the best so far.
+    user_activities = [ { Keys.ACTIVITY_ID_KEY: activity_id } for activity_id, _, _, _ in activities_bests ]
+    progression = data_mgr.compute_progression(user_id, user_activities, Keys.TYPE_RUNNING_KEY, Keys.BEST_5K)
+    expected = []
+    for activity_id, _, value in brute_force_history(activities_bests, Keys.TYPE_RUNNING_KEY, Keys.BEST_5K):
+        if not expected or value < expected[-1][0]:
+            expected.append([ value, activity_id ])
+    assert progression == expected
+
+def connect(config_file_name):
+    """Connects to the database from the configuration file."""
+    import AppDatabase
+
+    config = Config.Config()
+    config.load(config_file_name)
+    db = AppDatabase.MongoDatabase()
+    db.connect(config)
+    return db
+
+def delete_user_bests(db, user_id):
+    """Removes everything the test wrote."""
+    db.activity_bests_collection.delete_many({ Keys.USER_ID_KEY: user_id })
+    db.records_collection.delete_many({ Keys.USER_ID_KEY: user_id })
+
+def test_database_queries(db):
+    """The record history and top records queries, against the same brute force search."""
+    from bson.objectid import ObjectId
+
+    user_id = str(ObjectId())
+    activities_bests = generate_bests(200, 2)
+    try:
+        assert db.create_activity_bests_in_bulk(user_id, [ (activity_id, activity_type, start_time, dict(bests)) for activity_id, activity_type, start_time, bests in activities_bests ])
+        for activity_type, record_name in [ (Keys.TYPE_RUNNING_KEY, Keys.BEST_5K), (Keys.TYPE_CYCLING_KEY, Keys.BEST_20_MIN_POWER) ]:
+            assert db.retrieve_record_history_for_user(user_id, activity_type, record_name) == brute_force_history(activities_bests, activity_type, record_name)
+        for activity_type, record_name, cutoff_time_lower, cutoff_time_higher, limit in top_record_queries(activities_bests):
+            expected = brute_force_top_records(activities_bests, activity_type, record_name, cutoff_time_lower, cutoff_time_higher, limit)
+            lower_is_better = record_name in Keys.TIME_KEYS
+            assert db.retrieve_top_records_for_user(user_id, activity_type, record_name, cutoff_time_lower, cutoff_time_higher, lower_is_better, limit) == expected
+
+        # Replacing an activity's bests replaces its documents rather than adding to them.
+        activity_id, activity_type, start_time, bests = activities_bests[0]
+        assert db.create_activity_bests(user_id, activity_id, activity_type, start_time, { Keys.BEST_5K: 1000.0 })
+        assert db.retrieve_top_records_for_user(user_id, activity_type, Keys.BEST_5K, None, None, True, 2)[0] == (activity_id, start_time, 1000.0)
+        assert len(db.retrieve_record_history_for_user(user_id, activity_type, Keys.BEST_5K)) == len(brute_force_history(activities_bests, activity_type, Keys.BEST_5K))
+    finally:
+        delete_user_bests(db, user_id)
+
+def test_database_migration(db):
+    """Bests stored in the old format, in the user's records document keyed by activity ID, are moved to one document per record."""
+    """The personal records in the same document are left alone, and running the migration again doesn't duplicate anything."""
+    from bson.objectid import ObjectId
+
+    user_id = str(ObjectId())
+    activities_bests = generate_bests(20, 3)
+    deleted_activity_id = str(uuid.uuid4())
+    personal_records = { Keys.BEST_5K: 1100.0 }
+    old_records = { Keys.USER_ID_KEY: user_id, Keys.TYPE_RUNNING_KEY: personal_records, deleted_activity_id: {} }
+    for activity_id, activity_type, start_time, bests in activities_bests:
+        old_bests = dict(bests)
+        old_bests[Keys.ACTIVITY_TYPE_KEY] = activity_type
+        old_bests[Keys.ACTIVITY_START_TIME_KEY] = start_time
+        old_records[activity_id] = old_bests
+    try:
+        db.records_collection.insert_one(old_records)
+        assert db.migrate_activity_bests() >= len(activities_bests)
+
+        migrated_records = db.records_collection.find_one({ Keys.USER_ID_KEY: user_id })
+        assert migrated_records[Keys.TYPE_RUNNING_KEY] == personal_records
+        for activity_id, _, _, _ in activities_bests:
+            assert activity_id not in migrated_records
+        assert deleted_activity_id not in migrated_records
+
+        # One document for each record, plus the type and start time that mark the activity as analyzed.
+        num_documents = db.activity_bests_collection.count_documents({ Keys.USER_ID_KEY: user_id })
+        assert num_documents == 3 * len(activities_bests)
+        all_bests = db.retrieve_activity_bests_for_user(user_id)
+        for activity_id, activity_type, start_time, bests in activities_bests:
+            for record_name in bests:
+                assert all_bests[activity_id][record_name] == bests[record_name]
+            assert all_bests[activity_id][Keys.ACTIVITY_START_TIME_KEY] == start_time
+
+        db.migrate_activity_bests()
+        assert db.activity_bests_collection.count_documents({ Keys.USER_ID_KEY: user_id }) == num_documents
+    finally:
+        delete_user_bests(db, user_id)
+
+def run_unit_tests(config_file_name=None):
+    """Entry point for the unit tests."""
+    test_data_mgr()
+    if config_file_name:
+        db = connect(config_file_name)
+        test_database_queries(db)
+        test_database_migration(db)
+    return True
+
+def run_benchmark(config_file_name, num_activities):
+    """Compares finding a user's best 5K times with the top records query and with reading all of their bests, as the records pages used to."""
+    from bson.objectid import ObjectId
+
+    db = connect(config_file_name)
+    user_id = str(ObjectId())
+    activities_bests = generate_bests(num_activities, 4)
+    try:
+        db.create_activity_bests_in_bulk(user_id, activities_bests)
+
+        start = time.time()
+        db.retrieve_top_records_for_user(user_id, Keys.TYPE_RUNNING_KEY, Keys.BEST_5K, None, None, True, 5)
+        print("Top 5 of {} activities, query: {:.4f} seconds".format(num_activities, time.time() - start))
+
+        start = time.time()
+        all_bests = db.retrieve_activity_bests_for_user(user_id)
+        sorted([ bests[Keys.BEST_5K] for bests in all_bests.values() if Keys.BEST_5K in bests ])[:5]
+        print("Top 5 of {} activities, all bests: {:.4f} seconds".format(num_activities, time.time() - start))
+    finally:
+        delete_user_bests(db, user_id)
+
+def main():
+    # Parse command line options.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Compares the top records query with reading all of the bests, requires --config", required=False)
+    parser.add_argument("--config", default="", help="Also tests the queries and the migration against the database from the specified configuration file", required=False)
+
+    try:
+        args = parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    if args.benchmark:
+        if not args.config:
+            parser.error("--benchmark requires --config")
+        run_benchmark(args.config, 10000)
+    else:
+        run_unit_tests(args.config)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2022 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Checks that location and sensor data written to the activity's time buckets is read back complete and in order, and that deleting or trimming an activity removes every bucket."""
+"""Also checks that the live feed's cursor picks up values that arrive late, in buckets it has already read from."""
+
+import argparse
+import inspect
+import os
+import random
+import sys
+import uuid
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import AppDatabase
+import Config
+import DataMgr
+import Keys
+
+START_TIME_MS = 1600000000000
+POINT_INTERVAL_MS = 1000
+NUM_BUCKETS = 4 # The track covers this many buckets
+CHUNK_SIZE = 30 # Points in each update, as a phone would send them
+
+def generate_track():
+    """Returns locations and heart rate readings, one per second, covering several buckets. Locations are [time, lat, lon, alt, horizontal accuracy, vertical accuracy]."""
+    num_points = int(NUM_BUCKETS * AppDatabase.ACTIVITY_BUCKET_DURATION_MS / POINT_INTERVAL_MS)
+    locations = []
+    heart_rates = []
+    for i in range(num_points):
+        time_ms = START_TIME_MS + i * POINT_INTERVAL_MS
+        locations.append([ time_ms, 39.0 + i * 0.00001, -77.0 + i * 0.00001, 100.0 + (i % 50), 3.0, 5.0 ])
+        heart_rates.append([ time_ms, float(120 + (i % 40)) ])
+    return locations, heart_rates
+
+def out_of_order_chunks(locations, heart_rates, seed):
+    """Splits the track into the updates a phone would send, in a shuffled order and with each chunk reversed, so values arrive out of order both"""
+    """across buckets and within them. The first chunk still arrives first, and in order, since it sets the activity's start time."""
+    chunks = []
+    for i in range(CHUNK_SIZE, len(locations), CHUNK_SIZE):
+        chunks.append((list(reversed(locations[i:i + CHUNK_SIZE])), list(reversed(heart_rates[i:i + CHUNK_SIZE]))))
+    random.Random(seed).shuffle(chunks)
+    return [ (locations[:CHUNK_SIZE], heart_rates[:CHUNK_SIZE]) ] + chunks
+
+def test_bucket_start_time():
+    """Every timestamp belongs to the bucket that starts at or before it, and no more than a bucket's length before it."""
+    assert AppDatabase.retrieve_bucket_start_time(0) == 0
+    for time_ms in [ START_TIME_MS, START_TIME_MS + 1, START_TIME_MS + AppDatabase.ACTIVITY_BUCKET_DURATION_MS - 1, START_TIME_MS + AppDatabase.ACTIVITY_BUCKET_DURATION_MS ]:
+        bucket_start = AppDatabase.retrieve_bucket_start_time(time_ms)
+        assert bucket_start % AppDatabase.ACTIVITY_BUCKET_DURATION_MS == 0
+        assert bucket_start <= time_ms < bucket_start + AppDatabase.ACTIVITY_BUCKET_DURATION_MS
+
+def connect(config_file_name):
+    """Connects to the database from the configuration file."""
+    config = Config.Config()
+    config.load(config_file_name)
+    db = AppDatabase.MongoDatabase()
+    db.connect(config)
+    return config, db
+
+def write_track(db, device_str, activity_id, locations, heart_rates):
+    """Writes the track the way the live tracking API does."""
+    for location_chunk, heart_rate_chunk in out_of_order_chunks(locations, heart_rates, 5):
+        assert db.update_activity(device_str, activity_id, location_chunk, { Keys.APP_HEART_RATE_KEY: heart_rate_chunk }, None)
+
+def count_buckets(db, activity_id, stream_name):
+    return db.activity_buckets_collection.count_documents({ Keys.ACTIVITY_ID_KEY: activity_id, Keys.ACTIVITY_BUCKET_STREAM_KEY: stream_name })
+
+def count_all_buckets(db, activity_id):
+    return db.activity_buckets_collection.count_documents({ Keys.ACTIVITY_ID_KEY: activity_id })
+
+def test_reassembly(db):
+    """The reassembled track is complete and in time order, no matter what order it was written in."""
+    device_str = str(uuid.uuid4())
+    activity_id = str(uuid.uuid4())
+    locations, heart_rates = generate_track()
+    try:
+        write_track(db, device_str, activity_id, locations, heart_rates)
+        assert count_buckets(db, activity_id, Keys.ACTIVITY_LOCATIONS_KEY) == NUM_BUCKETS
+        assert count_buckets(db, activity_id, Keys.APP_HEART_RATE_KEY) == NUM_BUCKETS
+
+        activity = db.retrieve_activity(activity_id)
+        assert [ location[Keys.LOCATION_TIME_KEY] for location in activity[Keys.ACTIVITY_LOCATIONS_KEY] ] == [ location[0] for location in locations ]
+        assert [ location[Keys.LOCATION_LAT_KEY] for location in activity[Keys.ACTIVITY_LOCATIONS_KEY] ] == [ location[1] for location in locations ]
+        assert activity[Keys.APP_HEART_RATE_KEY] == [ { str(time_ms): value } for time_ms, value in heart_rates ]
+
+        # Reading a single stream, as the live feed does on its first request.
+        values, _ = db.retrieve_activity_stream_since(activity_id, Keys.ACTIVITY_LOCATIONS_KEY, None)
+        assert [ value[Keys.LOCATION_TIME_KEY] for value in values ] == [ location[0] for location in locations ]
+    finally:
+        db.delete_activity(activity_id)
+
+def test_live_cursor(db):
+    """Reading after every update, as a spectator would, returns each value exactly once even though the updates land in earlier buckets than ones already read."""
+    device_str = str(uuid.uuid4())
+    activity_id = str(uuid.uuid4())
+    locations, heart_rates = generate_track()
+    try:
+        read_times = []
+        cursor = None
+        for location_chunk, heart_rate_chunk in out_of_order_chunks(locations, heart_rates, 7):
+            assert db.update_activity(device_str, activity_id, location_chunk, { Keys.APP_HEART_RATE_KEY: heart_rate_chunk }, None)
+            values, cursor = db.retrieve_activity_stream_since(activity_id, Keys.ACTIVITY_LOCATIONS_KEY, cursor)
+            new_times = [ value[Keys.LOCATION_TIME_KEY] for value in values ]
+            assert sorted(new_times) == sorted(location[0] for location in location_chunk)
+            read_times.extend(new_times)
+        assert sorted(read_times) == [ location[0] for location in locations ]
+
+        # Nothing new, and the end cursor is where the reads left off.
+        values, same_cursor = db.retrieve_activity_stream_since(activity_id, Keys.ACTIVITY_LOCATIONS_KEY, cursor)
+        assert values == [] and same_cursor == cursor
+        assert db.retrieve_activity_stream_end_cursor(activity_id, Keys.ACTIVITY_LOCATIONS_KEY) == cursor
+
+        # A single late point, in the first bucket, after the last bucket has been read.
+        late_time_ms = START_TIME_MS + POINT_INTERVAL_MS // 2
+        assert db.update_activity(device_str, activity_id, [ [ late_time_ms, 39.0, -77.0, 100.0, 3.0, 5.0 ] ], None, None)
+        values, _ = db.retrieve_activity_stream_since(activity_id, Keys.ACTIVITY_LOCATIONS_KEY, cursor)
+        assert [ value[Keys.LOCATION_TIME_KEY] for value in values ] == [ late_time_ms ]
+    finally:
+        db.delete_activity(activity_id)
+
+def test_delete(db):
+    """Deleting the activity deletes every one of its buckets, for every stream."""
+    device_str = str(uuid.uuid4())
+    activity_id = str(uuid.uuid4())
+    locations, heart_rates = generate_track()
+    write_track(db, device_str, activity_id, locations, heart_rates)
+    assert count_all_buckets(db, activity_id) == 2 * NUM_BUCKETS
+    assert db.delete_activity(activity_id)
+    assert count_all_buckets(db, activity_id) == 0
+    assert db.retrieve_activity(activity_id) is None
+
+def test_trim(config, db):
+    """Trimming the activity rewrites it without any buckets, and nothing from the trimmed part comes back."""
+    device_str = str(uuid.uuid4())
+    activity_id = str(uuid.uuid4())
+    locations, heart_rates = generate_track()
+    data_mgr = DataMgr.DataMgr(config=config, root_url="file://" + parentdir, analysis_scheduler=None, import_scheduler=None, database=db)
+    trim_secs = int(AppDatabase.ACTIVITY_BUCKET_DURATION_MS * 1.5 / 1000) # Ends part way through a bucket
+    trim_before_ms = START_TIME_MS + trim_secs * 1000
+    try:
+        write_track(db, device_str, activity_id, locations, heart_rates)
+        assert data_mgr.trim_activity(db.retrieve_activity(activity_id), Keys.TRIM_FROM_BEGINNING_VALUE, trim_secs)
+        assert count_all_buckets(db, activity_id) == 0
+
+        activity = db.retrieve_activity(activity_id)
+        expected_times = [ location[0] for location in locations if location[0] >= trim_before_ms ]
+        assert [ location[Keys.LOCATION_TIME_KEY] for location in activity[Keys.ACTIVITY_LOCATIONS_KEY] ] == expected_times
+        heart_rate_times = [ float(list(reading.keys())[0]) for reading in activity[Keys.APP_HEART_RATE_KEY] ]
+        assert len(heart_rate_times) > 0
+        assert heart_rate_times == sorted(heart_rate_times)
+        assert heart_rate_times[0] >= trim_before_ms
+
+        # Anything written after the trim goes back into buckets, and is read along with the trimmed data.
+        new_time_ms = locations[-1][0] + POINT_INTERVAL_MS
+        assert db.update_activity(device_str, activity_id, [ [ new_time_ms, 39.5, -77.5, 100.0, 3.0, 5.0 ] ], None, None)
+        activity = db.retrieve_activity(activity_id)
+        assert [ location[Keys.LOCATION_TIME_KEY] for location in activity[Keys.ACTIVITY_LOCATIONS_KEY] ] == expected_times + [ new_time_ms ]
+    finally:
+        db.delete_activity(activity_id)
+
+def run_unit_tests(config_file_name=None):
+    """Entry point for the unit tests."""
+    test_bucket_start_time()
+    if config_file_name:
+        config, db = connect(config_file_name)
+        test_reassembly(db)
+        test_live_cursor(db)
+        test_delete(db)
+        test_trim(config, db)
+    return True
+
+def main():
+    # Parse command line options.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="", help="Tests the bucketed storage in the database from the specified configuration file", required=False)
+
+    try:
+        args = parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    run_unit_tests(args.config)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2017 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Checks that paging through a user's activity list returns every activity once, in order, and that friends' private activities stay private."""
+
+import argparse
+import inspect
+import os
+import random
+import sys
+import time
+import uuid
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+sys.path.insert(0, os.path.join(parentdir, "bench"))
+import Api
+import Config
+import DataMgr
+import Keys
+import MemoryDatabase
+
+START_TIME = 1600000000
+
+class Environment(object):
+    """A data manager backed by an in-memory database, with a user, a friend, and a stranger, each with a device."""
+
+    def __init__(self):
+        self.database = MemoryDatabase.MemoryDatabase()
+        self.data_mgr = DataMgr.DataMgr(config=Config.Config(), root_url="file://" + parentdir, analysis_scheduler=None, import_scheduler=None, database=self.database)
+        self.user_id = self.create_user("user@example.com", "User")
+        self.friend_id = self.create_user("friend@example.com", "Friend")
+        self.stranger_id = self.create_user("stranger@example.com", "Stranger")
+        self.database.create_friend(self.user_id, self.friend_id)
+
+    def create_user(self, username, realname):
+        """Creates a user with one device."""
+        user_id = self.database.create_user(username, realname, "not a real hash")
+        self.database.create_user_device(user_id, str(uuid.uuid4()))
+        return user_id
+
+    def add_activity(self, user_id, start_time, visibility=Keys.ACTIVITY_VISIBILITY_PUBLIC, on_device=False):
+        """Stores an activity, either recorded on the user's device or entered by hand. Returns the activity ID."""
+        activity_id = str(uuid.uuid4())
+        activity = { Keys.ACTIVITY_ID_KEY: activity_id, Keys.ACTIVITY_START_TIME_KEY: start_time, Keys.ACTIVITY_TYPE_KEY: Keys.TYPE_RUNNING_KEY, \
+            Keys.ACTIVITY_NAME_KEY: "Run", Keys.ACTIVITY_VISIBILITY_KEY: visibility, Keys.APP_LOCATIONS_KEY: [] }
+        if on_device:
+            activity[Keys.ACTIVITY_DEVICE_STR_KEY] = self.database.retrieve_user_devices(user_id)[0]
+        else:
+            activity[Keys.ACTIVITY_USER_ID_KEY] = user_id
+        self.database.create_complete_activity(activity)
+        return activity_id
+
+    def page_through(self, include_friends, page_size):
+        """Reads the whole list one page at a time, passing each page's cursor string back in, as an API client would."""
+        activities = []
+        before = None
+        while True:
+            page = self.data_mgr.retrieve_activity_list_page(self.user_id, "User", include_friends, None, None, before, page_size)
+            activities.extend(page)
+            if len(page) < page_size:
+                return activities
+            before = Api.parse_page_cursor(Api.format_page_cursor(page[-1]))
+            assert before is not None
+
+def list_order(activity):
+    """The order the list is expected to be in."""
+    return (activity[Keys.ACTIVITY_START_TIME_KEY], activity[Keys.ACTIVITY_ID_KEY])
+
+def test_paging():
+    """Pages of any size should add up to the whole list, most recent first, even when several activities share a start time."""
+    env = Environment()
+    rand = random.Random(1)
+    expected_ids = set()
+    for i in range(100):
+        start_time = START_TIME + rand.randint(0, 20) * 60 # Lots of ties
+        expected_ids.add(env.add_activity(env.user_id, start_time, on_device=(i % 2 == 0)))
+
+    full_list = env.data_mgr.retrieve_user_activity_list(env.user_id, "User", None, None, None)
+    assert set([ activity[Keys.ACTIVITY_ID_KEY] for activity in full_list ]) == expected_ids
+    for page_size in [ 1, 7, 50, 100, 1000 ]:
+        activities = env.page_through(False, page_size)
+        assert [ activity[Keys.ACTIVITY_ID_KEY] for activity in activities ] == [ activity[Keys.ACTIVITY_ID_KEY] for activity in full_list ]
+        assert activities == sorted(activities, key=list_order, reverse=True)
+        for activity in activities:
+            assert activity[Keys.REALNAME_KEY] == "User"
+            assert set(activity.keys()) <= set(DataMgr.LIST_ACTIVITY_KEYS + [ Keys.REALNAME_KEY ])
+
+def test_friends():
+    """Friends' public activities are listed with the friend's name, their private activities and strangers' activities are not."""
+    env = Environment()
+    own_id = env.add_activity(env.user_id, START_TIME + 1, Keys.ACTIVITY_VISIBILITY_PRIVATE)
+    public_id = env.add_activity(env.friend_id, START_TIME + 2, on_device=True)
+    env.add_activity(env.friend_id, START_TIME + 3, Keys.ACTIVITY_VISIBILITY_PRIVATE)
+    env.add_activity(env.friend_id, START_TIME + 4, Keys.ACTIVITY_VISIBILITY_PRIVATE, on_device=True)
+    env.add_activity(env.stranger_id, START_TIME + 5)
+
+    activities = env.page_through(True, 1)
+    assert [ activity[Keys.ACTIVITY_ID_KEY] for activity in activities ] == [ public_id, own_id ]
+    assert [ activity[Keys.REALNAME_KEY] for activity in activities ] == [ "Friend", "User" ]
+    assert [ activity[Keys.ACTIVITY_ID_KEY] for activity in env.page_through(False, 10) ] == [ own_id ]
+
+    visible = env.data_mgr.retrieve_all_activities_visible_to_user(env.user_id, "User", None, None, None)
+    assert [ activity[Keys.ACTIVITY_ID_KEY] for activity in visible ] == [ public_id, own_id ]
+
+def test_cursors():
+    """Cursors survive the round trip to the client, and anything else is rejected."""
+    activity_id = str(uuid.uuid4())
+    for start_time in [ START_TIME, START_TIME + 0.5 ]:
+        cursor = Api.format_page_cursor({ Keys.ACTIVITY_ID_KEY: activity_id, Keys.ACTIVITY_START_TIME_KEY: start_time })
+        assert Api.parse_page_cursor(cursor) == (start_time, activity_id)
+    assert Api.parse_page_cursor(Api.format_page_cursor({ Keys.ACTIVITY_ID_KEY: activity_id })) == (None, activity_id)
+    for cursor in [ "", ":", "123", "123:", "123:not an id", "abc:" + activity_id, "1:2:" + activity_id ]:
+        assert Api.parse_page_cursor(cursor) is None
+
+def run_unit_tests():
+    """Entry point for the unit tests."""
+    test_paging()
+    test_friends()
+    test_cursors()
+    return True
+
+def run_benchmark(num_activities, page_size):
+    """Compares reading the first page of a long list with reading the whole list, as the activity list pages used to."""
+    env = Environment()
+    for i in range(num_activities):
+        env.add_activity(env.user_id, START_TIME + i * 3600, on_device=(i % 2 == 0))
+        env.add_activity(env.friend_id, START_TIME + i * 3600 + 60)
+
+    start_time = time.perf_counter()
+    env.data_mgr.retrieve_all_activities_visible_to_user(env.user_id, "User", None, None, None)
+    print("Whole list of {} activities: {:.3f} seconds".format(2 * num_activities, time.perf_counter() - start_time))
+
+    start_time = time.perf_counter()
+    env.data_mgr.retrieve_activity_list_page(env.user_id, "User", True, None, None, None, page_size)
+    print("First page of {} activities: {:.3f} seconds".format(page_size, time.perf_counter() - start_time))
+
+def main():
+    # Parse command line options.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Compares reading one page of the activity list with reading the whole list", required=False)
+
+    try:
+        args = parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    if args.benchmark:
+        run_benchmark(20000, 50)
+    else:
+        run_unit_tests()
+
+if __name__ == "__main__":
+    main()
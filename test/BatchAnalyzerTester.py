@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2022 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Checks that batch analysis jobs resume from their checkpoint, that only one worker runs a job, and that a worker whose lease was taken over stops."""
+
+import argparse
+import contextlib
+import inspect
+import os
+import sys
+import uuid
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+sys.path.insert(0, os.path.join(parentdir, "bench"))
+import ActivityAnalyzer
+import Config
+import DataMgr
+import Generators
+import Keys
+import MemoryDatabase
+import SessionMgr
+import UserMgr
+
+ACTIVITY_DURATION_SECS = 120
+OTHER_WORKER = "other worker"
+
+class TakeoverDataMgr(DataMgr.DataMgr):
+    """Lets another worker take over the job, as if this one had stalled past its lease, while the first batch is being read."""
+
+    def __init__(self, *, config, root_url, analysis_scheduler, import_scheduler, database):
+        DataMgr.DataMgr.__init__(self, config=config, root_url=root_url, analysis_scheduler=analysis_scheduler, import_scheduler=import_scheduler, database=database)
+        self.job_name = None
+
+    def retrieve_activities_for_batch_analysis(self, user_id, only_unanalyzed, checkpoint, limit):
+        activities = DataMgr.DataMgr.retrieve_activities_for_batch_analysis(self, user_id, only_unanalyzed, checkpoint, limit)
+        if self.job_name is not None:
+            self.database.batch_jobs[self.job_name][Keys.BATCH_JOB_LEASE_EXPIRY_KEY] = 0
+            self.database.acquire_batch_job(self.job_name, OTHER_WORKER, ActivityAnalyzer.BATCH_LEASE_SECS)
+            self.job_name = None
+        return activities
+
+class RecordingBatchAnalyzer(ActivityAnalyzer.BatchAnalyzer):
+    """Keeps the progress reports, which otherwise only go to the deferred task."""
+
+    def __init__(self, user_id, batch_size, data_mgr, user_mgr):
+        ActivityAnalyzer.BatchAnalyzer.__init__(self, user_id, False, None, Keys.ANALYSIS_ENGINE_ITERATIVE, batch_size, 2, data_mgr, user_mgr)
+        self.reports = []
+
+    def report_progress(self, status, num_processed, num_failed):
+        self.reports.append((status, num_processed, num_failed))
+
+def create_environment(num_activities, data_mgr_class=DataMgr.DataMgr):
+    """Returns a data manager and user manager backed by a fresh in-memory database, and the IDs of the user's activities, in the order they were created."""
+    config = Config.Config()
+    database = MemoryDatabase.MemoryDatabase()
+    data_mgr = data_mgr_class(config=config, root_url="file://" + parentdir, analysis_scheduler=None, import_scheduler=None, database=database)
+    user_mgr = UserMgr.UserMgr(config=config, session_mgr=SessionMgr.SessionMgr(), database=database)
+    user_id = database.create_user("test@example.com", "Test User", "not a real hash")
+    device_str = str(uuid.uuid4())
+    database.create_user_device(user_id, device_str)
+
+    activity_ids = []
+    for i in range(num_activities):
+        activity_id = str(uuid.uuid4())
+        synthetic = Generators.generate(Keys.TYPE_RUNNING_KEY, ACTIVITY_DURATION_SECS, i + 1)
+        database.create_complete_activity(Generators.to_activity_document(synthetic, activity_id, user_id, device_str))
+        activity_ids.append(MemoryDatabase.normalize_activity_id(activity_id))
+    return data_mgr, user_mgr, database, user_id, activity_ids
+
+def run_analyzer(analyzer):
+    """The analyzer reports its progress on stdout."""
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return analyzer.run()
+
+def analyzed(database, activity_ids):
+    """Returns which of the activities have a summary."""
+    return [ database.retrieve_activity_summary(activity_id) is not None for activity_id in activity_ids ]
+
+def test_resume_from_checkpoint():
+    """A job left behind by a worker that died is picked up from its checkpoint once the lease expires."""
+    data_mgr, user_mgr, database, user_id, activity_ids = create_environment(6)
+    analyzer = RecordingBatchAnalyzer(user_id, 2, data_mgr, user_mgr)
+    job_name = analyzer.job_name()
+
+    database.acquire_batch_job(job_name, OTHER_WORKER, ActivityAnalyzer.BATCH_LEASE_SECS)
+    database.update_batch_job(job_name, OTHER_WORKER, activity_ids[2], 3, 1, [], ActivityAnalyzer.BATCH_LEASE_SECS)
+    database.batch_jobs[job_name][Keys.BATCH_JOB_LEASE_EXPIRY_KEY] = 0
+
+    if not run_analyzer(analyzer):
+        print("The resumed job failed.")
+        return False
+    if analyzed(database, activity_ids) != [ False, False, False, True, True, True ]:
+        print("Expected only the activities after the checkpoint to be analyzed: " + str(analyzed(database, activity_ids)))
+        return False
+    if analyzer.reports[-1] != (Keys.TASK_STATUS_FINISHED, 6, 1):
+        print("Unexpected final progress: " + str(analyzer.reports[-1]))
+        return False
+    if job_name in database.batch_jobs:
+        print("The finished job was not removed.")
+        return False
+    return True
+
+def test_duplicate_job():
+    """A second worker exits without doing anything while the first one holds the lease."""
+    data_mgr, user_mgr, database, user_id, activity_ids = create_environment(2)
+    analyzer = RecordingBatchAnalyzer(user_id, 2, data_mgr, user_mgr)
+    job_name = analyzer.job_name()
+    database.acquire_batch_job(job_name, OTHER_WORKER, ActivityAnalyzer.BATCH_LEASE_SECS)
+
+    if not run_analyzer(analyzer):
+        print("The duplicate job reported a failure.")
+        return False
+    if any(analyzed(database, activity_ids)):
+        print("The duplicate job analyzed activities.")
+        return False
+    job = database.batch_jobs.get(job_name)
+    if job is None or job[Keys.BATCH_JOB_OWNER_KEY] != OTHER_WORKER or job[Keys.BATCH_JOB_CHECKPOINT_KEY] is not None:
+        print("The duplicate job changed the running job: " + str(job))
+        return False
+    return True
+
+def test_lease_takeover():
+    """A worker whose lease was taken over stops at its next checkpoint, without changing or removing the job."""
+    data_mgr, user_mgr, database, user_id, activity_ids = create_environment(4, TakeoverDataMgr)
+    analyzer = RecordingBatchAnalyzer(user_id, 2, data_mgr, user_mgr)
+    job_name = analyzer.job_name()
+    data_mgr.job_name = job_name
+
+    if run_analyzer(analyzer):
+        print("The worker that lost its lease reported success.")
+        return False
+    if analyzed(database, activity_ids) != [ True, True, False, False ]:
+        print("Expected the worker to stop after its first batch: " + str(analyzed(database, activity_ids)))
+        return False
+    job = database.batch_jobs.get(job_name)
+    if job is None or job[Keys.BATCH_JOB_OWNER_KEY] != OTHER_WORKER or job[Keys.BATCH_JOB_CHECKPOINT_KEY] is not None:
+        print("The worker that lost its lease changed the job: " + str(job))
+        return False
+    return True
+
+def test_failed_activities():
+    """Activities that can't be analyzed are counted, and the rest of the job carries on."""
+    data_mgr, user_mgr, database, _, activity_ids = create_environment(3)
+    synthetic = Generators.generate(Keys.TYPE_RUNNING_KEY, ACTIVITY_DURATION_SECS, 10)
+    orphan_activity = Generators.to_activity_document(synthetic, str(uuid.uuid4()), None, str(uuid.uuid4()))
+    del orphan_activity[Keys.ACTIVITY_USER_ID_KEY]
+    database.create_complete_activity(orphan_activity)
+
+    analyzer = RecordingBatchAnalyzer(None, 2, data_mgr, user_mgr)
+    if not run_analyzer(analyzer):
+        print("The job failed.")
+        return False
+    if not all(analyzed(database, activity_ids)):
+        print("The activities that could be analyzed weren't.")
+        return False
+    if analyzer.reports[-1] != (Keys.TASK_STATUS_FINISHED, 4, 1):
+        print("Unexpected final progress: " + str(analyzer.reports[-1]))
+        return False
+    return True
+
+def test_downsampled_sensors():
+    """Every sensor that's charted from downsampled readings is read for the analysis, so its downsampled readings are stored."""
+    data_mgr, user_mgr, database, user_id, activity_ids = create_environment(1)
+    activity = database.find_activity(activity_ids[0])
+    times = [ location[Keys.LOCATION_TIME_KEY] for location in activity[Keys.ACTIVITY_LOCATIONS_KEY] ]
+    sensor_names = [ Keys.APP_TEMP_KEY, Keys.APP_THREAT_COUNT_KEY, Keys.APP_BATTERY_LEVEL_KEY ]
+    for sensor_name in sensor_names:
+        activity[sensor_name] = [ { str(time_ms): 20.0 } for time_ms in times ]
+
+    analyzer = RecordingBatchAnalyzer(user_id, 2, data_mgr, user_mgr)
+    if not run_analyzer(analyzer):
+        print("The job failed.")
+        return False
+    downsampled = database.retrieve_activity_simplified_data(activity_ids[0], Keys.ACTIVITY_DOWNSAMPLED_SENSORS_KEY, sensor_names)
+    if downsampled is None or sorted(downsampled.keys()) != sorted(sensor_names):
+        print("Expected downsampled readings for " + str(sensor_names) + ", found " + str(downsampled))
+        return False
+    return True
+
+def run_unit_tests():
+    """Entry point for the unit tests."""
+    print("Testing batch analysis jobs...")
+
+    success = True
+    for test_func in [ test_resume_from_checkpoint, test_duplicate_job, test_lease_takeover, test_failed_activities, test_downsampled_sensors ]:
+        if test_func():
+            print(test_func.__name__ + ": passed")
+        else:
+            print(test_func.__name__ + ": failed")
+            success = False
+    return success
+
+def main():
+    # Parse command line options.
+    parser = argparse.ArgumentParser()
+
+    try:
+        parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    if not run_unit_tests():
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2022 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Checks that uploaded files survive the trip through compression and each blob store, that identical uploads are only stored once, and measures how well and how quickly they're compressed."""
+
+import argparse
+import inspect
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import BlobStore
+import Keys
+
+def available_compressions():
+    """Returns the compressions that can be tested, zstd is only available if the zstandard module is installed."""
+    compressions = [ Keys.BLOB_COMPRESSION_NONE, Keys.BLOB_COMPRESSION_GZIP ]
+    if BlobStore.zstandard is not None:
+        compressions.append(Keys.BLOB_COMPRESSION_ZSTD)
+    return compressions
+
+def make_gpx(num_points, seed):
+    """Returns the contents of a GPX file, which is what most uploads look like."""
+    rng = random.Random(seed)
+    lines = [ '<?xml version="1.0" encoding="UTF-8"?>', '<gpx version="1.1" creator="BlobStoreTester">', '<trk><trkseg>' ]
+    lat = 37.0
+    lon = -122.0
+    for i in range(num_points):
+        lat = lat + rng.uniform(-0.0001, 0.0001)
+        lon = lon + rng.uniform(-0.0001, 0.0001)
+        lines.append('<trkpt lat="%.7f" lon="%.7f"><ele>%.1f</ele><time>2021-01-01T%02d:%02d:%02dZ</time></trkpt>' % (lat, lon, 100.0 + rng.uniform(-1.0, 1.0), (i // 3600) % 24, (i // 60) % 60, i % 60))
+    lines.append('</trkseg></trk></gpx>')
+    return "\n".join(lines).encode("utf-8")
+
+def read_blob(store, name, compression, chunk_size):
+    """Reads a blob back a piece at a time, the way the import worker does."""
+    pieces = []
+    with BlobStore.open_decompressed(store.open(name), compression) as stream:
+        while True:
+            piece = stream.read(chunk_size)
+            if not piece:
+                break
+            pieces.append(piece)
+    return b"".join(pieces)
+
+def test_round_trip(store):
+    """Contents read back should be the same as what was written, for every compression, including empty and multi-chunk contents."""
+    contents = [ b"", b"x", make_gpx(100, 1), os.urandom(BlobStore.CHUNK_SIZE * 2 + 17) ]
+    for compression in available_compressions():
+        for data in contents:
+            name = BlobStore.create_blob_name(BlobStore.compute_digest(data))
+            stored_size = store.write(name, BlobStore.compress_chunks(data, compression))
+            assert stored_size >= 0
+            assert read_blob(store, name, compression, 4096) == data, compression
+            store.delete(name)
+            assert store.open(name) is None
+            store.delete(name) # Deleting something that isn't there is not an error
+
+def test_compression():
+    """Text compresses well, and asking for zstd without the module falls back to gzip."""
+    data = make_gpx(1000, 2)
+    compressed = b"".join(BlobStore.compress_chunks(data, Keys.BLOB_COMPRESSION_GZIP))
+    assert len(compressed) < len(data) / 3
+    if BlobStore.zstandard is None:
+        assert BlobStore.select_compression(Keys.BLOB_COMPRESSION_ZSTD) == Keys.BLOB_COMPRESSION_GZIP
+    else:
+        assert BlobStore.select_compression(Keys.BLOB_COMPRESSION_ZSTD) == Keys.BLOB_COMPRESSION_ZSTD
+    try:
+        BlobStore.select_compression("lzma")
+        assert False
+    except Exception:
+        pass
+
+def test_names():
+    """The same contents always have the same digest, but each write gets its own name, and names can't escape the store's directory."""
+    digest = BlobStore.compute_digest(b"abc")
+    assert digest == BlobStore.compute_digest(b"abc")
+    assert digest != BlobStore.compute_digest(b"abd")
+    assert BlobStore.create_blob_name(digest) != BlobStore.create_blob_name(digest)
+
+    store = BlobStore.DirectoryBlobStore(tempfile.gettempdir())
+    for name in [ "../../etc/passwd", "ab/cd", ".hidden", "" ]:
+        try:
+            store.path_for_name(name)
+            assert False, name
+        except Exception:
+            pass
+
+def test_database_uploads(config_file_name):
+    """Uploading the same file twice stores it once, and it's only deleted when neither upload refers to it."""
+    import AppDatabase
+    import Config
+
+    config = Config.Config()
+    config.load(config_file_name)
+    db = AppDatabase.MongoDatabase()
+    db.connect(config)
+
+    data = make_gpx(100, random.randint(0, 1000000))
+    digest = BlobStore.compute_digest(data)
+    first_id = db.create_pending_uploaded_file(data)
+    second_id = db.create_pending_uploaded_file(data)
+    assert first_id is not None and second_id is not None and first_id != second_id
+    blob = db.blobs_collection.find_one({ Keys.BLOB_DIGEST_KEY: digest })
+    assert blob[Keys.BLOB_REFERENCES_KEY] == 2
+    assert db.retrieve_pending_uploaded_file(second_id) == data
+
+    assert db.delete_pending_uploaded_file(first_id)
+    assert db.retrieve_pending_uploaded_file(second_id) == data
+    assert db.delete_pending_uploaded_file(second_id)
+    assert db.blobs_collection.find_one({ Keys.BLOB_DIGEST_KEY: digest }) is None
+    assert db.retrieve_pending_uploaded_file(second_id) is None
+
+def run_unit_tests(config_file_name=None):
+    """Entry point for the unit tests."""
+    root_dir = tempfile.mkdtemp()
+    try:
+        test_round_trip(BlobStore.DirectoryBlobStore(root_dir))
+    finally:
+        shutil.rmtree(root_dir)
+    test_compression()
+    test_names()
+    if config_file_name:
+        test_database_uploads(config_file_name)
+    return True
+
+def run_benchmark(num_points):
+    """Times writing and reading a large upload with each compression, and reports how much space it takes."""
+    data = make_gpx(num_points, 3)
+    root_dir = tempfile.mkdtemp()
+    try:
+        store = BlobStore.DirectoryBlobStore(root_dir)
+        for compression in available_compressions():
+            name = BlobStore.create_blob_name(BlobStore.compute_digest(data))
+            start = time.time()
+            stored_size = store.write(name, BlobStore.compress_chunks(data, compression))
+            write_secs = time.time() - start
+            start = time.time()
+            read_blob(store, name, compression, BlobStore.CHUNK_SIZE)
+            read_secs = time.time() - start
+            print("{}: {} bytes stored as {} ({:.1f}%), written in {:.3f} seconds, read in {:.3f} seconds".format(compression, len(data), stored_size, 100.0 * stored_size / len(data), write_secs, read_secs))
+    finally:
+        shutil.rmtree(root_dir)
+
+def main():
+    # Parse command line options.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Measures how well and how quickly a large upload is compressed", required=False)
+    parser.add_argument("--config", default="", help="Also tests uploads against the database from the specified configuration file", required=False)
+
+    try:
+        args = parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    if args.benchmark:
+        run_benchmark(100000)
+    else:
+        run_unit_tests(args.config)
+
+if __name__ == "__main__":
+    main()
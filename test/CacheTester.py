@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2022 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Checks the eviction, expiry, and invalidation behavior of the in-process caches, and benchmarks them."""
+
+import argparse
+import inspect
+import os
+import sys
+import time
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import Cache
+
+class MemoryInvalidationChannel(Cache.InvalidationChannel):
+    """Invalidation channel shared by objects in the same process, standing in for the database collection that processes share."""
+
+    def __init__(self, published):
+        self.published = published
+        self.next_index = len(published)
+        super(MemoryInvalidationChannel, self).__init__()
+
+    def publish(self, cache_name, key):
+        self.published.append((cache_name, key))
+
+    def poll(self):
+        invalidations = self.published[self.next_index:]
+        self.next_index = len(self.published)
+        return invalidations
+
+def test_eviction():
+    """The least recently used item should be the one that is evicted."""
+    cache = Cache.TtlCache("eviction test", 3, 60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.put("c", 3)
+    assert cache.get("a") == (True, 1)
+    cache.put("d", 4)
+    assert cache.get("b") == (False, None)
+    assert cache.get("a") == (True, 1)
+    assert cache.get("c") == (True, 3)
+    assert cache.get("d") == (True, 4)
+    stats = cache.statistics()
+    assert stats["size"] == 3
+    assert stats["evictions"] == 1
+    assert stats["hits"] == 4
+    assert stats["misses"] == 1
+
+def test_expiry():
+    """Items should not be returned after they expire, and None should be a legitimate value."""
+    cache = Cache.TtlCache("expiry test", 10, 60)
+    cache.put("none", None)
+    assert cache.get("none") == (True, None)
+    cache.put("short", 1, ttl_secs=0.05)
+    cache.put("past", 1, ttl_secs=-1.0)
+    assert cache.get("short") == (True, 1)
+    assert cache.get("past") == (False, None)
+    time.sleep(0.1)
+    assert cache.get("short") == (False, None)
+    assert cache.get("none") == (True, None)
+
+def test_generation():
+    """A value read before an invalidation should not be cached after it."""
+    cache = Cache.TtlCache("generation test", 10, 60)
+    generation = cache.current_generation()
+    cache.invalidate("a")
+    cache.put("a", "stale", generation=generation)
+    assert cache.get("a") == (False, None)
+    generation = cache.current_generation()
+    cache.put("a", "fresh", generation=generation)
+    assert cache.get("a") == (True, "fresh")
+
+def test_invalidation_channel():
+    """Invalidations should be applied locally right away, and to the other process when it polls."""
+    published = []
+    local_cache = Cache.TtlCache("channel test", 10, 60)
+    local_cache.put("a", 1)
+    local_cache.put("b", 2)
+
+    # Simulate another process publishing an invalidation.
+    Cache.set_invalidation_channel(MemoryInvalidationChannel(published))
+    try:
+        published.append(("channel test", "b"))
+        Cache.g_last_poll_time = 0.0
+        Cache.process_invalidations()
+        assert local_cache.get("a") == (True, 1)
+        assert local_cache.get("b") == (False, None)
+
+        # Local invalidations should be published.
+        Cache.invalidate("channel test", "a")
+        assert local_cache.get("a") == (False, None)
+        assert published[-1] == ("channel test", "a")
+    finally:
+        Cache.set_invalidation_channel(None)
+
+    stats = Cache.retrieve_statistics()
+    assert stats["channel test"]["invalidations"] == 2
+
+def run_unit_tests():
+    """Entry point for the unit tests."""
+    test_eviction()
+    test_expiry()
+    test_generation()
+    test_invalidation_channel()
+    return True
+
+def run_benchmark(num_items, num_lookups):
+    """Times lookups against a full cache."""
+    cache = Cache.TtlCache("benchmark", num_items, 300)
+    for i in range(num_items):
+        cache.put(str(i), { "setting": i })
+    keys = [ str(i % num_items) for i in range(num_lookups) ]
+    start = time.time()
+    for key in keys:
+        cache.get(key)
+    elapsed = time.time() - start
+    print("{} lookups: {:.3f} seconds ({:.2f} usec per lookup)".format(num_lookups, elapsed, 1000000.0 * elapsed / num_lookups))
+    print(cache.statistics())
+
+def main():
+    # Parse command line options.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Benchmarks one million lookups", required=False)
+
+    try:
+        args = parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    if args.benchmark:
+        run_benchmark(10000, 1000000)
+    else:
+        run_unit_tests()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2022 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Checks that duplicate uploads are found by their fingerprint, and by time for activities without a fingerprint."""
+
+import argparse
+import inspect
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+sys.path.insert(0, os.path.join(parentdir, "bench"))
+import Config
+import DataMgr
+import Importer
+import Keys
+import MemoryDatabase
+
+START_TIME = 1577880000 # 2020-01-01T12:00:00Z
+NUM_POINTS = 600
+
+class CountingDatabase(MemoryDatabase.MemoryDatabase):
+    """Counts the fingerprint queries, so the tests can check that each import looks its fingerprint up once."""
+
+    def __init__(self):
+        MemoryDatabase.MemoryDatabase.__init__(self)
+        self.num_fingerprint_queries = 0
+
+    def retrieve_activity_ids_by_fingerprints(self, user_id, fingerprints):
+        self.num_fingerprint_queries = self.num_fingerprint_queries + 1
+        return MemoryDatabase.MemoryDatabase.retrieve_activity_ids_by_fingerprints(self, user_id, fingerprints)
+
+def write_gpx_file(file_name, start_time, lat_offset):
+    """Writes a ten minute run, one point per second. Files with a different start time or offset are different activities."""
+    with open(file_name, 'w') as out_file:
+        out_file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        out_file.write('<gpx version="1.1" creator="DuplicateDetectionTester" xmlns="http://www.topografix.com/GPX/1/1">\n')
+        out_file.write('<metadata><name>Run</name><time>' + time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(start_time)) + '</time></metadata>\n')
+        out_file.write('<trk><name>Run</name><type>running</type><trkseg>\n')
+        for i in range(0, NUM_POINTS):
+            ts_str = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(start_time + i))
+            out_file.write('<trkpt lat="{:.7f}" lon="{:.7f}"><ele>100.0</ele><time>{}</time></trkpt>\n'.format(39.0 + lat_offset + i * 0.00001, -77.0 + i * 0.00001, ts_str))
+        out_file.write('</trkseg></trk></gpx>\n')
+
+def create_environment():
+    """Returns a data manager backed by a fresh in-memory database, and the ID of its one user."""
+    database = CountingDatabase()
+    data_mgr = DataMgr.DataMgr(config=Config.Config(), root_url="file://" + parentdir, analysis_scheduler=None, import_scheduler=None, database=database)
+    user_id = database.create_user("test@example.com", "Test User", "not a real hash")
+    return data_mgr, database, user_id
+
+def import_file(data_mgr, user_id, file_name):
+    """Imports one file, the way the import worker does. Returns the activity ID, or None if it wasn't imported."""
+    success, _, activity_id = Importer.Importer(data_mgr).import_activity_from_file("test user", user_id, file_name, os.path.basename(file_name), ".gpx", str(uuid.uuid4()))
+    if not success:
+        return None
+    return activity_id
+
+def fingerprint_file(file_name):
+    """Returns the file's fingerprint, without storing anything."""
+    fingerprint_writer = Importer.FingerprintWriter()
+    Importer.Importer(fingerprint_writer).import_activity_from_file("test user", None, file_name, os.path.basename(file_name), ".gpx", None)
+    return fingerprint_writer.fingerprint
+
+def test_single_file(temp_dir):
+    """Imports a file, then the same file again, and then a different file that starts at the same time."""
+    data_mgr, database, user_id = create_environment()
+    file_name = os.path.join(temp_dir, "run.gpx")
+    write_gpx_file(file_name, START_TIME, 0.0)
+    other_file_name = os.path.join(temp_dir, "other.gpx")
+    write_gpx_file(other_file_name, START_TIME, 0.01)
+
+    # Miss: nothing has been imported yet.
+    activity_id = import_file(data_mgr, user_id, file_name)
+    if activity_id is None:
+        print("The first import of the file failed.")
+        return False
+    stored_fingerprint = database.retrieve_activity(activity_id).get(Keys.ACTIVITY_FINGERPRINT_KEY)
+    if stored_fingerprint is None or stored_fingerprint != fingerprint_file(file_name):
+        print("The stored fingerprint does not match the file's fingerprint.")
+        return False
+
+    # Hit: the same file is found by its fingerprint, with one query, before anything is created.
+    database.num_fingerprint_queries = 0
+    if import_file(data_mgr, user_id, file_name) is not None:
+        print("The second import of the file was not detected as a duplicate.")
+        return False
+    if database.num_fingerprint_queries != 1:
+        print("Expected one fingerprint query, got " + str(database.num_fingerprint_queries) + ".")
+        return False
+    if len(database.activities) != 1:
+        print("The duplicate activity was stored.")
+        return False
+
+    # Miss: an activity at the same time with a different route has a different fingerprint. Time only matters for activities without one.
+    if not data_mgr.is_duplicate_activity(user_id, START_TIME, None, stored_fingerprint):
+        print("The fingerprint was not found.")
+        return False
+    if data_mgr.is_duplicate_activity(user_id, START_TIME, None, fingerprint_file(other_file_name)):
+        print("A different fingerprint at the same time was detected as a duplicate.")
+        return False
+    if not data_mgr.is_duplicate_activity(user_id, START_TIME + 60, None, None):
+        print("An activity without a fingerprint was not checked against the overlapping activity.")
+        return False
+    return True
+
+def test_overlap_fallback(temp_dir):
+    """Activities stored without a fingerprint are still found by their start and end times."""
+    data_mgr, database, user_id = create_environment()
+    database.create_complete_activity({ Keys.ACTIVITY_ID_KEY: str(uuid.uuid4()), Keys.ACTIVITY_USER_ID_KEY: user_id, Keys.ACTIVITY_TYPE_KEY: Keys.TYPE_RUNNING_KEY, \
+        Keys.ACTIVITY_START_TIME_KEY: START_TIME - 60, Keys.ACTIVITY_END_TIME_KEY: START_TIME + NUM_POINTS })
+
+    file_name = os.path.join(temp_dir, "run.gpx")
+    write_gpx_file(file_name, START_TIME, 0.0)
+    if import_file(data_mgr, user_id, file_name) is not None:
+        print("The file that overlaps an activity without a fingerprint was not detected as a duplicate.")
+        return False
+
+    later_file_name = os.path.join(temp_dir, "later.gpx")
+    write_gpx_file(later_file_name, START_TIME + 2 * NUM_POINTS, 0.0)
+    if import_file(data_mgr, user_id, later_file_name) is None:
+        print("The file that doesn't overlap anything was detected as a duplicate.")
+        return False
+    return True
+
+def run_unit_tests():
+    """Entry point for the unit tests."""
+    print("Testing duplicate detection...")
+
+    success = True
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for test_func in [ test_single_file, test_overlap_fallback ]:
+            if test_func(temp_dir):
+                print(test_func.__name__ + ": passed")
+            else:
+                print(test_func.__name__ + ": failed")
+                success = False
+    return success
+
+def main():
+    # Parse command line options.
+    parser = argparse.ArgumentParser()
+
+    try:
+        parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    if not run_unit_tests():
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2017 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Checks the streaming exporters, and benchmarks them on long activities."""
+
+import argparse
+import inspect
+import os
+import sys
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import Exporter
+import Keys
+
+import LocationAnalyzerTester
+import VectorizedAnalyzerTester
+
+GPX_NAMESPACE = "{http://www.topografix.com/GPX/1/1}"
+TCX_NAMESPACE = "{http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2}"
+
+def make_activity(num_secs, seed):
+    """Generates a ride with one second location, heart rate, cadence and power data."""
+    activity = {}
+    activity[Keys.ACTIVITY_TYPE_KEY] = Keys.TYPE_CYCLING_KEY
+    activity[Keys.APP_LOCATIONS_KEY] = VectorizedAnalyzerTester.make_locations(LocationAnalyzerTester.generate_track(num_secs, Keys.TYPE_CYCLING_KEY, seed))
+    activity[Keys.APP_HEART_RATE_KEY] = VectorizedAnalyzerTester.make_sensor_data(VectorizedAnalyzerTester.generate_heart_rate_data(num_secs, seed))
+    activity[Keys.APP_CADENCE_KEY] = VectorizedAnalyzerTester.make_sensor_data(VectorizedAnalyzerTester.generate_heart_rate_data(num_secs, seed + 1))
+    activity[Keys.APP_POWER_KEY] = VectorizedAnalyzerTester.make_sensor_data(VectorizedAnalyzerTester.generate_heart_rate_data(num_secs, seed + 2))
+    return activity
+
+def test_merge():
+    """Each row gets the first reading from each stream at or after its time, streams that have ended are left blank."""
+    activity = {}
+    activity[Keys.ACTIVITY_TYPE_KEY] = Keys.TYPE_CYCLING_KEY
+    activity[Keys.APP_LOCATIONS_KEY] = [ { Keys.LOCATION_TIME_KEY: t, Keys.LOCATION_LAT_KEY: 1.0, Keys.LOCATION_LON_KEY: 2.0, Keys.LOCATION_ALT_KEY: 3.0 } for t in [ 1000, 2000, 3000 ] ]
+    activity[Keys.APP_HEART_RATE_KEY] = [ { "500": 100 }, { "1500": 110 }, { "2000": 120 } ]
+    activity[Keys.APP_POWER_KEY] = [ { "1000": 0 } ]
+    activity[Keys.APP_CADENCE_KEY] = []
+
+    exporter = Exporter.Exporter()
+    rows = exporter.export(activity, None, 'csv').split("\r\n")
+    assert rows[0] == "time,latitude,longitude,altitude,cadence,hr,temp,power,x,y,z"
+    assert rows[1] == "1000,1.0,2.0,3.0,,110,,0,,,"
+    assert rows[2] == "2000,1.0,2.0,3.0,,120,,,,,"
+    assert rows[3] == "3000,1.0,2.0,3.0,,,,,,,"
+    assert rows[4] == ""
+
+    # Accelerometer data sets the clock when it is present.
+    activity[Keys.APP_ACCELEROMETER_KEY] = [ { Keys.APP_AXIS_TIME: t, Keys.APP_AXIS_NAME_X: 0.1, Keys.APP_AXIS_NAME_Y: 0.2, Keys.APP_AXIS_NAME_Z: 0.3 } for t in [ 1500, 1750, 3500 ] ]
+    rows = exporter.export(activity, None, 'csv').split("\r\n")
+    assert rows[1] == "1500,1.0,2.0,3.0,,110,,,0.1,0.2,0.3"
+    assert rows[2] == "1750,1.0,2.0,3.0,,120,,,0.1,0.2,0.3"
+    assert rows[3] == "3500,,,,,,,,0.1,0.2,0.3"
+
+def test_streaming():
+    """The streamed chunks add up to the whole file, and a long activity is sent in more than one chunk."""
+    activity = make_activity(3 * Exporter.EXPORT_CHUNK_POINTS + 10, 1)
+    exporter = Exporter.Exporter()
+    for file_type in [ 'csv', 'gpx', 'tcx' ]:
+        chunks = list(exporter.export_stream(activity, None, file_type))
+        assert len(chunks) > 3
+        assert ''.join(chunks) == exporter.export(activity, None, file_type)
+
+def test_xml():
+    """The GPX and TCX files are well formed and have a point for every location."""
+    activity = make_activity(600, 2)
+    exporter = Exporter.Exporter()
+
+    root = ET.fromstring(exporter.export(activity, None, 'gpx'))
+    trackpoints = root.findall(".//" + GPX_NAMESPACE + "trkpt")
+    assert len(trackpoints) == len(activity[Keys.APP_LOCATIONS_KEY])
+
+    root = ET.fromstring(exporter.export(activity, None, 'tcx'))
+    trackpoints = root.findall(".//" + TCX_NAMESPACE + "Trackpoint")
+    assert len(trackpoints) == len(activity[Keys.APP_LOCATIONS_KEY])
+
+def test_errors():
+    """Bad requests are reported when the stream is created, not part way through sending it."""
+    exporter = Exporter.Exporter()
+    activity = { Keys.ACTIVITY_TYPE_KEY: Keys.TYPE_PUSH_UP_KEY, Keys.APP_LOCATIONS_KEY: [] }
+    for file_type in [ 'gpx', 'tcx', 'fit' ]:
+        try:
+            exporter.export_stream(activity, None, file_type)
+            assert False
+        except Exception as e:
+            assert str(e) != ""
+    assert exporter.export(activity, None, 'csv') == "time,latitude,longitude,altitude,cadence,hr,temp,power,x,y,z\r\n"
+
+def run_unit_tests():
+    """Entry point for the unit tests."""
+    test_merge()
+    test_streaming()
+    test_xml()
+    test_errors()
+    return True
+
+def run_benchmark(sizes):
+    """Times each format on rides of increasing length, and measures the peak memory used when the file is built whole and when it is streamed."""
+    exporter = Exporter.Exporter()
+    for num_secs in sizes:
+        activity = make_activity(num_secs, num_secs)
+        for file_type in [ 'csv', 'gpx', 'tcx' ]:
+            tracemalloc.start()
+            start = time.time()
+            num_bytes = len(exporter.export(activity, None, file_type))
+            whole_elapsed = time.time() - start
+            _, whole_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            tracemalloc.start()
+            start = time.time()
+            for chunk in exporter.export_stream(activity, None, file_type):
+                pass
+            stream_elapsed = time.time() - start
+            _, stream_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            print("{} seconds of data, {} ({} bytes): whole file {:.3f} seconds and {} KB peak, streamed {:.3f} seconds and {} KB peak".format(num_secs, file_type, num_bytes, whole_elapsed, whole_peak // 1024, stream_elapsed, stream_peak // 1024))
+
+def main():
+    # Parse command line options.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Benchmarks on one and eight hour rides", required=False)
+
+    try:
+        args = parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    if args.benchmark:
+        run_benchmark([3600, 8 * 3600])
+    else:
+        run_unit_tests()
+
+if __name__ == "__main__":
+    main()
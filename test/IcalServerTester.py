@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2017 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Checks that calendar feeds are cached by plan version and that conditional requests get a 304 without the plan being read."""
+
+import argparse
+import datetime
+import inspect
+import os
+import sys
+import time
+import uuid
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import IcalServer
+import Keys
+import Workout
+
+class PlanStore(object):
+    """Stands in for the DataMgr, holds one plan and counts the number of times it is read."""
+
+    def __init__(self, num_workouts):
+        self.calendar_id = str(uuid.uuid4())
+        self.workouts = []
+        self.version = None
+        self.last_modified = None
+        self.num_plan_reads = 0
+        self.set_workouts(num_workouts)
+
+    def set_workouts(self, num_workouts):
+        """Replaces the plan, which gives it a new version."""
+        start_time = datetime.datetime(2026, 1, 5)
+        self.workouts = []
+        for i in range(num_workouts):
+            workout = Workout.Workout("test user")
+            workout.type = Keys.WORKOUT_TYPE_EASY_RUN
+            workout.scheduled_time = start_time + datetime.timedelta(days=i)
+            workout.add_warmup(300)
+            self.workouts.append(workout)
+        self.version = str(uuid.uuid4())
+        self.last_modified = int(time.time())
+
+    def retrieve_planned_workouts_version_by_calendar_id(self, calendar_id):
+        if calendar_id != self.calendar_id:
+            return None, None
+        return self.version, self.last_modified
+
+    def retrieve_planned_workouts_by_calendar_id(self, calendar_id):
+        self.num_plan_reads = self.num_plan_reads + 1
+        return self.workouts
+
+def test_conditional_requests():
+    """Unchanged calendars should be built once, and clients with an up to date copy should get a 304."""
+    store = PlanStore(7)
+    server = IcalServer.IcalServer(None, store, "https://example.com")
+
+    # The first request builds the calendar.
+    status, calendar, headers = server.handle_request(store.calendar_id)
+    assert status == 200
+    assert calendar.startswith("BEGIN:VCALENDAR\r\n")
+    assert calendar.endswith("END:VCALENDAR\r\n")
+    assert calendar.count("BEGIN:VEVENT") == 7
+    assert headers["ETag"] == '"' + store.version + '"'
+    assert "Last-Modified" in headers
+    assert store.num_plan_reads == 1
+
+    # Later requests are served from the cache, or not at all if the client already has it.
+    status, cached_calendar, _ = server.handle_request(store.calendar_id)
+    assert status == 200 and cached_calendar == calendar
+    status, body, _ = server.handle_request(store.calendar_id, if_none_match=headers["ETag"])
+    assert status == 304 and body == ""
+    status, _, _ = server.handle_request(store.calendar_id, if_none_match='W/"something else", ' + headers["ETag"])
+    assert status == 304
+    status, _, _ = server.handle_request(store.calendar_id, if_modified_since=headers["Last-Modified"])
+    assert status == 304
+    assert store.num_plan_reads == 1
+
+    # Changing the plan changes the version, so the calendar is built again.
+    store.set_workouts(3)
+    status, calendar, new_headers = server.handle_request(store.calendar_id, if_none_match=headers["ETag"])
+    assert status == 200
+    assert calendar.count("BEGIN:VEVENT") == 3
+    assert new_headers["ETag"] != headers["ETag"]
+    assert store.num_plan_reads == 2
+
+    # Unknown calendars.
+    status, _, _ = server.handle_request(str(uuid.uuid4()))
+    assert status == 404
+
+def run_unit_tests():
+    """Entry point for the unit tests."""
+    test_conditional_requests()
+    return True
+
+def run_benchmark(num_workouts, num_requests):
+    """Compares building the calendar on every request with serving it from the cache and answering conditional requests."""
+    store = PlanStore(num_workouts)
+    server = IcalServer.IcalServer(None, store, "https://example.com")
+
+    start = time.time()
+    for _ in range(num_requests):
+        server.create_calendar(store.retrieve_planned_workouts_by_calendar_id(store.calendar_id))
+    uncached_secs = time.time() - start
+
+    _, _, headers = server.handle_request(store.calendar_id)
+    start = time.time()
+    for _ in range(num_requests):
+        server.handle_request(store.calendar_id)
+    cached_secs = time.time() - start
+
+    start = time.time()
+    for _ in range(num_requests):
+        server.handle_request(store.calendar_id, if_none_match=headers["ETag"])
+    not_modified_secs = time.time() - start
+
+    print("{} requests for a calendar of {} workouts:".format(num_requests, num_workouts))
+    print("Built every time: {:.3f} seconds".format(uncached_secs))
+    print("Cached: {:.3f} seconds".format(cached_secs))
+    print("Not modified: {:.3f} seconds".format(not_modified_secs))
+
+def main():
+    # Parse command line options.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Measures the time taken to answer calendar requests", required=False)
+
+    try:
+        args = parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    if args.benchmark:
+        run_benchmark(120, 1000)
+    else:
+        run_unit_tests()
+
+if __name__ == "__main__":
+    main()
@@ -29,7 +29,9 @@ import inspect
 import logging
 import os
 import sys
+import tempfile
 import time
+import tracemalloc
 import uuid
 
 # Locate and load the importer module.
@@ -187,6 +189,102 @@ class TestActivityWriter(Importer.ActivityWriter):
         self.location_analyzer = None
         self.sensor_analyzers = []
 
+class CountingActivityWriter(Importer.ActivityWriter):
+    """Subclass that only counts what it is given, so the benchmark measures the importer and not the analysis."""
+
+    def __init__(self):
+        Importer.ActivityWriter.__init__(self)
+        self.num_locations = 0
+        self.num_sensor_readings = 0
+        self.num_writes = 0
+
+    def is_duplicate_activity(self, user_id, start_time, optional_activity_id, fingerprint=None):
+        """Inherited from ActivityWriter."""
+        return False
+
+    def create_activity(self, username, user_id, stream_name, stream_description, activity_type, start_time, desired_activity_id):
+        """Inherited from ActivityWriter."""
+        return "", desired_activity_id
+
+    def create_activity_track(self, device_str, activity_id, track_name, track_description):
+        """Inherited from ActivityWriter."""
+        pass
+
+    def create_activity_streams(self, device_str, activity_id, locations, sensor_readings_dict, events):
+        """Inherited from ActivityWriter."""
+        self.num_locations = self.num_locations + len(locations)
+        for sensor_type in sensor_readings_dict:
+            self.num_sensor_readings = self.num_sensor_readings + len(sensor_readings_dict[sensor_type])
+        self.num_writes = self.num_writes + 1
+
+def write_synthetic_gpx_file(file_name, num_points):
+    """Writes a GPX file with one point per second, along with heart rate and cadence extensions."""
+    start_time = 1577880000 # 2020-01-01T12:00:00Z
+    with open(file_name, 'w') as out_file:
+        out_file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        out_file.write('<gpx version="1.1" creator="ImportTester" xmlns="http://www.topografix.com/GPX/1/1" xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1">\n')
+        out_file.write('<metadata><name>Synthetic</name><time>' + time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(start_time)) + '</time></metadata>\n')
+        out_file.write('<trk><name>Synthetic</name><type>running</type><trkseg>\n')
+        for i in range(0, num_points):
+            ts_str = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(start_time + i)) + ".000Z"
+            out_file.write('<trkpt lat="{:.7f}" lon="{:.7f}"><ele>{:.1f}</ele><time>{}</time>'.format(39.0 + i * 0.00001, -77.0 + i * 0.00001, 100.0 + (i % 50), ts_str))
+            out_file.write('<extensions><gpxtpx:TrackPointExtension><gpxtpx:hr>{}</gpxtpx:hr><gpxtpx:cad>{}</gpxtpx:cad></gpxtpx:TrackPointExtension></extensions></trkpt>\n'.format(120 + (i % 40), 85 + (i % 10)))
+        out_file.write('</trkseg></trk></gpx>\n')
+
+def write_synthetic_tcx_file(file_name, num_points):
+    """Writes a TCX file with one point per second, along with heart rate, cadence, and power."""
+    start_time = 1577880000 # 2020-01-01T12:00:00Z
+    with open(file_name, 'w') as out_file:
+        out_file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        out_file.write('<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2" xmlns:ns3="http://www.garmin.com/xmlschemas/ActivityExtension/v2">\n')
+        out_file.write('<Activities><Activity Sport="Biking"><Id>' + time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(start_time)) + '</Id><Lap><Track>\n')
+        for i in range(0, num_points):
+            ts_str = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(start_time + i))
+            out_file.write('<Trackpoint><Time>{}</Time><Position><LatitudeDegrees>{:.7f}</LatitudeDegrees><LongitudeDegrees>{:.7f}</LongitudeDegrees></Position>'.format(ts_str, 39.0 + i * 0.00001, -77.0 + i * 0.00001))
+            out_file.write('<AltitudeMeters>{:.1f}</AltitudeMeters><HeartRateBpm><Value>{}</Value></HeartRateBpm><Cadence>{}</Cadence>'.format(100.0 + (i % 50), 120 + (i % 40), 85 + (i % 10)))
+            out_file.write('<Extensions><ns3:TPX><ns3:Watts>{}</ns3:Watts></ns3:TPX></Extensions></Trackpoint>\n'.format(200 + (i % 60)))
+        out_file.write('</Track></Lap></Activity></Activities></TrainingCenterDatabase>\n')
+
+def run_benchmarks(num_points):
+    """Measures import throughput and peak memory usage on large, synthetic GPX and TCX files."""
+    for file_ext, writer_func in [ ('.gpx', write_synthetic_gpx_file), ('.tcx', write_synthetic_tcx_file) ]:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_name = os.path.join(temp_dir, "synthetic" + file_ext)
+            writer_func(file_name, num_points)
+            file_size_mb = os.path.getsize(file_name) / (1024 * 1024)
+
+            # Time the import.
+            store = CountingActivityWriter()
+            importer = Importer.Importer(store)
+            start_time = time.time()
+            importer.import_activity_from_file("test user", "", file_name, os.path.basename(file_name), file_ext, str(uuid.uuid4()))
+            elapsed_time = time.time() - start_time
+
+            # Import it again to measure memory, tracing allocations slows things down too much to do both at once.
+            tracemalloc.start()
+            Importer.Importer(CountingActivityWriter()).import_activity_from_file("test user", "", file_name, os.path.basename(file_name), file_ext, str(uuid.uuid4()))
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            print("{}: {:.1f} MB, {} locations, {} sensor readings, {} writes".format(file_ext, file_size_mb, store.num_locations, store.num_sensor_readings, store.num_writes))
+            print("{}: {:.3f} seconds, {:.0f} points/second, peak memory {:.1f} MB".format(file_ext, elapsed_time, store.num_locations / elapsed_time, peak_memory / (1024 * 1024)))
+
+def test_timestamp_parsing():
+    """Checks the importer's ISO 8601 parser against known values."""
+    test_values = { "2020-01-01T12:00:00Z": 1577880000000,
+        "2020-01-01T12:00:00.250Z": 1577880000250,
+        "2020-01-01T12:00:00.5Z": 1577880000500,
+        "2020-01-01T12:00:00.123456Z": 1577880000123,
+        "2020-01-01T07:00:00-05:00": 1577880000000,
+        "2020-01-01T13:30:00.100+01:30": 1577880000100,
+        "2020-01-01T12:00:00": 1577880000000 }
+    for test_str in test_values:
+        actual = Importer.unix_time_ms_from_iso8601(test_str)
+        if actual != test_values[test_str]:
+            print("Timestamp parsing failed for " + test_str + ": " + str(actual) + " != " + str(test_values[test_str]))
+            return False
+    return True
+
 def print_records(store, activity_type):
 
     # Print title.
@@ -239,6 +337,9 @@ def run_unit_tests(test_files_dir_name):
     successes = []
     failures = []
 
+    if not test_timestamp_parsing():
+        failures.append("timestamp parsing")
+
     store = TestActivityWriter()
     importer = Importer.Importer(store)
 
@@ -317,7 +418,9 @@ def main():
 
     # Parse the command line arguments.
     parser = argparse.ArgumentParser()
-    parser.add_argument("--dir", type=str, action="store", default=os.path.dirname(os.path.realpath(__file__)), help="Directory of files to process", required=True)
+    parser.add_argument("--dir", type=str, action="store", default=os.path.dirname(os.path.realpath(__file__)), help="Directory of files to process", required=False)
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Measures import throughput on large, synthetic files", required=False)
+    parser.add_argument("--benchmark-points", type=int, action="store", default=500000, help="Number of points in each benchmark file", required=False)
 
     try:
         args = parser.parse_args()
@@ -327,7 +430,10 @@ def main():
 
     # Do the tests.
     try:
-        run_unit_tests(args.dir)
+        if args.benchmark:
+            run_benchmarks(args.benchmark_points)
+        else:
+            run_unit_tests(args.dir)
     except Exception as e:
         print("Test aborted!\n")
         print(e)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2022 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Checks that an upload that can't be queued, or can't be imported, doesn't leave its stored file behind."""
+
+import argparse
+import inspect
+import io
+import json
+import os
+import sys
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import ImportScheduler
+import ImportWorker
+import Keys
+
+class FakeDataMgr(object):
+    """Keeps the pending uploads and deferred tasks in memory. Any method can be made to fail."""
+
+    def __init__(self):
+        self.pending_uploads = {} # Maps the uploaded file ID to the file's contents
+        self.attached_uploads = {} # Maps the uploaded file ID to the activity ID
+        self.tasks = {} # Maps the internal task ID to its status
+        self.failures = set() # Names of the methods that should raise
+        self.next_id = 1
+
+    def check_failure(self, method_name):
+        if method_name in self.failures:
+            raise Exception("Simulated failure in " + method_name)
+
+    def create_pending_uploaded_file(self, file_data):
+        self.check_failure("create_pending_uploaded_file")
+        uploaded_file_id = str(self.next_id)
+        self.next_id = self.next_id + 1
+        self.pending_uploads[uploaded_file_id] = file_data
+        return uploaded_file_id
+
+    def open_pending_uploaded_file(self, uploaded_file_id):
+        self.check_failure("open_pending_uploaded_file")
+        if uploaded_file_id not in self.pending_uploads:
+            return None
+        return io.BytesIO(self.pending_uploads[uploaded_file_id])
+
+    def attach_uploaded_file_to_activity(self, uploaded_file_id, activity_id):
+        self.check_failure("attach_uploaded_file_to_activity")
+        if self.pending_uploads.pop(uploaded_file_id, None) is None:
+            return False
+        self.attached_uploads[uploaded_file_id] = activity_id
+        return True
+
+    def delete_pending_uploaded_file(self, uploaded_file_id):
+        self.check_failure("delete_pending_uploaded_file")
+        return self.pending_uploads.pop(uploaded_file_id, None) is not None
+
+    def create_deferred_task(self, user_id, task_type, celery_task_id, internal_task_id, details):
+        self.check_failure("create_deferred_task")
+        self.tasks[str(internal_task_id)] = Keys.TASK_STATUS_QUEUED
+        return True
+
+    def update_deferred_task(self, user_id, internal_task_id, activity_id, status, details=None):
+        self.check_failure("update_deferred_task")
+        self.tasks[str(internal_task_id)] = status
+        return True
+
+class FakeTask(object):
+    """What the scheduler gets back from celery."""
+
+    def __init__(self):
+        self.task_id = "celery-task"
+
+class FakeImporter(object):
+    """Stands in for the importer. The outcome (or exception) of every import is set by the test."""
+    outcome = (True, None, "activity")
+
+    def __init__(self, data_mgr):
+        self.data_mgr = data_mgr
+
+    def import_activity_from_file(self, username, user_id, local_file_name, uploaded_file_name, uploaded_file_ext, desired_activity_id):
+        assert os.path.exists(local_file_name)
+        if isinstance(FakeImporter.outcome, Exception):
+            raise FakeImporter.outcome
+        return FakeImporter.outcome
+
+class FakeImporterModule(object):
+    """Replaces the Importer module used by the worker."""
+    Importer = FakeImporter
+
+def enqueue(data_mgr):
+    """Uploads a small file through the scheduler. Returns the internal task ID, or None if the upload wasn't queued."""
+    scheduler = ImportScheduler.ImportScheduler()
+    return scheduler.add_file_to_queue("user", "user id", "PGdweD48L2dweD4=", "test.gpx", None, data_mgr)
+
+def test_enqueue_failures():
+    """Neither a broker failure nor a failure to record the task should leave the upload behind."""
+    queued = []
+    def fake_delay(params_str, internal_task_id):
+        queued.append(params_str)
+        return FakeTask()
+    def failed_delay(params_str, internal_task_id):
+        raise Exception("Simulated broker failure")
+
+    # The broker is down.
+    data_mgr = FakeDataMgr()
+    ImportWorker.import_activity.delay = failed_delay
+    assert enqueue(data_mgr) is None
+    assert len(data_mgr.pending_uploads) == 0
+
+    # The task was queued, but it can't be tracked.
+    data_mgr = FakeDataMgr()
+    data_mgr.failures.add("create_deferred_task")
+    ImportWorker.import_activity.delay = fake_delay
+    assert enqueue(data_mgr) is None
+    assert len(data_mgr.pending_uploads) == 0
+
+    # Everything worked, so the upload waits for the worker.
+    data_mgr = FakeDataMgr()
+    assert enqueue(data_mgr) is not None
+    assert len(data_mgr.pending_uploads) == 1
+    assert len(queued) == 2
+    assert Keys.UPLOADED_FILE_ID_KEY in json.loads(queued[-1])
+    return queued[-1]
+
+def run_import(params_str, outcome, failures):
+    """Runs the import task on a freshly stored upload. Returns the fake data manager so the test can see what was left behind."""
+    data_mgr = FakeDataMgr()
+    params = json.loads(params_str)
+    params[Keys.UPLOADED_FILE_ID_KEY] = data_mgr.create_pending_uploaded_file(b"<gpx></gpx>")
+    data_mgr.failures = failures
+    FakeImporter.outcome = outcome
+    ImportWorker.shared_data_mgr = lambda: data_mgr
+    ImportWorker.import_activity(json.dumps(params), "internal task")
+    return data_mgr
+
+def test_import_failures(params_str):
+    """The upload should only be kept if it was attached to the imported activity."""
+    ImportWorker.Importer = FakeImporterModule
+
+    # Success.
+    data_mgr = run_import(params_str, (True, None, "activity"), set())
+    assert len(data_mgr.pending_uploads) == 0
+    assert list(data_mgr.attached_uploads.values()) == [ "activity" ]
+    assert data_mgr.tasks["internal task"] == Keys.TASK_STATUS_FINISHED
+
+    # The importer didn't understand the file.
+    data_mgr = run_import(params_str, (False, None, None), set())
+    assert len(data_mgr.pending_uploads) == 0
+    assert len(data_mgr.attached_uploads) == 0
+    assert data_mgr.tasks["internal task"] == Keys.TASK_STATUS_ERROR
+
+    # The importer crashed.
+    data_mgr = run_import(params_str, Exception("Simulated importer crash"), set())
+    assert len(data_mgr.pending_uploads) == 0
+    assert len(data_mgr.attached_uploads) == 0
+
+    # The activity was imported, but the file couldn't be attached to it.
+    data_mgr = run_import(params_str, (True, None, "activity"), set([ "attach_uploaded_file_to_activity" ]))
+    assert len(data_mgr.pending_uploads) == 0
+    assert len(data_mgr.attached_uploads) == 0
+
+    # The task's status couldn't be updated.
+    data_mgr = run_import(params_str, (True, None, "activity"), set([ "update_deferred_task" ]))
+    assert len(data_mgr.pending_uploads) == 0
+    assert len(data_mgr.attached_uploads) == 0
+
+def run_unit_tests():
+    """Entry point for the unit tests."""
+    params_str = test_enqueue_failures()
+    test_import_failures(params_str)
+    return True
+
+def main():
+    # Parse command line options.
+    parser = argparse.ArgumentParser()
+
+    try:
+        parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    run_unit_tests()
+
+if __name__ == "__main__":
+    main()
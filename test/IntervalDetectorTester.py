@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2022 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Checks the interval detector against workouts with known intervals, compares it with the original k-means implementation, and benchmarks them."""
+
+import argparse
+import inspect
+import os
+import random
+import sys
+import time
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import Importer
+import IntervalDetector
+import Keys
+import LocationAnalyzer
+import LocationAnalyzerTester
+
+# The original implementation needs scikit-learn, which is no longer a dependency, and the peak finder from LibMath.
+try:
+    from sklearn.cluster import KMeans
+    from scipy.spatial.distance import cdist
+    import numpy as np
+    import peaks
+    import signals
+    import statistics
+    g_legacy_available = True
+except ImportError:
+    g_legacy_available = False
+
+# Workouts, as lists of (seconds, meters per second, is an interval) steps.
+WORKOUTS = {
+    "8 x 400m": [ (600, 3.0, False) ] + [ (80, 5.0, True), (90, 2.0, False) ] * 8 + [ (600, 3.0, False) ],
+    "10 x 1 minute": [ (600, 3.0, False) ] + [ (60, 4.2, True), (60, 3.0, False) ] * 10 + [ (600, 3.0, False) ],
+    "Tempo": [ (900, 3.0, False), (1200, 3.6, True), (900, 3.0, False) ],
+    "Steady": [ (3600, 3.0, False) ],
+    "Steady with stops": [ (600, 3.0, False), (60, 0.0, False), (600, 3.0, False), (120, 0.0, False), (600, 3.1, False) ],
+    "Bike 5 x 4 minutes": [ (900, 7.0, False) ] + [ (240, 11.0, True), (180, 6.0, False) ] * 5 + [ (600, 7.0, False) ],
+}
+
+def generate_workout(steps, seed, noise=0.4):
+    """Generates a one second track heading north that follows the workout steps, with some noise in the speed."""
+    """Returns the track, as a list of [time_ms, lat, lon, alt], and the list of (start time, end time, speed) of the intervals."""
+    rng = random.Random(seed)
+    time_ms = 1600000000000
+    lat = 40.0
+    lon = -75.0
+    track = []
+    intervals = []
+    for seconds, speed, is_interval in steps:
+        start_time_ms = time_ms
+        for _ in range(seconds):
+            current_speed = max(0.0, speed + rng.uniform(-noise, noise))
+            lat = lat + (current_speed / LocationAnalyzerTester.METERS_PER_DEGREE_LAT)
+            lon = lon + rng.uniform(-0.000005, 0.000005)
+            time_ms = time_ms + 1000
+            track.append([time_ms, lat, lon, 100.0])
+        if is_interval:
+            intervals.append((start_time_ms, time_ms, speed))
+    return track, intervals
+
+def analyze_track(track, activity_type):
+    """Runs the location analyzer over the track, without the analysis step, so the interval detectors can be run on its speed graph."""
+    analyzer = LocationAnalyzer.LocationAnalyzer(activity_type)
+    LocationAnalyzerTester.run_analyzer(analyzer, track)
+    return analyzer
+
+def legacy_examine_interval_peak(analyzer, start_index, end_index, speed_blocks):
+    """The original implementation's examination of a line of near-constant pace/speed."""
+    if start_index >= end_index:
+        return None
+
+    start_time = analyzer.speed_times[start_index]
+    end_time = analyzer.speed_times[end_index]
+    line_duration_seconds = end_time - start_time
+    line_length_meters = 0
+    line_avg_speed = 0.0
+
+    if line_duration_seconds > 10:
+        speeds = analyzer.speed_graph[start_index:end_index - 1]
+        start_distance_rec = None
+        end_distance_rec = None
+        for rec in analyzer.distance_buf:
+            if rec[0] == start_time:
+                start_distance_rec = rec
+            if rec[0] == end_time:
+                end_distance_rec = rec
+                break
+        line_length_meters = 0.0
+        if start_distance_rec is not None and end_distance_rec is not None:
+            line_length_meters = end_distance_rec[1] - start_distance_rec[1]
+        line_avg_speed = statistics.mean(speeds)
+        speed_blocks.append(line_avg_speed)
+
+    return start_time, end_time, line_duration_seconds, line_length_meters, line_avg_speed
+
+def legacy_detect_intervals(analyzer):
+    """The original implementation: peaks in the speed graph, filtered with k-means, with k chosen by an elbow search."""
+    smoothed_graph = signals.smooth(analyzer.speed_graph, 4)
+    if len(smoothed_graph) <= 1:
+        return []
+
+    peak_list = peaks.find_peaks_in_numeric_array_over_stddev(smoothed_graph, 0.3)
+    speed_blocks = []
+    filtered_interval_list = []
+    for peak in peak_list:
+        interval = legacy_examine_interval_peak(analyzer, peak.left_trough.x, peak.right_trough.x, speed_blocks)
+        if interval is not None:
+            filtered_interval_list.append(interval)
+
+    significant_intervals = []
+    num_speed_blocks = len(speed_blocks)
+    if num_speed_blocks >= 2:
+        x1 = np.array(speed_blocks)
+        x2 = np.array([1] * num_speed_blocks)
+        X = np.array(list(zip(x1, x2))).reshape(num_speed_blocks, 2)
+
+        max_k = 10
+        if num_speed_blocks < max_k:
+            max_k = num_speed_blocks
+
+        best_k = 0
+        best_labels = []
+        steepest_slope = 0
+        distortions = []
+        for k in range(1, max_k):
+            kmeans_model = KMeans(n_clusters=k, n_init=10).fit(X)
+            distances = cdist(X, kmeans_model.cluster_centers_, 'euclidean')
+            distances_sum = sum(np.min(distances, axis = 1))
+            distortion = distances_sum / X.shape[0]
+            distortions.append(distortion)
+
+            if len(distortions) >= 2 and k >= 2:
+                slope = (distortions[k-1] + distortions[k-2]) / 2
+                if best_k == 0 or slope > steepest_slope:
+                    best_k = k
+                    best_labels = kmeans_model.labels_
+                    steepest_slope = slope
+
+        interval_index = 0
+        for label in best_labels:
+            if label >= 1:
+                significant_intervals.append(filtered_interval_list[interval_index])
+            interval_index = interval_index + 1
+    return significant_intervals
+
+def print_intervals(name, intervals, start_time_ms):
+    """Prints the intervals, with times relative to the start of the activity."""
+    print("{}: {} intervals".format(name, len(intervals)))
+    for interval in intervals:
+        print("    {:.0f}s to {:.0f}s, {:.0f} meters, {:.2f} m/s".format((interval[0] - start_time_ms) / 1000.0, (interval[1] - start_time_ms) / 1000.0, interval[3], interval[4]))
+
+def compare_with_legacy(analyzer):
+    """Prints what the original implementation finds alongside what the detector finds, if the original can be run here."""
+    if not g_legacy_available:
+        print("Skipping the comparison, the original implementation needs scikit-learn and LibMath.")
+        return
+    start_time_ms = analyzer.distance_buf[0][0]
+    print_intervals("Change points", IntervalDetector.detect_intervals(analyzer.speed_times, analyzer.speed_graph, analyzer.distance_buf), start_time_ms)
+    print_intervals("K-means", legacy_detect_intervals(analyzer), start_time_ms)
+
+def check_workout(name, steps, seed):
+    """Checks that the detector finds the workout's intervals, and nothing else."""
+    track, expected_intervals = generate_workout(steps, seed)
+    analyzer = analyze_track(track, Keys.TYPE_RUNNING_KEY)
+    intervals = IntervalDetector.detect_intervals(analyzer.speed_times, analyzer.speed_graph, analyzer.distance_buf)
+    print("{}: expected {} intervals, found {}".format(name, len(expected_intervals), len(intervals)))
+    assert len(intervals) == len(expected_intervals)
+
+    # The speed graph is a moving average, so the edges of each interval are blurred by a few seconds, which also drags down the average speed of short intervals.
+    for interval, expected_interval in zip(intervals, expected_intervals):
+        start_time, end_time, duration, length, avg_speed = interval
+        expected_start_time, expected_end_time, expected_speed = expected_interval
+        assert abs(start_time - expected_start_time) <= 15000
+        assert abs(end_time - expected_end_time) <= 15000
+        assert duration == end_time - start_time
+        assert abs(avg_speed - expected_speed) <= 0.15 * expected_speed
+        assert abs(length - avg_speed * duration / 1000.0) <= 0.1 * length
+    compare_with_legacy(analyzer)
+
+def run_unit_tests(test_files_dir_name):
+    """Entry point for the unit tests."""
+
+    # Degenerate inputs.
+    assert IntervalDetector.detect_intervals([], [], []) == []
+    assert IntervalDetector.detect_intervals([ 1000 ], [ 3.0 ], [ [ 1000, 0.0 ] ]) == []
+    assert IntervalDetector.find_change_points(IntervalDetector.smooth([ 3.0 ] * 10, 5), 20, 1.0) == [ 0 ]
+
+    # Synthetic workouts with known intervals.
+    seed = 1
+    for name, steps in WORKOUTS.items():
+        check_workout(name, steps, seed)
+        seed = seed + 1
+
+    # Files from the test file repo, if provided.
+    if test_files_dir_name is not None:
+        for subdir, _, files in os.walk(test_files_dir_name):
+            for current_file in files:
+                full_path = os.path.join(subdir, current_file)
+                _, temp_file_ext = os.path.splitext(full_path)
+                if temp_file_ext in ['.gpx', '.tcx', '.fit']:
+                    collector = LocationAnalyzerTester.LocationCollector()
+                    importer = Importer.Importer(collector)
+                    success, _, _ = importer.import_activity_from_file("", "", full_path, current_file, temp_file_ext, None)
+                    if success and len(collector.locations) > 1:
+                        print(current_file + ":")
+                        analyzer = analyze_track(collector.locations, collector.activity_type)
+                        if g_legacy_available:
+                            compare_with_legacy(analyzer)
+                        else:
+                            intervals = IntervalDetector.detect_intervals(analyzer.speed_times, analyzer.speed_graph, analyzer.distance_buf)
+                            print_intervals("Change points", intervals, collector.locations[0][0])
+    return True
+
+def run_benchmark(sizes):
+    """Times the detector, and the original implementation if it can be run here, on interval workouts of increasing length."""
+    for num_points in sizes:
+        steps = [ (600, 3.0, False) ]
+        while sum([ step[0] for step in steps ]) < num_points:
+            steps.extend([ (80, 5.0, True), (90, 2.0, False) ])
+        track, _ = generate_workout(steps, num_points)
+        analyzer = analyze_track(track, Keys.TYPE_RUNNING_KEY)
+
+        start = time.time()
+        intervals = IntervalDetector.detect_intervals(analyzer.speed_times, analyzer.speed_graph, analyzer.distance_buf)
+        elapsed = time.time() - start
+        print("{} points: {:.3f} seconds, {} intervals".format(len(track), elapsed, len(intervals)))
+
+        if g_legacy_available:
+            start = time.time()
+            intervals = legacy_detect_intervals(analyzer)
+            elapsed = time.time() - start
+            print("{} points, k-means: {:.3f} seconds, {} intervals".format(len(track), elapsed, len(intervals)))
+
+def main():
+    # Parse command line options.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--importdir", default=None, help="Directory of files to compare", required=False, type=str, action="store")
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Benchmarks on 10k, 50k, and 200k point tracks", required=False)
+
+    try:
+        args = parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    if args.benchmark:
+        run_benchmark([10000, 50000, 200000])
+    else:
+        run_unit_tests(args.importdir)
+
+if __name__ == "__main__":
+    main()
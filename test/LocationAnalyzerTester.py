@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2022 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Compares the location analyzer's speed and record calculations against the original (quadratic) implementation, and benchmarks them."""
+
+import argparse
+import inspect
+import math
+import os
+import random
+import sys
+import time
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import Importer
+import Keys
+import LocationAnalyzer
+
+METERS_PER_DEGREE_LAT = 111195.0
+
+class LegacyLocationAnalyzer(LocationAnalyzer.LocationAnalyzer):
+    """The original implementation of update_speeds, which walks the entire distance buffer each time a point is added."""
+
+    def __init__(self, activity_type):
+        LocationAnalyzer.LocationAnalyzer.__init__(self, activity_type)
+
+    def do_legacy_record_check(self, record_name, seconds, meters, record_meters):
+        if int(meters) == int(record_meters):
+            old_value = self.get_best_time(record_name)
+            if old_value is None or seconds < old_value:
+                self.bests[record_name] = seconds
+
+    def update_speeds(self):
+        self.current_speed = 0.0
+
+        for time_distance_node in reversed(self.distance_buf):
+            current_time_ms = time_distance_node[0]
+            total_seconds = (self.last_time_ms - current_time_ms) / 1000.0
+            if total_seconds <= 0.0:
+                continue
+
+            current_distance = time_distance_node[1]
+            total_meters = self.total_distance - current_distance
+
+            if int(total_seconds) == self.speed_window_size:
+                self.current_speed = total_meters / total_seconds
+                if Keys.BEST_SPEED not in self.bests or self.current_speed > self.bests[Keys.BEST_SPEED]:
+                    self.bests[Keys.BEST_SPEED] = self.current_speed
+                if current_time_ms > self.last_speed_buf_update_time:
+                    self.speed_times.append(current_time_ms)
+                    self.speed_graph.append(self.current_speed)
+                    self.last_speed_buf_update_time = current_time_ms
+
+            for record_name, record_meters in self.record_distances:
+                if total_meters < record_meters:
+                    break
+                self.do_legacy_record_check(record_name, total_seconds, total_meters, record_meters)
+
+class LocationCollector(Importer.ActivityWriter):
+    """Collects the locations from an imported file so they can be fed to each analyzer."""
+
+    def __init__(self):
+        self.activity_type = None
+        self.locations = []
+        super(LocationCollector, self).__init__()
+
+    def is_duplicate_activity(self, user_id, start_time, optional_activity_id, fingerprint=None):
+        return False
+
+    def create_activity(self, username, user_id, stream_name, stream_description, activity_type, start_time, desired_activity_id):
+        self.activity_type = activity_type
+        self.locations = []
+        return None, None
+
+    def create_activity_locations(self, device_str, activity_id, locations):
+        self.locations.extend(locations)
+
+def generate_track(num_points, activity_type, seed):
+    """Generates a one second track heading north with a varying speed and some GPS jitter. Returns a list of [time_ms, lat, lon, alt]."""
+    rng = random.Random(seed)
+    if activity_type == Keys.TYPE_CYCLING_KEY:
+        base_speed = 8.0
+    else:
+        base_speed = 3.2
+    time_ms = 1600000000000
+    lat = 40.0
+    lon = -75.0
+    alt = 100.0
+    track = []
+    for i in range(num_points):
+        speed = base_speed * (1.0 + 0.3 * math.sin(i / 300.0)) + rng.uniform(-0.4, 0.4)
+        lat = lat + (speed / METERS_PER_DEGREE_LAT)
+        lon = lon + rng.uniform(-0.000005, 0.000005)
+        alt = alt + rng.uniform(-0.5, 0.5)
+        time_ms = time_ms + 1000 + rng.choice([0, 0, 0, 0, 0, 0, 0, 0, 7, -7]) # Occasional timing jitter
+        track.append([time_ms, lat, lon, alt])
+    return track
+
+def run_analyzer(analyzer, track):
+    """Feeds the track to the analyzer one point at a time, the same way the activity analyzer does. Returns the elapsed time in seconds."""
+    start = time.time()
+    for location in track:
+        analyzer.append_location(location[0], location[1], location[2], location[3], 0.0, 0.0)
+        analyzer.update_speeds()
+    return time.time() - start
+
+def max_sample_gap_secs(analyzer):
+    """Returns the longest time between consecutive points, in seconds."""
+    max_gap = 0.0
+    for i in range(1, len(analyzer.distance_buf)):
+        max_gap = max(max_gap, (analyzer.distance_buf[i][0] - analyzer.distance_buf[i - 1][0]) / 1000.0)
+    return max_gap
+
+def compare(track, activity_type):
+    """Runs both implementations on the track and checks that they agree."""
+    """Speed calculations must be identical. Record times are now interpolated, so they can only be better than the old value,"""
+    """and by no more than the time between two samples since the old code accepted anything within a meter of the record distance."""
+    legacy = LegacyLocationAnalyzer(activity_type)
+    current = LocationAnalyzer.LocationAnalyzer(activity_type)
+    run_analyzer(legacy, track)
+    run_analyzer(current, track)
+
+    assert current.speed_times == legacy.speed_times
+    assert current.speed_graph == legacy.speed_graph
+    assert current.current_speed == legacy.current_speed
+    assert current.get_best_time(Keys.BEST_SPEED) == legacy.get_best_time(Keys.BEST_SPEED)
+
+    tolerance = max_sample_gap_secs(current) + 0.001
+    for record_name, _ in current.record_distances:
+        legacy_value = legacy.get_best_time(record_name)
+        current_value = current.get_best_time(record_name)
+        if legacy_value is not None:
+            assert current_value is not None
+            assert current_value <= legacy_value + 0.001
+            assert legacy_value - current_value <= tolerance
+        print("{}: {} (was {})".format(record_name, current_value, legacy_value))
+
+def run_unit_tests(test_files_dir_name):
+    """Entry point for the unit tests."""
+
+    # Synthetic tracks.
+    for activity_type in [ Keys.TYPE_RUNNING_KEY, Keys.TYPE_CYCLING_KEY ]:
+        print("Synthetic " + activity_type + ":")
+        compare(generate_track(6000, activity_type, 1), activity_type)
+
+    # Files from the test file repo, if provided.
+    if test_files_dir_name is not None:
+        for subdir, _, files in os.walk(test_files_dir_name):
+            for current_file in files:
+                full_path = os.path.join(subdir, current_file)
+                _, temp_file_ext = os.path.splitext(full_path)
+                if temp_file_ext in ['.gpx', '.tcx', '.fit']:
+                    collector = LocationCollector()
+                    importer = Importer.Importer(collector)
+                    success, _, _ = importer.import_activity_from_file("", "", full_path, current_file, temp_file_ext, None)
+                    if success and collector.locations:
+                        print(current_file + ":")
+                        compare(collector.locations, collector.activity_type)
+    return True
+
+def run_benchmark(sizes, include_legacy):
+    """Times the analyzer on tracks of increasing length. The old implementation is quadratic, so it is only run on request."""
+    for num_points in sizes:
+        track = generate_track(num_points, Keys.TYPE_CYCLING_KEY, num_points)
+        elapsed = run_analyzer(LocationAnalyzer.LocationAnalyzer(Keys.TYPE_CYCLING_KEY), track)
+        print("{} points: {:.3f} seconds ({:.2f} usec/point)".format(num_points, elapsed, 1000000.0 * elapsed / num_points))
+        if include_legacy:
+            elapsed = run_analyzer(LegacyLocationAnalyzer(Keys.TYPE_CYCLING_KEY), track)
+            print("{} points, old implementation: {:.3f} seconds".format(num_points, elapsed))
+
+def main():
+    # Parse command line options.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--importdir", default=None, help="Directory of files to compare", required=False, type=str, action="store")
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Benchmarks on 10k, 50k, and 200k point tracks", required=False)
+    parser.add_argument("--legacy", action="store_true", default=False, help="Includes the old implementation in the benchmark (slow)", required=False)
+
+    try:
+        args = parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    if args.benchmark:
+        run_benchmark([10000, 50000, 200000], args.legacy)
+    else:
+        run_unit_tests(args.importdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2022 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Checks the indexed map search against a linear scan of every region, and benchmarks the two."""
+
+import argparse
+import inspect
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import GeoJsonReader
+import MapSearch
+import graphics
+
+class LinearMapSearch(object):
+    """The way the search used to be done: point-in-polygon against every region until one matches."""
+
+    def __init__(self, data_url):
+        data = GeoJsonReader.GeoJsonReader()
+        data.read(data_url)
+        self.regions = []
+        for name, coordinates in data.name_to_coordinate_map().items():
+            self.regions.append((name, MapSearch.extract_rings(coordinates)))
+        super(LinearMapSearch, self).__init__()
+
+    def search(self, lat, lon):
+        for name, rings in self.regions:
+            for ring in rings:
+                if graphics.is_point_in_poly_array(lon, lat, ring):
+                    return name
+        return None
+
+def data_urls(data_dir):
+    """Returns the URLs of the world, US, and Canadian geojson files."""
+    data_dir = os.path.abspath(data_dir)
+    return [ "file://" + os.path.join(data_dir, "world.geo.json"), "file://" + os.path.join(data_dir, "us_states.geo.json"), "file://" + os.path.join(data_dir, "canada.geo.json") ]
+
+def generate_points(num_points, seed):
+    """Random points, half of them within the continental US and southern Canada so the state and province lookups get exercised."""
+    rng = random.Random(seed)
+    points = []
+    for i in range(num_points):
+        if i % 2 == 0:
+            points.append((rng.uniform(-90.0, 90.0), rng.uniform(-180.0, 180.0)))
+        else:
+            points.append((rng.uniform(25.0, 55.0), rng.uniform(-125.0, -65.0)))
+    return points
+
+def run_unit_tests(data_dir):
+    """Entry point for the unit tests."""
+    world_url, us_url, canada_url = data_urls(data_dir)
+    linear_world = LinearMapSearch(world_url)
+    linear_us = LinearMapSearch(us_url)
+    indexed = MapSearch.MapSearch(world_url, us_url, canada_url)
+
+    # The index should find the same region as the linear scan.
+    for lat, lon in generate_points(2000, 1):
+        assert indexed.which_country(lat, lon) == linear_world.search(lat, lon)
+        assert indexed.which_us_state(lat, lon) == linear_us.search(lat, lon)
+
+    # Known locations.
+    assert indexed.search_map(28.5383, -81.3792) == [ 'United States', 'Florida' ]
+    assert indexed.search_map(48.8566, 2.3522)[0] == 'France'
+
+    # Saving and reloading the index shouldn't change anything.
+    with tempfile.TemporaryDirectory() as temp_dir:
+        index_file_name = os.path.join(temp_dir, "map.index")
+        MapSearch.MapSearch(world_url, us_url, canada_url, index_file_name)
+        assert os.path.isfile(index_file_name)
+        reloaded = MapSearch.MapSearch(world_url, us_url, canada_url, index_file_name)
+        for lat, lon in generate_points(200, 2):
+            assert reloaded.search_map(lat, lon) == indexed.search_map(lat, lon)
+    return True
+
+def run_benchmark(data_dir, num_points):
+    """Times the lookup of random points, with and without the index."""
+    world_url, us_url, canada_url = data_urls(data_dir)
+    points = generate_points(num_points, 3)
+
+    start = time.time()
+    linear_world = LinearMapSearch(world_url)
+    linear_us = LinearMapSearch(us_url)
+    linear_canada = LinearMapSearch(canada_url)
+    print("Linear load: {:.3f} seconds".format(time.time() - start))
+    start = time.time()
+    for lat, lon in points:
+        country = linear_world.search(lat, lon)
+        if country == 'United States':
+            linear_us.search(lat, lon)
+        elif country == 'Canada':
+            linear_canada.search(lat, lon)
+    print("Linear search of {} points: {:.3f} seconds".format(num_points, time.time() - start))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        index_file_name = os.path.join(temp_dir, "map.index")
+        start = time.time()
+        MapSearch.MapSearch(world_url, us_url, canada_url, index_file_name)
+        print("Index build: {:.3f} seconds".format(time.time() - start))
+        start = time.time()
+        indexed = MapSearch.MapSearch(world_url, us_url, canada_url, index_file_name)
+        print("Index load from disk: {:.3f} seconds".format(time.time() - start))
+    start = time.time()
+    for lat, lon in points:
+        indexed.search_map(lat, lon)
+    print("Indexed search of {} points: {:.3f} seconds".format(num_points, time.time() - start))
+
+def main():
+    # Parse command line options.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--datadir", default=os.path.join(parentdir, "data"), help="Directory containing the geojson files", required=False)
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Benchmarks the lookup of 100,000 random points", required=False)
+
+    try:
+        args = parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    if args.benchmark:
+        run_benchmark(args.datadir, 100000)
+    else:
+        run_unit_tests(args.datadir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2017 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Checks the latency histograms, percentile estimates, text exposition, and multi-process aggregation, and measures the decorator overhead."""
+
+import argparse
+import inspect
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import Perf
+
+OVERHEAD_BUDGET_USECS = 1.0
+
+def undecorated():
+    return 1
+
+@Perf.statistics
+def decorated():
+    return 1
+
+def test_percentiles():
+    """Percentiles of a known distribution should be within a bucket of the real value."""
+    for i in range(1, 1001):
+        Perf.record_latency("test_percentiles_seconds", { "case": "uniform" }, i / 1000.0)
+    histogram = Perf.retrieve_histograms()[("test_percentiles_seconds", (("case", "uniform"),))]
+    summary = Perf.summarize_histogram(histogram)
+    assert summary["count"] == 1000
+    assert abs(summary["avg"] - 0.5005) < 0.0001
+    for quantile_name, expected in [ ("p50", 0.5), ("p95", 0.95), ("p99", 0.99) ]:
+        assert abs(summary[quantile_name] - expected) / expected < 0.25
+
+    # Anything slower than the last bucket bound is reported as the last bucket bound.
+    Perf.record_latency("test_percentiles_seconds", { "case": "slow" }, 10000.0)
+    histogram = Perf.retrieve_histograms()[("test_percentiles_seconds", (("case", "slow"),))]
+    assert Perf.estimate_quantile(histogram, 0.5) == Perf.BUCKET_BOUNDS[-1]
+
+def test_threads():
+    """Nothing should be lost when several threads record into the same histogram."""
+    def worker():
+        for _ in range(10 * Perf.DRAIN_THRESHOLD):
+            decorated()
+
+    before = Perf.histogram_count(Perf.retrieve_histograms()[(Perf.FUNCTION_SECONDS_METRIC, (("function", "decorated"),))])
+    threads = [ threading.Thread(target=worker) for _ in range(8) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    after = Perf.histogram_count(Perf.retrieve_histograms()[(Perf.FUNCTION_SECONDS_METRIC, (("function", "decorated"),))])
+    assert after - before == 8 * 10 * Perf.DRAIN_THRESHOLD
+
+def test_exposition():
+    """The text exposition should have cumulative buckets, a sum, and a count for each series, and escape the label values."""
+    Perf.record_latency("test_exposition_seconds", { "request": 'say "hi"' }, 0.001)
+    Perf.record_latency("test_exposition_seconds", { "request": 'say "hi"' }, 0.002)
+    Perf.record_metric("test exposition size", 5)
+    text = Perf.render_exposition()
+    lines = text.splitlines()
+    assert "# TYPE test_exposition_seconds histogram" in lines
+    assert 'test_exposition_seconds_bucket{request="say \\"hi\\"",le="+Inf"} 2' in lines
+    assert 'test_exposition_seconds_count{request="say \\"hi\\""} 2' in lines
+    assert "openworkout_test_exposition_size_count 1" in lines
+    assert "openworkout_test_exposition_size_max 5.0" in lines
+
+    # Bucket counts never decrease.
+    counts = [ int(line.split(" ")[-1]) for line in lines if line.startswith("test_exposition_seconds_bucket") ]
+    assert counts == sorted(counts)
+
+def test_multi_process():
+    """Counts recorded in a child process should be included in the parent's totals."""
+    if not hasattr(os, 'fork'):
+        return
+
+    metrics_dir = tempfile.mkdtemp()
+    try:
+        Perf.configure(metrics_dir)
+        before = Perf.histogram_count(Perf.retrieve_histograms()[(Perf.FUNCTION_SECONDS_METRIC, (("function", "decorated"),))])
+        pid = os.fork()
+        if pid == 0:
+            for _ in range(10):
+                decorated()
+            Perf.write_snapshot()
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        histograms, _ = Perf.retrieve_all()
+        after = Perf.histogram_count(histograms[(Perf.FUNCTION_SECONDS_METRIC, (("function", "decorated"),))])
+        assert after - before == 10
+
+        # Snapshot files are named for the pid and the process's start time, since pids are reused.
+        assert Perf.snapshot_base_name() == str(os.getpid()) + "-" + str(Perf.g_process_start_ms) + Perf.SNAPSHOT_FILE_EXTENSION
+
+        # Children that exit hand their counts over to the retired snapshot and remove their own files.
+        for _ in range(2):
+            pid = os.fork()
+            if pid == 0:
+                for _ in range(5):
+                    decorated()
+                Perf.write_snapshot()
+                Perf.retire_snapshot()
+                Perf.write_snapshot() # Too late, so it doesn't bring the file back
+                os._exit(0)
+            os.waitpid(pid, 0)
+        snapshot_files = [ file_name for file_name in os.listdir(metrics_dir) if file_name.endswith(Perf.SNAPSHOT_FILE_EXTENSION) ]
+        assert len(snapshot_files) == 2 and Perf.RETIRED_SNAPSHOT_NAME in snapshot_files
+
+        histograms, _ = Perf.retrieve_all()
+        retired = Perf.histogram_count(histograms[(Perf.FUNCTION_SECONDS_METRIC, (("function", "decorated"),))])
+        assert retired - after == 10
+    finally:
+        Perf.configure("")
+        shutil.rmtree(metrics_dir)
+
+def measure_overhead(num_calls):
+    """Returns the time the decorator adds to each call, in microseconds."""
+    undecorated_secs = timeit.timeit(undecorated, number=num_calls)
+    decorated_secs = timeit.timeit(decorated, number=num_calls)
+    return 1000000.0 * (decorated_secs - undecorated_secs) / num_calls
+
+def run_unit_tests():
+    """Entry point for the unit tests."""
+    test_percentiles()
+    test_threads()
+    test_exposition()
+    test_multi_process()
+    return True
+
+def run_benchmark(num_calls):
+    """Measures the decorator overhead, the best of several runs so that other activity on the machine doesn't count against it."""
+    overhead_usecs = min(measure_overhead(num_calls) for _ in range(5))
+    print("Decorator overhead: {:.3f} usec per call, budget is {:.3f} usec".format(overhead_usecs, OVERHEAD_BUDGET_USECS))
+
+    start = time.time()
+    text = Perf.render_exposition()
+    elapsed = time.time() - start
+    print("Exposition of {} lines in {:.3f} seconds".format(len(text.splitlines()), elapsed))
+    assert overhead_usecs < OVERHEAD_BUDGET_USECS
+
+def main():
+    # Parse command line options.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Measures the overhead of the statistics decorator", required=False)
+
+    try:
+        args = parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    if args.benchmark:
+        run_benchmark(1000000)
+    else:
+        run_unit_tests()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2022 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Checks the power analyzer's rolling bests, normalized power, and power curve against brute force calculations, and benchmarks them."""
+
+import argparse
+import inspect
+import os
+import random
+import sys
+import time
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import FtpCalculator
+import Keys
+import PowerAnalyzer
+import Summarizer
+
+TOLERANCE = 0.0001
+
+def generate_power_data(num_secs, seed, jitter):
+    """Generates roughly one reading per second of power data. Returns a list of [time_ms, watts]."""
+    rng = random.Random(seed)
+    time_ms = 1600000000000
+    readings = []
+    for i in range(num_secs):
+        watts = max(0.0, 200.0 + 80.0 * ((i // 240) % 3 - 1) + rng.uniform(-40.0, 40.0))
+        readings.append([time_ms, watts])
+        time_ms = time_ms + 1000
+        if jitter:
+            time_ms = time_ms + rng.choice([0, 0, 0, 0, 0, 0, 13, -13, 250, 1000])
+    return readings
+
+def run_analyzer(readings):
+    """Feeds the readings to the analyzer one at a time. Returns the analyzer, the results, and the elapsed time in seconds."""
+    start = time.time()
+    analyzer = PowerAnalyzer.PowerAnalyzer(Keys.TYPE_CYCLING_KEY, None, None, None)
+    for reading in readings:
+        analyzer.append_sensor_value(reading[0], reading[1])
+    results = analyzer.analyze()
+    return analyzer, results, time.time() - start
+
+def brute_force_energy(readings):
+    """Integrates the power data one millisecond at a time, returning the energy expended in each whole second."""
+    start_time = readings[0][0]
+    num_secs = (readings[-1][0] - start_time) // 1000
+    energy = [ 0.0 ] * num_secs
+    for i in range(1, len(readings)):
+        prev_time, prev_watts = readings[i - 1]
+        hold_end_time = min(readings[i][0], prev_time + PowerAnalyzer.MAX_POWER_HOLD_MS)
+        for ms in range(prev_time, hold_end_time):
+            second = (ms - start_time) // 1000
+            if second < num_secs:
+                energy[second] = energy[second] + (prev_watts / 1000.0)
+    return energy
+
+def check(readings):
+    """Runs the analyzer on the readings and compares the results to brute force calculations."""
+    analyzer, results, _ = run_analyzer(readings)
+    energy = brute_force_energy(readings)
+    num_secs = len(energy)
+
+    # Power curve.
+    power_curve = results[Keys.POWER_CURVE]
+    assert len(power_curve) == len([ window_secs for window_secs in PowerAnalyzer.POWER_CURVE_DURATIONS if window_secs <= num_secs ])
+    for window_secs in [1, 5, 30, 60, 300, 720, 1200, 3600]:
+        if window_secs > num_secs:
+            assert str(window_secs) not in power_curve
+            continue
+        best = max(sum(energy[i:i + window_secs]) for i in range(0, num_secs - window_secs + 1)) / window_secs
+        assert abs(power_curve[str(window_secs)] - best) < TOLERANCE
+
+    # Rolling bests must agree with the power curve.
+    for record_name, window_secs in analyzer.record_windows:
+        if window_secs <= num_secs:
+            assert abs(results[record_name] - power_curve[str(window_secs)]) < TOLERANCE
+            print("{}: {:.1f} watts".format(record_name, results[record_name]))
+        else:
+            assert record_name not in results
+
+    # Normalized power.
+    smoothed = [ sum(energy[i - 30:i]) / 30.0 for i in range(30, num_secs + 1) ]
+    normalized_power = pow(sum([pow(x, 4) for x in smoothed]) / len(smoothed), 0.25)
+    assert abs(results[Keys.NORMALIZED_POWER] - normalized_power) < TOLERANCE
+    print("{}: {:.1f} watts".format(Keys.NORMALIZED_POWER, normalized_power))
+
+    # The FTP calculator and summarizer should be able to use the curve directly.
+    ftp_calc = FtpCalculator.FtpCalculator()
+    ftp_calc.add_activity_data(Keys.TYPE_CYCLING_KEY, time.time(), results)
+    if num_secs >= 1200:
+        assert abs(ftp_calc.estimate_ftp() - 0.95 * power_curve[str(1200)]) < TOLERANCE
+    summarizer = Summarizer.Summarizer()
+    summarizer.add_activity_data("1", Keys.TYPE_CYCLING_KEY, time.time(), results)
+    summarizer.add_activity_data("2", Keys.TYPE_VIRTUAL_CYCLING_KEY, time.time(), { Keys.POWER_CURVE: { "1": power_curve["1"] + 1.0, "5": power_curve["5"] - 1.0 } })
+    best_curve = summarizer.get_power_curve(Keys.TYPE_CYCLING_KEY)
+    assert len(best_curve) == len(power_curve)
+    assert best_curve["1"][1] == "2" and best_curve["5"][1] == "1" and best_curve["1200"][1] == "1"
+
+def run_unit_tests():
+    """Entry point for the unit tests."""
+    print("Regular one second data:")
+    check(generate_power_data(1500, 1, False))
+    print("Irregular data, with dropouts:")
+    check(generate_power_data(1500, 2, True))
+    return True
+
+def run_benchmark(sizes):
+    """Times the analyzer on rides of increasing length."""
+    for num_secs in sizes:
+        analyzer, _, elapsed = run_analyzer(generate_power_data(num_secs, num_secs, False))
+        start = time.time()
+        analyzer.compute_power_curve()
+        curve_elapsed = time.time() - start
+        print("{} seconds of data: {:.3f} seconds ({:.3f} seconds for the power curve)".format(num_secs, elapsed, curve_elapsed))
+
+def main():
+    # Parse command line options.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Benchmarks on one, three, six, and twelve hour rides", required=False)
+
+    try:
+        args = parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    if args.benchmark:
+        run_benchmark([3600, 3 * 3600, 6 * 3600, 12 * 3600])
+    else:
+        run_unit_tests()
+
+if __name__ == "__main__":
+    main()
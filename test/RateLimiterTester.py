@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2022 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Checks the API rate limiters against known request patterns, and measures the per-request overhead of each one."""
+
+import argparse
+import inspect
+import os
+import sys
+import threading
+import time
+import uuid
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import RateLimiter
+
+WINDOW_SECS = 86400
+
+def test_limiter(limiter):
+    """Runs a known pattern of requests through the limiter. Keys are random so the test can be repeated against a shared database."""
+    key = str(uuid.uuid4())
+    window_start = RateLimiter.retrieve_window_start(time.time(), WINDOW_SECS)
+
+    # Ten requests are allowed, the eleventh is not.
+    for i in range(10):
+        assert limiter.check(key, 10, WINDOW_SECS, now=window_start + i)
+    assert not limiter.check(key, 10, WINDOW_SECS, now=window_start + 10)
+
+    # Other keys are unaffected.
+    assert limiter.check(str(uuid.uuid4()), 10, WINDOW_SECS, now=window_start + 10)
+
+    # Just before halfway through the next window, a bit more than half of the previous window's requests still count.
+    halfway = window_start + WINDOW_SECS + (WINDOW_SECS / 2) - 60
+    for i in range(5):
+        assert limiter.check(key, 10, WINDOW_SECS, now=halfway + i)
+    assert not limiter.check(key, 10, WINDOW_SECS, now=halfway + 5)
+
+    # Two windows later everything has aged out.
+    later_window = window_start + 3 * WINDOW_SECS
+    for i in range(10):
+        assert limiter.check(key, 10, WINDOW_SECS, now=later_window + i)
+    assert not limiter.check(key, 10, WINDOW_SECS, now=later_window + 10)
+
+def test_memory_limiter_bounds():
+    """The number of keys held in memory should not grow without bound."""
+    limiter = RateLimiter.MemoryRateLimiter(max_keys=100)
+    for i in range(1000):
+        limiter.check(str(i), 10, WINDOW_SECS)
+    assert len(limiter.counts) == 100
+
+def test_concurrency(limiter):
+    """Threads racing on the same key should not exceed the limit."""
+    key = str(uuid.uuid4())
+    allowed = []
+
+    def worker():
+        for _ in range(100):
+            if limiter.check(key, 250, WINDOW_SECS):
+                allowed.append(1)
+
+    threads = [ threading.Thread(target=worker) for _ in range(8) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(allowed) == 250
+
+def create_database_limiter(config_file_name):
+    """Connects to the configured database, returns a limiter that uses its rate_limits collection."""
+    import AppDatabase
+    import Config
+
+    config = Config.Config()
+    config.load(config_file_name)
+    db = AppDatabase.MongoDatabase()
+    db.connect(config)
+    return AppDatabase.DatabaseRateLimiter(db.rate_limits_collection)
+
+def run_unit_tests(config_file_name=None):
+    """Entry point for the unit tests."""
+    test_limiter(RateLimiter.MemoryRateLimiter())
+    test_memory_limiter_bounds()
+    test_concurrency(RateLimiter.MemoryRateLimiter())
+    if config_file_name:
+        database_limiter = create_database_limiter(config_file_name)
+        test_limiter(database_limiter)
+        test_concurrency(database_limiter)
+    return True
+
+def run_benchmark(limiter, name, num_requests, num_keys):
+    """Times the rate check for a stream of requests spread over a number of keys."""
+    keys = [ str(uuid.uuid4()) for _ in range(num_keys) ]
+    start = time.time()
+    for i in range(num_requests):
+        limiter.check(keys[i % num_keys], num_requests, WINDOW_SECS)
+    elapsed = time.time() - start
+    print("{}: {} requests over {} keys in {:.3f} seconds, {:.1f} usec per request, {:.0f} requests per second".format(name, num_requests, num_keys, elapsed, 1000000.0 * elapsed / num_requests, num_requests / elapsed))
+
+def main():
+    # Parse command line options.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Measures the per-request overhead of the rate limiters", required=False)
+    parser.add_argument("--config", default="", help="Also tests the database rate limiter, using the database from the specified configuration file", required=False)
+
+    try:
+        args = parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    if args.benchmark:
+        run_benchmark(RateLimiter.MemoryRateLimiter(), "Memory", 100000, 1000)
+        if args.config:
+            run_benchmark(create_database_limiter(args.config), "Database", 5000, 100)
+    else:
+        run_unit_tests(args.config)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2022 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Checks that every page template compiles through the shared lookup, and benchmarks it against compiling a template for each request."""
+
+import argparse
+import inspect
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from mako.template import Template
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import Dirs
+import Templates
+
+NAV = "<nav>\n\t<ul>\n\t\t<li><a href=\"/my_activities/\">My Activities</a></li>\n\t</ul>\n"
+PAGES = {
+    "all_activities.html": { "nav": NAV, "product": "OpenWorkout", "root_url": "", "email": "foo@example.com", "name": "Mr Foo" },
+    "device_list.html": { "nav": NAV, "product": "OpenWorkout", "root_url": "", "email": "foo@example.com", "name": "Mr Foo" },
+    "map_single_osm.html": { "nav": NAV, "product": "OpenWorkout", "root_url": "", "name": "Mr Foo", "pagetitle": "Morning Run",
+        "unit_system": "metric", "is_foot_based_activity": "true", "summary": "<td>Distance</td><td>10.00 km</td><tr>\n" * 20,
+        "activity_id": "0a1b2c3d", "user_id": "4e5f6a7b", "ftp": "250", "resting_hr": "50", "max_hr": "190", "description": "",
+        "details": "", "tags": "<option>Race</option>\n", "comments": "None", "exports": "", "visibility": "" },
+}
+
+def create_lookup(module_dir):
+    html_dir = os.path.join(parentdir, Dirs.HTML_DIR)
+    Templates.create_lookup(html_dir, module_dir, False)
+    return html_dir
+
+def test_warm(html_dir):
+    """Every template in the HTML directory should compile."""
+    num_templates = len([ file_name for file_name in os.listdir(html_dir) if file_name.endswith(Templates.TEMPLATE_FILE_EXTENSION) ])
+    assert Templates.warm() == num_templates
+
+def test_render(html_dir, module_dir):
+    """The shared lookup should render exactly what a freshly compiled template renders."""
+    for file_name, kwargs in PAGES.items():
+        my_template = Template(filename=os.path.join(html_dir, file_name), module_directory=module_dir)
+        assert Templates.render(file_name, **kwargs) == my_template.render(**kwargs)
+        assert Templates.retrieve_template(file_name) is Templates.retrieve_template(file_name)
+
+def run_unit_tests():
+    """Entry point for the unit tests."""
+    module_dir = tempfile.mkdtemp()
+    try:
+        html_dir = create_lookup(module_dir)
+        test_warm(html_dir)
+        test_render(html_dir, module_dir)
+    finally:
+        shutil.rmtree(module_dir)
+    return True
+
+def run_benchmark(num_renders):
+    """Times rendering each page with a template compiled per request, as the pages used to be rendered, and with the shared lookup."""
+    module_dir = tempfile.mkdtemp()
+    try:
+        html_dir = create_lookup(module_dir)
+        Templates.warm()
+        for file_name, kwargs in PAGES.items():
+            html_file = os.path.join(html_dir, file_name)
+            start = time.time()
+            for _ in range(num_renders):
+                Template(filename=html_file, module_directory=module_dir).render(**kwargs)
+            per_request_elapsed = time.time() - start
+
+            start = time.time()
+            for _ in range(num_renders):
+                Templates.render(file_name, **kwargs)
+            lookup_elapsed = time.time() - start
+
+            print("{}: {:.1f} usec per render with a template per request, {:.1f} usec per render with the lookup".format(file_name, 1000000.0 * per_request_elapsed / num_renders, 1000000.0 * lookup_elapsed / num_renders))
+    finally:
+        shutil.rmtree(module_dir)
+
+def main():
+    # Parse command line options.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Benchmarks rendering the activity, device, and all activities pages", required=False)
+
+    try:
+        args = parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    if args.benchmark:
+        run_benchmark(1000)
+    else:
+        run_unit_tests()
+
+if __name__ == "__main__":
+    main()
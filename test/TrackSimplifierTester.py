@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2022 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Checks the track simplification and sensor downsampling against known shapes and a straightforward recursive implementation, and measures how long they take."""
+
+import argparse
+import inspect
+import math
+import os
+import random
+import sys
+import time
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import Keys
+import TrackSimplifier
+import numpy as np
+
+START_TIME_MS = 1600000000000
+START_LAT = 37.0
+START_LON = -122.0
+METERS_PER_DEGREE = TrackSimplifier.EARTH_RADIUS_METERS * math.pi / 180.0
+
+def make_location(time_ms, north_meters, east_meters, altitude):
+    """Returns a location the given distance from the start point."""
+    lat = START_LAT + north_meters / METERS_PER_DEGREE
+    lon = START_LON + east_meters / (METERS_PER_DEGREE * math.cos(math.radians(START_LAT)))
+    return { Keys.LOCATION_TIME_KEY: time_ms, Keys.LOCATION_LAT_KEY: lat, Keys.LOCATION_LON_KEY: lon, Keys.LOCATION_ALT_KEY: altitude, Keys.LOCATION_HORIZONTAL_ACCURACY_KEY: 5.0, Keys.LOCATION_VERTICAL_ACCURACY_KEY: 5.0 }
+
+def make_random_track(num_points, seed):
+    """Returns a track that wanders about like a run, one location per second, with a few stops."""
+    rng = random.Random(seed)
+    north = 0.0
+    east = 0.0
+    altitude = 100.0
+    heading = 0.0
+    locations = []
+    for i in range(num_points):
+        speed = 3.0
+        if (i // 600) % 5 == 4 and i % 600 < 30:
+            speed = 0.0
+        heading = heading + rng.gauss(0.0, 0.1)
+        north = north + speed * math.cos(heading) + rng.gauss(0.0, 0.5)
+        east = east + speed * math.sin(heading) + rng.gauss(0.0, 0.5)
+        altitude = altitude + rng.gauss(0.0, 0.3)
+        locations.append(make_location(START_TIME_MS + i * 1000, north, east, altitude))
+    return locations
+
+def reference_simplify_indexes(times, points, tolerance, first, last, keep):
+    """Textbook recursive Douglas-Peucker with the synchronized distance, one segment at a time."""
+    if last - first < 2:
+        return
+    duration = times[last] - times[first]
+    farthest = -1
+    farthest_distance = tolerance * tolerance
+    for i in range(first + 1, last):
+        fraction = 0.0
+        if duration > 0:
+            fraction = (times[i] - times[first]) / duration
+        expected = points[first] + fraction * (points[last] - points[first])
+        distance = float(np.sum(np.square(points[i] - expected)))
+        if distance > farthest_distance:
+            farthest = i
+            farthest_distance = distance
+    if farthest >= 0:
+        keep.append(farthest)
+        reference_simplify_indexes(times, points, tolerance, first, farthest, keep)
+        reference_simplify_indexes(times, points, tolerance, farthest, last, keep)
+
+def max_synchronized_error(times, points, indexes):
+    """Returns how far any point is from where the simplified track puts it at the same time."""
+    expected = np.column_stack([ np.interp(times, times[indexes], points[indexes, i]) for i in range(points.shape[1]) ])
+    return float(np.max(np.sqrt(np.sum(np.square(points - expected), axis=1))))
+
+def test_straight_line():
+    """A constant speed along a straight line only needs its end points."""
+    locations = [ make_location(START_TIME_MS + i * 1000, i * 3.0, i * 1.0, 100.0) for i in range(1000) ]
+    for resolution, zoom in TrackSimplifier.TRACK_RESOLUTIONS.items():
+        track = TrackSimplifier.simplify_track(locations, zoom)
+        assert track == [ locations[0], locations[-1] ], resolution
+
+def test_stop():
+    """Stopping along a straight line doesn't change the shape, but the simplified track still has to show when the stop happened."""
+    locations = [ make_location(START_TIME_MS + i * 1000, min(i, 500) * 3.0 + max(0, i - 800) * 3.0, 0.0, 100.0) for i in range(1300) ]
+    track = TrackSimplifier.simplify_track(locations, 16)
+    times = [ location[Keys.LOCATION_TIME_KEY] for location in track ]
+    assert START_TIME_MS + 500 * 1000 in times
+    assert START_TIME_MS + 800 * 1000 in times
+    assert len(track) == 4
+
+def test_invalid_locations():
+    """Locations the map pages wouldn't draw are left out."""
+    locations = [ make_location(START_TIME_MS + i * 1000, i * 3.0, 0.0, 100.0) for i in range(10) ]
+    locations[0][Keys.LOCATION_HORIZONTAL_ACCURACY_KEY] = 0.0
+    locations[9][Keys.LOCATION_HORIZONTAL_ACCURACY_KEY] = 100.0
+    track = TrackSimplifier.simplify_track(locations, 16)
+    assert track == [ locations[1], locations[8] ]
+
+def test_against_reference():
+    """The vectorized version should keep exactly the same points as the recursive one, and stay within the tolerance."""
+    locations = make_random_track(3000, 1)
+    locations, times, coordinates, alts, latitude = TrackSimplifier.track_points(locations)
+    points = np.column_stack((coordinates, alts))
+    for zoom in TrackSimplifier.TRACK_RESOLUTIONS.values():
+        tolerance = TrackSimplifier.meters_per_pixel(zoom, latitude)
+        indexes = TrackSimplifier.simplify_indexes(times, points, tolerance)
+        keep = [ 0, len(times) - 1 ]
+        reference_simplify_indexes(times, points, tolerance, 0, len(times) - 1, keep)
+        assert indexes.tolist() == sorted(keep), zoom
+        assert max_synchronized_error(times, points, indexes) <= tolerance + 0.001, zoom
+
+def test_resolutions():
+    """Zoom levels map to the least detailed resolution that looks the same, and more detail means more points."""
+    assert TrackSimplifier.resolution_for_zoom(3) == Keys.TRACK_RESOLUTION_LOW
+    assert TrackSimplifier.resolution_for_zoom(12) == Keys.TRACK_RESOLUTION_LOW
+    assert TrackSimplifier.resolution_for_zoom(13) == Keys.TRACK_RESOLUTION_MEDIUM
+    assert TrackSimplifier.resolution_for_zoom(16) == Keys.TRACK_RESOLUTION_HIGH
+    assert TrackSimplifier.resolution_for_zoom(20) == Keys.TRACK_RESOLUTION_FULL
+    assert TrackSimplifier.is_valid_resolution(Keys.TRACK_RESOLUTION_FULL)
+    assert not TrackSimplifier.is_valid_resolution("very high")
+
+    simplified = TrackSimplifier.create_simplified_data(make_random_track(3000, 2), {})
+    tracks = simplified[Keys.ACTIVITY_SIMPLIFIED_TRACKS_KEY]
+    assert len(tracks[Keys.TRACK_RESOLUTION_LOW]) <= len(tracks[Keys.TRACK_RESOLUTION_MEDIUM]) <= len(tracks[Keys.TRACK_RESOLUTION_HIGH]) < 3000
+
+def test_downsample():
+    """Downsampling keeps the first and last readings, the requested number of points, and a spike that would otherwise be lost."""
+    data = [ { str(START_TIME_MS + i * 1000): 150.0 + 10.0 * math.sin(i / 100.0) } for i in range(10000) ]
+    data[5000] = { str(START_TIME_MS + 5000 * 1000): 400.0 }
+    downsampled = TrackSimplifier.downsample_sensor_data(data, 500)
+    assert len(downsampled) <= 500
+    assert downsampled[0] is data[0]
+    assert downsampled[-1] is data[-1]
+    assert data[5000] in downsampled
+
+    # Short series are left alone.
+    assert TrackSimplifier.downsample_sensor_data(data[:100], 500) == data[:100]
+
+    # Sensor types that aren't charted aren't stored.
+    simplified = TrackSimplifier.create_simplified_data(None, { Keys.APP_HEART_RATE_KEY: data, "Events": [ {} ] })
+    assert list(simplified[Keys.ACTIVITY_DOWNSAMPLED_SENSORS_KEY].keys()) == [ Keys.APP_HEART_RATE_KEY ]
+    assert len(simplified[Keys.ACTIVITY_DOWNSAMPLED_SENSORS_KEY][Keys.APP_HEART_RATE_KEY]) <= TrackSimplifier.SENSOR_CHART_NUM_POINTS
+
+def run_unit_tests():
+    """Entry point for the unit tests."""
+    test_straight_line()
+    test_stop()
+    test_invalid_locations()
+    test_against_reference()
+    test_resolutions()
+    test_downsample()
+    return True
+
+def run_benchmark(num_points):
+    """Times simplifying a track and downsampling one sensor, as done when an activity is analyzed."""
+    locations = make_random_track(num_points, 3)
+    data = [ { str(START_TIME_MS + i * 1000): 150.0 + random.random() } for i in range(num_points) ]
+
+    start = time.time()
+    simplified = TrackSimplifier.create_simplified_data(locations, {})
+    elapsed = time.time() - start
+    counts = ", ".join([ resolution + " " + str(len(track)) for resolution, track in simplified[Keys.ACTIVITY_SIMPLIFIED_TRACKS_KEY].items() ])
+    print("Track of {} points simplified in {:.3f} seconds ({})".format(num_points, elapsed, counts))
+
+    start = time.time()
+    TrackSimplifier.downsample_sensor_data(data, TrackSimplifier.SENSOR_CHART_NUM_POINTS)
+    elapsed = time.time() - start
+    print("Sensor of {} readings downsampled in {:.3f} seconds".format(num_points, elapsed))
+
+def main():
+    # Parse command line options.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Measures how long it takes to simplify a four hour activity", required=False)
+
+    try:
+        args = parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    if args.benchmark:
+        run_benchmark(4 * 60 * 60)
+    else:
+        run_unit_tests()
+
+if __name__ == "__main__":
+    main()
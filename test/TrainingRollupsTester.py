@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2017 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Checks that the training rollups kept up to date one change at a time match rollups built from scratch, and benchmarks range queries."""
+
+import argparse
+import calendar
+import datetime
+import inspect
+import os
+import random
+import sys
+import threading
+import uuid
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+sys.path.insert(0, os.path.join(parentdir, "bench"))
+import Config
+import DataMgr
+import Keys
+import MemoryDatabase
+import TrainingRollups
+
+ACTIVITY_TYPES = [ Keys.TYPE_RUNNING_KEY, Keys.TYPE_CYCLING_KEY, Keys.TYPE_OPEN_WATER_SWIMMING_KEY ]
+TAGS = [ "Race", "Commute", "Shoes v1.2", "$5 Bike", "100% Effort" ]
+
+class InterleavingDatabase(MemoryDatabase.MemoryDatabase):
+    """Holds each thread's first read of an activity until every thread has read it, so their rollup updates all start from the same contribution."""
+
+    def __init__(self, num_threads):
+        MemoryDatabase.MemoryDatabase.__init__(self)
+        self.barrier = threading.Barrier(num_threads)
+        self.held_threads = set()
+        self.hold_readers = False
+
+    def retrieve_activity_small(self, activity_id):
+        activity = MemoryDatabase.MemoryDatabase.retrieve_activity_small(self, activity_id)
+        thread_id = threading.get_ident()
+        if self.hold_readers and thread_id not in self.held_threads:
+            self.held_threads.add(thread_id)
+            self.barrier.wait(timeout=10)
+        return activity
+
+def make_activity(rand, start_time):
+    """Generates an analyzed activity with random totals and tags."""
+    activity = {}
+    activity[Keys.ACTIVITY_ID_KEY] = str(uuid.uuid4())
+    activity[Keys.ACTIVITY_TYPE_KEY] = rand.choice(ACTIVITY_TYPES)
+    activity[Keys.ACTIVITY_START_TIME_KEY] = start_time
+    activity[Keys.ACTIVITY_TAGS_KEY] = rand.sample(TAGS, rand.randint(0, 2))
+    activity[Keys.ACTIVITY_SUMMARY_KEY] = { Keys.LONGEST_DISTANCE: rand.uniform(1000.0, 50000.0), Keys.APP_DURATION_KEY: rand.randint(600, 10800), Keys.INTENSITY_SCORE: rand.uniform(10.0, 200.0) }
+    return activity
+
+def apply_changes(rollups, increments):
+    """Does what the database does with the increments."""
+    for period_key, fields in increments.items():
+        TrainingRollups.apply_increments(rollups.setdefault(period_key, {}), fields)
+
+def rebuild(activities):
+    """Builds the rollups from scratch."""
+    rollups = {}
+    for activity in activities.values():
+        contribution = TrainingRollups.compute_contribution(activity)
+        if contribution is not None:
+            apply_changes(rollups, TrainingRollups.list_increments(contribution, 1))
+    return rollups
+
+def test_period_start():
+    """Days and months start at midnight UTC, weeks start on Monday."""
+    timestamp = calendar.timegm(datetime.datetime(2021, 3, 18, 15, 30).timetuple()) # A Thursday
+    assert TrainingRollups.period_start(Keys.ROLLUP_PERIOD_DAY, timestamp) == calendar.timegm(datetime.datetime(2021, 3, 18).timetuple())
+    assert TrainingRollups.period_start(Keys.ROLLUP_PERIOD_WEEK, timestamp) == calendar.timegm(datetime.datetime(2021, 3, 15).timetuple())
+    assert TrainingRollups.period_start(Keys.ROLLUP_PERIOD_MONTH, timestamp) == calendar.timegm(datetime.datetime(2021, 3, 1).timetuple())
+    day_start = TrainingRollups.period_start(Keys.ROLLUP_PERIOD_DAY, timestamp)
+    assert TrainingRollups.period_start(Keys.ROLLUP_PERIOD_DAY, day_start) == day_start
+
+def test_field_names():
+    """Tags can contain characters that aren't allowed in field names."""
+    for tag in TAGS + [ "%2E", "a.b.c" ]:
+        encoded = TrainingRollups.encode_field_name(tag)
+        assert '.' not in encoded and '$' not in encoded
+        assert TrainingRollups.decode_field_name(encoded) == tag
+
+def test_incremental_updates():
+    """Analyzes, retags, re-types, and deletes activities at random, keeping the rollups up to date as it goes, then compares with a rebuild."""
+    rand = random.Random(1)
+    start_time = calendar.timegm(datetime.datetime(2021, 1, 1).timetuple())
+    activities = {}
+    contributions = {}
+    rollups = {}
+
+    def update(activity_id):
+        new_contribution = None
+        if activity_id in activities:
+            new_contribution = TrainingRollups.compute_contribution(activities[activity_id])
+        apply_changes(rollups, TrainingRollups.list_changes(contributions.get(activity_id), new_contribution))
+        contributions[activity_id] = new_contribution
+
+    for _ in range(2000):
+        action = rand.random()
+        if action < 0.5 or len(activities) == 0:
+            activity = make_activity(rand, start_time + rand.randint(0, 365 * TrainingRollups.SECS_PER_DAY))
+            activities[activity[Keys.ACTIVITY_ID_KEY]] = activity
+            update(activity[Keys.ACTIVITY_ID_KEY])
+        else:
+            activity_id = rand.choice(list(activities.keys()))
+            if action < 0.7:
+                activities[activity_id][Keys.ACTIVITY_TAGS_KEY] = rand.sample(TAGS, rand.randint(0, 3))
+            elif action < 0.8:
+                activities[activity_id][Keys.ACTIVITY_TYPE_KEY] = rand.choice(ACTIVITY_TYPES)
+            else:
+                del activities[activity_id]
+            update(activity_id)
+
+    expected = rebuild(activities)
+    for period_key in set(expected.keys()) | set(rollups.keys()):
+        expected_rollup = TrainingRollups.decode_rollup(expected.get(period_key, {}))
+        actual_rollup = TrainingRollups.decode_rollup(rollups.get(period_key, {}))
+        if period_key not in expected:
+            assert abs(actual_rollup.get(Keys.ROLLUP_NUM_ACTIVITIES_KEY, 0)) == 0
+            continue
+        assert TrainingRollups.rollups_match(expected_rollup, actual_rollup), period_key
+
+    # The monthly totals add up to the same thing as the activities.
+    totals = TrainingRollups.sum_rollups([ TrainingRollups.decode_rollup(rollup) for (period, _), rollup in rollups.items() if period == Keys.ROLLUP_PERIOD_MONTH ])
+    assert totals[Keys.ROLLUP_NUM_ACTIVITIES_KEY] == len(activities)
+    for tag in TAGS:
+        tag_distance = sum([ activity[Keys.ACTIVITY_SUMMARY_KEY][Keys.LONGEST_DISTANCE] for activity in activities.values() if tag in activity[Keys.ACTIVITY_TAGS_KEY] ])
+        assert abs(totals[Keys.ROLLUP_TAGS_KEY].get(tag, {}).get(Keys.ROLLUP_DISTANCE_KEY, 0.0) - tag_distance) < 1e-3
+
+def test_concurrent_updates():
+    """Several workers bring the same activity's rollups up to date at once. The change is only counted once."""
+    num_threads = 4
+    database = InterleavingDatabase(num_threads)
+    data_mgr = DataMgr.DataMgr(config=Config.Config(), root_url="file://" + parentdir, analysis_scheduler=None, import_scheduler=None, database=database)
+    user_id = database.create_user("test@example.com", "Test User", "not a real hash")
+
+    activity = make_activity(random.Random(2), calendar.timegm(datetime.datetime(2021, 6, 1, 8, 0).timetuple()))
+    activity[Keys.ACTIVITY_USER_ID_KEY] = user_id
+    activity[Keys.ACTIVITY_TAGS_KEY] = []
+    activity_id = activity[Keys.ACTIVITY_ID_KEY]
+    database.create_complete_activity(activity)
+    assert data_mgr.update_training_rollups([ activity_id ])
+
+    # Retag it, then have every thread read the old contribution before any of them writes.
+    database.create_tags_on_activity_by_id(activity_id, [ "Race" ])
+    database.hold_readers = True
+    results = []
+    threads = [ threading.Thread(target=lambda: results.append(data_mgr.update_training_rollups([ activity_id ]))) for _ in range(num_threads) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [ True ] * num_threads
+    assert data_mgr.verify_training_rollups(user_id) == []
+
+    rollups = data_mgr.retrieve_training_rollups(user_id, Keys.ROLLUP_PERIOD_MONTH, None, None)
+    assert len(rollups) == 1
+    assert rollups[0][Keys.ROLLUP_NUM_ACTIVITIES_KEY] == 1
+    assert rollups[0][Keys.ROLLUP_TAGS_KEY]["Race"][Keys.ROLLUP_NUM_ACTIVITIES_KEY] == 1
+
+def test_unanalyzed():
+    """Activities that haven't been analyzed don't count, unless they were entered by hand."""
+    activity = { Keys.ACTIVITY_START_TIME_KEY: 1600000000, Keys.ACTIVITY_TYPE_KEY: Keys.TYPE_RUNNING_KEY }
+    assert TrainingRollups.compute_contribution(activity) is None
+    activity[Keys.APP_DISTANCE_KEY] = 5000.0
+    activity[Keys.APP_DURATION_KEY] = 1500.0
+    contribution = TrainingRollups.compute_contribution(activity)
+    assert contribution[Keys.ROLLUP_DISTANCE_KEY] == 5000.0
+    assert contribution[Keys.ROLLUP_DURATION_KEY] == 1500.0
+
+def run_unit_tests():
+    """Entry point for the unit tests."""
+    test_period_start()
+    test_field_names()
+    test_incremental_updates()
+    test_concurrent_updates()
+    test_unanalyzed()
+    return True
+
+def run_benchmark(num_activities_per_day):
+    """Counts the documents read to total a user's intensity over ranges of increasing length, from the activities and from the rollups."""
+    """Reading a document is the cost that matters once they come from the database, so that is what is compared."""
+    rand = random.Random(1)
+    start_time = calendar.timegm(datetime.datetime(2015, 1, 1).timetuple())
+    num_days = 5 * 365
+    activities = {}
+    for day in range(num_days):
+        for _ in range(num_activities_per_day):
+            activity = make_activity(rand, start_time + day * TrainingRollups.SECS_PER_DAY + rand.randint(0, TrainingRollups.SECS_PER_DAY - 1))
+            activities[activity[Keys.ACTIVITY_ID_KEY]] = activity
+    rollups = rebuild(activities)
+
+    range_end = start_time + num_days * TrainingRollups.SECS_PER_DAY
+    for range_days in [ 7, 28, 365, num_days ]:
+        range_start = range_end - range_days * TrainingRollups.SECS_PER_DAY
+        activities_read = [ activity for activity in activities.values() if range_start <= activity[Keys.ACTIVITY_START_TIME_KEY] < range_end ]
+        rollups_read = [ rollup for (period, period_start), rollup in rollups.items() if period == Keys.ROLLUP_PERIOD_DAY and range_start <= period_start < range_end ]
+        activity_total = sum([ activity[Keys.ACTIVITY_SUMMARY_KEY][Keys.INTENSITY_SCORE] for activity in activities_read ])
+        rollup_total = sum([ rollup[Keys.ROLLUP_INTENSITY_SCORE_KEY] for rollup in rollups_read ])
+        assert abs(activity_total - rollup_total) < 1e-3
+        print("{} days: {} activity documents, {} daily rollup documents".format(range_days, len(activities_read), len(rollups_read)))
+
+def main():
+    # Parse command line options.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Compares the number of documents read from the rollups and from the activities", required=False)
+
+    try:
+        args = parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    if args.benchmark:
+        run_benchmark(2)
+    else:
+        run_unit_tests()
+
+if __name__ == "__main__":
+    main()
@@ -30,9 +30,29 @@ import os
 import sys
 import traceback
 
+import ActivityBestsTester
+import ActivityBucketsTester
+import ActivityListTester
 import ApiTester
+import BatchAnalyzerTester
+import BlobStoreTester
+import CacheTester
 import CsvToJson
+import DuplicateDetectionTester
+import ExporterTester
+import IcalServerTester
 import ImportTester
+import ImportWorkerTester
+import IntervalDetectorTester
+import LocationAnalyzerTester
+import MapSearchTester
+import PerfTester
+import PowerAnalyzerTester
+import RateLimiterTester
+import TemplateTester
+import TrackSimplifierTester
+import TrainingRollupsTester
+import VectorizedAnalyzerTester
 import WorkoutPlanTester
 
 # Locate and load the config module.
@@ -43,12 +63,73 @@ import Config
 
 ERROR_LOG = 'error.log'
 
+def do_activity_bests_tests(config_file_name):
+    ActivityBestsTester.run_unit_tests(config_file_name)
+
+def do_activity_buckets_tests(config_file_name):
+    ActivityBucketsTester.run_unit_tests(config_file_name)
+
+def do_activity_list_tests():
+    ActivityListTester.run_unit_tests()
+
 def do_api_tests(url, username, password, realname):
     ApiTester.run_unit_tests(url, username, password, realname)
 
+def do_batch_analyzer_tests():
+    BatchAnalyzerTester.run_unit_tests()
+
+def do_blob_store_tests():
+    BlobStoreTester.run_unit_tests()
+
+def do_cache_tests():
+    CacheTester.run_unit_tests()
+
+def do_duplicate_detection_tests():
+    DuplicateDetectionTester.run_unit_tests()
+
+def do_exporter_tests():
+    ExporterTester.run_unit_tests()
+
+def do_ical_server_tests():
+    IcalServerTester.run_unit_tests()
+
+def do_import_worker_tests():
+    ImportWorkerTester.run_unit_tests()
+
 def do_importer_tests(test_files_dir_name):
     ImportTester.run_unit_tests(test_files_dir_name)
 
+def do_interval_detector_tests(test_files_dir_name):
+    IntervalDetectorTester.run_unit_tests(test_files_dir_name)
+
+def do_location_analyzer_tests(test_files_dir_name):
+    LocationAnalyzerTester.run_unit_tests(test_files_dir_name)
+
+def do_map_search_tests():
+    datadir = os.path.join(parentdir, "data")
+    MapSearchTester.run_unit_tests(datadir)
+
+def do_perf_tests():
+    PerfTester.run_unit_tests()
+
+def do_power_analyzer_tests():
+    PowerAnalyzerTester.run_unit_tests()
+
+def do_rate_limiter_tests():
+    RateLimiterTester.run_unit_tests()
+
+def do_template_tests():
+    TemplateTester.run_unit_tests()
+
+def do_track_simplifier_tests():
+    TrackSimplifierTester.run_unit_tests()
+
+def do_training_rollups_tests():
+    TrainingRollupsTester.run_unit_tests()
+
+def do_vectorized_analyzer_tests():
+    VectorizedAnalyzerTester.run_unit_tests()
+
 def do_workout_plan_tests(config):
     testdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
     csv_file_name = os.path.join(testdir, "WorkoutTrainingInputs.csv")
@@ -79,10 +160,50 @@ def main():
 
     # Do the tests.
     try:
+        print("Activity Bests Tests:")
+        do_activity_bests_tests(args.config)
+        print("Activity Buckets Tests:")
+        do_activity_buckets_tests(args.config)
+        print("Activity List Tests:")
+        do_activity_list_tests()
         print("API Tests:")
         do_api_tests(args.url, args.username, args.password, args.realname)
+        print("Batch Analyzer Tests:")
+        do_batch_analyzer_tests()
+        print("Blob Store Tests:")
+        do_blob_store_tests()
+        print("Cache Tests:")
+        do_cache_tests()
+        print("Duplicate Detection Tests:")
+        do_duplicate_detection_tests()
+        print("Exporter Tests:")
+        do_exporter_tests()
+        print("Ical Server Tests:")
+        do_ical_server_tests()
+        print("Import Worker Tests:")
+        do_import_worker_tests()
         print("Importer Tests:")
         do_importer_tests(args.importdir)
+        print("Interval Detector Tests:")
+        do_interval_detector_tests(args.importdir)
+        print("Location Analyzer Tests:")
+        do_location_analyzer_tests(args.importdir)
+        print("Map Search Tests:")
+        do_map_search_tests()
+        print("Perf Tests:")
+        do_perf_tests()
+        print("Power Analyzer Tests:")
+        do_power_analyzer_tests()
+        print("Rate Limiter Tests:")
+        do_rate_limiter_tests()
+        print("Template Tests:")
+        do_template_tests()
+        print("Track Simplifier Tests:")
+        do_track_simplifier_tests()
+        print("Training Rollups Tests:")
+        do_training_rollups_tests()
+        print("Vectorized Analyzer Tests:")
+        do_vectorized_analyzer_tests()
         print("Workout Plan Tests:")
         do_workout_plan_tests(config)
     except AssertionError as e:
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+#
+# # MIT License
+#
+# Copyright (c) 2022 Michael J Simms
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Checks that the vectorized analysis engine produces the same summary as the iterative one, and benchmarks the two on long activities."""
+
+import argparse
+import inspect
+import os
+import random
+import sys
+import time
+
+# Locate and load modules from the main source directory.
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+import FtpCalculator
+import Keys
+import LocationAnalyzer
+import SensorAnalyzerFactory
+import VectorizedAnalyzer
+
+import LocationAnalyzerTester
+import PowerAnalyzerTester
+
+TOLERANCE = 0.000001 # Relative, the engines add things up in a different order so the last few bits can differ
+
+def assert_close(expected, actual):
+    """Compares two summaries, allowing for rounding differences in the floating point values."""
+    if isinstance(expected, dict):
+        assert sorted(expected.keys()) == sorted(actual.keys())
+        for key in expected:
+            assert_close(expected[key], actual[key])
+    elif isinstance(expected, (list, tuple)):
+        assert len(expected) == len(actual)
+        for expected_item, actual_item in zip(expected, actual):
+            assert_close(expected_item, actual_item)
+    elif isinstance(expected, float):
+        assert isinstance(actual, float)
+        assert abs(expected - actual) <= TOLERANCE * max(1.0, abs(expected))
+    else:
+        assert type(expected) == type(actual)
+        assert expected == actual
+
+def make_locations(track):
+    """Converts a generated track to location dictionaries, as they are stored in the database. A few of them are invalid."""
+    locations = []
+    for index, point in enumerate(track):
+        location = { Keys.LOCATION_TIME_KEY: point[0], Keys.LOCATION_LAT_KEY: point[1], Keys.LOCATION_LON_KEY: point[2], Keys.LOCATION_ALT_KEY: point[3] }
+        if index % 997 == 500:
+            location[Keys.LOCATION_LAT_KEY] = 0.0
+        elif index % 1009 == 600:
+            location[Keys.LOCATION_HORIZONTAL_ACCURACY_KEY] = 75.0
+        locations.append(location)
+    return locations
+
+def make_sensor_data(readings):
+    """Converts [time, value] pairs to single item dictionaries, as they are stored in the database."""
+    return [ { str(reading[0]): reading[1] } for reading in readings ]
+
+def generate_heart_rate_data(num_secs, seed):
+    """Generates one heart rate reading per second."""
+    rng = random.Random(seed)
+    time_ms = 1600000000000
+    readings = []
+    for i in range(num_secs):
+        readings.append([time_ms, float(int(140.0 + 20.0 * ((i // 600) % 2) + rng.uniform(-5.0, 5.0)))])
+        time_ms = time_ms + 1000
+    return readings
+
+def analyze_locations_iteratively(activity_type, locations):
+    """Feeds the locations to the analyzer one at a time, as the activity analyzer does."""
+    analyzer = LocationAnalyzer.LocationAnalyzer(activity_type)
+    for location in locations:
+        horizontal_accuracy = location.get(Keys.LOCATION_HORIZONTAL_ACCURACY_KEY, 0.0)
+        analyzer.append_location(location[Keys.LOCATION_TIME_KEY], location[Keys.LOCATION_LAT_KEY], location[Keys.LOCATION_LON_KEY], location[Keys.LOCATION_ALT_KEY], horizontal_accuracy, 0.0)
+        analyzer.update_speeds()
+    return analyzer
+
+def compare_locations(activity_type, locations):
+    """Runs both engines on the locations and checks that they agree."""
+    iterative = analyze_locations_iteratively(activity_type, locations)
+    vectorized = VectorizedAnalyzer.create_location_analyzer(activity_type, locations)
+    assert_close(iterative.analyze(), vectorized.analyze())
+    assert vectorized.speed_times == iterative.speed_times
+    assert_close(iterative.distance_buf, vectorized.distance_buf)
+    assert_close(iterative.current_speed, vectorized.current_speed)
+    assert_close(iterative.total_vertical, vectorized.total_vertical)
+    assert_close(iterative.avg_speed, vectorized.avg_speed)
+
+def compare_sensor(sensor_type, activity_type, data):
+    """Runs both engines on the sensor data and checks that they agree."""
+    iterative = SensorAnalyzerFactory.create_with_data(sensor_type, data, activity_type, None, None, None)
+    vectorized = VectorizedAnalyzer.create_sensor_analyzer(sensor_type, data, activity_type, None, None, None)
+    iterative_results = iterative.analyze()
+    assert_close(iterative_results, vectorized.analyze())
+    assert vectorized.max_time == iterative.max_time
+    return iterative_results
+
+def test_locations():
+    """Synthetic tracks, including ones with invalid points and a few points out of order."""
+    for activity_type in [ Keys.TYPE_RUNNING_KEY, Keys.TYPE_CYCLING_KEY ]:
+        locations = make_locations(LocationAnalyzerTester.generate_track(6000, activity_type, 1))
+        compare_locations(activity_type, locations)
+        compare_locations(activity_type, locations[:1])
+        compare_locations(activity_type, [])
+        locations[100], locations[101] = locations[101], locations[100]
+        compare_locations(activity_type, locations)
+
+def test_sensors():
+    """Heart rate, cadence, and power, including power data with dropouts and irregular timing."""
+    compare_sensor(Keys.APP_HEART_RATE_KEY, Keys.TYPE_RUNNING_KEY, make_sensor_data(generate_heart_rate_data(3600, 1)))
+    compare_sensor(Keys.APP_CADENCE_KEY, Keys.TYPE_RUNNING_KEY, make_sensor_data(generate_heart_rate_data(600, 2)))
+    compare_sensor(Keys.APP_CADENCE_KEY, Keys.TYPE_CYCLING_KEY, make_sensor_data(generate_heart_rate_data(600, 3)))
+    compare_sensor(Keys.APP_HEART_RATE_KEY, Keys.TYPE_RUNNING_KEY, [])
+    for jitter in [ False, True ]:
+        results = compare_sensor(Keys.APP_POWER_KEY, Keys.TYPE_CYCLING_KEY, make_sensor_data(PowerAnalyzerTester.generate_power_data(1500, 4, jitter)))
+        assert Keys.NORMALIZED_POWER in results
+
+def test_zone_distribution():
+    """Readings on a zone's cutoff belong to that zone, readings above every cutoff belong to the last zone."""
+    calc = FtpCalculator.FtpCalculator()
+    zones = calc.power_training_zones(250.0)
+    powers = [ { "0": 0.0 }, { "1": zones[0] }, { "2": zones[0] + 0.001 }, { "3": zones[-1] }, { "4": zones[-1] + 1.0 }, { "5": 1000.0 } ]
+    expected = [ 0.0 ] * (len(zones) + 1)
+    expected[0] = 2.0
+    expected[1] = 1.0
+    expected[len(zones) - 1] = 1.0
+    expected[len(zones)] = 2.0
+    assert calc.compute_power_zone_distribution(250.0, powers) == expected
+
+def run_unit_tests():
+    """Entry point for the unit tests."""
+    test_locations()
+    test_sensors()
+    test_zone_distribution()
+    return True
+
+def load_iteratively(locations, heart_rate_data, power_data):
+    """Creates the analyzers the way the iterative engine does."""
+    return [ analyze_locations_iteratively(Keys.TYPE_CYCLING_KEY, locations),
+        SensorAnalyzerFactory.create_with_data(Keys.APP_HEART_RATE_KEY, heart_rate_data, Keys.TYPE_CYCLING_KEY, None, None, None),
+        SensorAnalyzerFactory.create_with_data(Keys.APP_POWER_KEY, power_data, Keys.TYPE_CYCLING_KEY, None, None, None) ]
+
+def load_vectorized(locations, heart_rate_data, power_data):
+    """Creates the analyzers the way the vectorized engine does."""
+    return [ VectorizedAnalyzer.create_location_analyzer(Keys.TYPE_CYCLING_KEY, locations),
+        VectorizedAnalyzer.create_sensor_analyzer(Keys.APP_HEART_RATE_KEY, heart_rate_data, Keys.TYPE_CYCLING_KEY, None, None, None),
+        VectorizedAnalyzer.create_sensor_analyzer(Keys.APP_POWER_KEY, power_data, Keys.TYPE_CYCLING_KEY, None, None, None) ]
+
+def run_benchmark(sizes):
+    """Times both engines on rides of increasing length, with one second location, heart rate, and power data."""
+    """Loading is the part that differs between the engines, the summaries (e.g. the power curve) are computed by the same code."""
+    for num_secs in sizes:
+        locations = make_locations(LocationAnalyzerTester.generate_track(num_secs, Keys.TYPE_CYCLING_KEY, num_secs))
+        heart_rate_data = make_sensor_data(generate_heart_rate_data(num_secs, num_secs))
+        power_data = make_sensor_data(PowerAnalyzerTester.generate_power_data(num_secs, num_secs, False))
+
+        for engine_name, load in [ ("iterative", load_iteratively), ("vectorized", load_vectorized) ]:
+            start = time.time()
+            analyzers = load(locations, heart_rate_data, power_data)
+            load_elapsed = time.time() - start
+            for analyzer in analyzers:
+                analyzer.analyze()
+            total_elapsed = time.time() - start
+            print("{} seconds of data, {}: {:.3f} seconds to load, {:.3f} seconds in total".format(num_secs, engine_name, load_elapsed, total_elapsed))
+
+def main():
+    # Parse command line options.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action="store_true", default=False, help="Benchmarks on one, six, and twelve hour rides", required=False)
+
+    try:
+        args = parser.parse_args()
+    except IOError as e:
+        parser.error(e)
+        sys.exit(1)
+
+    if args.benchmark:
+        run_benchmark([3600, 6 * 3600, 12 * 3600])
+    else:
+        run_unit_tests()
+
+if __name__ == "__main__":
+    main()